@@ -21,11 +21,12 @@ from pyprovide import Injector
 
 from gradefast import utils
 from gradefast.config.local import GradeFastLocalModule
+from gradefast.grader.diffing import DIFF_ENGINES
 from gradefast.hosts import LocalHost
 from gradefast.loggingwrapper import get_logger, init_logging, shutdown_logging
-from gradefast.models import LocalPath, Path, Settings, SettingsBuilder
+from gradefast.models import LocalPath, Path, Settings, SettingsBuilder, SettingsDefaults
 from gradefast.parsers import ModelParseError, parse_commands, parse_grade_structure, parse_settings
-from gradefast.run import run_gradefast
+from gradefast.run import run_gradefast, run_gradefast_batch
 
 try:
     import yaml
@@ -95,13 +96,17 @@ def get_argument_parser() -> argparse.ArgumentParser:
         help="A file in which to save the current GradeFast state, allowing GradeFast to recover "
              "if you quit and come back later. This file is checked on startup; if it already "
              "exists, then GradeFast reads it to resume from where it left off.\n"
-             "DEFAULT: [yaml filename]_save_data.sqlite (if --save-file-format=sqlite) or "
+             "DEFAULT: [yaml filename]_save_data.sqlite (if --save-file-format=sqlite), "
+             "[yaml filename]_structured_save_data.sqlite (if --save-file-format=structured), or "
              "[yaml filename].save.data (if --save-file-format=legacy), in the same directory as "
              "the YAML file"
     )
     parser.add_argument(
-        "--save-file-format", choices=("sqlite", "legacy"),
-        help="Which format to use for the GradeFast save file (see \"--save-file\").\n"
+        "--save-file-format", choices=("sqlite", "structured", "legacy"),
+        help="Which format to use for the GradeFast save file (see \"--save-file\"). The "
+             "\"structured\" format is also SQLite, but with a table for each kind of data "
+             "(instead of pickled data), so it can be queried directly. An \"sqlite\" save file "
+             "is converted when it's opened with \"structured\" (but not the other way around).\n"
              "DEFAULT: \"sqlite\""
     )
     parser.add_argument(
@@ -138,6 +143,72 @@ def get_argument_parser() -> argparse.ArgumentParser:
              "DEFAULT: {}".format(DEFAULT_PORT),
         default=DEFAULT_PORT
     )
+    parser.add_argument(
+        "--gradebook-server", choices=["flask", "async"],
+        help="The HTTP server to run the gradebook with. \"flask\" uses a thread for each "
+             "connected gradebook client, and \"async\" (which requires the 'uvicorn' package) "
+             "handles lots of connected clients more efficiently.\n"
+             "DEFAULT: {}".format(SettingsDefaults.gradebook_server)
+    )
+    parser.add_argument(
+        "--prefetch", metavar="N", type=int, default=0,
+        help="Run commands for up to N upcoming submissions in the background while you grade the "
+             "current one. Only commands that don't need any interaction are run ahead of time "
+             "(by default, those with \"input\"; see the \"prefetch\" command property). "
+             "Once you modify or repeat a command, or open a shell, the rest of the submission's "
+             "commands are run live.\n"
+             "DEFAULT: 0 (disabled)"
+    )
+    parser.add_argument(
+        "--prefetch-workers", metavar="N", type=int,
+        help="The maximum number of submissions to prefetch commands for at the same time (see "
+             "\"--prefetch\").\n"
+             "DEFAULT: {}".format(SettingsDefaults.prefetch_workers)
+    )
+    parser.add_argument(
+        "--background-workers", metavar="N", type=int,
+        help="The maximum number of background commands to run at the same time. Any more are "
+             "queued until one of the others finishes.\n"
+             "DEFAULT: {}".format(SettingsDefaults.background_workers)
+    )
+    parser.add_argument(
+        "--extract-workers", metavar="N", type=int,
+        help="The maximum number of submission archives to extract (or files to move into "
+             "folders) at the same time when adding submissions.\n"
+             "DEFAULT: {}".format(SettingsDefaults.extract_workers)
+    )
+    parser.add_argument(
+        "--diff-engine", choices=sorted(DIFF_ENGINES.keys()),
+        help="The algorithm to use to compare command output to \"diff\" references. "
+             "\"myers\" finds the smallest diff, \"patience\" lines up changes around lines "
+             "that only appear once (which is often easier to read), and \"difflib\" uses "
+             "Python's difflib (which can be very slow for long output).\n"
+             "DEFAULT: {}".format(SettingsDefaults.diff_engine)
+    )
+    parser.add_argument(
+        "--build-cache", metavar="FOLDER",
+        help="The folder to store the results of \"cacheable\" commands in, so they aren't run "
+             "again if nothing they depend on has changed (even after GradeFast is restarted).\n"
+             "DEFAULT: a folder next to the YAML file"
+    )
+    parser.add_argument(
+        "--no-build-cache", action="store_true",
+        help="Always run \"cacheable\" commands, without using the build cache."
+    )
+    parser.add_argument(
+        "--batch", action="store_true",
+        help="Run all the commands on all the submissions without stopping to ask anything, "
+             "then exit. The output is stored in the save file, so it's available the next time "
+             "GradeFast is run normally. Submissions that were already run are skipped. The "
+             "submissions must be specified with \"--submissions\" (unless they're already in "
+             "the save file), and the gradebook is not started."
+    )
+    parser.add_argument(
+        "-j", "--jobs", metavar="N", type=int,
+        help="The number of submissions to run at the same time in batch mode (see "
+             "\"--batch\").\n"
+             "DEFAULT: the number of CPUs"
+    )
     parser.add_argument(
         "--shell", metavar="CMD",
         help="A program used to parse and run the commands in the \"commands\" section of the "
@@ -252,15 +323,23 @@ def build_settings(args) -> Settings:
     yaml_directory = LocalPath(os.path.dirname(yaml_file_path))
 
     use_legacy_save_file_format = args.save_file_format == "legacy"
+    use_structured_save_file_format = args.save_file_format == "structured"
 
     if args.save_file:
         save_file = LocalPath(os.path.abspath(args.save_file))
     else:
-        ext = ".save.data" if use_legacy_save_file_format else "_save_data.sqlite"
+        if use_legacy_save_file_format:
+            ext = ".save.data"
+        elif use_structured_save_file_format:
+            ext = "_structured_save_data.sqlite"
+        else:
+            ext = "_save_data.sqlite"
         save_file = LocalPath(os.path.join(yaml_directory.get_local_path(), yaml_file_name + ext))
     logger.info("Save file: {}", save_file)
     if use_legacy_save_file_format:
         logger.info("Using legacy save file format")
+    elif use_structured_save_file_format:
+        logger.info("Using structured save file format")
 
     if args.log_file:
         log_file = LocalPath(os.path.abspath(args.log_file))
@@ -273,6 +352,12 @@ def build_settings(args) -> Settings:
     if log_as_html:
         logger.info("Logging as HTML")
 
+    if args.build_cache:
+        build_cache_path = LocalPath(os.path.abspath(args.build_cache))
+    else:
+        build_cache_path = LocalPath(os.path.join(yaml_directory.get_local_path(),
+                                                  yaml_file_name + "_build_cache"))
+
     base_env = dict(os.environ)
     base_env.update({
         "SUPPORT_DIRECTORY": yaml_directory.get_local_path(),
@@ -292,6 +377,7 @@ def build_settings(args) -> Settings:
     settings_builder.project_name = yaml_file_name
     settings_builder.save_file = save_file
     settings_builder.use_legacy_save_file_format = use_legacy_save_file_format
+    settings_builder.use_structured_save_file_format = use_structured_save_file_format
     settings_builder.log_file = log_file
     settings_builder.log_as_html = log_as_html
 
@@ -300,12 +386,25 @@ def build_settings(args) -> Settings:
     settings_builder.host = args.host
     settings_builder.port = args.port
     settings_builder.prompt_for_auth = not args.no_auth
+    if args.gradebook_server:
+        settings_builder.gradebook_server = args.gradebook_server
 
     # "commands" filled from YAML file
     # "submission_regex" filled from YAML file
     # "check_zipfiles" filled from YAML file
     # "check_file_extensions" filled from YAML file
     settings_builder.diff_file_path = yaml_directory
+    if args.diff_engine:
+        settings_builder.diff_engine = args.diff_engine
+    if not args.no_build_cache:
+        settings_builder.build_cache_path = build_cache_path
+    settings_builder.prefetch_count = max(0, args.prefetch)
+    if args.prefetch_workers:
+        settings_builder.prefetch_workers = args.prefetch_workers
+    if args.background_workers:
+        settings_builder.background_workers = args.background_workers
+    if args.extract_workers:
+        settings_builder.extract_workers = args.extract_workers
 
     settings_builder.use_readline = not args.no_readline
     settings_builder.use_color = not args.no_color
@@ -326,6 +425,10 @@ def main() -> None:
     init_logging(args.debug_file)
 
     settings = build_settings(args)
+    if settings.gradebook_enabled and settings.gradebook_server == "async":
+        from gradefast.gradebook import asyncserver
+        if asyncserver.uvicorn is None:
+            utils.required_package_error("uvicorn")
 
     # A PyProvide injector for all our needs
     injector = Injector(GradeFastLocalModule(settings))
@@ -347,7 +450,10 @@ def main() -> None:
         ]
 
     # Zhu Li, do the thing!
-    run_gradefast(injector, submission_paths)
+    if args.batch:
+        run_gradefast_batch(injector, submission_paths, max(1, args.jobs or os.cpu_count() or 1))
+    else:
+        run_gradefast(injector, submission_paths)
 
     # Make sure that all of our doors are shut for the winter
     shutdown_logging()
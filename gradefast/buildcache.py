@@ -0,0 +1,406 @@
+"""
+Content-addressed cache for the results of commands (like compiling), so they don't have to be run
+again when nothing they depend on has changed.
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Dict, List, Mapping, Optional, Sequence, Tuple
+
+from pyprovide import inject
+
+from gradefast.hosts import CommandResult, Host, LocalHost
+from gradefast.loggingwrapper import get_logger
+from gradefast.models import CommandItem, Path, Settings
+from gradefast.outputbuffer import OutputBuffer
+
+_logger = get_logger("buildcache")
+
+# The encoding used to store command output (like in OutputBuffer)
+_OUTPUT_ENCODING = "utf-8"
+_OUTPUT_ERRORS = "surrogatepass"
+
+# A snapshot of a folder: maps the relative path (with forward slashes) of each file to its digest
+Snapshot = Dict[str, str]
+
+
+def _write_atomically(path: str, data: bytes) -> None:
+    """
+    Write a file so that anyone reading it (including other processes) either sees the old
+    version or the new version, never part of one.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CachedBuild:
+    """
+    The result of a command that was restored from the build cache.
+    """
+
+    __slots__ = ("output", "artifacts", "restored")
+
+    def __init__(self, output: OutputBuffer, artifacts: int, restored: int) -> None:
+        """
+        :param output: The output that the command printed when it was recorded.
+        :param artifacts: The number of files that the command produced.
+        :param restored: The number of those files that had to be written back to the folder.
+        """
+        self.output = output
+        self.artifacts = artifacts
+        self.restored = restored
+
+
+class BuildRecording:
+    """
+    The state of a folder from right before a command was run, so what the command did can be
+    recorded in the build cache once it's done (see BuildCache.start_recording).
+    """
+
+    __slots__ = ("scope", "local_dir", "key_parts", "before")
+
+    def __init__(self, scope: str, local_dir: str, key_parts: list, before: Snapshot) -> None:
+        self.scope = scope
+        self.local_dir = local_dir
+        self.key_parts = key_parts
+        self.before = before
+
+
+class BuildCache:
+    """
+    Remembers the output of commands and the files that they produced, keyed on a hash of the
+    command, its input, its environment, and the contents of its working directory (or just the
+    files that match the command's "cache inputs" patterns).
+
+    Files that a command produced are left out of the key for later runs of the same command in the
+    same folder (otherwise, running a compile command would always change its own key).
+
+    Hashing a folder only reads the files whose modification time or size changed since they were
+    last hashed, so it's cheap for large folders that haven't changed. These digests are kept in the
+    cache folder along with everything else, so they last between GradeFast sessions. The cache
+    folder can be shared by several processes at once.
+    """
+
+    # Files modified this recently (in seconds) are always hashed again, since they might be
+    # modified again without their modification time changing
+    RACY_INTERVAL = 2
+
+    @inject()
+    def __init__(self, settings: Settings) -> None:
+        # Only the environment variables that are different from the base environment are
+        # included in the key (so things like terminal variables don't invalidate the cache
+        # between sessions)
+        self.base_env = settings.base_env or {}
+        self.cache_path = None  # type: Optional[str]
+        if settings.build_cache_path:
+            self.cache_path = settings.build_cache_path.get_local_path()
+
+        self._lock = threading.Lock()
+        self._digests = {}  # type: Dict[str, Tuple[int, int, str]]
+        if not self.cache_path:
+            return
+
+        self._digests_path = os.path.join(self.cache_path, "digests.json")
+        try:
+            with open(self._digests_path, "r") as f:
+                self._digests = {path: tuple(value) for path, value in json.load(f).items()}
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            _logger.exception("Error loading build cache digests from {}", self._digests_path)
+
+    def is_enabled(self) -> bool:
+        return self.cache_path is not None
+
+    def _get_object_path(self, digest: str) -> str:
+        return os.path.join(self.cache_path, "objects", digest[:2], digest)
+
+    def _get_entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_path, "entries", key + ".json")
+
+    def _get_scope_path(self, scope: str) -> str:
+        return os.path.join(self.cache_path, "scopes", scope + ".json")
+
+    def _get_digest(self, path: str) -> Optional[str]:
+        """
+        Get the digest of a file, reusing the last one if its modification time and size haven't
+        changed.
+
+        :return: The digest, or None if the file couldn't be read.
+        """
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        with self._lock:
+            known = self._digests.get(path)
+        if known is not None and known[0] == stat.st_mtime_ns and known[1] == stat.st_size:
+            return known[2]
+
+        try:
+            digest = _hash_file(path)
+        except OSError:
+            return None
+        if time.time() - stat.st_mtime > BuildCache.RACY_INTERVAL:
+            with self._lock:
+                self._digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def _save_digests(self) -> None:
+        with self._lock:
+            data = json.dumps(self._digests).encode("utf-8")
+        try:
+            _write_atomically(self._digests_path, data)
+        except OSError:
+            _logger.exception("Error saving build cache digests to {}", self._digests_path)
+
+    def _snapshot(self, local_dir: str, inputs: Optional[Sequence[str]] = None) -> Snapshot:
+        """
+        Get the digest of every file in a folder (or just the ones that match some patterns).
+        """
+        snapshot = {}  # type: Snapshot
+        for dir_path, dir_names, file_names in os.walk(local_dir):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                path = os.path.join(dir_path, file_name)
+                relative_path = os.path.relpath(path, local_dir).replace(os.sep, "/")
+                if inputs is not None and not any(fnmatch.fnmatchcase(relative_path, pattern)
+                                                  for pattern in inputs):
+                    continue
+                if os.path.islink(path) or not os.path.isfile(path):
+                    continue
+                digest = self._get_digest(path)
+                if digest is not None:
+                    snapshot[relative_path] = digest
+        return snapshot
+
+    def _load_json(self, path: str) -> Optional[object]:
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            _logger.exception("Error reading build cache file {}", path)
+            return None
+
+    def _get_key_parts(self, command: CommandItem, local_dir: str,
+                       environment: Mapping[str, str]) -> Tuple[str, list]:
+        """
+        Get the parts of a command's key that don't depend on the folder's contents, and the scope
+        (command and folder) that its list of produced files is stored under.
+        """
+        scope = hashlib.sha256(json.dumps([command.command, os.path.abspath(local_dir)])
+                               .encode("utf-8")).hexdigest()
+        env = sorted((name, value) for name, value in environment.items()
+                     if self.base_env.get(name) != value)
+        return scope, [command.command, command.stdin, env]
+
+    @staticmethod
+    def _get_key(key_parts: list, inputs: Snapshot) -> str:
+        return hashlib.sha256(json.dumps(key_parts + [sorted(inputs.items())])
+                              .encode("utf-8")).hexdigest()
+
+    def _get_inputs(self, scope: str, snapshot: Snapshot) -> Snapshot:
+        produced = set(self._load_json(self._get_scope_path(scope)) or [])
+        return {path: digest for path, digest in snapshot.items() if path not in produced}
+
+    def lookup(self, command: CommandItem, local_dir: str,
+               environment: Mapping[str, str]) -> Optional[CachedBuild]:
+        """
+        Look for a cached result of a command. If there is one, any files that the command
+        produced are restored into the folder (if they're missing or different).
+
+        :param command: The command that is about to be run.
+        :param local_dir: The working directory for the command.
+        :param environment: The full environment for the command.
+        :return: The cached result, or None if the command has to be run.
+        """
+        scope, key_parts = self._get_key_parts(command, local_dir, environment)
+        inputs = self._get_inputs(scope, self._snapshot(local_dir, command.cache.inputs))
+        key = self._get_key(key_parts, inputs)
+        entry = self._load_json(self._get_entry_path(key))
+        if entry is None:
+            _logger.debug("Build cache miss for {} in {}", command, local_dir)
+            return None
+
+        digests = [entry["output"]] + [digest for digest, _ in entry["artifacts"].values()]
+        if not all(os.path.exists(self._get_object_path(digest)) for digest in digests):
+            _logger.warning("Build cache entry {} is missing some files", key)
+            return None
+
+        restored = 0
+        for relative_path, (digest, mode) in sorted(entry["artifacts"].items()):
+            path = os.path.join(local_dir, *relative_path.split("/"))
+            if self._get_digest(path) == digest:
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".gradefast-")
+            os.close(fd)
+            shutil.copyfile(self._get_object_path(digest), temp_path)
+            os.chmod(temp_path, mode)
+            os.replace(temp_path, path)
+            restored += 1
+
+        output = OutputBuffer()
+        with open(self._get_object_path(entry["output"]), "r", encoding=_OUTPUT_ENCODING,
+                  errors=_OUTPUT_ERRORS, newline="") as f:
+            for chunk in iter(lambda: f.read(64 * 1024), ""):
+                output.write(chunk)
+        output.finish()
+
+        _logger.debug("Build cache hit for {} in {} ({} of {} files restored)", command,
+                      local_dir, restored, len(entry["artifacts"]))
+        return CachedBuild(output, len(entry["artifacts"]), restored)
+
+    def start_recording(self, command: CommandItem, local_dir: str,
+                        environment: Mapping[str, str]) -> BuildRecording:
+        """
+        Take a snapshot of a folder before running a command in it (to pass to record once it's
+        done).
+        """
+        scope, key_parts = self._get_key_parts(command, local_dir, environment)
+        return BuildRecording(scope, local_dir, key_parts, self._snapshot(local_dir))
+
+    def _store_output(self, output: OutputBuffer) -> str:
+        """
+        Store a command's output as an object, without reading it all into memory at once (it's
+        hashed while it's written to a temporary file, which is then moved into place).
+
+        :return: The output's digest.
+        """
+        objects_path = os.path.join(self.cache_path, "objects")
+        os.makedirs(objects_path, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=objects_path, prefix=".tmp-")
+        try:
+            digest = hashlib.sha256()
+            with os.fdopen(fd, "wb") as f:
+                for chunk in output.iter_text():
+                    data = chunk.encode(_OUTPUT_ENCODING, _OUTPUT_ERRORS)
+                    digest.update(data)
+                    f.write(data)
+            output_digest = digest.hexdigest()
+            object_path = self._get_object_path(output_digest)
+            if not os.path.exists(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.replace(temp_path, object_path)
+                return output_digest
+        except:
+            os.remove(temp_path)
+            raise
+        os.remove(temp_path)
+        return output_digest
+
+    def record(self, command: CommandItem, recording: BuildRecording,
+               output: OutputBuffer) -> None:
+        """
+        Store the result of a command that ran successfully, along with any files that it produced
+        (the ones that are new or changed since start_recording).
+        """
+        local_dir = recording.local_dir
+        after = self._snapshot(local_dir)
+        produced = sorted(path for path, digest in after.items()
+                          if recording.before.get(path) != digest)
+
+        # Produced files are never inputs (for this time or any later time)
+        scope_path = self._get_scope_path(recording.scope)
+        all_produced = sorted(set(self._load_json(scope_path) or []) | set(produced))
+        _write_atomically(scope_path, json.dumps(all_produced).encode("utf-8"))
+        before = {path: digest for path, digest in recording.before.items()
+                  if path not in all_produced}
+        if command.cache.inputs is not None:
+            before = {path: digest for path, digest in before.items()
+                      if any(fnmatch.fnmatchcase(path, pattern)
+                             for pattern in command.cache.inputs)}
+        key = self._get_key(recording.key_parts, before)
+
+        artifacts = {}  # type: Dict[str, List]
+        for relative_path in produced:
+            path = os.path.join(local_dir, *relative_path.split("/"))
+            digest = after[relative_path]
+            object_path = self._get_object_path(digest)
+            if not os.path.exists(object_path):
+                with open(path, "rb") as f:
+                    _write_atomically(object_path, f.read())
+            artifacts[relative_path] = [digest, os.stat(path).st_mode & 0o777]
+
+        entry = {
+            "command": command.command,
+            "output": self._store_output(output),
+            "artifacts": artifacts,
+            "time": time.time()
+        }
+        _write_atomically(self._get_entry_path(key), json.dumps(entry).encode("utf-8"))
+        self._save_digests()
+        _logger.debug("Recorded {} in build cache ({} files produced)", command, len(artifacts))
+
+
+def get_build_cache_dir(build_cache: BuildCache, host: Host, command: CommandItem,
+                        path: Path) -> Optional[str]:
+    """
+    Determine whether a command's result can come from the build cache.
+
+    :return: The local path to the command's working directory if it can, or None if it can't.
+    """
+    if command.cache is None or not build_cache.is_enabled() or not isinstance(host, LocalHost):
+        return None
+    return host.gradefast_path_to_local_path(path).get_local_path()
+
+
+def run_command_captured_cached(host: Host, build_cache: BuildCache, command: CommandItem,
+                                path: Path, environment: Mapping[str, str],
+                                stop_event: threading.Event = None) -> CommandResult:
+    """
+    Run a command with Host.run_command_captured, unless its result is in the build cache. If the
+    command is cacheable (and it finishes successfully), its result is added to the build cache.
+
+    :param stop_event: See Host.run_command_captured.
+
+    :raises CommandStartError: If the command couldn't be started.
+    """
+    local_dir = get_build_cache_dir(build_cache, host, command, path)
+    recording = None
+    if local_dir is not None:
+        try:
+            cached = build_cache.lookup(command, local_dir, environment)
+            if cached is not None:
+                now = time.time()
+                return CommandResult(cached.output, 0, now, now)
+            recording = build_cache.start_recording(command, local_dir, environment)
+        except OSError:
+            _logger.exception("Error checking build cache for {}", command)
+
+    result = host.run_command_captured(command.command, path, environment, command.stdin,
+                                       limits=command.limits, stop_event=stop_event)
+    if recording is not None and not result.get_error():
+        try:
+            build_cache.record(command, recording, result.output)
+        except OSError:
+            _logger.exception("Error recording {} in build cache", command)
+    return result
@@ -14,7 +14,8 @@ from pyprovide import InjectableClass, InjectableClassType, Module, class_provid
 
 from gradefast import hosts
 from gradefast.models import Settings
-from gradefast.persister import Persister, ShelvePersister, SqlitePersister
+from gradefast.persister import Persister, ShelvePersister, SqlitePersister, \
+    StructuredSqlitePersister
 
 
 class GradeFastLocalModule(Module):
@@ -78,5 +79,7 @@ class GradeFastLocalModule(Module):
     def provide_persister(self, settings: Settings) -> InjectableClass[Persister]:
         if settings.use_legacy_save_file_format:
             return ShelvePersister
+        elif settings.use_structured_save_file_format:
+            return StructuredSqlitePersister
         else:
             return SqlitePersister
@@ -9,10 +9,11 @@ Licensed under the MIT License. For more, see the LICENSE file.
 Author: Jake Hartz <jake@hartz.io>
 """
 
-import itertools
+import collections
 import queue
 import threading
-from typing import Any, Callable, Iterable, List, Type, TypeVar
+import time
+from typing import Any, Callable, Dict, Iterable, List, Set, Type, TypeVar
 
 from pyprovide import Injector, inject
 
@@ -38,6 +39,19 @@ class Event:
             Event._last_event_id += 1
             self.event_id = Event._last_event_id
 
+    def coalesces_with(self, pending_event: "Event") -> bool:
+        """
+        Determine whether this event is redundant because of another event that is still waiting
+        to be handled by the same event handler. If so, this event is dropped for that handler.
+
+        This should only return True for events whose handlers act on the latest state rather than
+        on data in the event (e.g. "send out the current submission list"). The default
+        implementation never coalesces.
+
+        :param pending_event: An event that was dispatched earlier but hasn't been handled yet.
+        """
+        return False
+
     def __str__(self) -> str:
         return self.__class__.__name__
 
@@ -69,8 +83,10 @@ class EventHandler:
 
     def handle(self, event: Event) -> None:
         """
-        Take some action in response to an event. This method may be called in a fresh thread
-        (different from the one that called "accept").
+        Take some action in response to an event. This method is called in one of the event
+        manager's worker threads (different from the one that called "accept"). It is never called
+        for more than one event at a time, and events are handled in the order they were
+        dispatched.
         """
         raise NotImplementedError()
 
@@ -78,51 +94,129 @@ class EventHandler:
         return self.__class__.__name__
 
 
+class EventHandlerStats:
+    """
+    Counters for how an event handler is keeping up with the events dispatched to it. All times
+    are in seconds.
+    """
+
+    __slots__ = ("handled", "coalesced", "queue_depth", "max_queue_depth", "total_wait_time",
+                 "max_wait_time", "total_handle_time", "max_handle_time")
+
+    def __init__(self) -> None:
+        self.handled = 0
+        self.coalesced = 0
+        self.queue_depth = 0
+        self.max_queue_depth = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.total_handle_time = 0.0
+        self.max_handle_time = 0.0
+
+    def copy(self) -> "EventHandlerStats":
+        stats = EventHandlerStats()
+        for name in EventHandlerStats.__slots__:
+            setattr(stats, name, getattr(self, name))
+        return stats
+
+    def __str__(self) -> str:
+        if self.handled == 0:
+            return "handled 0, coalesced {}, queued {}".format(self.coalesced, self.queue_depth)
+        return "handled {}, coalesced {}, queued {} (max {}), " \
+               "wait {:.3f}s avg/{:.3f}s max, handle {:.3f}s avg/{:.3f}s max".format(
+                   self.handled, self.coalesced, self.queue_depth, self.max_queue_depth,
+                   self.total_wait_time / self.handled, self.max_wait_time,
+                   self.total_handle_time / self.handled, self.max_handle_time)
+
+
 class EventManager:
     """
     Keeps a registry of event handlers and handles dispatching events to event handlers. This
     facilitates communication between the Grader and the GradeBook.
 
-    When an event is dispatched, it is put into a queue and is handled later by a different thread.
-    Additionally, multiple event handlers may be running in different threads at the same time.
+    When an event is dispatched, it is put into a queue for each event handler that accepts it, and
+    is handled later by one of a fixed pool of worker threads. Each event handler only handles one
+    event at a time, in the order they were dispatched, but different event handlers may be running
+    in different threads at the same time.
+
+    Events that are made redundant by an event that's still waiting in the same event handler's
+    queue are dropped (see Event.coalesces_with).
     """
 
+    # The number of worker threads that run event handlers. This needs to be more than 1, since
+    # some event handlers (like the one for AuthRequestedEvent) block waiting for the user.
+    WORKER_COUNT = 4
+
     @inject(injector=Injector.CURRENT_INJECTOR)
     def __init__(self, injector: Injector) -> None:
         self.injector = injector
         self._handlers = []  # type: List[EventHandler]
-        self._event_queue = queue.Queue()  # type: queue.Queue
-        threading.Thread(
-            name="EventManTh",
-            target=self._event_thread_target,
-            daemon=True
-        ).start()
+
+        # All of these are protected by self._lock
+        self._lock = threading.Lock()
+        self._pending = {}  # type: Dict[EventHandler, collections.deque]
+        self._scheduled = set()  # type: Set[EventHandler]
+        self._stats = {}  # type: Dict[EventHandler, EventHandlerStats]
+
+        # Event handlers that have pending events and aren't already running
+        self._ready_handlers = queue.Queue()  # type: queue.Queue
+
+        for i in range(EventManager.WORKER_COUNT):
+            threading.Thread(
+                name="EventTh-{:02}".format(i),
+                target=self._event_thread_target,
+                daemon=True
+            ).start()
 
     def _event_thread_target(self) -> None:
-        count = itertools.count()
         while True:
-            event = self._event_queue.get()
-            for handler in self._handlers:
-                try:
-                    accepted = handler.accept(event)
-                except:
-                    _logger.exception("Exception when calling {}.accept with event {}",
-                                      handler, event)
+            handler = self._ready_handlers.get()
+            with self._lock:
+                event, dispatch_time = self._pending[handler].popleft()
+                self._stats[handler].queue_depth -= 1
+
+            start_time = time.monotonic()
+            try:
+                handler.handle(event)
+            except:
+                _logger.exception("Exception when calling {}.handle with event {}", handler, event)
+            end_time = time.monotonic()
+
+            with self._lock:
+                stats = self._stats[handler]
+                stats.handled += 1
+                stats.total_wait_time += start_time - dispatch_time
+                stats.max_wait_time = max(stats.max_wait_time, start_time - dispatch_time)
+                stats.total_handle_time += end_time - start_time
+                stats.max_handle_time = max(stats.max_handle_time, end_time - start_time)
+
+                if self._pending[handler]:
+                    # Go to the back of the line, so other event handlers get a turn
+                    self._ready_handlers.put(handler)
                 else:
-                    if accepted:
-                        threading.Thread(
-                            name="EventTh-{:02}".format(next(count)),
-                            target=self._event_handle_target,
-                            args=(handler, event),
-                            daemon=True
-                        ).start()
+                    self._scheduled.discard(handler)
 
-    @staticmethod
-    def _event_handle_target(handler: EventHandler, event: Event) -> None:
-        try:
-            handler.handle(event)
-        except:
-            _logger.exception("Exception when calling {}.handle with event {}", handler, event)
+    def _add_handlers(self, handlers: Iterable[EventHandler]) -> None:
+        with self._lock:
+            for handler in handlers:
+                self._handlers.append(handler)
+                self._pending[handler] = collections.deque()
+                self._stats[handler] = EventHandlerStats()
+
+    def get_stats(self) -> Dict[str, EventHandlerStats]:
+        """
+        Get a snapshot of the counters for each registered event handler, keyed by the name of the
+        event handler.
+        """
+        with self._lock:
+            return {str(handler): stats.copy() for handler, stats in self._stats.items()}
+
+    def log_stats(self) -> None:
+        """
+        Write the counters for each registered event handler to the debug log.
+        """
+        for name, stats in sorted(self.get_stats().items()):
+            _logger.debug("Event handler stats for {}: {}", name, stats)
 
     def register_event_handler(self, event_class: Type[T], handler: Callable[[T], None]) -> None:
         """
@@ -138,7 +232,11 @@ class EventManager:
             def handle(self, event: Event) -> None:
                 handler(event)
 
-        self._handlers.append(FunctionalEventHandler())
+            def __str__(self) -> str:
+                return "{}({})".format(super().__str__(),
+                                       getattr(handler, "__qualname__", handler))
+
+        self._add_handlers([FunctionalEventHandler()])
 
     def register_event_handlers(self, *event_handlers: EventHandler) -> None:
         """
@@ -147,7 +245,7 @@ class EventManager:
         """
         _logger.info("Registering event handlers: {}",
                      ", ".join(str(h) for h in event_handlers))
-        self._handlers += event_handlers
+        self._add_handlers(event_handlers)
 
     def register_event_handler_classes(self, *event_handler_classes: Type[EventHandler]) -> None:
         """
@@ -159,7 +257,7 @@ class EventManager:
         """
         _logger.info("Registering event handler classes: {}",
                      ", ".join(str(c) for c in event_handler_classes))
-        self._handlers += [self.injector.get_instance(cls) for cls in event_handler_classes]
+        self._add_handlers([self.injector.get_instance(cls) for cls in event_handler_classes])
 
     def register_all_event_handlers(self, mod: Any) -> None:
         """
@@ -191,7 +289,35 @@ class EventManager:
         before the event is handled.
         """
         assert isinstance(event, Event)
-        self._event_queue.put(event)
+        dispatch_time = time.monotonic()
+        with self._lock:
+            handlers = list(self._handlers)
+
+        # "accept" is called without holding the lock, so a slow one doesn't hold up everything
+        # else (and one that dispatches an event doesn't deadlock)
+        accepting_handlers = []  # type: List[EventHandler]
+        for handler in handlers:
+            try:
+                if handler.accept(event):
+                    accepting_handlers.append(handler)
+            except:
+                _logger.exception("Exception when calling {}.accept with event {}", handler, event)
+
+        with self._lock:
+            for handler in accepting_handlers:
+                pending = self._pending[handler]
+                stats = self._stats[handler]
+                if any(event.coalesces_with(pending_event) for pending_event, _ in pending):
+                    _logger.debug("Coalescing event {} for {}", event, handler)
+                    stats.coalesced += 1
+                    continue
+
+                pending.append((event, dispatch_time))
+                stats.queue_depth += 1
+                stats.max_queue_depth = max(stats.max_queue_depth, stats.queue_depth)
+                if handler not in self._scheduled:
+                    self._scheduled.add(handler)
+                    self._ready_handlers.put(handler)
 
 
 #############################################################################
@@ -203,6 +329,9 @@ class NewSubmissionsEvent(Event):
     """
     An event representing that a new list of submissions is available from the SubmissionManager.
     """
+    def coalesces_with(self, pending_event: Event) -> bool:
+        # The handlers always use the latest list of submissions
+        return isinstance(pending_event, NewSubmissionsEvent)
 
 
 class SubmissionStartedEvent(Event):
@@ -233,6 +362,18 @@ class EndOfSubmissionsEvent(Event):
     """
     An event representing that all the submissions are done being graded.
     """
+    def coalesces_with(self, pending_event: Event) -> bool:
+        return isinstance(pending_event, EndOfSubmissionsEvent)
+
+
+class BackgroundCommandsUpdatedEvent(Event):
+    """
+    An event representing that the status of the background commands (see
+    BackgroundCommandManager) has changed.
+    """
+    def coalesces_with(self, pending_event: Event) -> bool:
+        # The handlers always use the latest status
+        return isinstance(pending_event, BackgroundCommandsUpdatedEvent)
 
 
 class SubmissionGradeExternallyUpdatedEvent(Event):
@@ -244,6 +385,11 @@ class SubmissionGradeExternallyUpdatedEvent(Event):
         super().__init__()
         self.submission_id = submission_id
 
+    def coalesces_with(self, pending_event: Event) -> bool:
+        # The handlers always send the submission's latest grade
+        return isinstance(pending_event, SubmissionGradeExternallyUpdatedEvent) and \
+            pending_event.submission_id == self.submission_id
+
     def __str__(self) -> str:
         return "{} (submission ID {})".format(super().__str__(), self.submission_id)
 
@@ -0,0 +1,282 @@
+"""
+An asyncio-based ASGI server for the GradeBook, for when lots of GradeBook clients are connected at
+once (see the "--gradebook-server" option).
+
+With the Flask server, each client's event stream ties up a thread for as long as the client is
+connected. Here, each event stream is just an asyncio task. Every other route is still handled by
+the GradeBook's Flask app (in a thread pool, through a minimal WSGI bridge).
+
+This needs Python 3.7 or later (like uvicorn itself).
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+import asyncio
+import io
+import sys
+import urllib.parse
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from gradefast.gradebook.clientupdates import KEEPALIVE_INTERVAL, KEEPALIVE_MESSAGE, ClientUpdate, \
+    ClientUpdateQueue
+from gradefast.gradebook.gradebook import EVENTS_PATH, EVENT_QUEUE_SIZE, GradeBook
+from gradefast.loggingwrapper import get_logger
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+_logger = get_logger("gradebook.asyncserver")
+
+# ASGI types
+Scope = Dict[str, Any]
+Message = Dict[str, Any]
+Receive = Callable[[], Awaitable[Message]]
+Send = Callable[[Message], Awaitable[None]]
+
+# How long to wait for a client to accept more of its event stream before giving up on it (in
+# seconds). Until then, its updates wait (and get coalesced) in its update queue.
+SEND_TIMEOUT = 30
+
+
+class AsyncClientUpdateQueue(ClientUpdateQueue):
+    """
+    A ClientUpdateQueue for a client's event stream that is read by a coroutine in the server's
+    event loop (updates can still be put in from any thread).
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, maxsize: int) -> None:
+        super().__init__(maxsize)
+        self._loop = loop
+        # This is only touched from the event loop, and it's made there too (older versions of
+        # Python bind an Event to the current thread's event loop when it's made)
+        self._ready = None  # type: Optional[asyncio.Event]
+
+    def _get_ready_event(self) -> asyncio.Event:
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        return self._ready
+
+    def _on_put(self) -> None:
+        try:
+            self._loop.call_soon_threadsafe(self._set_ready)
+        except RuntimeError:
+            # The event loop is closed (i.e. the server is shutting down)
+            pass
+
+    def _set_ready(self) -> None:
+        self._get_ready_event().set()
+
+    async def get_async(self) -> ClientUpdate:
+        """
+        Remove and return the next update in the queue, waiting for one if the queue is empty.
+        This must be called from the event loop.
+        """
+        ready = self._get_ready_event()
+        while True:
+            ready.clear()
+            client_update = self.get_nowait()
+            if client_update is not None:
+                return client_update
+            await ready.wait()
+
+
+class AsyncGradeBookServer:
+    """
+    An ASGI app that serves a GradeBook's event streams itself, and passes everything else along
+    to the GradeBook's Flask (WSGI) app.
+    """
+
+    def __init__(self, gradebook: GradeBook, wsgi_app: Callable) -> None:
+        self.gradebook = gradebook
+        self.wsgi_app = wsgi_app
+
+    def run(self, host: str, port: int) -> None:
+        """
+        Run the server with uvicorn until it's stopped.
+        """
+        if uvicorn is None:
+            raise RuntimeError("The async GradeBook server needs the 'uvicorn' package")
+        config = uvicorn.Config(self, host=host, port=port, lifespan="off", access_log=False,
+                                log_level="warning")
+        uvicorn.Server(config).run()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return
+
+        if scope["path"] == EVENTS_PATH:
+            await self._serve_events(scope, receive, send)
+        else:
+            await self._serve_wsgi(scope, receive, send)
+
+    @staticmethod
+    async def _send_response(send: Send, status: int, body: bytes = b"",
+                             headers: List[Tuple[bytes, bytes]] = None) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": headers or []
+        })
+        await send({
+            "type": "http.response.body",
+            "body": body
+        })
+
+    async def _serve_events(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        Serve a client's event stream until the client disconnects (or stops keeping up).
+        """
+        query = urllib.parse.parse_qs(scope["query_string"].decode("latin-1"))
+        try:
+            client_id = self.gradebook.get_events_client_id(query.get("events_key", [""])[0])
+        except ValueError:
+            await self._send_response(send, 400)
+            return
+        except KeyError:
+            await self._send_response(send, 401)
+            return
+        _logger.debug("Client {} connected to _events (async)", client_id)
+
+        update_queue = AsyncClientUpdateQueue(asyncio.get_running_loop(), EVENT_QUEUE_SIZE)
+        self.gradebook.open_event_stream(client_id, update_queue)
+        disconnected = asyncio.ensure_future(self._wait_for_disconnect(receive))
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (b"content-type", b"text/event-stream; charset=utf-8"),
+                    (b"cache-control", b"no-cache"),
+                    # Tell nginx (and friends) not to buffer the stream
+                    (b"x-accel-buffering", b"no")
+                ]
+            })
+
+            while not disconnected.done():
+                next_update = asyncio.ensure_future(update_queue.get_async())
+                done, _ = await asyncio.wait([next_update, disconnected],
+                                             timeout=KEEPALIVE_INTERVAL,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if next_update in done:
+                    client_update = next_update.result()
+                    if not self.gradebook.should_send_client_update(client_id, client_update):
+                        continue
+                    body = client_update.encode()
+                else:
+                    next_update.cancel()
+                    if disconnected.done():
+                        break
+                    body = KEEPALIVE_MESSAGE
+
+                # If the client isn't reading what we send, this will block (once the transport's
+                # buffer fills up) until it catches up. Meanwhile, its updates wait in its own
+                # update queue, and nobody else is held up.
+                await asyncio.wait_for(send({
+                    "type": "http.response.body",
+                    "body": body,
+                    "more_body": True
+                }), SEND_TIMEOUT)
+
+        except asyncio.TimeoutError:
+            _logger.warning("Client {} isn't keeping up with its event stream; disconnecting it",
+                            client_id)
+        except OSError as ex:
+            _logger.debug("Client {} event stream closed: {}", client_id, ex)
+        finally:
+            disconnected.cancel()
+            self.gradebook.close_event_stream(client_id, update_queue)
+            _logger.debug("Client {} disconnected from _events (async)", client_id)
+
+    @staticmethod
+    async def _wait_for_disconnect(receive: Receive) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+
+    async def _serve_wsgi(self, scope: Scope, receive: Receive, send: Send) -> None:
+        """
+        Pass a request along to the WSGI app, running it in a thread pool.
+        """
+        body = b""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body", False):
+                break
+
+        environ = _make_wsgi_environ(scope, body)
+        status, headers, response_body = await asyncio.get_running_loop().run_in_executor(
+            None, _call_wsgi_app, self.wsgi_app, environ)
+        await self._send_response(
+            send, int(status.split(" ", 1)[0]), response_body,
+            [(name.lower().encode("latin-1"), value.encode("latin-1"))
+             for name, value in headers])
+
+
+def _make_wsgi_environ(scope: Scope, body: bytes) -> Dict[str, object]:
+    """
+    Make a WSGI environ dict for an ASGI HTTP request (see PEP 3333).
+    """
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope["query_string"].decode("latin-1"),
+        "SERVER_NAME": str(server[0]),
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": "HTTP/" + scope.get("http_version", "1.1"),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False
+    }  # type: Dict[str, object]
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name == "CONTENT_TYPE" or name == "CONTENT_LENGTH":
+            key = name
+        else:
+            key = "HTTP_" + name
+        if key in environ:
+            value = environ[key] + "," + value
+        environ[key] = value
+    return environ
+
+
+def _call_wsgi_app(wsgi_app: Callable, environ: Dict[str, object]) \
+        -> Tuple[str, List[Tuple[str, str]], bytes]:
+    """
+    Call a WSGI app and collect its entire response.
+
+    :return: A tuple of the form (status, headers, body).
+    """
+    response = []  # type: List[object]
+    chunks = []  # type: List[bytes]
+
+    def start_response(status: str, headers: List[Tuple[str, str]],
+                       exc_info: Optional[tuple] = None) -> Callable[[bytes], None]:
+        response[:] = [status, headers]
+        return chunks.append
+
+    result = wsgi_app(environ, start_response)
+    try:
+        for chunk in result:
+            chunks.append(chunk)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return response[0], response[1], b"".join(chunks)
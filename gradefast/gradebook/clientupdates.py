@@ -0,0 +1,216 @@
+"""
+Updates that the GradeBook server sends to GradeBook clients through their event streams.
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+import collections
+import itertools
+import threading
+from typing import Dict, Hashable, Optional
+
+from gradefast import utils
+
+# How often to send a comment down an idle event stream, so proxies and browsers don't give up on
+# it, and so we notice when a client has gone away (in seconds)
+KEEPALIVE_INTERVAL = 15
+KEEPALIVE_MESSAGE = b": keep-alive\n\n"
+
+
+class ClientUpdate:
+    """
+    Represents an event that the GradeBook server is sending to GradeBook clients.
+
+    The same ClientUpdate is usually sent to every client, so it is encoded (to JSON, and then to
+    the Server-Sent Events format) once, when it is created, and every client's event stream shares
+    the encoded bytes.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, event: str, data: object = None, requires_authentication: bool = True,
+                 state_key: Hashable = None, is_patch: bool = False) -> None:
+        """
+        Create a new ClientUpdate to send to GradeBook clients.
+
+        :param event: The name of the update
+        :param data: The data associated with this update (will be json-encoded if it's not a
+            string)
+        :param requires_authentication: Whether this update should only be sent to authenticated
+            clients
+        :param state_key: What part of the client's state this update is about, if it's something
+            that a later update could supersede (see ClientUpdateQueue)
+        :param is_patch: Whether this update only has some changes to that part of the client's
+            state (so it can't supersede anything), rather than all of it
+        """
+        self._event = event
+        self._data = data if isinstance(data, str) else utils.to_compact_json(data)
+        self._requires_authentication = requires_authentication
+        self._state_key = state_key
+        self._is_patch = is_patch
+        self._id = next(ClientUpdate._ids)
+        self._encoded = self._encode()
+
+    @staticmethod
+    def create_update_event(update_type: str, update_data: object = None,
+                            state_key: Hashable = None, is_patch: bool = False) -> "ClientUpdate":
+        """
+        Create a new ClientUpdate containing an "update" event to send to GradeBook clients.
+
+        :param update_type: The type of "update" event (see connection.js).
+        :param update_data: Data corresponding with this type (must be JSON-encodable).
+        :param state_key: See ClientUpdate's constructor.
+        :param is_patch: See ClientUpdate's constructor.
+        :return: An instance of ClientUpdate
+        """
+        return ClientUpdate("update", {
+            "update_type": update_type,
+            "update_data": update_data or {}
+        }, state_key=state_key, is_patch=is_patch)
+
+    def get_event(self) -> str:
+        return self._event
+
+    def requires_authentication(self) -> bool:
+        return self._requires_authentication
+
+    def get_state_key(self) -> Optional[Hashable]:
+        return self._state_key
+
+    def is_patch(self) -> bool:
+        return self._is_patch
+
+    def encode(self) -> bytes:
+        """
+        Return the event in the HTML5 Server-Sent Events format, encoded as UTF-8.
+
+        https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events
+        """
+        return self._encoded
+
+    def _encode(self) -> bytes:
+        if not self._data:
+            return b""
+
+        parts = ["id: ", str(self._id), "\n"]
+        if self._event:
+            parts += ["event: ", str(self._event), "\n"]
+        for line in self._data.splitlines():
+            parts += ["data: ", line, "\n"]
+        parts.append("\n")
+        return "".join(parts).encode("utf-8")
+
+
+class ClientUpdateQueue:
+    """
+    A bounded queue of the ClientUpdates waiting to be sent to a GradeBook client. Updates can be
+    put in from any thread.
+
+    An update that has all of some part of a client's state (see ClientUpdate's "state_key")
+    supersedes any updates about the same thing that are still waiting, so those are dropped. If
+    the queue fills up anyway (i.e. the client isn't keeping up at all), everything waiting is
+    replaced with a single RESYNC update, which tells the client to ask for the latest state of
+    everything (see the _resync route). The RESYNC can't bring back one-time updates that aren't
+    part of that state (e.g. "hello" and "auth"), so those are kept.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        self._maxsize = maxsize
+        self._condition = threading.Condition()
+
+        # The waiting updates (in order), by the order that they were put in the queue
+        self._updates = collections.OrderedDict()  # type: Dict[int, ClientUpdate]
+        self._next_index = 0
+
+        # The indexes of the waiting updates that have a state key, by state key (in order)
+        self._indexes_by_state_key = {}  # type: Dict[Hashable, collections.deque]
+
+    def __len__(self) -> int:
+        with self._condition:
+            return len(self._updates)
+
+    def put(self, client_update: ClientUpdate) -> bool:
+        """
+        Add an update to the queue, dropping any waiting updates that it supersedes.
+
+        :return: False if the queue was full, so the waiting updates (including this one) were
+            replaced with a RESYNC update, except for the ones that it can't replace. Otherwise,
+            True.
+        """
+        with self._condition:
+            state_key = client_update.get_state_key()
+            if state_key is not None and not client_update.is_patch():
+                for index in self._indexes_by_state_key.pop(state_key, ()):
+                    del self._updates[index]
+
+            is_full = len(self._updates) >= self._maxsize
+            if is_full:
+                kept_updates = [update for update in
+                                itertools.chain(self._updates.values(), [client_update])
+                                if ClientUpdateQueue._survives_resync(update)]
+                self._updates.clear()
+                self._indexes_by_state_key.clear()
+                for kept_update in kept_updates:
+                    self._add(kept_update)
+                self._add(ClientUpdate.create_update_event("RESYNC"))
+            else:
+                self._add(client_update)
+
+            self._condition.notify()
+        self._on_put()
+        return not is_full
+
+    def _add(self, client_update: ClientUpdate) -> None:
+        index = self._next_index
+        self._next_index += 1
+        self._updates[index] = client_update
+        state_key = client_update.get_state_key()
+        if state_key is not None:
+            self._indexes_by_state_key.setdefault(state_key, collections.deque()).append(index)
+
+    @staticmethod
+    def _survives_resync(client_update: ClientUpdate) -> bool:
+        """
+        Determine whether an update has to be kept when the queue overflows, because the RESYNC
+        update that replaces everything else won't resend it.
+        """
+        if client_update.get_event() == "auth":
+            return True
+        return client_update.get_state_key() is None and \
+            not client_update.requires_authentication()
+
+    def _on_put(self) -> None:
+        """
+        Called (outside of the lock) after an update is put in the queue.
+        """
+        pass
+
+    def get(self, timeout: float = None) -> Optional[ClientUpdate]:
+        """
+        Remove and return the next update in the queue, waiting for one if the queue is empty.
+
+        :param timeout: The maximum amount of time to wait (in seconds), or None to wait forever.
+        :return: The next update, or None if there wasn't one before the timeout.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._updates, timeout)
+            return self.get_nowait()
+
+    def get_nowait(self) -> Optional[ClientUpdate]:
+        """
+        Remove and return the next update in the queue, or None if the queue is empty.
+        """
+        with self._condition:
+            if not self._updates:
+                return None
+            _, client_update = self._updates.popitem(last=False)
+            state_key = client_update.get_state_key()
+            if state_key is not None:
+                # This is the oldest waiting update, so it's the first one with its state key, too
+                indexes = self._indexes_by_state_key[state_key]
+                indexes.popleft()
+                if not indexes:
+                    del self._indexes_by_state_key[state_key]
+            return client_update
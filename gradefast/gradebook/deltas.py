@@ -0,0 +1,88 @@
+"""
+Helpers for sending GradeBook clients just what changed (in a submission's grade, or in the list of
+submissions), instead of everything every time.
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple
+
+# A flattened copy of the data from SubmissionGrade.get_data(). "fields" has the top-level values
+# (everything except "grades"), and "items" maps the path of each grade item to its values
+# (everything except "children").
+GradeSnapshot = NamedTuple("GradeSnapshot", [
+    ("fields", Dict[str, object]),
+    ("items", Dict[Tuple[int, ...], Dict[str, object]])
+])
+
+
+def make_grade_snapshot(data: Mapping[str, object]) -> GradeSnapshot:
+    """
+    Flatten the data from SubmissionGrade.get_data() so that it can be compared using
+    diff_grade_snapshots.
+    """
+    fields = {key: value for key, value in data.items() if key != "grades"}
+    items = {}  # type: Dict[Tuple[int, ...], Dict[str, object]]
+
+    stack = [((index,), item) for index, item in enumerate(data.get("grades", []))]
+    while stack:
+        path, item = stack.pop()
+        items[path] = {key: value for key, value in item.items() if key != "children"}
+        for index, child in enumerate(item.get("children", [])):
+            stack.append((path + (index,), child))
+
+    return GradeSnapshot(fields, items)
+
+
+def diff_grade_snapshots(old: GradeSnapshot, new: GradeSnapshot) -> Optional[Dict[str, object]]:
+    """
+    Find what changed between two snapshots of the same submission's grade.
+
+    Both snapshots must have the same grade structure (which never changes for a submission; adding
+    or editing a hint only changes an item's "hints" value).
+
+    :return: None if nothing changed. Otherwise, a patch of the form {"fields": {...}, "items":
+        [{"path": [...], "changes": {...}}, ...]}, where "fields" has any top-level values that
+        changed and "items" has the values that changed for each grade item (in path order).
+    """
+    fields = {key: value for key, value in new.fields.items()
+              if key not in old.fields or old.fields[key] != value}
+
+    items = []  # type: List[Dict[str, object]]
+    for path in sorted(new.items.keys()):
+        old_item = old.items.get(path, {})
+        changes = {key: value for key, value in new.items[path].items()
+                   if key not in old_item or old_item[key] != value}
+        if changes:
+            items.append({
+                "path": list(path),
+                "changes": changes
+            })
+
+    if not fields and not items:
+        return None
+    return {
+        "fields": fields,
+        "items": items
+    }
+
+
+def diff_submission_summaries(sent_summaries: Dict[int, Dict[str, object]],
+                              summaries: Iterable[Dict[str, object]]) -> List[Dict[str, object]]:
+    """
+    Find the submission summaries (from SubmissionSummary.to_json()) that are different from the
+    ones that were last sent to clients.
+
+    :param sent_summaries: The summaries that were last sent, by submission ID. This is updated
+        with any summaries that changed.
+    :param summaries: The latest summaries of the submissions that might have changed.
+    :return: The summaries that changed, in the same order as "summaries".
+    """
+    changed = []  # type: List[Dict[str, object]]
+    for summary in summaries:
+        if sent_summaries.get(summary["id"]) != summary:
+            sent_summaries[summary["id"]] = summary
+            changed.append(summary)
+    return changed
@@ -10,6 +10,7 @@ from iochannels import Channel, Msg, DEFAULT_BAD_CHOICE_MSG
 from pyprovide import Injector, inject
 
 from gradefast import events
+from gradefast.grader.background import BackgroundCommandManager
 from gradefast.loggingwrapper import get_logger
 
 # All concrete event handlers should be listed here.
@@ -20,6 +21,7 @@ __all__ = [
     "SubmissionFinishedHandler",
     "EndOfSubmissionsHandler",
     "SubmissionGradeExternallyUpdatedHandler",
+    "BackgroundCommandsUpdatedHandler",
     "AuthGrantedEventHandler",
 
     "AuthRequestedEventHandler"
@@ -61,7 +63,7 @@ class NewSubmissionsHandler(GradeBookEventHandler):
     handled_event_class = events.NewSubmissionsEvent
 
     def _handle_sync(self, event: events.NewSubmissionsEvent, gradebook_instance) -> None:
-        gradebook_instance.send_submission_list()
+        gradebook_instance.send_submission_list_changes()
 
 
 class SubmissionStartedHandler(GradeBookEventHandler):
@@ -70,16 +72,16 @@ class SubmissionStartedHandler(GradeBookEventHandler):
     def _handle_sync(self, event: events.SubmissionStartedEvent, gradebook_instance) -> None:
         # Switch to this submission for all gradebook clients
         gradebook_instance.set_current_submission(event.submission_id)
-        # Send the submission list too, now that we probably have logs for this guy
-        gradebook_instance.send_submission_list()
+        # Send the submission list changes too, now that we probably have logs for this guy
+        gradebook_instance.send_submission_list_changes([event.submission_id])
 
 
 class SubmissionFinishedHandler(GradeBookEventHandler):
     handled_event_class = events.SubmissionFinishedEvent
 
     def _handle_sync(self, event: events.SubmissionFinishedEvent, gradebook_instance) -> None:
-        # Send the submission list so gradebook clients have updated timing info
-        gradebook_instance.send_submission_list()
+        # Send the submission list changes so gradebook clients have updated timing info
+        gradebook_instance.send_submission_list_changes([event.submission_id])
 
 
 class EndOfSubmissionsHandler(GradeBookEventHandler):
@@ -97,8 +99,17 @@ class SubmissionGradeExternallyUpdatedHandler(GradeBookEventHandler):
                      gradebook_instance) -> None:
         # Send the submission's latest details to any interested gradebook clients
         gradebook_instance.send_submission_updated(event.submission_id)
-        # Send the latest submission list, in case total scores were updated
-        gradebook_instance.send_submission_list()
+        # Send the submission list changes, in case total scores were updated
+        gradebook_instance.send_submission_list_changes([event.submission_id])
+
+
+class BackgroundCommandsUpdatedHandler(GradeBookEventHandler):
+    handled_event_class = events.BackgroundCommandsUpdatedEvent
+
+    def _handle_sync(self, event: events.BackgroundCommandsUpdatedEvent,
+                     gradebook_instance) -> None:
+        background_command_manager = self.injector.get_instance(BackgroundCommandManager)
+        gradebook_instance.send_background_commands(background_command_manager.get_status())
 
 
 class AuthGrantedEventHandler(GradeBookEventHandler):
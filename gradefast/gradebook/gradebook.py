@@ -9,16 +9,20 @@ Author: Jake Hartz <jake@hartz.io>
 import csv
 import io
 import mimetypes
-import queue
 import threading
 import uuid
 from collections import OrderedDict
-from typing import Callable, Dict, Iterable, List, Mapping, Set, TypeVar, cast
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Set, Tuple, TypeVar, \
+    cast
 
 from pyprovide import inject
 
 from gradefast import events, exceptions, grades, utils
 from gradefast.gradebook import eventhandlers
+from gradefast.gradebook.clientupdates import KEEPALIVE_INTERVAL, KEEPALIVE_MESSAGE, ClientUpdate, \
+    ClientUpdateQueue
+from gradefast.gradebook.deltas import GradeSnapshot, diff_grade_snapshots, \
+    diff_submission_summaries, make_grade_snapshot
 from gradefast.loggingwrapper import get_logger
 from gradefast.models import Settings
 from gradefast.submissions import SubmissionManager
@@ -33,65 +37,11 @@ _logger = get_logger("gradebook")
 
 T = TypeVar("T")
 
+# The path of the event stream that clients get updates from
+EVENTS_PATH = "/gradefast/_events"
 
-class ClientUpdate:
-    """
-    Represents an event that the GradeBook server is sending to GradeBook clients.
-    """
-
-    _last_id = 0
-
-    def __init__(self, event: str, data: object = None,
-                 requires_authentication: bool = True) -> None:
-        """
-        Create a new ClientUpdate to send to GradeBook clients.
-
-        :param event: The name of the update
-        :param data: The data associated with this update (will be json-encoded if it's not a
-            string)
-        :param requires_authentication: Whether this update should only be sent to authenticated
-            clients
-        """
-        self._event = event
-        self._data = data if isinstance(data, str) else utils.to_json(data)
-        self._requires_authentication = requires_authentication
-
-        ClientUpdate._last_id += 1
-        self._id = ClientUpdate._last_id
-
-    @staticmethod
-    def create_update_event(update_type: str, update_data: object = None) -> "ClientUpdate":
-        """
-        Create a new ClientUpdate containing an "update" event to send to GradeBook clients.
-
-        :param update_type: The type of "update" event (see connection.js).
-        :param update_data: Data corresponding with this type (must be JSON-encodable).
-        :return: An instance of ClientUpdate
-        """
-        return ClientUpdate("update", {
-            "update_type": update_type,
-            "update_data": update_data or {}
-        })
-
-    def requires_authentication(self) -> bool:
-        return self._requires_authentication
-
-    def encode(self) -> str:
-        """
-        Return the event in the HTML5 Server-Sent Events format.
-
-        https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events
-        """
-        if not self._data:
-            return ""
-
-        result = "id: " + str(self._id) + "\n"
-        if self._event:
-            result += "event: " + str(self._event) + "\n"
-        for line in str(self._data).splitlines():
-            result += "data: " + line + "\n"
-        result += "\n"
-        return result
+# The maximum number of updates that can be waiting to be sent to a client (see ClientUpdateQueue)
+EVENT_QUEUE_SIZE = 999
 
 
 class GradeBook:
@@ -112,6 +62,8 @@ class GradeBook:
 
         self._current_submission_id = None  # type: int
         self._is_done = False
+        # The latest status of the background commands (see send_background_commands)
+        self._background_commands = []  # type: List[dict]
 
         # Each instance of the GradeBook client is given its own unique ID (a UUID).
         # They are stored in these sets.
@@ -124,7 +76,7 @@ class GradeBook:
 
         # When a client accesses the events stream, it has an "update queue" (a Queue that update
         # events are sent to).
-        self._client_update_queues = {}  # type: Dict[uuid.UUID, queue.Queue]
+        self._client_update_queues = {}  # type: Dict[uuid.UUID, ClientUpdateQueue]
 
         # Secret key used by the client and any other integrations for accessing downloadables
         # (CSV and JSON).
@@ -141,12 +93,26 @@ class GradeBook:
         # This is sent to the client through the client's events stream after authentication.
         self._client_update_keys = {}  # type: Dict[uuid.UUID, uuid.UUID]
 
+        # The latest version number of each submission's grade that was sent to clients, along with
+        # a snapshot of what was sent (see send_submission_updated). This lock makes sure that the
+        # versions are sent out in order.
+        self._submission_versions = {}  # type: Dict[int, Tuple[int, GradeSnapshot]]
+        self._submission_versions_lock = threading.Lock()
+
+        # The submission summaries that were last sent to clients, along with a version number for
+        # the submission list (see send_submission_list_changes)
+        self._sent_submission_summaries = OrderedDict()  # type: Dict[int, Dict[str, object]]
+        self._submission_list_version = 0
+        self._submission_list_lock = threading.Lock()
+
         # Set up MIME type for JS source map
         mimetypes.add_type("application/json", ".map")
 
     def run(self, debug: bool = False) -> None:
         """
-        Start the Flask server (using Werkzeug internally).
+        Start the GradeBook server: either the Flask server (using Werkzeug internally), or the
+        async server (using uvicorn, with the Flask app handling everything except the event
+        streams), depending on the "gradebook_server" setting.
 
         :param debug: Whether to start the server in debug mode (includes tracebacks with HTTP 500
             error pages)
@@ -157,6 +123,13 @@ class GradeBook:
         # Initialize the routes for the app
         self._init_routes(app)
 
+        if self.settings.gradebook_server == "async":
+            from gradefast.gradebook.asyncserver import AsyncGradeBookServer
+            app.debug = debug
+            _logger.info("Running async server")
+            AsyncGradeBookServer(self, app).run(self.settings.host, int(self.settings.port))
+            return
+
         # Start the server
         kwargs = {
             "threaded": True,
@@ -385,6 +358,41 @@ class GradeBook:
                 return json_bad_request(
                     "Look what you did... (seriously, look in the server error console)")
 
+        # AJAX endpoint to trigger a ClientUpdate with the full details of a submission and/or the
+        # full submission list (for when a client missed some SUBMISSION_UPDATED or
+        # SUBMISSIONS_PATCH updates), and/or everything else (for when a client got a RESYNC
+        # update)
+        @app.route("/gradefast/_resync", methods=["POST"])
+        def _gradefast_resync() -> flask.Response:
+            client_id = get_uuid_from_form("client_id")
+            if client_id not in self._client_ids:
+                return json_bad_request("Unknown client ID")
+            if client_id not in self._authenticated_client_ids:
+                return json_bad_request("Client not authenticated")
+
+            if "submission_list" in flask.request.form:
+                _logger.debug("Client {} requested resync of submission list", client_id)
+                self.send_submission_list(client_id)
+
+            if "submission_id" in flask.request.form:
+                submission_id = get_int_from_form("submission_id")
+                try:
+                    self.submission_manager.get_submission(submission_id)
+                except IndexError:
+                    return json_bad_request("Invalid submission ID")
+
+                _logger.debug("Client {} requested resync of submission {}",
+                              client_id, submission_id)
+                self.send_submission_updated(submission_id, full_update_client_id=client_id)
+
+            if "state" in flask.request.form:
+                _logger.debug("Client {} requested resync of everything else", client_id)
+                shown_submission_id = None
+                if "submission_id" in flask.request.form:
+                    shown_submission_id = get_int_from_form("submission_id")
+                self.resend_client_state(client_id, shown_submission_id)
+            return json_aight()
+
         # AJAX endpoint to trigger a ClientUpdate with refreshed stats
         @app.route("/gradefast/_refresh_stats", methods=["POST"])
         def _gradefast_refresh_stats() -> flask.Response:
@@ -399,38 +407,68 @@ class GradeBook:
             return json_aight()
 
         # Event stream
-        @app.route("/gradefast/_events")
+        # (when running the async server, this route is handled by AsyncGradeBookServer instead)
+        @app.route(EVENTS_PATH)
         def _gradefast_events() -> flask.Response:
             try:
-                events_key = uuid.UUID(flask.request.args["events_key"])
+                client_id = self.get_events_client_id(flask.request.args.get("events_key", ""))
             except ValueError:
                 return flask.abort(400)
-            if events_key not in self._events_keys:
+            except KeyError:
                 return flask.abort(401)
-            client_id = self._events_keys[events_key]
             _logger.debug("Client {} connected to _events", client_id)
 
-            def gen() -> Iterable[str]:
-                update_queue = queue.Queue(999)  # type: queue.Queue
-                self._client_update_queues[client_id] = update_queue
-                # Some browsers need an initial kick to fire the "open" event on the EventSource
-                update_queue.put(ClientUpdate("hello", requires_authentication=False))
+            def gen() -> Iterable[bytes]:
+                update_queue = ClientUpdateQueue(EVENT_QUEUE_SIZE)
+                self.open_event_stream(client_id, update_queue)
                 try:
                     while True:
-                        client_update = update_queue.get()
-                        if client_update.requires_authentication():
-                            if client_id not in self._authenticated_client_ids:
-                                continue
-
-                        yield client_update.encode()
+                        client_update = update_queue.get(KEEPALIVE_INTERVAL)
+                        if client_update is None:
+                            # This is also how we find out if the client has gone away
+                            yield KEEPALIVE_MESSAGE
+                        elif self.should_send_client_update(client_id, client_update):
+                            yield client_update.encode()
 
                 except GeneratorExit:
                     pass
                 finally:
-                    if self._client_update_queues[client_id] is update_queue:
-                        del self._client_update_queues[client_id]
+                    self.close_event_stream(client_id, update_queue)
             return flask.Response(gen(), mimetype="text/event-stream")
 
+    def get_events_client_id(self, events_key: str) -> uuid.UUID:
+        """
+        Get the ID of the client that an events key (for the _events stream) belongs to.
+
+        :raises ValueError: If the events key isn't a valid UUID.
+        :raises KeyError: If the events key doesn't belong to any client.
+        """
+        return self._events_keys[uuid.UUID(events_key)]
+
+    def open_event_stream(self, client_id: uuid.UUID, update_queue: ClientUpdateQueue) -> None:
+        """
+        Start sending a client's updates to a queue when the client connects to the _events stream.
+        """
+        self._client_update_queues[client_id] = update_queue
+        # Some browsers need an initial kick to fire the "open" event on the EventSource
+        update_queue.put(ClientUpdate("hello", requires_authentication=False))
+
+    def close_event_stream(self, client_id: uuid.UUID, update_queue: ClientUpdateQueue) -> None:
+        """
+        Stop sending a client's updates to a queue when the client disconnects from the _events
+        stream (unless the client already reconnected with a new queue).
+        """
+        if self._client_update_queues.get(client_id) is update_queue:
+            del self._client_update_queues[client_id]
+
+    def should_send_client_update(self, client_id: uuid.UUID, client_update: ClientUpdate) -> bool:
+        """
+        Check whether an update that came out of a client's update queue should actually be sent
+        to the client (it might have been queued before the client was authenticated).
+        """
+        return not client_update.requires_authentication() or \
+            client_id in self._authenticated_client_ids
+
     def _get_grades_export(self, include_all: bool) -> List[OrderedDict]:
         """
         Return a list of ordered dicts representing the scores, feedback, and timing for each
@@ -490,34 +528,127 @@ class GradeBook:
             client_ids = {client_id}
 
         for client_id in client_ids:
-            if client_id in self._client_update_queues:
-                try:
-                    self._client_update_queues[client_id].put_nowait(client_update)
-                except queue.Full:
-                    _logger.warning("Client {} event queue is full", client_id)
+            update_queue = self._client_update_queues.get(client_id)
+            if update_queue is not None and not update_queue.put(client_update):
+                _logger.warning("Client {} fell too far behind; asking it to resync", client_id)
 
-    def send_submission_list(self) -> None:
+    def send_submission_list_changes(self, submission_ids: Iterable[int] = None) -> None:
         """
-        Send the latest submission list to GradeBook clients.
+        Send GradeBook clients the summaries of any submissions that changed since they were last
+        sent (as a SUBMISSIONS_PATCH update), so they can update their submission lists. If any
+        submissions were added or removed, the entire list is sent instead (as a NEW_SUBMISSIONS
+        update).
+
+        :param submission_ids: The IDs of the submissions that might have changed. By default, this
+            checks every submission that has been loaded (the others can only change if a hint is
+            added or edited).
         """
-        self._send_client_update(ClientUpdate.create_update_event("NEW_SUBMISSIONS", {
-            "submissions": list(self.submission_manager.get_all_submissions())
-        }))
+        with self._submission_list_lock:
+            self._send_submission_list_changes(submission_ids)
+
+    def _send_submission_list_changes(self, submission_ids: Optional[Iterable[int]]) -> None:
+        """
+        Implementation of send_submission_list_changes. This must be called with the submission list
+        lock held.
+        """
+        if list(self._sent_submission_summaries.keys()) != \
+                list(self.submission_manager.get_all_submission_ids()):
+            # Submissions were added or removed, so everyone needs the whole thing
+            self._sent_submission_summaries = OrderedDict(
+                (summary.get_id(), summary.to_json())
+                for summary in self.submission_manager.get_all_submission_summaries())
+            self._submission_list_version += 1
+            self._send_client_update(ClientUpdate.create_update_event(
+                "NEW_SUBMISSIONS", self._get_submission_list_data(), state_key="SUBMISSION_LIST"))
+            return
+
+        if submission_ids is None:
+            submission_ids = self.submission_manager.get_loaded_submission_ids()
+        changed = diff_submission_summaries(
+            self._sent_submission_summaries,
+            (self.submission_manager.get_submission_summary(submission_id).to_json()
+             for submission_id in submission_ids))
+        if changed:
+            self._submission_list_version += 1
+            self._send_client_update(ClientUpdate.create_update_event("SUBMISSIONS_PATCH", {
+                "submissions": changed,
+                "version": self._submission_list_version,
+                "base_version": self._submission_list_version - 1
+            }, state_key="SUBMISSION_LIST", is_patch=True))
+
+    def _get_submission_list_data(self) -> Dict[str, object]:
+        """
+        Get the submission list that was last sent to clients, along with its version. This must be
+        called with the submission list lock held.
+        """
+        return {
+            "submissions": list(self._sent_submission_summaries.values()),
+            "version": self._submission_list_version
+        }
+
+    def send_submission_list(self, client_id: uuid.UUID) -> None:
+        """
+        Send the entire latest submission list to a GradeBook client (e.g. if it missed some
+        updates). Everyone else gets any changes, too, so they stay on the same version.
+        """
+        with self._submission_list_lock:
+            self._send_submission_list_changes(None)
+            self._send_client_update(ClientUpdate.create_update_event(
+                "NEW_SUBMISSIONS", self._get_submission_list_data(), state_key="SUBMISSION_LIST"),
+                client_id)
 
     def send_submission_updated(self, submission_id: int, originating_client_id: uuid.UUID = None,
-                                originating_client_seq: int = None) -> None:
+                                originating_client_seq: int = None,
+                                full_update_client_id: uuid.UUID = None) -> None:
         """
         Send a submission's latest grades, comments, etc. after it has been updated to any
         interested GradeBook clients.
+
+        Each time a submission's grade changes, its version number goes up, and clients are only
+        sent a patch with the grade items that changed since the last version (plus the new
+        totals). If a client sees a gap in the version numbers, it asks for a full update (see the
+        _resync route).
+
+        :param submission_id: The ID of the submission that was updated.
+        :param originating_client_id: The ID of the GradeBook client whose action caused this.
+        :param originating_client_seq: The sequence number of that client's action.
+        :param full_update_client_id: The ID of a GradeBook client that should be sent the entire
+            grade (after any patch is sent to everyone).
         """
         submission = self.submission_manager.get_submission(submission_id)
-        data = submission.get_grade().get_data()
-        data.update({
-            "submission_id": submission_id,
-            "originating_client_id": originating_client_id,
-            "originating_client_seq": originating_client_seq
-        })
-        self._send_client_update(ClientUpdate.create_update_event("SUBMISSION_UPDATED", data))
+
+        def make_update(values: Dict[str, object], **extra: object) -> ClientUpdate:
+            values.update({
+                "submission_id": submission_id,
+                "originating_client_id": originating_client_id,
+                "originating_client_seq": originating_client_seq
+            })
+            values.update(extra)
+            return ClientUpdate.create_update_event(
+                "SUBMISSION_UPDATED", values, state_key=("SUBMISSION_UPDATED", submission_id),
+                is_patch=not values["full"])
+
+        with self._submission_versions_lock:
+            data = submission.get_grade().get_data()
+            snapshot = make_grade_snapshot(data)
+
+            if submission_id not in self._submission_versions:
+                # Nobody has seen this submission yet, so everyone gets the whole thing
+                self._submission_versions[submission_id] = 1, snapshot
+                self._send_client_update(make_update(data, full=True, version=1))
+                return
+
+            version, old_snapshot = self._submission_versions[submission_id]
+            patch = diff_grade_snapshots(old_snapshot, snapshot)
+            if patch is not None:
+                version += 1
+                self._submission_versions[submission_id] = version, snapshot
+                self._send_client_update(make_update(patch, full=False, version=version,
+                                                     base_version=version - 1))
+
+            if full_update_client_id is not None:
+                self._send_client_update(make_update(data, full=True, version=version),
+                                         full_update_client_id)
 
     def send_updated_stats(self, client_id: uuid.UUID = None) -> None:
         """
@@ -526,7 +657,14 @@ class GradeBook:
         self._send_client_update(ClientUpdate.create_update_event("UPDATED_STATS", {
             "grading_stats": self.submission_manager.get_grading_stats(),
             "timing_stats": self.submission_manager.get_timing_stats()
-        }), client_id)
+        }, state_key="UPDATED_STATS"), client_id)
+
+    def send_background_commands(self, status: List[dict]) -> None:
+        """
+        Send the latest status of the background commands to GradeBook clients.
+        """
+        self._background_commands = status
+        self._send_client_update(self._make_background_commands_update())
 
     def auth_granted(self, auth_event_id: int) -> None:
         """
@@ -550,13 +688,42 @@ class GradeBook:
         self._client_update_keys[client_id] = uuid.uuid4()
 
         # Send the client its auth keys
-        self._send_client_update(ClientUpdate("auth", {
-            "data_key": data_key,
-            "update_key": self._client_update_keys[client_id],
-            "initial_submission_list": list(self.submission_manager.get_all_submissions()),
-            "initial_submission_id": self._current_submission_id,
-            "is_done": self._is_done
-        }), client_id)
+        with self._submission_list_lock:
+            self._send_submission_list_changes(None)
+            submission_list_data = self._get_submission_list_data()
+            self._send_client_update(ClientUpdate("auth", {
+                "data_key": data_key,
+                "update_key": self._client_update_keys[client_id],
+                "initial_submission_list": submission_list_data["submissions"],
+                "initial_submission_list_version": submission_list_data["version"],
+                "initial_submission_id": self._current_submission_id,
+                "is_done": self._is_done
+            }), client_id)
+        if self._background_commands:
+            self._send_client_update(self._make_background_commands_update(), client_id)
+
+    def _make_background_commands_update(self) -> ClientUpdate:
+        return ClientUpdate.create_update_event("BACKGROUND_COMMANDS", {
+            "background_commands": self._background_commands
+        }, state_key="BACKGROUND_COMMANDS")
+
+    def resend_client_state(self, client_id: uuid.UUID,
+                            shown_submission_id: Optional[int] = None) -> None:
+        """
+        Send a GradeBook client the latest state of everything except the submission list and
+        grades (e.g. if it missed some updates; see the RESYNC update in ClientUpdateQueue).
+
+        :param client_id: The ID of the client to send to.
+        :param shown_submission_id: The ID of the submission that the client is showing, if any.
+            If grading has moved on to a different submission, the client is sent there.
+        """
+        if self._background_commands:
+            self._send_client_update(self._make_background_commands_update(), client_id)
+        self.send_updated_stats(client_id)
+        if self._is_done or (self._current_submission_id is not None and
+                             self._current_submission_id != shown_submission_id):
+            self._send_client_update(self._make_current_submission_update(self._is_done),
+                                     client_id)
 
     def set_current_submission(self, submission_id: int) -> None:
         """
@@ -565,9 +732,7 @@ class GradeBook:
         self._current_submission_id = submission_id
 
         # Tell GradeBook clients about this change in the current submission
-        self._send_client_update(ClientUpdate.create_update_event("SUBMISSION_STARTED", {
-            "submission_id": submission_id
-        }))
+        self._send_client_update(self._make_current_submission_update(False))
 
     def set_done(self) -> None:
         """
@@ -576,7 +741,16 @@ class GradeBook:
         self._is_done = True
 
         # Tell GradeBook clients that we're done
-        self._send_client_update(ClientUpdate.create_update_event("END_OF_SUBMISSIONS"))
+        self._send_client_update(self._make_current_submission_update(True))
+
+    def _make_current_submission_update(self, is_done: bool) -> ClientUpdate:
+        # (either one of these supersedes the other)
+        if is_done:
+            return ClientUpdate.create_update_event("END_OF_SUBMISSIONS",
+                                                    state_key="CURRENT_SUBMISSION")
+        return ClientUpdate.create_update_event("SUBMISSION_STARTED", {
+            "submission_id": self._current_submission_id
+        }, state_key="CURRENT_SUBMISSION")
 
     def _parse_action(self, submission_id: int, client_id: uuid.UUID, client_seq: int,
                       action: Mapping[str, object]) -> None:
@@ -596,16 +770,20 @@ class GradeBook:
         self._apply_action_to_grade(submission.get_grade(), action)
         new_score_tuple = submission.get_grade().get_score()
 
-        # Recalculate the score, etc., and tell clients
-        self.send_submission_updated(submission_id, client_id, client_seq)
+        # Recalculate the score, etc., and tell clients. An empty action is a client asking for the
+        # whole submission (e.g. when it switches to it), so it gets a full update.
+        full_update_client_id = None if action.get("type") else client_id
+        self.send_submission_updated(submission_id, client_id, client_seq, full_update_client_id)
 
         # If the overall scores changed, update the submission list (so clients get the new overall
         # scores to show in the submission list).
-        # NOTE: If a hint was changed, that could affect other submissions' scores, even if it
-        # didn't affect us.
-        # TODO: Clean this up
-        if old_score_tuple != new_score_tuple or action.get("type") == "EDIT_HINT":
-            self.send_submission_list()
+        # NOTE: If a hint was added or changed, that could affect other submissions' scores (even
+        # ones that haven't been loaded), even if it didn't affect us.
+        if action.get("type") in ("ADD_HINT", "EDIT_HINT"):
+            self.send_submission_list_changes(
+                list(self.submission_manager.get_all_submission_ids()))
+        elif old_score_tuple != new_score_tuple:
+            self.send_submission_list_changes([submission_id])
 
     @staticmethod
     def _apply_action_to_grade(grade: grades.SubmissionGrade, action: Mapping[str, object]) -> None:
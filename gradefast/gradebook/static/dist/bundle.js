@@ -1822,10 +1822,13 @@ var WAITING_FOR_USER_TO_GET_THEIR_ASS_MOVING = "WAIT_FOR_USER_TO_GET_THEIR_ASS_M
 var SET_DATA_KEY = "SET_DATA_KEY";
 var LOADING_SUBMISSION = "LOADING_SUBMISSION";
 var INIT_SUBMISSION = "INIT_SUBMISSION";
+var PATCH_SUBMISSION = "PATCH_SUBMISSION";
 var SHOW_SUBMISSIONS = "SHOW_SUBMISSIONS";
 var HIDE_SUBMISSIONS = "HIDE_SUBMISSIONS";
 var SET_SUBMISSIONS = "SET_SUBMISSIONS";
+var PATCH_SUBMISSIONS = "PATCH_SUBMISSIONS";
 var SET_STATS = "SET_STATS";
+var SET_BACKGROUND_COMMANDS = "SET_BACKGROUND_COMMANDS";
 
 // These string values are also recognized by the GradeBook server
 // (see GradeBook::_parse_action in gradebook.py)
@@ -1890,6 +1893,19 @@ var actions = exports.actions = {
             points_earned: points_earned, points_possible: points_possible, grades: Immutable.fromJS(grades)
         };
     },
+    patchSubmission: function patchSubmission(submission_id, fields, items) {
+        return {
+            type: PATCH_SUBMISSION,
+
+            submission_id: submission_id, fields: fields,
+            items: items.map(function (item) {
+                return {
+                    path: item.path,
+                    changes: Immutable.fromJS(item.changes)
+                };
+            })
+        };
+    },
     showSubmissions: function showSubmissions() {
         return function (dispatch) {
             // Propagate the action locally
@@ -1916,6 +1932,14 @@ var actions = exports.actions = {
             submissions: submissions
         };
     },
+    patchSubmissions: function patchSubmissions(list) {
+        return {
+            type: PATCH_SUBMISSIONS,
+            submissions: list.map(function (l) {
+                return Immutable.fromJS(l);
+            })
+        };
+    },
     setStats: function setStats(grading_stats, timing_stats) {
         return {
             type: SET_STATS,
@@ -1923,6 +1947,12 @@ var actions = exports.actions = {
             timing_stats: Immutable.fromJS(timing_stats)
         };
     },
+    setBackgroundCommands: function setBackgroundCommands(background_commands) {
+        return {
+            type: SET_BACKGROUND_COMMANDS,
+            background_commands: Immutable.fromJS(background_commands)
+        };
+    },
     setLate: function setLate(is_late) {
         return dispatchActionAndTellServer({
             type: SET_LATE,
@@ -2054,6 +2084,8 @@ var initialState = Immutable.Map({
     "grading_stats": Immutable.Map(),
     "timing_stats": Immutable.Map(),
 
+    "background_commands": Immutable.List(),
+
     "submission_id": null,
     "submission_is_late": false,
     "submission_overall_comments": "",
@@ -2103,6 +2135,26 @@ function app(state, action) {
             }
             break;
 
+        case PATCH_SUBMISSION:
+            if (action.submission_id === state.get("submission_id")) {
+                // Top-level fields are stored with a "submission_" prefix
+                Object.keys(action.fields).forEach(function (key) {
+                    state = state.set("submission_" + key, action.fields[key]);
+                });
+                action.items.forEach(function (item) {
+                    // Path [0, 2] is at ["submission_grades", 0, "children", 2]
+                    var keyPath = ["submission_grades"];
+                    item.path.forEach(function (index, i) {
+                        if (i > 0) keyPath.push("children");
+                        keyPath.push(index);
+                    });
+                    state = state.updateIn(keyPath, function (gradeState) {
+                        return gradeState.merge(item.changes);
+                    });
+                });
+            }
+            break;
+
         case SHOW_SUBMISSIONS:
             state = state.set("submissions_visible", true);
             break;
@@ -2115,6 +2167,12 @@ function app(state, action) {
             state = state.set("submissions", action.submissions);
             break;
 
+        case PATCH_SUBMISSIONS:
+            action.submissions.forEach(function (submission) {
+                state = state.setIn(["submissions", submission.get("id")], submission);
+            });
+            break;
+
         case SET_STATS:
             state = state.merge({
                 "grading_stats": action.grading_stats,
@@ -2122,6 +2180,10 @@ function app(state, action) {
             });
             break;
 
+        case SET_BACKGROUND_COMMANDS:
+            state = state.set("background_commands", action.background_commands);
+            break;
+
         case SET_LATE:
             state = state.set("submission_is_late", action.is_late);
             break;
@@ -7381,6 +7443,26 @@ var eventSource = null;
 var client_seq = 0;
 var update_key = null;
 
+// The submission (and version of its grade) that we last got a full SUBMISSION_UPDATED for, which
+// any patches we get are applied on top of
+var submission_version = {
+    submission_id: null,
+    version: null,
+    resync_pending: false
+};
+
+// The version of the submission list that we have (see NEW_SUBMISSIONS and SUBMISSIONS_PATCH)
+var submission_list_version = {
+    version: null,
+    resync_pending: false
+};
+
+// Fields that we change locally before telling the server (see dispatchActionAndTellServer in
+// actions.js). These are skipped in outdated patches from our own actions, so they don't clobber
+// anything newer (like what the user is in the middle of typing).
+var LOCAL_FIELDS = ["is_late", "overall_comments"];
+var LOCAL_ITEM_FIELDS = ["enabled", "score", "comments"];
+
 function sendAuthRequest() {
     var device = navigator.userAgent;
     if (device.startsWith("Mozilla/")) {
@@ -7392,12 +7474,16 @@ function sendAuthRequest() {
     });
 }
 
-function authKeysReceived(new_data_key, new_update_key, initial_submission_list, initial_submission_id, is_done) {
+function authKeysReceived(new_data_key, new_update_key, initial_submission_list, initial_submission_list_version, initial_submission_id, is_done) {
     console.log("Received auth keys");
     update_key = new_update_key;
     _store.store.dispatch(_actions.actions.setDataKey(new_data_key));
 
     // Now that we are authenticated, move on from the "Loading" screen
+    submission_list_version = {
+        version: initial_submission_list_version,
+        resync_pending: false
+    };
     _store.store.dispatch(_actions.actions.setSubmissions(initial_submission_list));
     if (is_done) {
         // Show the submission list and statistics
@@ -7421,6 +7507,47 @@ function sendUpdate(submission_id) {
     });
 }
 
+function sendResyncRequest(submission_id) {
+    submission_version.resync_pending = true;
+    (0, _utils.post)(CONFIG.BASE + "_resync", {
+        client_id: CONFIG.CLIENT_ID,
+        submission_id: submission_id
+    });
+}
+
+function sendSubmissionListResyncRequest() {
+    submission_list_version.resync_pending = true;
+    (0, _utils.post)(CONFIG.BASE + "_resync", {
+        client_id: CONFIG.CLIENT_ID,
+        submission_list: true
+    });
+}
+
+function sendFullResyncRequest() {
+    // Ask for the submission list, the submission we're showing (if any), and anything else that
+    // we might have missed (like moving on to a different submission)
+    var params = {
+        client_id: CONFIG.CLIENT_ID,
+        submission_list: true,
+        state: true
+    };
+    submission_list_version.resync_pending = true;
+    var submission_id = _store.store.getState().get("submission_id");
+    if (typeof submission_id === "number") {
+        submission_version.resync_pending = true;
+        params.submission_id = submission_id;
+    }
+    (0, _utils.post)(CONFIG.BASE + "_resync", params);
+}
+
+function withoutKeys(obj, keys) {
+    var result = {};
+    Object.keys(obj).forEach(function (key) {
+        if (keys.indexOf(key) === -1) result[key] = obj[key];
+    });
+    return result;
+}
+
 function sendRefreshStatsRequest() {
     (0, _utils.post)(CONFIG.BASE + "_refresh_stats", {
         client_id: CONFIG.CLIENT_ID
@@ -7430,19 +7557,35 @@ function sendRefreshStatsRequest() {
 var updateTypeHandlers = {
     NEW_SUBMISSIONS: function NEW_SUBMISSIONS(data) {
         // Update our list of submissions
+        submission_list_version = {
+            version: data.version,
+            resync_pending: false
+        };
         _store.store.dispatch(_actions.actions.setSubmissions(data.submissions));
     },
+    SUBMISSIONS_PATCH: function SUBMISSIONS_PATCH(data) {
+        // Update the submissions that changed in our list of submissions
+        if (submission_list_version.resync_pending) return;
+        if (data.base_version !== submission_list_version.version) {
+            // We missed something, so ask for the whole thing
+            console.warn("Missed SUBMISSIONS_PATCH (have version", submission_list_version.version, "but got patch from version", data.base_version + "); resyncing");
+            sendSubmissionListResyncRequest();
+            return;
+        }
+        submission_list_version.version = data.version;
+        _store.store.dispatch(_actions.actions.patchSubmissions(data.submissions));
+    },
     SUBMISSION_STARTED: function SUBMISSION_STARTED(data) {
         // Tell the forces at large to go to this submission
         _store.store.dispatch(_actions.actions.goToSubmission(data.submission_id));
     },
     SUBMISSION_UPDATED: function SUBMISSION_UPDATED(data) {
-        // Should we ignore this update?
-        // Only if it came from us, and is already outdated
+        // Is this update outdated?
+        // Only if it came from us, and we've done something since then
+        var outdated = false;
         if (data.originating_client_id === CONFIG.CLIENT_ID) {
             if (data.originating_client_seq < client_seq) {
-                // This update is outdated
-                return;
+                outdated = true;
             } else if (data.originating_client_seq > client_seq) {
                 // Umm, somehow someone has been sending events as us...
                 // (or it's our future selves -- BUT WHERE ARE ALL THE TIME TRAVELLERS)
@@ -7451,7 +7594,47 @@ var updateTypeHandlers = {
             }
         }
 
-        _store.store.dispatch(_actions.actions.initSubmission(data.submission_id, data.is_late, data.overall_comments, data.overall_comments_html, data.points_earned, data.points_possible, data.grades));
+        if (data.full) {
+            // We only care about the submission that we're showing
+            if (data.submission_id !== _store.store.getState().get("submission_id")) return;
+
+            submission_version = {
+                submission_id: data.submission_id,
+                version: data.version,
+                resync_pending: false
+            };
+            // Outdated full updates are still useful if we don't have anything for this submission
+            // yet (but otherwise, they'd overwrite what we've done since then)
+            if (outdated && !_store.store.getState().get("loading")) return;
+
+            _store.store.dispatch(_actions.actions.initSubmission(data.submission_id, data.is_late, data.overall_comments, data.overall_comments_html, data.points_earned, data.points_possible, data.grades));
+            return;
+        }
+
+        // It's a patch. If we haven't gotten the full submission yet, we'll get a full update soon
+        // (see goToSubmission in actions.js), so ignore it until then.
+        if (data.submission_id !== submission_version.submission_id) return;
+        if (submission_version.resync_pending) return;
+        if (data.base_version !== submission_version.version) {
+            // We missed something, so ask for the whole thing
+            console.warn("Missed SUBMISSION_UPDATED for submission", data.submission_id, "(have version", submission_version.version, "but got patch from version", data.base_version + "); resyncing");
+            sendResyncRequest(data.submission_id);
+            return;
+        }
+        submission_version.version = data.version;
+
+        var fields = data.fields;
+        var items = data.items;
+        if (outdated) {
+            fields = withoutKeys(fields, LOCAL_FIELDS);
+            items = items.map(function (item) {
+                return {
+                    path: item.path,
+                    changes: withoutKeys(item.changes, LOCAL_ITEM_FIELDS)
+                };
+            });
+        }
+        _store.store.dispatch(_actions.actions.patchSubmission(data.submission_id, fields, items));
     },
     END_OF_SUBMISSIONS: function END_OF_SUBMISSIONS(data) {
         // Show the submission list and statistics
@@ -7459,6 +7642,14 @@ var updateTypeHandlers = {
     },
     UPDATED_STATS: function UPDATED_STATS(data) {
         _store.store.dispatch(_actions.actions.setStats(data.grading_stats, data.timing_stats));
+    },
+    BACKGROUND_COMMANDS: function BACKGROUND_COMMANDS(data) {
+        _store.store.dispatch(_actions.actions.setBackgroundCommands(data.background_commands));
+    },
+    RESYNC: function RESYNC(data) {
+        // We fell too far behind, so the server dropped the updates that were waiting for us
+        console.warn("Missed too many updates; resyncing everything");
+        sendFullResyncRequest();
     }
 };
 
@@ -7489,7 +7680,7 @@ function initEventSource(onReady) {
 
         if (jsonData.data_key && jsonData.update_key) {
             //console.log("AUTH EVENT:", jsonData);
-            authKeysReceived(jsonData.data_key, jsonData.update_key, jsonData.initial_submission_list, jsonData.initial_submission_id, jsonData.is_done);
+            authKeysReceived(jsonData.data_key, jsonData.update_key, jsonData.initial_submission_list, jsonData.initial_submission_list_version, jsonData.initial_submission_id, jsonData.is_done);
         } else {
             (0, _utils.reportResponseError)(path, "event: auth", "Missing keys", jsonData);
         }
@@ -17663,6 +17854,60 @@ var SubmissionList = React.createClass({
             )
         );
     },
+    renderBackgroundCommands: function renderBackgroundCommands() {
+        return React.createElement(
+            "table",
+            { className: "submission-list" },
+            React.createElement(
+                "tbody",
+                null,
+                this.props.background_commands.map(function (job) {
+                    var elapsed_time = job.get("elapsed_time");
+                    return React.createElement(
+                        "tr",
+                        { key: job.get("job_id"), title: job.get("error") || "" },
+                        React.createElement(
+                            "td",
+                            null,
+                            "(",
+                            job.get("submission_id"),
+                            ")"
+                        ),
+                        React.createElement(
+                            "td",
+                            null,
+                            React.createElement(
+                                "strong",
+                                null,
+                                job.get("submission_name")
+                            )
+                        ),
+                        React.createElement(
+                            "td",
+                            null,
+                            job.get("name")
+                        ),
+                        React.createElement(
+                            "td",
+                            null,
+                            job.get("status")
+                        ),
+                        React.createElement(
+                            "td",
+                            { title: elapsed_time === null ? "" : elapsed_time + " sec" },
+                            elapsed_time === null ? "" : formatTime(elapsed_time)
+                        ),
+                        React.createElement(
+                            "td",
+                            null,
+                            job.get("output_size"),
+                            " characters of output"
+                        )
+                    );
+                })
+            )
+        );
+    },
     render: function render() {
         var _this2 = this;
 
@@ -17771,6 +18016,16 @@ var SubmissionList = React.createClass({
                     })
                 )
             ),
+            this.props.background_commands.size === 0 ? undefined : React.createElement(
+                "div",
+                null,
+                React.createElement(
+                    "h3",
+                    { className: "centered" },
+                    "Background Commands"
+                ),
+                this.renderBackgroundCommands()
+            ),
             React.createElement(
                 "h3",
                 { className: "centered" },
@@ -17793,7 +18048,8 @@ function mapStateToProps(state) {
 
         submissions: state.get("submissions"),
         grading_stats: state.get("grading_stats"),
-        timing_stats: state.get("timing_stats")
+        timing_stats: state.get("timing_stats"),
+        background_commands: state.get("background_commands")
     };
 }
 
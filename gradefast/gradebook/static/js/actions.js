@@ -7,10 +7,13 @@ const WAITING_FOR_USER_TO_GET_THEIR_ASS_MOVING = "WAIT_FOR_USER_TO_GET_THEIR_ASS
 const SET_DATA_KEY = "SET_DATA_KEY";
 const LOADING_SUBMISSION = "LOADING_SUBMISSION";
 const INIT_SUBMISSION = "INIT_SUBMISSION";
+const PATCH_SUBMISSION = "PATCH_SUBMISSION";
 const SHOW_SUBMISSIONS = "SHOW_SUBMISSIONS";
 const HIDE_SUBMISSIONS = "HIDE_SUBMISSIONS";
 const SET_SUBMISSIONS = "SET_SUBMISSIONS";
+const PATCH_SUBMISSIONS = "PATCH_SUBMISSIONS";
 const SET_STATS = "SET_STATS";
+const SET_BACKGROUND_COMMANDS = "SET_BACKGROUND_COMMANDS";
 
 // These string values are also recognized by the GradeBook server
 // (see GradeBook::_parse_action in gradebook.py)
@@ -81,6 +84,18 @@ export const actions = {
         };
     },
 
+    patchSubmission(submission_id, fields, items) {
+        return {
+            type: PATCH_SUBMISSION,
+
+            submission_id, fields,
+            items: items.map((item) => ({
+                path: item.path,
+                changes: Immutable.fromJS(item.changes)
+            }))
+        };
+    },
+
     showSubmissions() {
         return (dispatch) => {
             // Propagate the action locally
@@ -108,6 +123,13 @@ export const actions = {
         };
     },
 
+    patchSubmissions(list) {
+        return {
+            type: PATCH_SUBMISSIONS,
+            submissions: list.map(l => Immutable.fromJS(l))
+        };
+    },
+
     setStats(grading_stats, timing_stats) {
         return {
             type: SET_STATS,
@@ -116,6 +138,13 @@ export const actions = {
         };
     },
 
+    setBackgroundCommands(background_commands) {
+        return {
+            type: SET_BACKGROUND_COMMANDS,
+            background_commands: Immutable.fromJS(background_commands)
+        };
+    },
+
     setLate(is_late) {
         return dispatchActionAndTellServer({
             type: SET_LATE,
@@ -255,6 +284,8 @@ const initialState = Immutable.Map({
     "grading_stats": Immutable.Map(),
     "timing_stats": Immutable.Map(),
 
+    "background_commands": Immutable.List(),
+
     "submission_id": null,
     "submission_is_late": false,
     "submission_overall_comments": "",
@@ -304,6 +335,24 @@ export function app(state, action) {
             }
             break;
 
+        case PATCH_SUBMISSION:
+            if (action.submission_id === state.get("submission_id")) {
+                // Top-level fields are stored with a "submission_" prefix
+                Object.keys(action.fields).forEach((key) => {
+                    state = state.set("submission_" + key, action.fields[key]);
+                });
+                action.items.forEach((item) => {
+                    // Path [0, 2] is at ["submission_grades", 0, "children", 2]
+                    const keyPath = ["submission_grades"];
+                    item.path.forEach((index, i) => {
+                        if (i > 0) keyPath.push("children");
+                        keyPath.push(index);
+                    });
+                    state = state.updateIn(keyPath, (gradeState) => gradeState.merge(item.changes));
+                });
+            }
+            break;
+
         case SHOW_SUBMISSIONS:
             state = state.set("submissions_visible", true);
             break;
@@ -316,6 +365,12 @@ export function app(state, action) {
             state = state.set("submissions", action.submissions);
             break;
 
+        case PATCH_SUBMISSIONS:
+            action.submissions.forEach((submission) => {
+                state = state.setIn(["submissions", submission.get("id")], submission);
+            });
+            break;
+
         case SET_STATS:
             state = state.merge({
                 "grading_stats": action.grading_stats,
@@ -323,6 +378,10 @@ export function app(state, action) {
             });
             break;
 
+        case SET_BACKGROUND_COMMANDS:
+            state = state.set("background_commands", action.background_commands);
+            break;
+
         case SET_LATE:
             state = state.set("submission_is_late", action.is_late);
             break;
@@ -130,6 +130,40 @@ const SubmissionList = React.createClass({
         );
     },
 
+    renderBackgroundCommands() {
+        return (
+            <table className="submission-list"><tbody>
+                {
+                    this.props.background_commands.map((job) => {
+                        const elapsed_time = job.get("elapsed_time");
+                        return (
+                            <tr key={job.get("job_id")} title={job.get("error") || ""}>
+                                <td>
+                                    ({job.get("submission_id")})
+                                </td>
+                                <td>
+                                    <strong>{job.get("submission_name")}</strong>
+                                </td>
+                                <td>
+                                    {job.get("name")}
+                                </td>
+                                <td>
+                                    {job.get("status")}
+                                </td>
+                                <td title={elapsed_time === null ? "" : elapsed_time + " sec"}>
+                                    {elapsed_time === null ? "" : formatTime(elapsed_time)}
+                                </td>
+                                <td>
+                                    {job.get("output_size")} characters of output
+                                </td>
+                            </tr>
+                        );
+                    })
+                }
+            </tbody></table>
+        );
+    },
+
     render() {
         return (
             <div>
@@ -199,6 +233,13 @@ const SubmissionList = React.createClass({
                     </tbody>
                 </table>
 
+                {this.props.background_commands.size === 0 ? undefined :
+                    <div>
+                        <h3 className="centered">Background Commands</h3>
+                        {this.renderBackgroundCommands()}
+                    </div>
+                }
+
                 <h3 className="centered">Grade Statistics</h3>
                 {this.renderStats(this.props.grading_stats, formatPercent, "%")}
 
@@ -215,7 +256,8 @@ function mapStateToProps(state) {
 
         submissions: state.get("submissions"),
         grading_stats: state.get("grading_stats"),
-        timing_stats: state.get("timing_stats")
+        timing_stats: state.get("timing_stats"),
+        background_commands: state.get("background_commands")
     };
 }
 
@@ -6,6 +6,26 @@ let eventSource = null;
 let client_seq = 0;
 let update_key = null;
 
+// The submission (and version of its grade) that we last got a full SUBMISSION_UPDATED for, which
+// any patches we get are applied on top of
+let submission_version = {
+    submission_id: null,
+    version: null,
+    resync_pending: false
+};
+
+// The version of the submission list that we have (see NEW_SUBMISSIONS and SUBMISSIONS_PATCH)
+let submission_list_version = {
+    version: null,
+    resync_pending: false
+};
+
+// Fields that we change locally before telling the server (see dispatchActionAndTellServer in
+// actions.js). These are skipped in outdated patches from our own actions, so they don't clobber
+// anything newer (like what the user is in the middle of typing).
+const LOCAL_FIELDS = ["is_late", "overall_comments"];
+const LOCAL_ITEM_FIELDS = ["enabled", "score", "comments"];
+
 export function sendAuthRequest() {
     let device = navigator.userAgent;
     if (device.startsWith("Mozilla/")) {
@@ -17,12 +37,16 @@ export function sendAuthRequest() {
     });
 }
 
-function authKeysReceived(new_data_key, new_update_key, initial_submission_list, initial_submission_id, is_done) {
+function authKeysReceived(new_data_key, new_update_key, initial_submission_list, initial_submission_list_version, initial_submission_id, is_done) {
     console.log("Received auth keys");
     update_key = new_update_key;
     store.dispatch(actions.setDataKey(new_data_key));
 
     // Now that we are authenticated, move on from the "Loading" screen
+    submission_list_version = {
+        version: initial_submission_list_version,
+        resync_pending: false
+    };
     store.dispatch(actions.setSubmissions(initial_submission_list));
     if (is_done) {
         // Show the submission list and statistics
@@ -44,6 +68,47 @@ export function sendUpdate(submission_id, action = {}) {
     });
 }
 
+function sendResyncRequest(submission_id) {
+    submission_version.resync_pending = true;
+    post(CONFIG.BASE + "_resync", {
+        client_id: CONFIG.CLIENT_ID,
+        submission_id
+    });
+}
+
+function sendSubmissionListResyncRequest() {
+    submission_list_version.resync_pending = true;
+    post(CONFIG.BASE + "_resync", {
+        client_id: CONFIG.CLIENT_ID,
+        submission_list: true
+    });
+}
+
+function sendFullResyncRequest() {
+    // Ask for the submission list, the submission we're showing (if any), and anything else that
+    // we might have missed (like moving on to a different submission)
+    const params = {
+        client_id: CONFIG.CLIENT_ID,
+        submission_list: true,
+        state: true
+    };
+    submission_list_version.resync_pending = true;
+    const submission_id = store.getState().get("submission_id");
+    if (typeof submission_id === "number") {
+        submission_version.resync_pending = true;
+        params.submission_id = submission_id;
+    }
+    post(CONFIG.BASE + "_resync", params);
+}
+
+function withoutKeys(obj, keys) {
+    const result = {};
+    Object.keys(obj).forEach((key) => {
+        if (keys.indexOf(key) === -1) result[key] = obj[key];
+    });
+    return result;
+}
+
 export function sendRefreshStatsRequest() {
     post(CONFIG.BASE + "_refresh_stats", {
         client_id: CONFIG.CLIENT_ID
@@ -53,21 +118,39 @@ export function sendRefreshStatsRequest() {
 const updateTypeHandlers = {
     NEW_SUBMISSIONS(data) {
         // Update our list of submissions
+        submission_list_version = {
+            version: data.version,
+            resync_pending: false
+        };
         store.dispatch(actions.setSubmissions(data.submissions));
     },
 
+    SUBMISSIONS_PATCH(data) {
+        // Update the submissions that changed in our list of submissions
+        if (submission_list_version.resync_pending) return;
+        if (data.base_version !== submission_list_version.version) {
+            // We missed something, so ask for the whole thing
+            console.warn("Missed SUBMISSIONS_PATCH (have version", submission_list_version.version,
+                "but got patch from version", data.base_version + "); resyncing");
+            sendSubmissionListResyncRequest();
+            return;
+        }
+        submission_list_version.version = data.version;
+        store.dispatch(actions.patchSubmissions(data.submissions));
+    },
+
     SUBMISSION_STARTED(data) {
         // Tell the forces at large to go to this submission
         store.dispatch(actions.goToSubmission(data.submission_id));
     },
 
     SUBMISSION_UPDATED(data) {
-        // Should we ignore this update?
-        // Only if it came from us, and is already outdated
+        // Is this update outdated?
+        // Only if it came from us, and we've done something since then
+        let outdated = false;
         if (data.originating_client_id === CONFIG.CLIENT_ID) {
             if (data.originating_client_seq < client_seq) {
-                // This update is outdated
-                return;
+                outdated = true;
             } else if (data.originating_client_seq > client_seq) {
                 // Umm, somehow someone has been sending events as us...
                 // (or it's our future selves -- BUT WHERE ARE ALL THE TIME TRAVELLERS)
@@ -79,15 +162,55 @@ const updateTypeHandlers = {
             }
         }
 
-        store.dispatch(actions.initSubmission(
-            data.submission_id,
-            data.is_late,
-            data.overall_comments,
-            data.overall_comments_html,
-            data.points_earned,
-            data.points_possible,
-            data.grades
-        ));
+        if (data.full) {
+            // We only care about the submission that we're showing
+            if (data.submission_id !== store.getState().get("submission_id")) return;
+
+            submission_version = {
+                submission_id: data.submission_id,
+                version: data.version,
+                resync_pending: false
+            };
+            // Outdated full updates are still useful if we don't have anything for this submission
+            // yet (but otherwise, they'd overwrite what we've done since then)
+            if (outdated && !store.getState().get("loading")) return;
+
+            store.dispatch(actions.initSubmission(
+                data.submission_id,
+                data.is_late,
+                data.overall_comments,
+                data.overall_comments_html,
+                data.points_earned,
+                data.points_possible,
+                data.grades
+            ));
+            return;
+        }
+
+        // It's a patch. If we haven't gotten the full submission yet, we'll get a full update soon
+        // (see goToSubmission in actions.js), so ignore it until then.
+        if (data.submission_id !== submission_version.submission_id) return;
+        if (submission_version.resync_pending) return;
+        if (data.base_version !== submission_version.version) {
+            // We missed something, so ask for the whole thing
+            console.warn("Missed SUBMISSION_UPDATED for submission", data.submission_id,
+                "(have version", submission_version.version, "but got patch from version",
+                data.base_version + "); resyncing");
+            sendResyncRequest(data.submission_id);
+            return;
+        }
+        submission_version.version = data.version;
+
+        let fields = data.fields;
+        let items = data.items;
+        if (outdated) {
+            fields = withoutKeys(fields, LOCAL_FIELDS);
+            items = items.map((item) => ({
+                path: item.path,
+                changes: withoutKeys(item.changes, LOCAL_ITEM_FIELDS)
+            }));
+        }
+        store.dispatch(actions.patchSubmission(data.submission_id, fields, items));
     },
 
     END_OF_SUBMISSIONS(data) {
@@ -97,6 +220,16 @@ const updateTypeHandlers = {
 
     UPDATED_STATS(data) {
         store.dispatch(actions.setStats(data.grading_stats, data.timing_stats));
+    },
+
+    BACKGROUND_COMMANDS(data) {
+        store.dispatch(actions.setBackgroundCommands(data.background_commands));
+    },
+
+    RESYNC(data) {
+        // We fell too far behind, so the server dropped the updates that were waiting for us
+        console.warn("Missed too many updates; resyncing everything");
+        sendFullResyncRequest();
     }
 };
 
@@ -130,6 +263,7 @@ export function initEventSource(onReady) {
                 jsonData.data_key,
                 jsonData.update_key,
                 jsonData.initial_submission_list,
+                jsonData.initial_submission_list_version,
                 jsonData.initial_submission_id,
                 jsonData.is_done);
         } else {
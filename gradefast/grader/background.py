@@ -0,0 +1,258 @@
+"""
+GradeFast Background Command Manager - Runs background commands without holding up the grader.
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+import concurrent.futures
+import itertools
+import threading
+import time
+from typing import Dict, List, Mapping, Optional
+
+from pyprovide import inject
+
+from gradefast import events
+from gradefast.hosts import BackgroundCommand, CommandStartError, Host
+from gradefast.loggingwrapper import get_logger
+from gradefast.models import CommandItem, Path, Settings
+from gradefast.outputbuffer import OutputBuffer
+
+_logger = get_logger("grader.background")
+
+
+class BackgroundJob:
+    """
+    A background command that was submitted to the BackgroundCommandManager, along with its
+    current status.
+    """
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+
+    _job_ids = itertools.count(1)
+
+    def __init__(self, submission_id: int, submission_name: str, command: CommandItem, path: Path,
+                 environment: Mapping[str, str]) -> None:
+        self.job_id = next(BackgroundJob._job_ids)
+        self.submission_id = submission_id
+        self.submission_name = submission_name
+        self.command = command
+        self.path = path
+        self.environment = environment
+
+        self.status = BackgroundJob.QUEUED
+        self.start_time = None  # type: Optional[float]
+        self.end_time = None  # type: Optional[float]
+        self.background_command = None  # type: Optional[BackgroundCommand]
+        self.error = None  # type: Optional[str]
+
+    def is_done(self) -> bool:
+        return self.status in (BackgroundJob.FINISHED, BackgroundJob.FAILED)
+
+    def get_elapsed_time(self) -> Optional[float]:
+        """
+        Get how long the command has been running for (or how long it ran for, if it's done), in
+        seconds.
+        """
+        if self.start_time is None:
+            return None
+        return (self.end_time or time.time()) - self.start_time
+
+    def get_output_size(self) -> int:
+        """
+        Get the number of characters of output that the command has printed so far.
+        """
+        if self.background_command is None:
+            return 0
+        return self.background_command.get_output_size()
+
+    def get_output(self) -> Optional[OutputBuffer]:
+        """
+        Get the output from the command, once it's done.
+        """
+        if self.background_command is None or not self.is_done():
+            return None
+        return self.background_command.get_output()
+
+    def __str__(self) -> str:
+        return "{} ({})".format(self.command.name, self.submission_name)
+
+    def to_json(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "submission_id": self.submission_id,
+            "submission_name": self.submission_name,
+            "name": self.command.name,
+            "status": self.status,
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "elapsed_time": self.get_elapsed_time(),
+            "output_size": self.get_output_size(),
+            "error": self.error
+        }
+
+
+class BackgroundCommandManager:
+    """
+    Runs background commands in a bounded pool of worker threads, so only a few of them run at the
+    same time (the rest are queued until a worker is free). The status of every command is
+    available while it runs, and GradeBook clients are kept updated through
+    BackgroundCommandsUpdatedEvents.
+
+    Finished commands are collected with claim_finished() so their results can be added to their
+    submissions' logs right away, instead of waiting until the end of the grading session.
+    """
+
+    # How often to send out status updates while commands are running (in seconds), so the
+    # elapsed times and output sizes stay fresh
+    STATUS_INTERVAL = 2
+
+    @inject()
+    def __init__(self, host: Host, settings: Settings,
+                 event_manager: events.EventManager) -> None:
+        self.host = host
+        self.settings = settings
+        self.event_manager = event_manager
+
+        # Held while changing the list of jobs or the status of any job
+        self._lock = threading.Lock()
+        self._jobs = []  # type: List[BackgroundJob]
+        self._unclaimed_jobs = []  # type: List[BackgroundJob]
+        self._futures = {}  # type: Dict[int, concurrent.futures.Future]
+        # Whether stop_all has been called (so any command that's still starting is stopped)
+        self._stopping = False
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, settings.background_workers))
+        self._status_thread = None  # type: Optional[threading.Thread]
+
+    def submit(self, submission_id: int, submission_name: str, command: CommandItem, path: Path,
+               environment: Mapping[str, str]) -> BackgroundJob:
+        """
+        Queue a background command to be run as soon as there's a free worker.
+
+        :param submission_id: The ID of the submission that the command is being run for.
+        :param submission_name: The name of the submission.
+        :param command: The command to run.
+        :param path: The working directory for the command.
+        :param environment: A dictionary of environment variables for the command.
+        :return: The BackgroundJob tracking the command.
+        """
+        job = BackgroundJob(submission_id, submission_name, command, path, environment)
+        _logger.debug("Queueing background command {}", job)
+        with self._lock:
+            self._jobs.append(job)
+            self._futures[job.job_id] = self._executor.submit(self._run_job, job)
+            if self._status_thread is None:
+                self._status_thread = threading.Thread(name="BackgroundStatusTh",
+                                                       target=self._status_thread_target,
+                                                       daemon=True)
+                self._status_thread.start()
+        self._status_changed()
+        return job
+
+    def _run_job(self, job: BackgroundJob) -> None:
+        with self._lock:
+            job.start_time = time.time()
+        error = None  # type: Optional[str]
+        try:
+            background_command = self.host.start_background_command(
+                job.command.command, job.path, job.environment, job.command.stdin,
+                limits=job.command.limits)
+            with self._lock:
+                job.background_command = background_command
+                job.status = BackgroundJob.RUNNING
+                if self._stopping:
+                    # stop_all was called while the command was starting
+                    background_command.stop()
+            self._status_changed()
+            background_command.wait()
+            error = background_command.get_error()
+        except CommandStartError as e:
+            error = "Error starting background command: {}".format(e.message)
+        except:
+            _logger.exception("Error running background command {}", job)
+            error = "Error running background command"
+
+        with self._lock:
+            job.error = error
+            job.end_time = time.time()
+            job.status = BackgroundJob.FAILED if error else BackgroundJob.FINISHED
+            self._unclaimed_jobs.append(job)
+        _logger.debug("Background command {} {}", job, job.status)
+        self._status_changed()
+
+    def _status_changed(self) -> None:
+        self.event_manager.dispatch_event(events.BackgroundCommandsUpdatedEvent())
+
+    def _status_thread_target(self) -> None:
+        while True:
+            time.sleep(BackgroundCommandManager.STATUS_INTERVAL)
+            with self._lock:
+                running = any(job.status == BackgroundJob.RUNNING for job in self._jobs)
+            if running:
+                self._status_changed()
+
+    def get_jobs(self) -> List[BackgroundJob]:
+        """
+        Get all the background commands that were submitted, in order.
+        """
+        with self._lock:
+            return list(self._jobs)
+
+    def get_status(self) -> List[dict]:
+        """
+        Get the status of every background command (as JSON-encodable dicts).
+        """
+        with self._lock:
+            return [job.to_json() for job in self._jobs]
+
+    def has_pending_jobs(self) -> bool:
+        """
+        Determine whether any background commands are still queued or running.
+        """
+        with self._lock:
+            return any(not job.is_done() for job in self._jobs)
+
+    def claim_finished(self) -> List[BackgroundJob]:
+        """
+        Get the background commands that finished since the last time this was called.
+        """
+        with self._lock:
+            jobs = self._unclaimed_jobs
+            self._unclaimed_jobs = []
+        return jobs
+
+    def wait_for_next(self) -> None:
+        """
+        Wait until at least one more background command finishes (or return right away if there's
+        nothing left running).
+        """
+        with self._lock:
+            futures = [self._futures[job.job_id] for job in self._jobs if not job.is_done()]
+        if futures:
+            concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+
+    def stop_all(self) -> None:
+        """
+        Stop any background commands that are still running, and drop the ones that are queued
+        (they're still passed to claim_finished, so they end up in their submissions' logs).
+        """
+        with self._lock:
+            self._stopping = True
+            for job in self._jobs:
+                if self._futures[job.job_id].cancel():
+                    job.status = BackgroundJob.FAILED
+                    job.error = "Background command never started"
+                    self._unclaimed_jobs.append(job)
+                elif job.background_command is not None and not job.is_done():
+                    job.background_command.stop()
+        self._status_changed()
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,239 @@
+"""
+GradeFast Batch Grader - Runs commands on all the submissions at once, without any interaction.
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+import concurrent.futures
+from typing import Dict, List, Type
+
+from iochannels import Channel, HTMLMemoryLog, MemoryLog, Msg
+from pyprovide import inject
+
+from gradefast.buildcache import BuildCache, run_command_captured_cached
+from gradefast.grader.diffing import DiffReference, get_diff_engine
+from gradefast.grader.grader import DiffReferenceCache, DiffReferenceError, apply_diff_score, \
+    get_diff_reference, get_scoring_diff, print_command_header, print_command_set_footer, \
+    print_command_set_header, print_diff
+from gradefast.grader.prefetch import CommandVisitor, walk_commands_unattended
+from gradefast.hosts import CommandResult, CommandStartError, Host, LocalHost
+from gradefast.loggingwrapper import get_logger
+from gradefast.models import Command, CommandItem, CommandSet, Path, Settings
+from gradefast.submissions import Submission, SubmissionManager
+
+_logger = get_logger("grader.batch")
+
+# Each batch worker process keeps its own cache of diff references, which is shared by all the
+# submissions that it runs
+_diff_reference_cache = DiffReferenceCache()
+
+
+class BatchStep:
+    """
+    Something that happened while running the commands for a submission in a batch worker
+    process. These are sent back to the main process (so everything in them must be picklable),
+    where they're printed into the submission's logs.
+    """
+
+    COMMAND_SET_START = "command set start"
+    COMMAND_SET_END = "command set end"
+    COMMAND = "command"
+    STOPPED = "stopped"
+
+    __slots__ = ("kind", "command", "result", "error", "diff_reference", "diff_error")
+
+    def __init__(self, kind: str, command: Command = None, result: CommandResult = None,
+                 error: str = None) -> None:
+        self.kind = kind
+        self.command = command
+        self.result = result
+        self.error = error
+        self.diff_reference = None  # type: DiffReference
+        self.diff_error = None  # type: str
+
+
+class _BatchVisitor(CommandVisitor):
+    def __init__(self, host: Host, settings: Settings, diff_reference_cache: DiffReferenceCache,
+                 build_cache: BuildCache) -> None:
+        self.host = host
+        self.settings = settings
+        self.diff_reference_cache = diff_reference_cache
+        self.build_cache = build_cache
+        self.steps = []  # type: List[BatchStep]
+
+    def visit_command(self, command: CommandItem, path: Path, environment: Dict[str, str]) -> bool:
+        step = BatchStep(BatchStep.COMMAND, command)
+        self.steps.append(step)
+
+        if command.is_passthrough:
+            step.error = "Passthrough commands can't be run in batch mode"
+            return True
+
+        if command.diff:
+            try:
+                step.diff_reference = get_diff_reference(self.host, self.settings, command.diff,
+                                                         path, environment,
+                                                         self.diff_reference_cache)
+            except DiffReferenceError as e:
+                step.diff_error = e.message
+
+        # Background commands are just run in order along with everything else, since there's
+        # nobody waiting on them
+        try:
+            step.result = run_command_captured_cached(self.host, self.build_cache, command, path,
+                                                      environment)
+        except CommandStartError as e:
+            step.error = "Error starting command: {}".format(e.message)
+            return True
+
+        if step.result.get_error():
+            step.error = "Error running command: {}".format(step.result.get_error())
+        return True
+
+    def enter_command_set(self, command_set: CommandSet, path: Path) -> None:
+        self.steps.append(BatchStep(BatchStep.COMMAND_SET_START, command_set))
+
+    def exit_command_set(self, command_set: CommandSet) -> None:
+        self.steps.append(BatchStep(BatchStep.COMMAND_SET_END, command_set))
+
+    def stopped(self, reason: str) -> None:
+        self.steps.append(BatchStep(BatchStep.STOPPED, error=reason))
+
+
+def run_batch_submission(host_class: Type[LocalHost], settings: Settings, submission_name: str,
+                         submission_path: Path) -> List[BatchStep]:
+    """
+    Run all the commands on a submission. This is run in a batch worker process, so it must stay
+    at the module level (so it can be pickled).
+
+    :param host_class: The LocalHost class to use to run the commands.
+    :param settings: The GradeFast settings.
+    :param submission_name: The name of the submission.
+    :param submission_path: The path to the root of the submission.
+    :return: A list of everything that happened, to be passed to BatchGrader.record_steps.
+    """
+    # Batch workers never interact with the user, so the host doesn't get a channel
+    host = host_class(None, settings)
+    visitor = _BatchVisitor(host, settings, _diff_reference_cache, BuildCache(settings))
+    walk_commands_unattended(host, settings.commands, submission_path, settings.base_env or {},
+                             submission_name, visitor)
+    # The main process is responsible for the output's spill files from here on
+    for step in visitor.steps:
+        if step.result is not None:
+            step.result.output.transfer_spill_file()
+    return visitor.steps
+
+
+class BatchGrader:
+    """
+    Runs the commands on all the submissions without prompting the user, spreading the submissions
+    out over a pool of worker processes. The output is recorded in each submission's logs (and,
+    through the SubmissionManager, in the save file), so a later interactive session starts with
+    everything already run.
+
+    Since nobody is around to answer questions, command sets with "confirm folder" use the folder
+    that was found, and a submission is stopped early if a folder is ambiguous.
+    """
+
+    @inject()
+    def __init__(self, channel: Channel, host: Host, settings: Settings,
+                 submission_manager: SubmissionManager) -> None:
+        self.channel = channel
+        self.host = host
+        self.settings = settings
+        self.submission_manager = submission_manager
+
+    def run_commands(self, jobs: int) -> None:
+        """
+        Run the commands on every submission that doesn't already have logs from a previous run.
+
+        :param jobs: The maximum number of worker processes to use.
+        """
+        if not isinstance(self.host, LocalHost):
+            raise TypeError("Batch mode is only supported for local hosts")
+
+        submissions = []  # type: List[Submission]
+        for summary in self.submission_manager.get_all_submission_summaries():
+            if summary.has_logs():
+                continue
+            # Submissions whose folders are gone are dropped instead of run
+            if self.submission_manager.drop_submission_if_missing(summary.get_id()):
+                continue
+            submissions.append(self.submission_manager.get_submission(summary.get_id()))
+        if not submissions:
+            self.channel.status("All submissions have already been run")
+            return
+
+        self.channel.print()
+        self.channel.status("Running commands on {} submissions with {} workers",
+                            len(submissions), jobs)
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(run_batch_submission, type(self.host), self.settings,
+                                submission.get_name(), submission.get_path()): submission
+                for submission in submissions
+            }
+            for index, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+                submission = futures[future]
+                try:
+                    steps = future.result()
+                except:
+                    _logger.exception("Error running commands for submission {}", submission)
+                    self.channel.error("Error running commands for submission {}", submission)
+                    continue
+
+                self.record_steps(submission, steps)
+                self.channel.print()
+                self.channel.output(Msg().status("[{}/{}]", index, len(futures))
+                                         .print("Finished {}", submission))
+
+    def record_steps(self, submission: Submission, steps: List[BatchStep]) -> None:
+        """
+        Print the results from a batch worker, adding them to the logs for a submission.
+        """
+        html_log = HTMLMemoryLog()
+        text_log = MemoryLog()
+        self.channel.add_delegate(html_log, text_log)
+
+        for step in steps:
+            if step.kind == BatchStep.COMMAND_SET_START:
+                print_command_set_header(self.channel, step.command)
+            elif step.kind == BatchStep.COMMAND_SET_END:
+                print_command_set_footer(self.channel, step.command)
+            elif step.kind == BatchStep.STOPPED:
+                self.channel.print()
+                self.channel.error("{}", step.error)
+                self.channel.error("Skipping the rest of this submission")
+            else:
+                self._print_command_step(submission, step)
+
+        submission.add_logs(html_log, text_log)
+        submission.close_logs()
+
+    def _print_command_step(self, submission: Submission, step: BatchStep) -> None:
+        print_command_header(self.channel, submission.get_name(), step.command)
+        self.channel.print("")
+        if step.diff_error:
+            self.channel.error("{}", step.diff_error)
+        if step.result is not None:
+            self.channel.output(Msg(end="").print("{}", step.result.output.get_summary()))
+            self.channel.print()
+        if step.error:
+            self.channel.print()
+            self.channel.error("{}", step.error)
+        elif step.diff_reference is not None:
+            self.channel.print()
+            self.channel.status("DIFF with reference from {}", step.diff_reference.source)
+            self.channel.print()
+            engine = get_diff_engine(self.settings.diff_engine)
+            opcodes = print_diff(self.channel, step.result.output, step.diff_reference,
+                                 step.command.diff, engine)
+            if step.command.diff.scoring:
+                self.channel.print()
+                opcodes, exact = get_scoring_diff(step.result.output, step.diff_reference,
+                                                  step.command.diff, engine, opcodes)
+                apply_diff_score(self.channel, submission.get_grade(), step.command.diff.scoring,
+                                 opcodes, exact)
@@ -0,0 +1,438 @@
+"""
+GradeFast Diffing - Compares the output of commands to reference content, line by line.
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+import difflib
+import re
+from typing import Dict, Hashable, List, Optional, Sequence, Tuple, Type
+
+from gradefast.models import CommandItem
+
+# A block of lines that match in both sequences: (start in a, start in b, length)
+MatchingBlock = Tuple[int, int, int]
+
+# An operation to turn one sequence into another, like difflib.SequenceMatcher's opcodes:
+# (tag, a_start, a_end, b_start, b_end), where the tag is "equal", "delete", "insert", or "replace"
+Opcode = Tuple[str, int, int, int, int]
+
+
+class DiffEngine:
+    """
+    Base class for algorithms that find the matching blocks between 2 sequences (of anything
+    hashable, but usually ints; see diff_lines).
+    """
+
+    # Whether the last diff found as many matching items as possible (False if it had to settle for
+    # a longer diff to save time, in which case its matching blocks can't be used to score it)
+    exact = True
+
+    def get_matching_blocks(self, a: Sequence[Hashable],
+                            b: Sequence[Hashable]) -> List[MatchingBlock]:
+        """
+        Find the blocks of items that are in both sequences (in order, not overlapping, and not
+        including any empty blocks).
+        """
+        raise NotImplementedError()
+
+    def get_opcodes(self, a: Sequence[Hashable], b: Sequence[Hashable]) -> List[Opcode]:
+        """
+        Get the operations to turn "a" into "b" (based on get_matching_blocks).
+        """
+        opcodes = []  # type: List[Opcode]
+        i = j = 0
+        for a_start, b_start, size in self.get_matching_blocks(a, b) + [(len(a), len(b), 0)]:
+            if i < a_start and j < b_start:
+                opcodes.append(("replace", i, a_start, j, b_start))
+            elif i < a_start:
+                opcodes.append(("delete", i, a_start, j, b_start))
+            elif j < b_start:
+                opcodes.append(("insert", i, a_start, j, b_start))
+            if size:
+                opcodes.append(("equal", a_start, a_start + size, b_start, b_start + size))
+            i = a_start + size
+            j = b_start + size
+        return opcodes
+
+
+class DifflibDiffEngine(DiffEngine):
+    """
+    Diff engine using Python's difflib.SequenceMatcher. This can be very slow for long sequences,
+    and it doesn't always find as many matching items as possible (so it's never exact).
+    """
+
+    exact = False
+
+    def get_matching_blocks(self, a: Sequence[Hashable],
+                            b: Sequence[Hashable]) -> List[MatchingBlock]:
+        matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+        return [block for block in matcher.get_matching_blocks() if block[2]]
+
+
+class MyersDiffEngine(DiffEngine):
+    """
+    Diff engine using Myers' O(ND) algorithm ("An O(ND) Difference Algorithm and Its Variations",
+    1986), in its linear-space form: find the middle of the shortest edit path from both ends at
+    once, then split there and repeat on each half.
+
+    If a section of the sequences would take more than "max_cost" steps (i.e. the sequences are
+    very long and have lots of changes), the search stops early and the section is split at the
+    furthest point that either search reached instead (like GNU diff does when a diff is "too
+    expensive"). The diff might not be the shortest one (see "exact"), but it never takes forever.
+    """
+
+    MAX_COST = 1024
+
+    def __init__(self, max_cost: int = None) -> None:
+        self.max_cost = max_cost if max_cost is not None else MyersDiffEngine.MAX_COST
+
+    def get_matching_blocks(self, a: Sequence[Hashable],
+                            b: Sequence[Hashable]) -> List[MatchingBlock]:
+        self.exact = True
+        blocks = []  # type: List[MatchingBlock]
+        self._diff_range(a, b, 0, len(a), 0, len(b), blocks)
+        return _merge_blocks(blocks)
+
+    def _diff_range(self, a: Sequence[Hashable], b: Sequence[Hashable], a_lo: int, a_hi: int,
+                    b_lo: int, b_hi: int, blocks: List[MatchingBlock]) -> None:
+        # Use a stack instead of recursion, and make sure the blocks come out in order
+        stack = [(a_lo, a_hi, b_lo, b_hi)]
+        while stack:
+            a_lo, a_hi, b_lo, b_hi = stack.pop()
+
+            # Strip off the common prefix and suffix first (cheap, and very common)
+            prefix = 0
+            while a_lo + prefix < a_hi and b_lo + prefix < b_hi and \
+                    a[a_lo + prefix] == b[b_lo + prefix]:
+                prefix += 1
+            if prefix:
+                blocks.append((a_lo, b_lo, prefix))
+                a_lo += prefix
+                b_lo += prefix
+
+            suffix = 0
+            while a_lo < a_hi - suffix and b_lo < b_hi - suffix and \
+                    a[a_hi - suffix - 1] == b[b_hi - suffix - 1]:
+                suffix += 1
+            if suffix:
+                a_hi -= suffix
+                b_hi -= suffix
+
+            if a_lo < a_hi and b_lo < b_hi:
+                split = self._find_middle(a, b, a_lo, a_hi, b_lo, b_hi)
+                if split is not None:
+                    x, y = split
+                    # Pushed in reverse order (so the first half is handled first), with the
+                    # suffix as its own (already matched) section after both halves
+                    if suffix:
+                        stack.append((a_hi, a_hi + suffix, b_hi, b_hi + suffix))
+                    stack.append((x, a_hi, y, b_hi))
+                    stack.append((a_lo, x, b_lo, y))
+                    continue
+
+            if suffix:
+                blocks.append((a_hi, b_hi, suffix))
+
+    def _find_middle(self, a: Sequence[Hashable], b: Sequence[Hashable], a_lo: int, a_hi: int,
+                     b_lo: int, b_hi: int) -> Optional[Tuple[int, int]]:
+        """
+        Find a point (x, y) on a shortest edit path through a[a_lo:a_hi] and b[b_lo:b_hi], by
+        searching forward from the start and backward from the end until the paths overlap. If
+        that takes more than "max_cost" steps, settle for the point on an edit path that's
+        furthest from either end.
+
+        :return: The point to split the sequences at, or None if there's nothing in common (or no
+            progress was made before hitting "max_cost").
+        """
+        n = a_hi - a_lo
+        m = b_hi - b_lo
+        if n * m > self.max_cost and set(a[a_lo:a_hi]).isdisjoint(b[b_lo:b_hi]):
+            # Don't bother searching if there's nothing in common
+            return None
+
+        max_d = min((n + m + 1) // 2, self.max_cost)
+        offset = max_d + 1
+        forward = [-1] * (2 * offset + 1)
+        backward = [-1] * (2 * offset + 1)
+        forward[offset + 1] = 0
+        backward[offset + 1] = 0
+        delta = n - m
+        # If the total length is odd, then the forward path will be the one to hit the backward
+        # path (otherwise, it's the other way around)
+        front = delta % 2 != 0
+
+        # How much to trim off the ends of the range of diagonals (once the paths run off the edge
+        # of the edit graph)
+        forward_start = forward_end = backward_start = backward_end = 0
+
+        for d in range(max_d):
+            for k in range(-d + forward_start, d + 1 - forward_end, 2):
+                if k == -d or (k != d and forward[offset + k - 1] < forward[offset + k + 1]):
+                    x = forward[offset + k + 1]
+                else:
+                    x = forward[offset + k - 1] + 1
+                y = x - k
+                while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                    x += 1
+                    y += 1
+                forward[offset + k] = x
+                if x > n:
+                    forward_end += 2
+                elif y > m:
+                    forward_start += 2
+                elif front:
+                    backward_k = delta - k
+                    if -d < backward_k < d and backward[offset + backward_k] != -1 and \
+                            x >= n - backward[offset + backward_k]:
+                        return a_lo + x, b_lo + y
+
+            for k in range(-d + backward_start, d + 1 - backward_end, 2):
+                if k == -d or (k != d and backward[offset + k - 1] < backward[offset + k + 1]):
+                    x = backward[offset + k + 1]
+                else:
+                    x = backward[offset + k - 1] + 1
+                y = x - k
+                while x < n and y < m and a[a_hi - x - 1] == b[b_hi - y - 1]:
+                    x += 1
+                    y += 1
+                backward[offset + k] = x
+                if x > n:
+                    backward_end += 2
+                elif y > m:
+                    backward_start += 2
+                elif not front:
+                    forward_k = delta - k
+                    if -d <= forward_k <= d and forward[offset + forward_k] != -1:
+                        forward_x = forward[offset + forward_k]
+                        if forward_x >= n - x:
+                            return a_lo + forward_x, b_lo + forward_x - forward_k
+
+        if max_d == (n + m + 1) // 2:
+            # The paths would have met by now if there was anything in common
+            return None
+
+        # Too expensive; split at whichever point (still in the edit graph) is furthest along its
+        # path, so at least the part before or after it can be diffed properly
+        self.exact = False
+        best_progress = 0
+        best_split = None  # type: Optional[Tuple[int, int]]
+        for k in range(-max_d, max_d + 1):
+            x = forward[offset + k]
+            y = x - k
+            if 0 <= x <= n and 0 <= y <= m and best_progress < x + y < n + m:
+                best_progress = x + y
+                best_split = a_lo + x, b_lo + y
+            x = backward[offset + k]
+            y = x - k
+            if 0 <= x <= n and 0 <= y <= m and best_progress < x + y < n + m:
+                best_progress = x + y
+                best_split = a_hi - x, b_hi - y
+        return best_split
+
+
+class PatienceDiffEngine(MyersDiffEngine):
+    """
+    Diff engine using "patience diff": lines that appear exactly once in each sequence are matched
+    up first (keeping the longest run of them that's in the same order in both), and the sections
+    between them are diffed with Myers' algorithm. This tends to line up diffs at meaningful lines
+    (rather than at common lines like blank lines or closing braces), but matching up the unique
+    lines first can cost other matches (so it's never exact).
+    """
+
+    def get_matching_blocks(self, a: Sequence[Hashable],
+                            b: Sequence[Hashable]) -> List[MatchingBlock]:
+        blocks = []  # type: List[MatchingBlock]
+        stack = [(0, len(a), 0, len(b))]
+        while stack:
+            a_lo, a_hi, b_lo, b_hi = stack.pop()
+            anchors = self._find_unique_anchors(a, b, a_lo, a_hi, b_lo, b_hi)
+            if not anchors:
+                self._diff_range(a, b, a_lo, a_hi, b_lo, b_hi, blocks)
+                continue
+
+            # Handle the sections between the anchors in order (so push them in reverse)
+            sections = []
+            for i, j in anchors:
+                sections.append((a_lo, i, b_lo, j))
+                sections.append((i, i + 1, j, j + 1))
+                a_lo, b_lo = i + 1, j + 1
+            sections.append((a_lo, a_hi, b_lo, b_hi))
+            stack.extend(reversed(sections))
+        self.exact = False
+        return _merge_blocks(blocks)
+
+    @staticmethod
+    def _find_unique_anchors(a: Sequence[Hashable], b: Sequence[Hashable], a_lo: int, a_hi: int,
+                             b_lo: int, b_hi: int) -> List[Tuple[int, int]]:
+        # Find the items that are unique in both ranges
+        a_counts = {}  # type: Dict[Hashable, int]
+        for i in range(a_lo, a_hi):
+            a_counts[a[i]] = -1 if a[i] in a_counts else i
+        b_counts = {}  # type: Dict[Hashable, int]
+        for j in range(b_lo, b_hi):
+            b_counts[b[j]] = -1 if b[j] in b_counts else j
+        pairs = [(i, b_counts[item]) for item, i in a_counts.items()
+                 if i != -1 and b_counts.get(item, -1) != -1]
+        if len(pairs) == (a_hi - a_lo) == (b_hi - b_lo) and \
+                all(i - a_lo == j - b_lo for i, j in pairs):
+            # Everything matches already (which _diff_range handles fine); don't bother
+            return []
+        pairs.sort()
+
+        # Find the longest increasing subsequence (by position in b) using patience sorting
+        pile_tops = []  # type: List[int]
+        predecessors = [-1] * len(pairs)
+        for index, (_, j) in enumerate(pairs):
+            low, high = 0, len(pile_tops)
+            while low < high:
+                middle = (low + high) // 2
+                if pairs[pile_tops[middle]][1] < j:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low > 0:
+                predecessors[index] = pile_tops[low - 1]
+            if low == len(pile_tops):
+                pile_tops.append(index)
+            else:
+                pile_tops[low] = index
+
+        anchors = []  # type: List[Tuple[int, int]]
+        index = pile_tops[-1] if pile_tops else -1
+        while index != -1:
+            anchors.append(pairs[index])
+            index = predecessors[index]
+        anchors.reverse()
+        return anchors
+
+
+def _merge_blocks(blocks: List[MatchingBlock]) -> List[MatchingBlock]:
+    """
+    Sort matching blocks and combine any that are right next to each other.
+    """
+    merged = []  # type: List[MatchingBlock]
+    for a_start, b_start, size in sorted(blocks):
+        if merged:
+            last_a, last_b, last_size = merged[-1]
+            if last_a + last_size == a_start and last_b + last_size == b_start:
+                merged[-1] = (last_a, last_b, last_size + size)
+                continue
+        merged.append((a_start, b_start, size))
+    return merged
+
+
+DIFF_ENGINES = {
+    "myers": MyersDiffEngine,
+    "patience": PatienceDiffEngine,
+    "difflib": DifflibDiffEngine
+}  # type: Dict[str, Type[DiffEngine]]
+
+DEFAULT_DIFF_ENGINE = "myers"
+
+
+def get_diff_engine(name: str = None) -> DiffEngine:
+    """
+    Get a diff engine by name (see DIFF_ENGINES).
+
+    :raises ValueError: If there's no diff engine with that name.
+    """
+    try:
+        return DIFF_ENGINES[name or DEFAULT_DIFF_ENGINE]()
+    except KeyError:
+        raise ValueError("Unknown diff engine: {}".format(name))
+
+
+def clean_line(line: str, collapse_whitespace: bool = False) -> str:
+    """
+    Clean up a line to make diffing work better: ignore case and trailing whitespace (or, if
+    "collapse_whitespace" is set, ignore leading whitespace and treat any whitespace as a single
+    space).
+    """
+    if collapse_whitespace:
+        line = re.sub(r"\s+", " ", line.strip())
+    else:
+        line = line.rstrip()
+    return line.lower()
+
+
+class DiffReference:
+    """
+    Reference content that command output is compared to, split into lines. The cleaned-up lines
+    (see clean_line) are only computed once, so a DiffReference can be reused for many diffs.
+    """
+
+    __slots__ = ("text", "source", "lines", "_clean_lines")
+
+    def __init__(self, text: str, source: str) -> None:
+        """
+        :param text: The reference content.
+        :param source: A description of where the reference content came from.
+        """
+        self.text = text
+        self.source = source
+        self.lines = text.splitlines()
+        self._clean_lines = {}  # type: Dict[bool, List[str]]
+
+    def get_clean_lines(self, collapse_whitespace: bool = False) -> List[str]:
+        if collapse_whitespace not in self._clean_lines:
+            self._clean_lines[collapse_whitespace] = [clean_line(line, collapse_whitespace)
+                                                      for line in self.lines]
+        return self._clean_lines[collapse_whitespace]
+
+    def __getstate__(self) -> dict:
+        return {"text": self.text, "source": self.source}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["text"], state["source"])
+
+
+def diff_lines(reference: Sequence[str], output: Sequence[str], collapse_whitespace: bool = False,
+               engine: DiffEngine = None, reference_clean: Sequence[str] = None) -> List[Opcode]:
+    """
+    Diff some lines of output against some lines of reference content, ignoring case and
+    whitespace differences (see clean_line).
+
+    Each distinct cleaned-up line is replaced with an int before diffing, so the diff engine only
+    ever compares ints.
+
+    :param reference_clean: The reference lines, already cleaned up (if they're available, like
+        from DiffReference.get_clean_lines).
+    :return: The operations to turn the reference lines into the output lines. If they're the
+        same, this is empty.
+    """
+    if reference_clean is None:
+        reference_clean = [clean_line(line, collapse_whitespace) for line in reference]
+    line_ids = {}  # type: Dict[str, int]
+    reference_ids = [line_ids.setdefault(line, len(line_ids)) for line in reference_clean]
+    output_ids = [line_ids.setdefault(clean_line(line, collapse_whitespace), len(line_ids))
+                  for line in output]
+    if reference_ids == output_ids:
+        return []
+    return (engine or get_diff_engine()).get_opcodes(reference_ids, output_ids)
+
+
+def score_diff(opcodes: Sequence[Opcode], rule: str) -> float:
+    """
+    Turn the result of a diff (from diff_lines) into a score, based on one of the rules from
+    CommandItem.DiffScoring. For any rule other than RULE_ALL_OR_NOTHING, the diff needs to be
+    exact (see DiffEngine.exact), or the score is too low.
+
+    :return: The fraction of the points that the output earned (between 0 and 1).
+    """
+    if not opcodes:
+        # The output matches the reference
+        return 1.0
+    if rule == CommandItem.DiffScoring.RULE_ALL_OR_NOTHING:
+        return 0.0
+
+    reference_length = opcodes[-1][2]
+    output_length = opcodes[-1][4]
+    matching = sum(a_end - a_start for tag, a_start, a_end, _, _ in opcodes if tag == "equal")
+    if rule == CommandItem.DiffScoring.RULE_MATCHING_LINES:
+        return matching / max(reference_length, output_length)
+    if rule == CommandItem.DiffScoring.RULE_SIMILARITY:
+        return 2 * matching / (reference_length + output_length)
+    raise ValueError("Unknown diff scoring rule: {}".format(rule))
@@ -6,26 +6,396 @@ Licensed under the MIT License. For more, see the LICENSE file.
 Author: Jake Hartz <jake@hartz.io>
 """
 
-import difflib
+import collections
+import concurrent.futures
+import functools
 import os
 import random
 import re
-from collections import defaultdict
-from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple, Union
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Mapping, Optional, Sequence, Set, Tuple, \
+    Union
 
 from iochannels import Channel, HTMLMemoryLog, MemoryLog, Msg
 from pyprovide import Injector, inject
 
-from gradefast import events
+from gradefast import events, exceptions
+from gradefast.buildcache import BuildCache, CachedBuild, get_build_cache_dir
+from gradefast.grader.background import BackgroundCommandManager, BackgroundJob
 from gradefast.grader.banners import BANNERS
-from gradefast.hosts import BackgroundCommand, CommandRunError, CommandStartError, Host
+from gradefast.grader.diffing import DiffEngine, DiffReference, MyersDiffEngine, Opcode, \
+    diff_lines, get_diff_engine, score_diff
+from gradefast.grader.prefetch import CommandPrefetcher, PrefetchKey, get_command_environment, \
+    get_prefetch_key
+from gradefast.grades import SubmissionGrade, SubmissionGradeScore
+from gradefast.hosts import CommandResult, CommandRunError, CommandStartError, Host, \
+    split_archive_name
 from gradefast.loggingwrapper import get_logger
-from gradefast.models import Command, CommandItem, Path, Settings
+from gradefast.models import Command, CommandItem, CommandSet, Path, Settings
+from gradefast.outputbuffer import OutputBuffer
+from gradefast.parsers import make_score_number
 from gradefast.submissions import Submission, SubmissionManager
 
 _logger = get_logger("grader")
 
 
+# The number of unchanged lines to show around each change in a diff (longer runs of unchanged
+# lines are folded)
+DIFF_CONTEXT = 3
+
+# The number of diff lines to print at once
+DIFF_BATCH_SIZE = 500
+
+
+def print_diff(channel: Channel, output: OutputBuffer, reference: DiffReference,
+               options: CommandItem.Diff, engine: DiffEngine = None) -> List[Opcode]:
+    """
+    Print the results of performing a diff between "output" and "reference".
+
+    :param engine: The diff engine to use (by default, the one from get_diff_engine()).
+    :return: The result of the diff (see diff_lines).
+    """
+    # Nothing ain't anything without a reference
+    channel.bg_happy("- Reference")
+    channel.bg_sad  ("+ Output")
+    channel.bg_meh  ("  Both")
+    channel.print   ("-----------")
+    channel.print   ("")
+
+    # Split everything by lines
+    output_lines = output.get_lines()
+    reference_lines = reference.lines
+
+    opcodes = diff_lines(reference_lines, output_lines, options.collapse_whitespace, engine,
+                         reference.get_clean_lines(options.collapse_whitespace))
+    if not opcodes:
+        channel.status("Output matches the reference ({} lines)", len(output_lines))
+        return opcodes
+
+    # Print that diff! (a batch of lines at a time, rather than one line at a time)
+    msg = Msg(sep="", end="")
+    msg_lines = 0
+
+    def add_line(signal: str, line: str, kind: str) -> None:
+        nonlocal msg, msg_lines
+        msg.bright("{}", signal)
+        getattr(msg, kind)("{}", line)
+        msg.print("\n")
+        msg_lines += 1
+        if msg_lines >= DIFF_BATCH_SIZE:
+            channel.output(msg)
+            msg = Msg(sep="", end="")
+            msg_lines = 0
+
+    for index, (tag, ref_start, ref_end, out_start, out_end) in enumerate(opcodes):
+        if tag == "equal":
+            # Lines from both reference and output (print the output side), with long runs folded
+            # down to the context around the changes
+            show_before = DIFF_CONTEXT if index > 0 else 0
+            show_after = DIFF_CONTEXT if index < len(opcodes) - 1 else 0
+            if out_end - out_start > show_before + show_after + 1:
+                for i in range(out_start, out_start + show_before):
+                    add_line("  ", output_lines[i], "bg_meh")
+                msg.status("... {} matching lines ...", out_end - out_start - show_before -
+                           show_after).print("\n")
+                msg_lines += 1
+                for i in range(out_end - show_after, out_end):
+                    add_line("  ", output_lines[i], "bg_meh")
+            else:
+                for i in range(out_start, out_end):
+                    add_line("  ", output_lines[i], "bg_meh")
+        else:
+            # Lines from reference only, then lines from output only
+            for i in range(ref_start, ref_end):
+                add_line("- ", reference_lines[i], "bg_happy")
+            for i in range(out_start, out_end):
+                add_line("+ ", output_lines[i], "bg_sad")
+
+    if msg_lines:
+        channel.output(msg)
+    return opcodes
+
+
+def _find_diff_score_item(grade: SubmissionGrade,
+                          scoring: CommandItem.DiffScoring) -> SubmissionGradeScore:
+    """
+    Find the grade item that a diff's score goes in.
+
+    :raises DiffScoreError: If there isn't exactly one grade score that matches.
+    """
+    if isinstance(scoring.grade_item, str):
+        items = list(grade.get_by_name(scoring.grade_item))
+        description = "named \"{}\"".format(scoring.grade_item)
+    else:
+        try:
+            items = [grade.get_by_path(scoring.grade_item)]
+        except (exceptions.BadPathError, AttributeError):
+            # (AttributeError if the path goes through a grade score like it's a section)
+            items = []
+        description = "at path {}".format(list(scoring.grade_item))
+
+    items = [item for item in items if isinstance(item, SubmissionGradeScore)]
+    if not items:
+        raise DiffScoreError("No grade score {}".format(description))
+    if len(items) > 1:
+        raise DiffScoreError("More than one grade score {}".format(description))
+    return items[0]
+
+
+def get_scoring_diff(output: OutputBuffer, reference: DiffReference, options: CommandItem.Diff,
+                     engine: DiffEngine, opcodes: List[Opcode]) -> Tuple[List[Opcode], bool]:
+    """
+    Get the diff to score a command's output with. The diff engine used to print the diff might
+    not find as many matching lines as possible (see DiffEngine.exact), in which case the output is
+    diffed again with MyersDiffEngine.
+
+    :param engine: The diff engine that was passed to print_diff.
+    :param opcodes: The result of print_diff.
+    :return: The result of the diff to score, and whether it's exact.
+    """
+    if not opcodes or engine.exact:
+        return opcodes, True
+    if type(engine) is MyersDiffEngine:
+        # Diffing again would give up at the same point
+        return opcodes, False
+
+    scoring_engine = MyersDiffEngine()
+    opcodes = diff_lines(reference.lines, output.get_lines(), options.collapse_whitespace,
+                         scoring_engine, reference.get_clean_lines(options.collapse_whitespace))
+    return opcodes, scoring_engine.exact
+
+
+def apply_diff_score(channel: Channel, grade: SubmissionGrade, scoring: CommandItem.DiffScoring,
+                     opcodes: Sequence[Opcode], exact: bool = True) -> bool:
+    """
+    Set the score of a grade item based on the result of a diff (replacing any score that it had
+    before, including the effects of any hints).
+
+    :param channel: Where to print the new score (or why it couldn't be set).
+    :param grade: The grade for the submission that the diff was for.
+    :param scoring: Which grade item to set, and how to score the diff.
+    :param opcodes: The result of the diff (from print_diff).
+    :param exact: Whether the diff found all the matching lines (see DiffEngine.exact). If not,
+        only the "all or nothing" rule can be scored.
+    :return: Whether the score was set.
+    """
+    try:
+        item = _find_diff_score_item(grade, scoring)
+    except DiffScoreError as e:
+        channel.error("Couldn't score diff: {}", e.message)
+        return False
+
+    if opcodes and not exact and scoring.rule != CommandItem.DiffScoring.RULE_ALL_OR_NOTHING:
+        # Better no score than a wrong one
+        channel.error("Couldn't score diff: The output has too many changes to count its matching "
+                      "lines exactly")
+        return False
+
+    _, points_possible = item.get_score(False)
+    score = make_score_number(round(points_possible * score_diff(opcodes, scoring.rule), 2))
+    item.set_effective_score(score)
+    channel.status("Set score for \"{}\" to {} / {} ({})", item.get_name(), score,
+                   points_possible, scoring.rule)
+    return True
+
+
+def print_command_set_header(channel: Channel, command_set: CommandSet) -> None:
+    """
+    Print the heading shown before the commands in a command set are run.
+    """
+    msg = Msg(sep="").print("\n").status("Command Set")
+    if command_set.name:
+        msg.status(": {}", command_set.name)
+    if command_set.folder:
+        msg.print(" ({})", command_set.folder)
+    channel.output(msg)
+
+
+def print_command_set_footer(channel: Channel, command_set: CommandSet) -> None:
+    """
+    Print the line shown after all the commands in a command set are run.
+    """
+    channel.print()
+    channel.status("End Command Set", end="")
+    if command_set.name:
+        channel.status(": {}", command_set.name, end="")
+    channel.print()
+
+
+def print_command_header(channel: Channel, submission_name: str, command: CommandItem) -> None:
+    """
+    Print the heading shown before a command is run on a submission.
+    """
+    msg = Msg(sep="\n").print()
+    status_title = ("-" * 3) + " " + submission_name
+    if len(status_title) < 56:
+        status_title += " "
+        status_title += "-" * (56 - len(status_title))
+    msg.status(status_title)
+
+    msg.status("::: {}", command.name)
+    if command.is_background:
+        msg.status("    (background command)")
+    for line in command.command.split("\n"):
+        if line:
+            msg.bright("    {}", line)
+    channel.output(msg.print())
+
+
+class DiffReferenceError(Exception):
+    """
+    Represents an error in getting the reference content for a diff.
+    """
+    def __init__(self, message: str) -> None:
+        self.message = message
+
+
+class DiffScoreError(Exception):
+    """
+    Represents an error in finding the grade item to put a diff's score in.
+    """
+    def __init__(self, message: str) -> None:
+        self.message = message
+
+
+class DiffReferenceCache:
+    """
+    Remembers the reference content for diffs, so it doesn't have to be read or generated again
+    for every submission (see get_diff_reference for what is cached).
+    """
+
+    # The maximum number of references to keep
+    MAX_SIZE = 64
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._references = collections.OrderedDict()  # type: Dict[Hashable, DiffReference]
+
+    def get(self, key: Hashable) -> Optional[DiffReference]:
+        with self._lock:
+            reference = self._references.get(key)
+            if reference is not None:
+                self._references.move_to_end(key)
+            return reference
+
+    def put(self, key: Hashable, reference: DiffReference) -> None:
+        with self._lock:
+            self._references[key] = reference
+            self._references.move_to_end(key)
+            while len(self._references) > DiffReferenceCache.MAX_SIZE:
+                self._references.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._references.clear()
+
+
+def _get_diff_reference_key(settings: Settings, diff: CommandItem.Diff, path: Path,
+                            environment: Mapping[str, str]) -> Optional[Hashable]:
+    """
+    Get the key that a diff's reference content is cached under, or None if it can't be cached.
+    """
+    if diff.content:
+        return "content", diff.content
+
+    if diff.file and settings.diff_file_path:
+        local_diff_path = os.path.join(settings.diff_file_path.get_local_path(), diff.file)
+        try:
+            stat = os.stat(local_diff_path)
+        except OSError:
+            return None
+        return "file", local_diff_path, stat.st_mtime_ns, stat.st_size
+
+    if diff.command and diff.cache != CommandItem.Diff.CACHE_NONE:
+        if diff.cache == CommandItem.Diff.CACHE_GLOBAL:
+            # Leave out anything specific to the submission
+            return "command", diff.command, tuple(sorted(
+                (key, value) for key, value in environment.items() if key != "SUBMISSION_NAME"))
+        return "command", diff.command, path.get_gradefast_path(), \
+            tuple(sorted(environment.items()))
+
+    # Submission files are different for every submission
+    return None
+
+
+def get_diff_reference(host: Host, settings: Settings, diff: CommandItem.Diff, path: Path,
+                       environment: Mapping[str, str],
+                       cache: DiffReferenceCache = None) -> DiffReference:
+    """
+    Get the reference content that a command's output should be compared to. This doesn't interact
+    with the user, so it's safe to use outside of a CommandRunner.
+
+    If a cache is provided, then "content" and local "file" references are only read once (files
+    are read again if they're modified), and "command" references are reused based on the diff's
+    "cache" scope.
+
+    :param host: The host that the command is being run on.
+    :param settings: The GradeFast settings (for the folder containing local diff files).
+    :param diff: The diff options from the command.
+    :param path: The working directory for the command.
+    :param environment: A dictionary of environment variables for the command.
+    :param cache: The cache of reference content to use, if any.
+    :return: The reference content, and a description of where it came from.
+    :raises DiffReferenceError: If we couldn't get the reference content.
+    """
+    key = None
+    if cache is not None:
+        key = _get_diff_reference_key(settings, diff, path, environment)
+        if key is not None:
+            reference = cache.get(key)
+            if reference is not None:
+                _logger.debug("Using cached diff reference from {}", reference.source)
+                return reference
+
+    reference = DiffReference(*_read_diff_reference(host, settings, diff, path, environment))
+    if key is not None:
+        cache.put(key, reference)
+    return reference
+
+
+def _read_diff_reference(host: Host, settings: Settings, diff: CommandItem.Diff, path: Path,
+                         environment: Mapping[str, str]) -> Tuple[str, str]:
+    """
+    Read or generate the reference content for a diff (see get_diff_reference).
+
+    :return: A tuple with (str, str) representing the reference content and a description of
+        where it came from.
+    """
+    if diff.content:
+        return diff.content, "content from command config"
+
+    if diff.file and settings.diff_file_path:
+        local_diff_path = os.path.join(settings.diff_file_path.get_local_path(), diff.file)
+        try:
+            with open(local_diff_path) as f:
+                return f.read(), "local file ({})".format(diff.file)
+        except FileNotFoundError:
+            raise DiffReferenceError("Diff file not found: {} ({})".format(
+                diff.file, settings.diff_file_path))
+
+    if diff.submission_file:
+        diff_path = path.append(diff.submission_file)
+        try:
+            return host.read_text_file(diff_path), \
+                "submission file ({})".format(diff.submission_file)
+        except FileNotFoundError:
+            raise DiffReferenceError("Diff file not found: {} ({})".format(
+                diff.submission_file, path))
+
+    if diff.command:
+        try:
+            result = host.run_command_captured(diff.command, path, environment)
+        except CommandStartError as e:
+            raise DiffReferenceError("Error starting diff command: {}".format(e.message))
+        if result.get_error():
+            raise DiffReferenceError("Error running diff command: {}".format(result.get_error()))
+        return result.output.get_text(), "command ({})".format(diff.command)
+
+    raise DiffReferenceError("Diff object doesn't include "
+                             "\"content\", \"file\", \"submission_file\", or \"command\"")
+
+
 class Grader:
     """
     Control the grading process and run commands on submissions.
@@ -34,13 +404,19 @@ class Grader:
     @inject(injector=Injector.CURRENT_INJECTOR)
     def __init__(self, injector: Injector, channel: Channel, host: Host,
                  event_manager: events.EventManager, settings: Settings,
-                 submission_manager: SubmissionManager) -> None:
+                 submission_manager: SubmissionManager, prefetcher: CommandPrefetcher,
+                 background_command_manager: BackgroundCommandManager,
+                 build_cache: BuildCache) -> None:
         self.injector = injector
         self.channel = channel
         self.host = host
         self.event_manager = event_manager
         self.settings = settings
         self.submission_manager = submission_manager
+        self.prefetcher = prefetcher
+        self.background_command_manager = background_command_manager
+        self.diff_reference_cache = DiffReferenceCache()
+        self.build_cache = build_cache
 
     def prompt_for_submissions(self) -> bool:
         """
@@ -80,6 +456,10 @@ class Grader:
         The regular expression is used to limit which folders are picked up. Also, the first
         matched group in the regex is used as the name of the submission.
 
+        If "check_zipfiles" is set, then any matching archives (zip or tar files; see
+        ARCHIVE_EXTENSIONS in hosts.py) are extracted into folders. These (and any matching files
+        with one of the "check_file_extensions") are prepared in parallel.
+
         For more info on some of the parameters, see the documentation on the GradeFast wiki:
         https://github.com/jhartz/gradefast/wiki
 
@@ -89,24 +469,42 @@ class Grader:
         :return: True if the user actually tried to pick something (even if we couldn't find any
             submissions in the folder they picked); False if they cancelled.
         """
-        check_file_extensions = self.settings.check_file_extensions
-        if check_file_extensions is None:
-            check_file_extensions = []
-
-        # Step 1: Prompt the user for a folder
         path = self.host.choose_folder(base_folder)
         if not path:
             self.channel.error("No folder provided")
             return False
 
-        # Step 2: Find matching submissions
+        self.add_submissions_from_folder(path)
+        return True
+
+    def add_submissions_from_folder(self, path: Path) -> None:
+        """
+        Add a folder of submissions to our list of submissions, without prompting the user. See
+        add_submissions for details.
+
+        :param path: The path to the folder containing the submissions.
+        """
+        check_file_extensions = self.settings.check_file_extensions
+        if check_file_extensions is None:
+            check_file_extensions = []
+
+        # Step 1: Find matching submissions
         regex = None
         if self.settings.submission_regex:
             regex = re.compile(self.settings.submission_regex)
 
-        for name, type, is_link in sorted(self.host.list_folder(path)):
+        listing = sorted(self.host.list_folder(path))
+        # Anything that already exists in the folder (or that we're going to create) can't be used
+        # as the folder for a submission that's in a file
+        taken_names = set(entry[0] for entry in listing)
+
+        # Tuples of the form (submission name, folder name, folder path, job), where "job" is a
+        # function that gets the folder ready (or None if it's already a folder)
+        found = []  # type: List[Tuple[str, str, Path, Optional[Callable[[], None]]]]
+        for name, type, is_link in listing:
             submission_match = False  # type: Any
             folder_path = None  # type: Path
+            job = None  # type: Optional[Callable[[], None]]
 
             valid_submission = False
             if type == "folder":
@@ -119,42 +517,83 @@ class Grader:
                     folder_path = path.append(name)
                     valid_submission = True
             elif type == "file" and name.find(".") > 0:
-                name, ext = name.rsplit(".", maxsplit=1)
+                file_name = name
+                archive_name = split_archive_name(name) if self.settings.check_zipfiles else None
+                if archive_name:
+                    name, ext = archive_name
+                else:
+                    name, ext = name.rsplit(".", maxsplit=1)
                 if regex:
                     submission_match = regex.fullmatch(name)
                 else:
                     submission_match = True
-                if submission_match and not self.host.exists(path.append(name)):
+                if submission_match and name not in taken_names:
                     folder_path = path.append(name)
-                    file_path = path.append(name + "." + ext)
-                    if self.settings.check_zipfiles and ext == "zip":
-                        self.channel.print("Found submission zipfile: {}.zip", name)
-                        self.host.unzip(file_path, folder_path)
-                        self.channel.print("    extracted to {}/", name)
+                    file_path = path.append(file_name)
+                    if archive_name:
+                        self.channel.print("Found submission archive: {}", file_name)
+                        job = functools.partial(self.host.extract_archive, file_path, folder_path)
                         valid_submission = True
                     elif ext in check_file_extensions:
-                        self.channel.print("Found submission file: {}.{}", name, ext)
-                        self.host.move_to_folder(file_path, folder_path)
-                        self.channel.print("    moved into {}/", name)
+                        self.channel.print("Found submission file: {}", file_name)
+                        job = functools.partial(self.host.move_to_folder, file_path, folder_path)
                         valid_submission = True
 
             if valid_submission:
+                taken_names.add(name)
                 submission_name = name
                 if regex:
                     for group in submission_match.groups():
                         if group:
                             submission_name = group
                             break
-                # Add the submission, but don't send the event yet
-                # (we'll send one big one at the end)
+                found.append((submission_name, name, folder_path, job))
+
+        # Step 2: Extract archives and move files into folders (all at once, since extracting a lot
+        # of big archives one at a time can take a while)
+        failed = self._run_submission_jobs([(name, job) for _, name, _, job in found if job])
+
+        # Step 3: Add the submissions in order, but don't send the event yet
+        # (we'll send one big one at the end)
+        for submission_name, name, folder_path, _ in found:
+            if name not in failed:
                 self.submission_manager.add_submission(submission_name, name, folder_path,
                                                        send_event=False)
 
-        # Step 3: Tell the world
+        # Step 4: Tell the world
         if self.submission_manager.has_submissions():
             self.event_manager.dispatch_event(events.NewSubmissionsEvent())
 
-        return True
+    def _run_submission_jobs(self, jobs: List[Tuple[str, Callable[[], None]]]) -> Set[str]:
+        """
+        Run the functions that get submission folders ready (see add_submissions_from_folder), up to
+        "extract_workers" at a time, and print our progress as they finish.
+
+        :param jobs: A list of tuples of the form (folder name, job).
+        :return: The folder names of any jobs that failed.
+        """
+        failed = set()  # type: Set[str]
+        if not jobs:
+            return failed
+
+        self.channel.print()
+        self.channel.status("Preparing {} submission folder(s)...", len(jobs))
+        workers = max(1, self.settings.extract_workers)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(job): name for name, job in jobs}
+            for done_count, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                name = futures[future]
+                try:
+                    future.result()
+                except Exception as ex:
+                    _logger.exception("Error preparing submission folder {}", name)
+                    self.channel.error("[{}/{}] Couldn't prepare {}/: {}", done_count, len(jobs),
+                                       name, ex)
+                    failed.add(name)
+                else:
+                    self.channel.print("[{}/{}] Prepared {}/", done_count, len(jobs), name)
+        self.channel.print()
+        return failed
 
     def run_commands(self) -> None:
         """
@@ -170,8 +609,10 @@ class Grader:
         self.channel.print()
 
         submission_id = self.submission_manager.get_first_submission_id()
-        background_commands = []  # type: List[BackgroundCommand]
         while True:
+            # Add anything that finished in the background to the logs
+            self._record_finished_background_jobs()
+
             if not self.submission_manager.has_submissions():
                 # Ideally, this shouldn't ever happen, but...
                 self.channel.error_bordered("No submissions!")
@@ -191,6 +632,13 @@ class Grader:
                     # Well, they said they're done
                     break
 
+            if self.submission_manager.drop_submission_if_missing(submission_id):
+                self.channel.print()
+                self.channel.error("Dropped submission {}; its folder doesn't exist anymore",
+                                   submission_id)
+                submission_id = self.submission_manager.get_next_submission_id(submission_id)
+                continue
+
             submission = self.submission_manager.get_submission(submission_id)
 
             self.channel.print()
@@ -255,7 +703,7 @@ class Grader:
             elif what_to_do == "l" or what_to_do == "list":
                 # List all the submissions
                 id_len = len(str(self.submission_manager.get_last_submission_id()))
-                for submission in self.submission_manager.get_all_submissions():
+                for submission in self.submission_manager.get_all_submission_summaries():
                     self.channel.print("{:{}}: {}",
                                        submission.get_id(), id_len, submission.get_name())
 
@@ -280,6 +728,13 @@ class Grader:
             else:
                 # Run the next submission
 
+                # Pick up anything that was already run for this submission, and get started on the
+                # ones after it
+                if self.prefetcher.is_running(submission_id):
+                    self.channel.status("Waiting for prefetched commands to finish...")
+                prefetched_results = self.prefetcher.claim(submission_id)
+                self.prefetcher.prefetch_after(submission_id)
+
                 # Set up logs for the submission
                 html_log = HTMLMemoryLog()
                 text_log = MemoryLog()
@@ -290,13 +745,13 @@ class Grader:
                 self.event_manager.dispatch_event(events.SubmissionStartedEvent(submission_id))
 
                 runner = CommandRunner(self.injector, self.channel, self.host, self.settings,
-                                       submission)
+                                       submission, self.background_command_manager,
+                                       self.diff_reference_cache, self.build_cache,
+                                       prefetched_results)
                 runner.run()
 
                 # Stop the logs and clean up
-                html_log.close()
-                text_log.close()
-                background_commands += runner.get_background_commands()
+                submission.close_logs()
 
                 submission.stop_timer(timer_context)
                 self.event_manager.dispatch_event(events.SubmissionFinishedEvent(submission_id))
@@ -305,20 +760,68 @@ class Grader:
                 submission_id = self.submission_manager.get_next_submission_id(submission_id)
 
         # All done with everything
+        self.prefetcher.close()
         self.event_manager.dispatch_event(events.EndOfSubmissionsEvent())
+        self._wait_for_background_jobs()
+
+    def _wait_for_background_jobs(self) -> None:
+        """
+        Wait for any background commands that are still queued or running, adding each one to its
+        submission's logs as soon as it finishes.
+        """
+        try:
+            while self.background_command_manager.has_pending_jobs():
+                pending_count = sum(1 for job in self.background_command_manager.get_jobs()
+                                    if not job.is_done())
+                self.channel.print()
+                self.channel.status("Waiting for {} background command(s)...", pending_count)
+                self.background_command_manager.wait_for_next()
+                self._record_finished_background_jobs()
+        except (InterruptedError, KeyboardInterrupt):
+            self.channel.print()
+            self.channel.error("Stopping background commands")
+            self.background_command_manager.stop_all()
+        self._record_finished_background_jobs()
+        self.background_command_manager.close()
+
+    def _record_finished_background_jobs(self) -> None:
+        """
+        Print the results of any background commands that finished since the last time this was
+        called, adding them to the logs for their submissions.
+        """
+        jobs = self.background_command_manager.claim_finished()
+        for job in jobs:
+            if job.submission_id not in self.submission_manager.get_all_submission_ids():
+                # The submission was dropped in the meantime
+                self._print_background_job(job)
+                continue
+
+            submission = self.submission_manager.get_submission(job.submission_id)
+            html_log = HTMLMemoryLog()
+            text_log = MemoryLog()
+            self.channel.add_delegate(html_log, text_log)
+            submission.add_logs(html_log, text_log)
+            try:
+                self._print_background_job(job)
+            finally:
+                submission.close_logs()
+
+        if jobs:
+            # Update the "has logs" flags for GradeBook clients
+            self.event_manager.dispatch_event(events.NewSubmissionsEvent())
 
-        for background_command in background_commands:
-            background_command = background_command
+    def _print_background_job(self, job: BackgroundJob) -> None:
+        print_command_header(self.channel, job.submission_name, job.command)
+        self.channel.output(Msg().status("Background command {}", job.status)
+                                 .print("(ran for {:.2f} sec)", job.get_elapsed_time() or 0))
+        output = job.get_output()
+        if output:
             self.channel.print()
-            self.channel.output(Msg().status("Waiting for background command")
-                                     .print("{}", background_command.get_description()))
-            background_command.wait()
+            self.channel.output(Msg(end="").print("{}", output.get_summary()))
             self.channel.print()
-            if background_command.get_error():
-                self.channel.error("ERROR: {}", background_command.get_error())
-            if background_command.get_output():
-                self.channel.status("Background command output:")
-                self.channel.print(background_command.get_output())
+        if job.error:
+            self.channel.print()
+            self.channel.error("{}", job.error)
 
 
 class CommandRunner:
@@ -327,17 +830,29 @@ class CommandRunner:
     """
 
     def __init__(self, injector: Injector, channel: Channel, host: Host, settings: Settings,
-                 submission: Submission) -> None:
+                 submission: Submission, background_command_manager: BackgroundCommandManager,
+                 diff_reference_cache: DiffReferenceCache = None, build_cache: BuildCache = None,
+                 prefetched_results: Mapping[PrefetchKey, CommandResult] = None) -> None:
         """
         Initialize a new CommandRunner to use for running commands on a submission.
+
+        :param background_command_manager: Where background commands are sent to be run.
+        :param diff_reference_cache: Where reference content for diffs is cached (shared between
+            submissions).
+        :param build_cache: Where the results of "cacheable" commands are cached.
+        :param prefetched_results: Results of commands that were already run for this submission
+            by the CommandPrefetcher. Each one is used at most once, and none are used once the
+            user modifies or repeats a command or opens a shell.
         """
         self.injector = injector
         self.channel = channel
         self.host = host
         self.settings = settings
         self._submission = submission
-
-        self._background_commands = []  # type: List[BackgroundCommand]
+        self._background_command_manager = background_command_manager
+        self._diff_reference_cache = diff_reference_cache
+        self._build_cache = build_cache
+        self._prefetched_results = dict(prefetched_results or {})
 
     def _check_folder(self, path: Path) -> Optional[Path]:
         """
@@ -445,12 +960,6 @@ class CommandRunner:
             self.channel.error("Submission interrupted")
             self.channel.print("")
 
-    def get_background_commands(self) -> List[BackgroundCommand]:
-        """
-        Get any background commands that were started. (They're not necessarily still running.)
-        """
-        return self._background_commands
-
     def _do_command_set(self, commands: Sequence[Command], path: Path,
                         environment: Mapping[str, str]) -> bool:
         """
@@ -476,12 +985,7 @@ class CommandRunner:
             if hasattr(command, "commands"):
                 # It's a command set
 
-                msg = Msg(sep="").print("\n").status("Command Set")
-                if command.name:
-                    msg.status(": {}", command.name)
-                if command.folder:
-                    msg.print(" ({})", command.folder)
-                self.channel.output(msg)
+                print_command_set_header(self.channel, command)
 
                 new_path = path
                 if command.folder:
@@ -506,11 +1010,7 @@ class CommandRunner:
                 if not self._do_command_set(command.commands, new_path, new_environment):
                     return False
 
-                self.channel.print()
-                self.channel.status("End Command Set", end="")
-                if command.name:
-                    self.channel.status(": {}", command.name, end="")
-                self.channel.print()
+                print_command_set_footer(self.channel, command)
             else:
                 # It's a command item
 
@@ -533,40 +1033,25 @@ class CommandRunner:
         """
         _logger.debug("_do_command: {}", command)
 
-        msg = Msg(sep="\n").print()
-        status_title = ("-" * 3) + " " + self._submission.get_name()
-        if len(status_title) < 56:
-            status_title += " "
-            status_title += "-" * (56 - len(status_title))
-        msg.status(status_title)
-
-        msg.status("::: {}", command.name)
-        if command.is_background:
-            msg.status("    (background command)")
-        for line in command.command.split("\n"):
-            if line:
-                msg.bright("    {}", line)
-        self.channel.output(msg.print())
+        print_command_header(self.channel, self._submission.get_name(), command)
 
         # Set up the command environment dictionary
         # (This is used for running the command, and if we open a shell)
-        env = dict(environment)
-        env.update(command.environment)
-        env.update({
-            "SUBMISSION_NAME": self._submission.get_name()
-        })
+        env = get_command_environment(command, environment, self._submission.get_name())
 
         # Before starting, ask the user what they want to do
         while True:
             choice = self.channel.prompt("What now?", ["o", "f", "m", "s", "ss", "?", ""])
             if choice == "o":
                 # Open a shell in the current folder
+                self._discard_prefetched_results("a shell was opened")
                 self.host.open_shell(path, env)
             elif choice == "f":
                 # Open the current folder
                 self.host.open_folder(path)
             elif choice == "m":
                 # Modify the command
+                self._discard_prefetched_results("a command was modified")
                 command = self._get_modified_command(command)
             elif choice == "s":
                 # Skip this command
@@ -604,29 +1089,40 @@ class CommandRunner:
             self.channel.print("")
             if choice == "y":
                 # Repeat the command
+                self._discard_prefetched_results("a command was repeated")
                 return self._do_command(command, path, environment)
             else:
                 # Move on to the next command
                 return True
 
+    def _discard_prefetched_results(self, reason: str) -> None:
+        """
+        Stop using prefetched results for the rest of this submission, since they might not
+        match what the commands would do now (they were run before the user changed anything).
+
+        :param reason: What the user did (for logging).
+        """
+        if self._prefetched_results:
+            _logger.debug("Discarding {} prefetched results because {}",
+                          len(self._prefetched_results), reason)
+            self._prefetched_results.clear()
+
     def _run_background_command(self, command: CommandItem, path: Path,
                                 environment: Mapping[str, str]) -> None:
         """
-        Actually run an individual background command.
+        Actually run an individual background command (or, if too many are already running, queue
+        it to be run later).
 
         :param command: The command to run.
         :param path: The working directory for the command.
         :param environment: A dictionary of environment variables for the command.
         """
-        try:
-            self._background_commands.append(self.host.start_background_command(
-                command.command, path, environment, command.stdin))
-        except CommandStartError as e:
-            self.channel.print()
-            self.channel.error("Error starting background command: {}", e.message)
-        else:
-            self.channel.print()
-            self.channel.status("Background command started.")
+        self._background_command_manager.submit(self._submission.get_id(),
+                                                self._submission.get_name(), command, path,
+                                                environment)
+        self.channel.print()
+        self.channel.status("Background command queued. Its output will be added to the logs "
+                            "when it's done.")
 
     def _run_foreground_command(self, command: CommandItem, path: Path,
                                 environment: Mapping[str, str]) -> None:
@@ -637,52 +1133,32 @@ class CommandRunner:
         :param path: The working directory for the command.
         :param environment: A dictionary of environment variables for the command.
         """
-        # Filled with the text content to compare the command's output to (if any)
+        # Filled with the content to compare the command's output to (if any)
         diff_reference = None
-        diff_reference_source = None
 
         if command.diff:
-            if command.diff.content:
-                diff_reference = command.diff.content
-                diff_reference_source = "content from command config"
-            elif command.diff.file and self.settings.diff_file_path:
-                local_diff_path = os.path.join(self.settings.diff_file_path.get_local_path(),
-                                               command.diff.file)
-                try:
-                    with open(local_diff_path) as f:
-                        diff_reference = f.read()
-                    diff_reference_source = "local file ({})".format(command.diff.file)
-                except FileNotFoundError:
-                    self.channel.error("Diff file not found: {} ({})", command.diff.file,
-                                       self.settings.diff_file_path)
-            elif command.diff.submission_file:
-                diff_path = path.append(command.diff.submission_file)
-                try:
-                    diff_reference = self.host.read_text_file(diff_path)
-                    diff_reference_source = "submission file ({})".format(
-                        command.diff.submission_file)
-                except FileNotFoundError:
-                    self.channel.error("Diff file not found: {} ({})",
-                                       command.diff.submission_file, path)
-            elif command.diff.command:
-                try:
-                    diff_reference = self.host.run_command(command.diff.command, path, environment,
-                                                           print_output=False)
-                    diff_reference_source = "command ({})".format(command.diff.command)
-                except CommandStartError as e:
-                    self.channel.error("Error starting diff command: {}", e.message)
-                except CommandRunError as e:
-                    self.channel.error("Error running diff command: {}", e.message)
-            else:
-                self.channel.error("Diff object doesn't include "
-                                   "\"content\", \"file\", \"submission_file\", or \"command\"")
+            try:
+                diff_reference = get_diff_reference(self.host, self.settings, command.diff, path,
+                                                    environment, self._diff_reference_cache)
+            except DiffReferenceError as e:
+                self.channel.error("{}", e.message)
+
+        prefetched_result = None
+        if not command.is_passthrough:
+            prefetched_result = self._prefetched_results.pop(
+                get_prefetch_key(command, path, environment), None)
 
         output = None
         try:
             if command.is_passthrough:
                 self.host.run_command_passthrough(command.command, path, environment)
+            elif prefetched_result is not None:
+                self._print_prefetched_result(prefetched_result)
+                if prefetched_result.get_error():
+                    raise CommandRunError(prefetched_result.get_error())
+                output = prefetched_result.output
             else:
-                output = self.host.run_command(command.command, path, environment, command.stdin)
+                output = self._run_command(command, path, environment)
         except CommandStartError as e:
             self.channel.print()
             self.channel.error("Error starting command: {}", e.message)
@@ -694,72 +1170,71 @@ class CommandRunner:
 
         if diff_reference is not None:
             self.channel.print()
-            self.channel.status("DIFF with reference from {}", diff_reference_source)
+            self.channel.status("DIFF with reference from {}", diff_reference.source)
             self.channel.print()
-            self._print_diff(output, diff_reference, command.diff)
+            engine = get_diff_engine(self.settings.diff_engine)
+            opcodes = print_diff(self.channel, output, diff_reference, command.diff, engine)
+            if command.diff.scoring:
+                self.channel.print()
+                opcodes, exact = get_scoring_diff(output, diff_reference, command.diff, engine,
+                                                  opcodes)
+                if apply_diff_score(self.channel, self._submission.get_grade(),
+                                    command.diff.scoring, opcodes, exact):
+                    self.injector.get_instance(events.EventManager).dispatch_event(
+                        events.SubmissionGradeExternallyUpdatedEvent(self._submission.get_id()))
+
+    def _run_command(self, command: CommandItem, path: Path,
+                     environment: Mapping[str, str]) -> OutputBuffer:
+        """
+        Run a foreground command (or get its result from the build cache, if it's cacheable).
 
-    @staticmethod
-    def _clean_lines(lines: Sequence[str], collapse_whitespace: bool = False) \
-            -> Tuple[List[str], Dict[str, List[str]]]:
+        :raises CommandStartError: If the command couldn't be started.
+        :raises CommandRunError: If the command didn't finish successfully.
         """
-        Clean up some lines of output to make diffing work better. In particular, make an
-        entirely-lowercase version and optionally collapse whitespace.
+        local_dir = None
+        if self._build_cache is not None:
+            local_dir = get_build_cache_dir(self._build_cache, self.host, command, path)
+
+        recording = None
+        if local_dir is not None:
+            try:
+                cached = self._build_cache.lookup(command, local_dir, environment)
+                if cached is not None:
+                    self._print_cached_build(cached)
+                    return cached.output
+                recording = self._build_cache.start_recording(command, local_dir, environment)
+            except OSError as e:
+                _logger.exception("Error checking build cache for {}", command)
+                self.channel.error("Error checking build cache: {}", e)
+
+        output = self.host.run_command(command.command, path, environment, command.stdin,
+                                       tty=command.is_tty, limits=command.limits)
+        if recording is not None:
+            try:
+                self._build_cache.record(command, recording, output)
+            except OSError as e:
+                _logger.exception("Error recording {} in build cache", command)
+                self.channel.error("Error recording command in build cache: {}", e)
+        return output
+
+    def _print_cached_build(self, cached: CachedBuild) -> None:
+        """
+        Print the output from a command that was restored from the build cache.
+        """
+        self.channel.output(Msg().status("Cached output")
+                                 .print("(nothing changed since it last ran; restored {} of {} "
+                                        "files it produced)", cached.restored, cached.artifacts))
+        self.channel.print()
+        self.channel.output(Msg(end="").print("{}", cached.output.get_summary()))
+        self.channel.print()
 
-        :return: A tuple with (list of str, dict) representing the list of cleaned-up lines
-            (each ending with a newline) and a dictionary mapping each cleaned-up line to a list
-            of the original line(s) that it came from (none ending with a newline).
+    def _print_prefetched_result(self, result: CommandResult) -> None:
         """
-        clean_to_orig = defaultdict(lambda: [])  # type: Dict[str, List[str]]
-        clean_lines = []  # type: List[str]
-        for line in lines:
-            if collapse_whitespace:
-                line = re.sub(r'\s+', " ", line.strip())
-            else:
-                line = line.rstrip()
-
-            clean_line = line.lower() + "\n"
-            clean_lines.append(clean_line)
-            clean_to_orig[clean_line].append(line)
-        return clean_lines, clean_to_orig
-
-    def _print_diff(self, output: str, reference: str, options: CommandItem.Diff) -> None:
-        """
-        Print the results of performing a diff between "output" and "reference".
-        """
-        # Nothing ain't anything without a reference
-        self.channel.bg_happy("- Reference")
-        self.channel.bg_sad  ("+ Output")
-        self.channel.bg_meh  ("  Both")
-        self.channel.print   ("-----------")
-        self.channel.print   ("")
-
-        # Split everything by lines
-        output_lines = output.splitlines()
-        reference_lines = reference.splitlines()
-
-        # Try some metric-level hackery to ignore case and clean up a bit
-        reference_clean, reference_orig = CommandRunner._clean_lines(
-            reference_lines, options.collapse_whitespace)
-        output_clean, output_orig = CommandRunner._clean_lines(
-            output_lines, options.collapse_whitespace)
-
-        # Print that diff!
-        for line in difflib.ndiff(reference_clean, output_clean):
-            signal = line[0]
-            content = line[2:]
-            self.channel.bright("{}", line[0:2], end="")
-            if signal == "-":
-                # Line from reference only
-                self.channel.bg_happy("{}", reference_orig[content].pop(0))
-            elif signal == "+":
-                # Line from output only
-                self.channel.bg_sad("{}", output_orig[content].pop(0))
-            elif signal == "?":
-                # Extra line (to mark locations, etc.)
-                self.channel.bright("{}", content.rstrip("\n"))
-            else:
-                # Line from both reference and output
-                # Pop the reference side
-                reference_orig[content].pop(0)
-                # Pop and print the output side
-                self.channel.bg_meh("{}", output_orig[content].pop(0))
+        Print the output from a command that was already run by the CommandPrefetcher.
+        """
+        self.channel.output(Msg().status("Prefetched output")
+                                 .print("(ran for {:.2f} sec, finished {:.0f} sec ago)",
+                                        result.get_duration(), time.time() - result.end_time))
+        self.channel.print()
+        self.channel.output(Msg(end="").print("{}", result.output.get_summary()))
+        self.channel.print()
@@ -0,0 +1,342 @@
+"""
+GradeFast Prefetcher - Runs commands for upcoming submissions before the user gets to them.
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+import concurrent.futures
+import re
+import threading
+from typing import Dict, Mapping, Optional, Sequence, Tuple, Union
+
+from pyprovide import inject
+
+from gradefast.buildcache import BuildCache, run_command_captured_cached
+from gradefast.hosts import CommandResult, CommandStartError, Host
+from gradefast.loggingwrapper import get_logger
+from gradefast.models import Command, CommandItem, CommandSet, Path, Settings
+from gradefast.submissions import SubmissionManager
+
+_logger = get_logger("grader.prefetch")
+
+# (command name, command, stdin, working directory, environment)
+PrefetchKey = Tuple[str, str, Optional[str], str, Tuple[Tuple[str, str], ...]]
+
+
+def get_command_environment(command: CommandItem, environment: Mapping[str, str],
+                            submission_name: str) -> Dict[str, str]:
+    """
+    Build the environment dictionary that a command item is run with.
+
+    :param command: The command that is going to be run.
+    :param environment: The base environment from any parent command sets.
+    :param submission_name: The name of the submission that the command is being run on.
+    """
+    env = dict(environment)
+    env.update(command.environment)
+    env.update({
+        "SUBMISSION_NAME": submission_name
+    })
+    return env
+
+
+def get_prefetch_key(command: CommandItem, path: Path, environment: Mapping[str, str]) \
+        -> PrefetchKey:
+    """
+    Get a key that uniquely identifies a run of a command item, so we know if a prefetched result
+    is for the same thing that the user is about to run.
+
+    :param command: The command to run.
+    :param path: The working directory for the command.
+    :param environment: The full environment for the command (see get_command_environment).
+    """
+    return (command.get_name(), command.command, command.stdin, path.get_gradefast_path(),
+            tuple(sorted(environment.items())))
+
+
+def find_folder_unattended(host: Host, base_path: Path,
+                           subfolder: Union[str, Sequence[str]]) -> Optional[Path]:
+    """
+    Find a new path to a folder based on a current folder and either a subfolder or a list of
+    regular expressions representing subfolders, without prompting the user. This follows the same
+    rules as CommandRunner._find_folder in grader.py.
+
+    :param host: The host to look for the folder on.
+    :param base_path: The path to the base folder to start the search from.
+    :param subfolder: The name of a subfolder (or relative path to a subfolder), or a list of
+        regular expressions.
+    :return: The path to a valid (sub)*folder, or None if we'd have to ask the user to choose
+        between multiple folders.
+    """
+    path = base_path
+    if isinstance(subfolder, str):
+        path = path.append(subfolder)
+    else:
+        for folder_regex in subfolder:
+            regex = re.compile(folder_regex)
+            matches = [name for name, type, is_link in host.list_folder(path)
+                       if type == "folder" and regex.fullmatch(name) is not None]
+            if len(matches) > 1:
+                # The user would have to make a choice here
+                return None
+            if len(matches) == 0:
+                break
+            path = path.append(matches[0])
+
+    if not host.folder_exists(path):
+        path = base_path
+    return path
+
+
+class CommandVisitor:
+    """
+    Callbacks used by walk_commands_unattended as it walks through the commands for a submission.
+    Subclasses must implement visit_command; the rest are optional.
+    """
+
+    def visit_command(self, command: CommandItem, path: Path, environment: Dict[str, str]) -> bool:
+        """
+        Called for each command item.
+
+        :param command: The command item.
+        :param path: The working directory for the command.
+        :param environment: The full environment for the command (see get_command_environment).
+        :return: True to move on to the next command, or False to stop walking.
+        """
+        raise NotImplementedError("visit_command must be implemented by subclass")
+
+    def enter_command_set(self, command_set: CommandSet, path: Path) -> None:
+        """
+        Called before walking through the commands in a command set.
+        """
+        pass
+
+    def exit_command_set(self, command_set: CommandSet) -> None:
+        """
+        Called after walking through all the commands in a command set.
+        """
+        pass
+
+    def stopped(self, reason: str) -> None:
+        """
+        Called if we had to stop walking because we couldn't figure out where the commands should
+        be run without asking the user.
+        """
+        pass
+
+
+def walk_commands_unattended(host: Host, commands: Sequence[Command], path: Path,
+                             environment: Mapping[str, str], submission_name: str,
+                             visitor: CommandVisitor) -> bool:
+    """
+    Walk through a group of commands in the order that they would be run on a submission,
+    resolving command set folders and merging environments like CommandRunner._do_command_set in
+    grader.py, but without prompting the user.
+
+    :param host: The host that the commands would be run on.
+    :param commands: The commands to walk through.
+    :param path: The initial working directory for the commands.
+    :param environment: A base dictionary of environment variables for the commands.
+    :param submission_name: The name of the submission that the commands are for.
+    :param visitor: The CommandVisitor to call for each command and command set.
+    :return: True if we made it through all the commands, or False if the walk was stopped.
+    """
+    if not host.folder_exists(path):
+        _logger.debug("walk_commands_unattended: Folder not found: {}", path)
+        visitor.stopped("Folder not found: {}".format(path))
+        return False
+
+    for command in commands:
+        if hasattr(command, "commands"):
+            # It's a command set
+            new_path = path
+            if command.folder:
+                new_path = find_folder_unattended(host, path, command.folder)
+                if new_path is None:
+                    _logger.debug("walk_commands_unattended: Ambiguous folder {} in {}",
+                                  command.folder, path)
+                    visitor.stopped("Multiple folders found when looking for {} in {}".format(
+                        command.folder, path))
+                    return False
+
+            new_environment = dict(environment)
+            new_environment.update(command.environment)
+
+            visitor.enter_command_set(command, new_path)
+            if not walk_commands_unattended(host, command.commands, new_path, new_environment,
+                                            submission_name, visitor):
+                return False
+            visitor.exit_command_set(command)
+        else:
+            # It's a command item
+            if not visitor.visit_command(
+                    command, path, get_command_environment(command, environment, submission_name)):
+                return False
+
+    return True
+
+
+class CommandPrefetcher:
+    """
+    Runs commands for the next few submissions in a bounded pool of worker threads, while the user
+    is still busy with the current submission. The results are cached per submission so they can
+    be shown right away when the user gets to each command.
+
+    Only commands that don't need any interaction with the user are prefetched (see
+    CommandItem.can_prefetch). Since later commands might depend on the side effects of earlier
+    ones, prefetching for a submission stops at the first foreground command that can't be
+    prefetched.
+    """
+
+    @inject()
+    def __init__(self, host: Host, settings: Settings, submission_manager: SubmissionManager,
+                 build_cache: BuildCache) -> None:
+        self.host = host
+        self.settings = settings
+        self.submission_manager = submission_manager
+        self.build_cache = build_cache
+
+        self._lock = threading.Lock()
+        self._futures = {}  # type: Dict[int, concurrent.futures.Future]
+        # Setting one of these stops the prefetching for a submission (see claim)
+        self._stop_events = {}  # type: Dict[int, threading.Event]
+
+        self._executor = None  # type: Optional[concurrent.futures.ThreadPoolExecutor]
+        if self.is_enabled():
+            _logger.info("Prefetching {} submissions ahead with {} workers",
+                         settings.prefetch_count, settings.prefetch_workers)
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(1, settings.prefetch_workers))
+
+    def is_enabled(self) -> bool:
+        return self.settings.prefetch_count > 0
+
+    def prefetch_after(self, submission_id: int) -> None:
+        """
+        Start prefetching commands for the submissions after a certain submission (up to the
+        configured number of submissions ahead).
+
+        :param submission_id: The ID of the submission that the user is currently on.
+        """
+        if not self.is_enabled():
+            return
+
+        next_id = submission_id
+        for _ in range(self.settings.prefetch_count):
+            next_id = self.submission_manager.get_next_submission_id(next_id)
+            if next_id is None:
+                break
+            with self._lock:
+                if next_id in self._futures:
+                    continue
+                submission = self.submission_manager.get_submission(next_id)
+                _logger.debug("Queueing prefetch for submission {} (ID {})", submission, next_id)
+                stop_event = threading.Event()
+                self._stop_events[next_id] = stop_event
+                self._futures[next_id] = self._executor.submit(
+                    self._prefetch_submission, submission.get_name(), submission.get_path(),
+                    stop_event)
+
+    def is_running(self, submission_id: int) -> bool:
+        """
+        Determine whether commands are currently being prefetched for a submission.
+        """
+        with self._lock:
+            future = self._futures.get(submission_id)
+        return future is not None and future.running()
+
+    def claim(self, submission_id: int) -> Dict[PrefetchKey, CommandResult]:
+        """
+        Get the prefetched results for a submission that the user is about to start. If the
+        prefetching is still in progress, this waits for it to finish (so we're not running
+        commands in the same folder twice at once). If it hasn't started yet, it is cancelled.
+
+        If the wait is interrupted, the prefetching is stopped (including any command that it's
+        in the middle of), and no results are returned. Even then, this doesn't return until the
+        prefetching is actually done.
+
+        Each submission's results can only be claimed once; after that, any commands are run live.
+
+        :param submission_id: The ID of the submission.
+        :return: A dict mapping keys from get_prefetch_key to the results of those commands.
+        """
+        with self._lock:
+            future = self._futures.pop(submission_id, None)
+            stop_event = self._stop_events.pop(submission_id, None)
+        if future is None or future.cancel():
+            return {}
+
+        try:
+            return future.result()
+        except (InterruptedError, KeyboardInterrupt):
+            _logger.info("Interrupted while waiting for prefetch of submission ID {}; stopping it",
+                         submission_id)
+            stop_event.set()
+            self._wait_until_stopped(future)
+        except:
+            _logger.exception("Error prefetching submission ID {}", submission_id)
+        return {}
+
+    @staticmethod
+    def _wait_until_stopped(future: concurrent.futures.Future) -> None:
+        """
+        Wait for a prefetch that was told to stop to finish. This can't be interrupted, but it
+        won't be long (see LocalHost.KILL_GRACE_PERIOD).
+        """
+        while True:
+            try:
+                concurrent.futures.wait([future])
+                return
+            except (InterruptedError, KeyboardInterrupt):
+                pass
+
+    def close(self) -> None:
+        """
+        Cancel any prefetching that hasn't started yet, stop any that's in progress, and stop
+        accepting new work.
+        """
+        if self._executor is None:
+            return
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            for stop_event in self._stop_events.values():
+                stop_event.set()
+            self._futures.clear()
+            self._stop_events.clear()
+        self._executor.shutdown(wait=False)
+
+    def _prefetch_submission(self, submission_name: str, submission_path: Path,
+                             stop_event: threading.Event) -> Dict[PrefetchKey, CommandResult]:
+        _logger.debug("Prefetching commands for {} in {}", submission_name, submission_path)
+        visitor = _PrefetchVisitor(self.host, self.build_cache, stop_event)
+        walk_commands_unattended(self.host, self.settings.commands, submission_path,
+                                 self.settings.base_env or {}, submission_name, visitor)
+        _logger.debug("Prefetched {} commands for {}", len(visitor.results), submission_name)
+        return visitor.results
+
+
+class _PrefetchVisitor(CommandVisitor):
+    def __init__(self, host: Host, build_cache: BuildCache, stop_event: threading.Event) -> None:
+        self.host = host
+        self.build_cache = build_cache
+        self.stop_event = stop_event
+        self.results = {}  # type: Dict[PrefetchKey, CommandResult]
+
+    def visit_command(self, command: CommandItem, path: Path, environment: Dict[str, str]) -> bool:
+        if self.stop_event.is_set():
+            return False
+        if not command.can_prefetch():
+            # Background commands aren't waited for, so nothing after them can depend on them
+            return command.is_background
+
+        try:
+            result = run_command_captured_cached(self.host, self.build_cache, command, path,
+                                                 environment, self.stop_event)
+        except CommandStartError as e:
+            _logger.debug("Error starting prefetched command {}: {}", command, e.message)
+            return False
+        self.results[get_prefetch_key(command, path, environment)] = result
+        return True
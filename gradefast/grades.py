@@ -6,7 +6,8 @@ Licensed under the MIT License. For more, see the LICENSE file.
 Author: Jake Hartz <jake@hartz.io>
 """
 
-from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+import threading
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
 
 from gradefast import exceptions, utils
 from gradefast.models import GradeItem, GradeScore, GradeSection, Hint, ScoreNumber, WeakScoreNumber
@@ -90,6 +91,23 @@ Section Score: {points_earned} / {points_possible}
 </div>"""
 
 
+# Bumped whenever a hint is added or replaced. Hints live in the grade structure, which is shared by
+# every submission, so any cached scores or feedback computed before the bump are stale.
+_hint_generation = 0
+
+
+def _hints_changed() -> None:
+    global _hint_generation
+    _hint_generation += 1
+
+
+def get_hint_generation() -> int:
+    """
+    Get a number that changes whenever a hint is added or replaced in any grade structure.
+    """
+    return _hint_generation
+
+
 def _get_deducted_points(score: ScoreNumber, late_deduction_percent: ScoreNumber,
                          precision: int = 0) -> ScoreNumber:
     """
@@ -111,7 +129,8 @@ class SubmissionGradeItem:
     """
 
     __slots__ = ("_change_handler", "_grade_item", "_name", "_name_html", "_notes", "_notes_html",
-                 "_enabled", "_hints_set")
+                 "_enabled", "_hints_set", "_parent", "_score_cache", "_feedback_cache",
+                 "_cache_generation", "_cache_lock")
 
     def __init__(self, grade_item: GradeItem) -> None:
         """
@@ -120,6 +139,20 @@ class SubmissionGradeItem:
         self._change_handler = None
         self._grade_item = grade_item
 
+        # The SubmissionGradeSection or SubmissionGrade that contains this item (set by the parent)
+        self._parent = None  # type: Optional[Union[SubmissionGradeSection, SubmissionGrade]]
+
+        # Cached results of get_score (keyed by is_late) and get_feedback (keyed by is_late and
+        # depth). These are cleared whenever this item or any of its children changes, and ignored
+        # if any hints have changed since they were filled.
+        self._score_cache = {}  # type: Dict[bool, Tuple[ScoreNumber, ScoreNumber]]
+        self._feedback_cache = {}  # type: Dict[Tuple[bool, int], str]
+        self._cache_generation = _hint_generation
+        # Held while filling or clearing the caches, so a result that was calculated before a
+        # change can't be stored after it (replaced with the SubmissionGrade's lock, so it's shared
+        # by the whole grade tree)
+        self._cache_lock = threading.RLock()
+
         # "None" indicates that we should use the default from grade_item. (We'll set these
         # properties if they're changed for this specific submission.) This technique is also used
         # for mutable but expensive properties in subclasses (i.e. anything that's not numeric).
@@ -157,6 +190,7 @@ class SubmissionGradeItem:
         self.set_notes(state["notes"])
         self.set_enabled(state["enabled"])
         self._hints_set = state["hints_set"]
+        self._invalidate_caches()
 
     def set_change_handler(self, change_handler: Callable[[], None]) -> None:
         """
@@ -172,9 +206,27 @@ class SubmissionGradeItem:
         """
         Tell the world (or at least someone who cares to listen) that our state has changed.
         """
+        self._invalidate_caches()
         if self._change_handler:
             self._change_handler()
 
+    def _invalidate_caches(self) -> None:
+        """
+        Clear the cached score and feedback for this grade item and everything above it in the
+        grade tree.
+        """
+        with self._cache_lock:
+            self._score_cache.clear()
+            self._feedback_cache.clear()
+            if self._parent is not None:
+                self._parent._invalidate_caches()
+
+    def _check_cache_generation(self) -> None:
+        if self._cache_generation != _hint_generation:
+            self._score_cache.clear()
+            self._feedback_cache.clear()
+            self._cache_generation = _hint_generation
+
     def enumerate_all(self, include_disabled: bool = False) -> Iterable["SubmissionGradeItem"]:
         """
         Enumerate recursively over all grade items (sections, scores, etc.), including ourself and
@@ -270,6 +322,7 @@ class SubmissionGradeItem:
         """
         self._grade_item.add_hint(Hint(name=name, value=make_score_number(value),
                                        default_enabled=False))
+        _hints_changed()
         self.changed()
 
     def replace_hint(self, index: int, name: str, value: WeakScoreNumber) -> None:
@@ -287,27 +340,54 @@ class SubmissionGradeItem:
         old_hint = self._grade_item.hints[index]
         self._grade_item.replace_hint(index, Hint(name=name, value=make_score_number(value),
                                                   default_enabled=old_hint.default_enabled))
+        _hints_changed()
         self.changed()
 
     def get_score(self, is_late: bool) -> Tuple[ScoreNumber, ScoreNumber]:
         """
-        Get the current point values and total possible points for this grade item.
+        Get the current point values and total possible points for this grade item. The result is
+        cached until this item (or one of its children) changes.
 
         :param is_late: Whether the parent submission is marked as late
         :return: A tuple with the points earned for this item/section (int or float) and the total
             points possible for this item/section (int or float).
         """
-        raise NotImplementedError("get_score must be implemented by subclass")
+        with self._cache_lock:
+            self._check_cache_generation()
+            score = self._score_cache.get(is_late)
+            if score is None:
+                score = self._calculate_score(is_late)
+                self._score_cache[is_late] = score
+            return score
+
+    def _calculate_score(self, is_late: bool) -> Tuple[ScoreNumber, ScoreNumber]:
+        """
+        Actually calculate the value returned by get_score.
+        """
+        raise NotImplementedError("_calculate_score must be implemented by subclass")
 
     def get_feedback(self, is_late: bool, depth: int = 0) -> str:
         """
-        Get the feedback for this grade item.
+        Get the feedback for this grade item. Like the score, the result is cached until this item
+        (or one of its children) changes.
 
         :param is_late: Whether the parent submission is marked as late
         :param depth: How deep we are in the grade structure (used to vary style)
         :return: The feedback, including score and comments, for this item and any children
         """
-        raise NotImplementedError("get_feedback must be implemented by subclass")
+        with self._cache_lock:
+            self._check_cache_generation()
+            feedback = self._feedback_cache.get((is_late, depth))
+            if feedback is None:
+                feedback = self._render_feedback(is_late, depth)
+                self._feedback_cache[(is_late, depth)] = feedback
+            return feedback
+
+    def _render_feedback(self, is_late: bool, depth: int) -> str:
+        """
+        Actually render the value returned by get_feedback.
+        """
+        raise NotImplementedError("_render_feedback must be implemented by subclass")
 
     def get_data(self) -> Dict[str, object]:
         """
@@ -395,6 +475,7 @@ class SubmissionGradeScore(SubmissionGradeItem):
     def set_state(self, state: dict) -> None:
         super().set_state(state)
         self._base_score = state["base_score"]
+        # This calls changed(), which takes care of the new base score too
         self.set_comments(state["comments"])
 
     def enumerate_all(self, include_disabled: bool = False) -> Iterable[SubmissionGradeItem]:
@@ -449,14 +530,14 @@ class SubmissionGradeScore(SubmissionGradeItem):
             self._comments_html = utils.markdown_to_html(comments)
         self.changed()
 
-    def get_score(self, is_late: bool) -> Tuple[ScoreNumber, ScoreNumber]:
+    def _calculate_score(self, is_late: bool) -> Tuple[ScoreNumber, ScoreNumber]:
         points_earned = self._base_score
         for index, hint in enumerate(self._grade_item.hints):
             if self.is_hint_enabled(index):
                 points_earned += hint.value
         return points_earned, self._points
 
-    def get_feedback(self, is_late: bool, depth: int = 0) -> str:
+    def _render_feedback(self, is_late: bool, depth: int) -> str:
         # Start off with the score (although we skip the score if it's 0 out of 0)
         points_earned, points_possible = self.get_score(is_late)
         score_feedback = ""
@@ -520,7 +601,7 @@ class SubmissionGradeSection(SubmissionGradeItem):
         super().__init__(grade_section)
 
         self._late_deduction = grade_section.default_late_deduction
-        self._children = _create_tree_from_structure(grade_section.grades)
+        self._children = _create_tree_from_structure(grade_section.grades, self)
 
     def get_state(self) -> dict:
         state = super().get_state()
@@ -558,7 +639,7 @@ class SubmissionGradeSection(SubmissionGradeItem):
         self._late_deduction = late_deduction
         self.changed()
 
-    def get_score(self, is_late: bool) -> Tuple[ScoreNumber, ScoreNumber]:
+    def _calculate_score(self, is_late: bool) -> Tuple[ScoreNumber, ScoreNumber]:
         points_earned = 0.0
         points_possible = 0.0
 
@@ -584,7 +665,7 @@ class SubmissionGradeSection(SubmissionGradeItem):
 
         return points_earned, points_possible
 
-    def get_feedback(self, is_late: bool, depth: int = 0) -> str:
+    def _render_feedback(self, is_late: bool, depth: int) -> str:
         points_earned, points_possible = self.get_score(is_late)
 
         # Add the title and overall points earned / points possible
@@ -634,9 +715,14 @@ class SubmissionGradeSection(SubmissionGradeItem):
         return data
 
 
-def _create_tree_from_structure(structure: Sequence[GradeItem]) -> List[SubmissionGradeItem]:
+def _create_tree_from_structure(structure: Sequence[GradeItem],
+                                parent: Union[SubmissionGradeSection, "SubmissionGrade"]) \
+        -> List[SubmissionGradeItem]:
     """
     Create a list of SubmissionGradeItem subclass instances from a list of GradeItems.
+
+    :param structure: The list of GradeItems.
+    :param parent: The SubmissionGradeSection or SubmissionGrade that will contain the new items.
     """
     items = []  # type: List[SubmissionGradeItem]
     for item in structure:
@@ -646,6 +732,7 @@ def _create_tree_from_structure(structure: Sequence[GradeItem]) -> List[Submissi
             items.append(SubmissionGradeSection(item))
         else:
             raise ValueError("Invalid structure item: {}".format(item))
+        items[-1]._parent = parent
     return items
 
 
@@ -659,12 +746,23 @@ class SubmissionGrade:
     """
 
     __slots__ = ("_change_handler", "_grades", "_is_late", "_overall_comments",
-                 "_overall_comments_html")
+                 "_overall_comments_html", "_score_cache", "_feedback_cache", "_cache_generation",
+                 "_cache_lock")
 
     def __init__(self, grade_structure: Sequence[GradeItem]) -> None:
         self._change_handler = None
 
-        self._grades = _create_tree_from_structure(grade_structure)
+        # Cached results of get_score and get_feedback (see SubmissionGradeItem)
+        self._score_cache = None  # type: Optional[Tuple[ScoreNumber, ScoreNumber]]
+        self._feedback_cache = None  # type: Optional[str]
+        self._cache_generation = _hint_generation
+        # Grades are read and changed from many threads (the GradeBook's, the grader's, event
+        # handlers); this guards the caches of every item in the grade tree
+        self._cache_lock = threading.RLock()
+
+        self._grades = _create_tree_from_structure(grade_structure, self)
+        for item in self.enumerate_all(include_disabled=True):
+            item._cache_lock = self._cache_lock
 
         self._is_late = False
         self._overall_comments = ""
@@ -692,9 +790,20 @@ class SubmissionGrade:
             item.set_change_handler(change_handler)
 
     def changed(self) -> None:
+        self._invalidate_caches()
         if self._change_handler:
             self._change_handler()
 
+    def _invalidate_caches(self) -> None:
+        with self._cache_lock:
+            self._score_cache = None
+            self._feedback_cache = None
+
+    def _check_cache_generation(self) -> None:
+        if self._cache_generation != _hint_generation:
+            self._invalidate_caches()
+            self._cache_generation = _hint_generation
+
     def enumerate_all(self, include_disabled: bool = False) -> Iterable[SubmissionGradeItem]:
         for item in self._grades:
             yield from item.enumerate_all(include_disabled)
@@ -783,31 +892,41 @@ class SubmissionGrade:
         :return: A tuple with the points earned for this submission and the total points possible
             for this submission.
         """
-        points_earned = 0.0
-        points_possible = 0.0
+        with self._cache_lock:
+            self._check_cache_generation()
+            if self._score_cache is not None:
+                return self._score_cache
 
-        for item in self._grades:
-            if item._enabled:
-                item_earned, item_possible = item.get_score(self._is_late)
-                # Add to the total
-                points_earned += item_earned
-                points_possible += item_possible
+            points_earned = 0.0
+            points_possible = 0.0
 
-        # Make everything an int if we can
-        points_earned = make_score_number(points_earned)
-        points_possible = make_score_number(points_possible)
+            for item in self._grades:
+                if item._enabled:
+                    item_earned, item_possible = item.get_score(self._is_late)
+                    # Add to the total
+                    points_earned += item_earned
+                    points_possible += item_possible
 
-        return points_earned, points_possible
+            # Make everything an int if we can
+            points_earned = make_score_number(points_earned)
+            points_possible = make_score_number(points_possible)
+
+            self._score_cache = points_earned, points_possible
+            return self._score_cache
 
     def get_feedback(self) -> str:
         """
         Patch together all the grade comments for this submission.
         """
-        content = "\n".join(item.get_feedback(self._is_late, 1)
-                            for item in self._grades
-                            if item._enabled)
-        return FeedbackHTMLTemplates.base.format(content=content,
-                                                 overall_comments=self._overall_comments_html)
+        with self._cache_lock:
+            self._check_cache_generation()
+            if self._feedback_cache is None:
+                content = "\n".join(item.get_feedback(self._is_late, 1)
+                                    for item in self._grades
+                                    if item._enabled)
+                self._feedback_cache = FeedbackHTMLTemplates.base.format(
+                    content=content, overall_comments=self._overall_comments_html)
+            return self._feedback_cache
 
     def get_data(self) -> Dict[str, object]:
         """
@@ -6,12 +6,19 @@ Licensed under the MIT License. For more, see the LICENSE file.
 Author: Jake Hartz <jake@hartz.io>
 """
 
+import codecs
 import errno
 import io
+import locale
 import os
+import selectors
 import shutil
+import signal
 import subprocess
+import sys
+import tarfile
 import threading
+import time
 import zipfile
 from typing import Any, Callable, List, Mapping, Optional, Sequence, Tuple, Union
 
@@ -19,7 +26,45 @@ from iochannels import Channel, Msg
 from pyprovide import inject
 
 from gradefast.loggingwrapper import get_logger
-from gradefast.models import LocalPath, Path, Settings
+from gradefast.models import CommandItem, LocalPath, Path, Settings
+from gradefast.outputbuffer import OutputBuffer
+
+try:
+    import pty
+    import termios
+except ImportError:
+    # Not available on Windows
+    pty = None
+    termios = None
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+_logger = get_logger("hosts")
+
+# A tiny Python script that sets the CPU and memory limits for a command, and then replaces itself
+# with the command (so the command, and everything that it runs, inherits them). This is run as a
+# wrapper around a command that has those limits (see LocalHost._start_process).
+# (We can't set the limits with Popen's "preexec_fn", since that isn't safe when there are other
+# threads running, and GradeFast always has a few of those.)
+#     Arguments: CPU_LIMIT MEMORY_LIMIT COMMAND [ARGS...]
+_SET_LIMITS_SCRIPT = """
+import math, os, resource, sys
+cpu_limit, memory_limit = sys.argv[1:3]
+if cpu_limit:
+    # The soft limit sends a "SIGXCPU"; the hard limit (a second later) is a "SIGKILL"
+    seconds = int(math.ceil(float(cpu_limit)))
+    resource.setrlimit(resource.RLIMIT_CPU, (seconds, seconds + 1))
+if memory_limit:
+    resource.setrlimit(resource.RLIMIT_AS, (int(memory_limit), int(memory_limit)))
+try:
+    os.execvp(sys.argv[3], sys.argv[3:])
+except OSError as ex:
+    sys.stderr.write("Couldn't start {}: {}\\n".format(sys.argv[3], ex))
+    sys.exit(127)
+"""
 
 
 class BackgroundCommand:
@@ -39,7 +84,7 @@ class BackgroundCommand:
         """
         raise NotImplementedError()
 
-    def get_output(self) -> str:
+    def get_output(self) -> OutputBuffer:
         """
         Get all the output from the command.
 
@@ -47,6 +92,19 @@ class BackgroundCommand:
         """
         raise NotImplementedError()
 
+    def get_output_size(self) -> int:
+        """
+        Get the amount of output (in characters) that the command has printed so far, without
+        waiting for it to finish.
+        """
+        raise NotImplementedError()
+
+    def stop(self) -> None:
+        """
+        Stop the command if it's still running, without waiting for it to exit.
+        """
+        raise NotImplementedError()
+
     def get_error(self) -> Optional[str]:
         """
         Get an error message, if the command did not finish successfully.
@@ -56,6 +114,39 @@ class BackgroundCommand:
         raise NotImplementedError()
 
 
+class CommandResult:
+    """
+    The captured result of a command that has finished running without any interaction with the
+    user (see Host.run_command_captured).
+    """
+
+    __slots__ = ("output", "returncode", "start_time", "end_time", "error")
+
+    def __init__(self, output: OutputBuffer, returncode: int, start_time: float, end_time: float,
+                 error: str = None) -> None:
+        self.output = output
+        self.returncode = returncode
+        self.start_time = start_time
+        self.end_time = end_time
+        self.error = error
+
+    def get_duration(self) -> float:
+        """
+        Get how long the command took to run, in seconds.
+        """
+        return self.end_time - self.start_time
+
+    def get_error(self) -> Optional[str]:
+        """
+        Get an error message, if the command did not finish successfully.
+        """
+        if self.error:
+            return self.error
+        if self.returncode != 0:
+            return "Command had nonzero return code: {}".format(self.returncode)
+        return None
+
+
 class CommandStartError(Exception):
     """
     Represents an error in starting a command.
@@ -72,6 +163,72 @@ class CommandRunError(Exception):
         self.message = message
 
 
+# The file extensions of archives that can be extracted with extract_archive (the longer ones come
+# first so "tar.gz" is matched before "gz" could be)
+ARCHIVE_EXTENSIONS = ("tar.bz2", "tar.gz", "tar.xz", "tbz2", "tgz", "txz", "tar", "zip")
+
+
+def split_archive_name(name: str) -> Optional[Tuple[str, str]]:
+    """
+    Split the filename of an archive into its base name and extension.
+
+    :param name: The filename (e.g. "submission.tar.gz").
+    :return: A tuple of the form (base name, extension) (e.g. ("submission", "tar.gz")), or None if
+        the file doesn't have one of the extensions in ARCHIVE_EXTENSIONS.
+    """
+    lower_name = name.lower()
+    for ext in ARCHIVE_EXTENSIONS:
+        if lower_name.endswith("." + ext) and len(name) > len(ext) + 1:
+            return name[:-len(ext) - 1], name[-len(ext):]
+    return None
+
+
+def extract_archive(local_path: LocalPath, folder_local_path: LocalPath) -> None:
+    """
+    Extract a zip or tar archive (possibly compressed with gzip, bzip2, or xz) into a folder. Any
+    members that would end up outside of the folder (absolute paths, "..", or links pointing
+    elsewhere) are skipped.
+
+    :param local_path: The path to the archive.
+    :param folder_local_path: The folder to extract it into. It is created if it doesn't exist.
+    """
+    archive_path = local_path.get_local_path()
+    folder = folder_local_path.get_local_path()
+    os.makedirs(folder, exist_ok=True)
+
+    if archive_path.lower().endswith(".zip") or zipfile.is_zipfile(archive_path):
+        # zipfile already sanitizes the member paths
+        with zipfile.ZipFile(archive_path, "r") as archive:
+            archive.extractall(folder)
+        return
+
+    with tarfile.open(archive_path, "r:*") as archive:
+        if hasattr(tarfile, "data_filter"):
+            def skip_unsafe(member: tarfile.TarInfo, path: str) -> Optional[tarfile.TarInfo]:
+                try:
+                    return tarfile.data_filter(member, path)
+                except tarfile.FilterError as ex:
+                    _logger.warning("Skipping archive member in {}: {}", archive_path, ex)
+                    return None
+
+            archive.extractall(folder, filter=skip_unsafe)
+            return
+
+        real_folder = os.path.realpath(folder)
+
+        def is_safe(member: tarfile.TarInfo) -> bool:
+            if not (member.isfile() or member.isdir() or member.issym()):
+                return False
+            target = os.path.realpath(os.path.join(real_folder, member.name))
+            if member.issym():
+                target = os.path.realpath(os.path.join(os.path.dirname(target),
+                                                       member.linkname))
+            return os.path.commonpath([real_folder, target]) == real_folder
+
+        archive.extractall(folder, members=[member for member in archive.getmembers()
+                                            if is_safe(member)])
+
+
 class Host:
     """
     Abstract class for interactions between the grader and an operating system host.
@@ -86,25 +243,57 @@ class Host:
         self.settings = settings
 
     def run_command(self, command: str, path: Path, environment: Mapping[str, str],
-                    stdin: str = None, print_output: bool = True) -> str:
+                    stdin: str = None, print_output: bool = True, tty: bool = False,
+                    limits: CommandItem.Limits = None) -> OutputBuffer:
         """
         Execute a command on this host.
 
         If print_output is true, the output of the command will be written using self.channel.print
-        as it comes in. Regardless of print_output, the output of the command will also be
-        returned after the command has finished.
+        as it comes in (if there's a lot of output, only the beginning and end are printed).
+        Regardless of print_output, the output of the command will also be returned after the
+        command has finished.
 
         If input is needed and "stdin" is None, then self.channel.input will be used.
 
         If there is an error when starting the command (e.g. command not found), a
         CommandStartError will be raised. If there is an error running the command (e.g. the
-        command exited with a nonzero return code), a CommandRunError will be raised.
+        command exited with a nonzero return code, or it was stopped for going over one of its
+        limits), a CommandRunError will be raised.
 
         :param command: The command to run.
         :param path: The working directory for the command.
         :param environment: Any environmental variables for this command.
         :param stdin: Any input to use as stdin. If not provided, self.channel.input will be used.
         :param print_output: Whether to print the output using self.channel.print as it comes in.
+        :param tty: Whether to run the command under a pseudo-terminal (if this host supports it),
+            so it thinks it's writing to a terminal. This makes most programs line-buffer their
+            output (so prompts show up right away), and keeps stdout and stderr in order.
+        :param limits: Any limits on the command. If the command goes over one of these, it is
+            stopped. Hosts that can't enforce some of the limits may ignore them.
+        """
+        raise NotImplementedError()
+
+    def run_command_captured(self, command: str, path: Path, environment: Mapping[str, str],
+                             stdin: str = None, limits: CommandItem.Limits = None,
+                             stop_event: threading.Event = None) -> CommandResult:
+        """
+        Execute a command on this host without any interaction with the user. Nothing is printed
+        using self.channel, and self.channel.input is never used (if "stdin" is None, the command's
+        standard input is closed right away). This is safe to call from any thread.
+
+        If there is an error when starting the command (e.g. command not found), a
+        CommandStartError will be raised. Unlike the "run_command" method, a nonzero return code is
+        NOT raised as a CommandRunError; instead, it is included in the returned CommandResult
+        (along with any limit that the command went over).
+
+        :param command: The command to run.
+        :param path: The working directory for the command.
+        :param environment: Any environmental variables for this command.
+        :param stdin: Any input to use as stdin.
+        :param limits: Any limits on the command (see run_command).
+        :param stop_event: If this is set while the command is running, the command is stopped
+            (like when it goes over a limit).
+        :return: A CommandResult with the command's output, return code, and timing.
         """
         raise NotImplementedError()
 
@@ -125,7 +314,8 @@ class Host:
         raise NotImplementedError()
 
     def start_background_command(self, command: str, path: Path, environment: Mapping[str, str],
-                                 stdin: str = None) -> BackgroundCommand:
+                                 stdin: str = None,
+                                 limits: CommandItem.Limits = None) -> BackgroundCommand:
         """
         Start a command executing in the background.
 
@@ -140,6 +330,7 @@ class Host:
         :param path: The working directory for the command.
         :param environment: Any environmental variables for this command.
         :param stdin: Any input to use as stdin.
+        :param limits: Any limits on the command (see run_command).
 
         :return: A BackgroundCommand representing the executing command.
         """
@@ -161,12 +352,17 @@ class Host:
         """
         Move a file into a destination folder. The destination folder will be created if it doesn't
         already exist.
+
+        This may be called from multiple threads at once (for different files).
         """
         raise NotImplementedError()
 
-    def unzip(self, path: Path, folder_path: Path) -> None:
+    def extract_archive(self, path: Path, folder_path: Path) -> None:
         """
-        Unzip a zipfile into a destination folder. The destination folder may already exist.
+        Extract an archive (any of the types in ARCHIVE_EXTENSIONS) into a destination folder. The
+        destination folder may already exist.
+
+        This may be called from multiple threads at once (for different archives).
         """
         raise NotImplementedError()
 
@@ -355,34 +551,143 @@ class LocalHost(Host):
 
     logger = get_logger("hosts.LocalHost")
 
+    # How long a process gets to exit after being asked nicely (with a "SIGTERM") when it goes
+    # over one of its limits, before it's killed (with a "SIGKILL")
+    KILL_GRACE_PERIOD = 2
+
+    # How often run_command_captured checks its "stop_event" while a command is running
+    STOP_EVENT_POLL_INTERVAL = 0.2
+
     @staticmethod
-    def _kill_process_gracefully(process: subprocess.Popen) -> None:
-        if process.poll() is None:
+    def _uses_process_group(limits: Optional[CommandItem.Limits]) -> bool:
+        # Processes with limits get their own process group (on POSIX systems), so anything that
+        # they start is stopped along with them
+        return limits is not None and os.name == "posix"
+
+    @staticmethod
+    def _signal_process(process: subprocess.Popen, use_group: bool, force: bool) -> None:
+        if use_group:
+            try:
+                os.killpg(process.pid, signal.SIGKILL if force else signal.SIGTERM)
+            except (ProcessLookupError, PermissionError):
+                # Everything in the process group already exited
+                pass
+        elif process.poll() is None:
+            if force:
+                process.kill()
+            else:
+                process.terminate()
+
+    @staticmethod
+    def _kill_process_gracefully(process: subprocess.Popen, use_group: bool = False) -> None:
+        if process.poll() is not None:
             return
         # Stop the process gracefully (with a "SIGTERM")
-        process.terminate()
+        LocalHost._signal_process(process, use_group, force=False)
         # We won't leave until the process is actually dead
         LocalHost.logger.debug("Waiting for process to die")
         while process.poll() is None:
             try:
                 process.wait()
             except (InterruptedError, KeyboardInterrupt):
-                if process.poll() is None:
-                    # We tried being peaceful; this time, go for the "SIGKILL"
-                    process.kill()
+                # We tried being peaceful; this time, go for the "SIGKILL"
+                LocalHost._signal_process(process, use_group, force=True)
+
+    class Watchdog:
+        """
+        Stops a process if it goes over its time limit or its output limit, and figures out which
+        limit (if any) the process went over once it's done. The CPU and memory limits are
+        enforced by the operating system (see LocalHost._start_process).
+        """
+
+        def __init__(self, process: subprocess.Popen,
+                     limits: Optional[CommandItem.Limits]) -> None:
+            self._process = process
+            self._limits = limits
+            self.use_group = LocalHost._uses_process_group(limits)
+            self._stop_reason = None  # type: Optional[str]
+            self._lock = threading.Lock()
+
+            self._timer = None  # type: Optional[threading.Timer]
+            if limits and limits.timeout:
+                self._timer = threading.Timer(
+                    limits.timeout, self.stop,
+                    args=("Command timed out after {} seconds".format(limits.timeout),))
+                self._timer.daemon = True
+                self._timer.start()
+
+        def get_max_output(self) -> Optional[int]:
+            return self._limits.max_output if self._limits else None
+
+        def stop_for_output(self) -> None:
+            self.stop("Command printed more than {} characters of output".format(
+                self._limits.max_output))
+
+        def stop(self, reason: str) -> None:
+            """
+            Stop the process (in the background, so this never blocks), first with a "SIGTERM",
+            then with a "SIGKILL" if it hasn't exited after LocalHost.KILL_GRACE_PERIOD.
+            """
+            with self._lock:
+                if self._stop_reason is not None or self._process.poll() is not None:
+                    return
+                self._stop_reason = reason
+            LocalHost.logger.info("Stopping process {!r}: {}", self._process.args, reason)
+            threading.Thread(target=self._kill, daemon=True).start()
+
+        def _kill(self) -> None:
+            LocalHost._signal_process(self._process, self.use_group, force=False)
+            try:
+                self._process.wait(LocalHost.KILL_GRACE_PERIOD)
+            except subprocess.TimeoutExpired:
+                LocalHost.logger.debug("Process {!r} ignored SIGTERM", self._process.args)
+            # With a process group, this also cleans up anything left over after the process exits
+            LocalHost._signal_process(self._process, self.use_group, force=True)
+
+        def finish(self) -> None:
+            """
+            Stop watching the process (once it's done).
+            """
+            if self._timer:
+                self._timer.cancel()
+
+        def get_error(self, returncode: int) -> Optional[str]:
+            """
+            Get a message describing the limit that the process went over, if any.
+            """
+            if self._stop_reason is not None:
+                return self._stop_reason
+            if self._limits and self._limits.cpu_limit and hasattr(signal, "SIGXCPU"):
+                # Going over the soft CPU limit sends a "SIGXCPU", and going over the hard limit
+                # sends a "SIGKILL" (and a shell reports those as 128 + the signal number)
+                if returncode in (-signal.SIGXCPU, -signal.SIGKILL,
+                                  128 + signal.SIGXCPU, 128 + signal.SIGKILL):
+                    return "Command went over its CPU time limit of {} seconds".format(
+                        self._limits.cpu_limit)
+            return None
 
     class LocalBackgroundCommand(BackgroundCommand):
         logger = get_logger("hosts.LocalBackgroundCommand")
 
-        def __init__(self, process: subprocess.Popen, command_str: str, path: Path) -> None:
-            self._output = None  # type: Optional[str]
+        def __init__(self, process: subprocess.Popen, command_str: str, path: Path,
+                     watchdog: "LocalHost.Watchdog") -> None:
             self._error_msg = None  # type: Optional[str]
             self._process = process
+            self._watchdog = watchdog
             self._done = False
             self._lock = threading.Lock()
             self._command_str = command_str
             self._path = path
 
+            # Read the output as it comes in, so the process never gets stuck on a full pipe
+            self._output = OutputBuffer()
+            self._reader_thread = threading.Thread(
+                target=LocalHost._stdout_reader_thread,
+                args=(process, process.stdout.fileno(), self._output, None,
+                      threading.Event(), watchdog.get_max_output(), watchdog.stop_for_output))
+            self._reader_thread.daemon = True
+            self._reader_thread.start()
+
         def get_description(self) -> str:
             return "(in {}):\n{}".format(
                 self._path, "\n".join("    " + line for line in self._command_str.splitlines()))
@@ -396,31 +701,46 @@ class LocalHost(Host):
                     self._process.wait()
                 except (InterruptedError, KeyboardInterrupt):
                     self.logger.debug("Background command interrupted {}", self.get_description())
-                    LocalHost._kill_process_gracefully(self._process)
+                    LocalHost._kill_process_gracefully(self._process, self._watchdog.use_group)
                     self._error_msg = "Background command interrupted"
                 self.logger.debug("Background command DONE {}", self.get_description())
                 self._done = True
-                try:
-                    # Since we already closed stdin, but haven't touched stdout, we should be fine
-                    # reading it directly
-                    self._output = self._process.stdout.read()
-                except:
-                    self.logger.exception("Error reading output from background command {}",
-                                          self.get_description())
+                self._reader_thread.join()
+                self._watchdog.finish()
+                if not self._error_msg:
+                    error = self._watchdog.get_error(self._process.returncode)
+                    if error:
+                        self._error_msg = "Background command stopped: {}".format(error)
                 if not self._error_msg and self._process.returncode != 0:
                     self._error_msg = "Background command had nonzero return code: {}".format(
                         self._process.returncode)
 
-        def get_output(self) -> str:
+        def get_output(self) -> OutputBuffer:
             self.wait()
             return self._output
 
+        def get_output_size(self) -> int:
+            return len(self._output)
+
+        def stop(self) -> None:
+            self._watchdog.stop("Command was stopped before it finished")
+
         def get_error(self) -> Optional[str]:
             self.wait()
             return self._error_msg
 
     def _start_process(self, command: str, path: Path, environment: Mapping[str, str],
-                       **kwargs: Any) -> subprocess.Popen:
+                       limits: CommandItem.Limits = None, **kwargs: Any) -> subprocess.Popen:
+        if LocalHost._uses_process_group(limits):
+            kwargs["start_new_session"] = True
+        set_limits = False
+        if limits and (limits.cpu_limit or limits.memory_limit):
+            if resource is None:
+                self.logger.warning("CPU and memory limits aren't supported here; ignoring them "
+                                    "for {!r}", command)
+            else:
+                set_limits = True
+
         args = command  # type: Union[str, List[str]]
         if self.settings.shell_command:
             # Use the user-provided shell
@@ -428,10 +748,18 @@ class LocalHost(Host):
             if self.settings.shell_args:
                 args += self.settings.shell_args
             args.append(command)
+        elif set_limits:
+            # Same as what Popen does with "shell=True" (we know we're on a POSIX system, since
+            # the "resource" module is available)
+            args = ["/bin/sh", "-c", command]
         else:
             # Let the platform default shell parse the command
             kwargs["shell"] = True
 
+        if set_limits:
+            args = [sys.executable, "-c", _SET_LIMITS_SCRIPT,
+                    str(limits.cpu_limit or ""), str(limits.memory_limit or "")] + args
+
         local_path_str = self.gradefast_path_to_local_path(path).get_local_path()
         self.logger.debug("Starting process {!r} (cwd: {})", args, local_path_str)
         try:
@@ -445,6 +773,39 @@ class LocalHost(Host):
         return self._start_process(command, path, environment, stdin=subprocess.PIPE,
                                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT, **kwargs)
 
+    def _start_process_with_pty(self, command: str, path: Path, environment: Mapping[str, str],
+                                limits: CommandItem.Limits = None) -> Tuple[subprocess.Popen, int]:
+        """
+        Start a process with its stdin, stdout, and stderr all connected to a new pseudo-terminal.
+
+        :return: The process, and the file descriptor for our end of the pseudo-terminal (which the
+            caller must close).
+        """
+        master_fd, slave_fd = pty.openpty()
+        try:
+            # Don't echo the input back as output (the user already sees what they type, and the
+            # input shouldn't show up in the output that gets diffed)
+            attributes = termios.tcgetattr(slave_fd)
+            attributes[3] &= ~termios.ECHO
+            termios.tcsetattr(slave_fd, termios.TCSANOW, attributes)
+            process = self._start_process(command, path, environment, limits, stdin=slave_fd,
+                                          stdout=slave_fd, stderr=slave_fd)
+        except:
+            os.close(master_fd)
+            raise
+        finally:
+            os.close(slave_fd)
+        return process, master_fd
+
+    @staticmethod
+    def _try_pty_write(process: subprocess.Popen, master_fd: int, data: bytes) -> None:
+        try:
+            os.write(master_fd, data)
+        except OSError as e:
+            # This usually means that the process already exited
+            LocalHost.logger.debug("{} when writing to the terminal of process {!r}",
+                                   type(e).__name__, process.args)
+
     @staticmethod
     def _try_stdin_write(process: subprocess.Popen, stdin: str = None) -> None:
         if stdin is not None:
@@ -478,67 +839,219 @@ class LocalHost(Host):
             else:
                 raise
 
+    # The range of sizes for each read from a process's stdout (the size grows while the process is
+    # outputting a lot, and shrinks back down when it calms down)
+    MIN_READ_SIZE = 4096
+    MAX_READ_SIZE = 1024 * 1024
+    # The minimum time between sending chunks of output to the channel (in seconds), so a process
+    # that outputs a ton doesn't flood the channel with tiny messages
+    OUTPUT_INTERVAL = 1 / 30
+    # How long an interactive process's output has to stop for (in seconds) before the end of it is
+    # printed, even if it's past the part that's printed as it comes in (since the process might be
+    # waiting for input)
+    IDLE_OUTPUT_INTERVAL = 0.25
+
     @staticmethod
-    def _stdout_reader_thread(process: subprocess.Popen, buffer: io.StringIO,
+    def _stdout_reader_thread(process: subprocess.Popen, stdout_fileno: int, buffer: OutputBuffer,
                               output_func: Optional[Callable[[Msg], None]],
-                              print_status_when_done: threading.Event) -> None:
+                              print_status_when_done: threading.Event,
+                              max_output: int = None,
+                              on_max_output: Callable[[], None] = None) -> None:
         LocalHost.logger.debug("Started thread to read from stdout of process {!r}", process.args)
-        stdout_fileno = process.stdout.fileno()
-        while True:
-            data = None
-            try:
-                if output_func:
-                    # Since process.stdout.read(...) is blocking, we used to read the process's
-                    # output one byte at a time, to make sure we could show it as soon as possible.
-                    #data = process.stdout.read(1)
-
-                    # Reading byte-by-byte is terribly inefficient with lots of output. So,
-                    # instead, this uses os.read(), which does a non-blocking read (if fewer bytes
-                    # are available than requested, then it just returns whatever it has).
-                    data = os.read(stdout_fileno, 1024).decode()
-                else:
-                    # Since there's no output function (i.e. nobody wants this output right away),
-                    # it's okay to let it buffer for a bit.
-                    data = process.stdout.read(1024)
-            except BrokenPipeError:
-                LocalHost.logger.debug("BrokenPipeError when reading stdout of process {!r}",
-                                       process.args)
-            except:
-                LocalHost.logger.exception("Exception when reading stdout of process {!r}",
+
+        # Decode incrementally, so characters that are split across reads still come out right
+        # (with the same encoding and newline handling as "universal_newlines")
+        decoder = io.IncrementalNewlineDecoder(
+            codecs.getincrementaldecoder(locale.getpreferredencoding(False))(errors="replace"),
+            translate=True)
+        read_size = LocalHost.MIN_READ_SIZE
+        pending_output = []  # type: List[str]
+        last_output_time = 0.0
+        last_read_time = 0.0
+        output_length = 0
+        # How much of the output has been printed (or skipped), and whether we've said that some
+        # of what hasn't been printed yet is going to be skipped
+        printed_length = 0
+        skipping = False
+
+        def limit_output(text: str) -> str:
+            # Once the output goes over "max_output", we cut it off (but keep reading until the
+            # process is stopped, so it doesn't get stuck on a full pipe in the meantime)
+            nonlocal output_length
+            if max_output is None:
+                return text
+            if output_length + len(text) > max_output:
+                text = text[:max_output - output_length]
+                if on_max_output:
+                    on_max_output()
+            output_length += len(text)
+            return text
+
+        def add_output(text: str) -> None:
+            # Only the part of the output that fits in the buffer's head is printed as it comes in;
+            # the end of the output (from the buffer's tail) is printed once the process is done,
+            # or whenever an interactive process stops outputting for a bit (see catch_up)
+            nonlocal printed_length, skipping
+            buffer.write(text)
+            if output_func and text:
+                if printed_length < buffer.head_size:
+                    text = text[:buffer.head_size - printed_length]
+                    pending_output.append(text)
+                    printed_length += len(text)
+                    if printed_length < len(buffer) or not selector or \
+                            time.monotonic() - last_output_time >= LocalHost.OUTPUT_INTERVAL:
+                        send_output()
+                if not skipping and len(buffer) - printed_length > buffer.tail_size:
+                    # There's more waiting than the tail can hold, so some of it won't be printed
+                    skipping = True
+                    output_func(Msg().print().status("(Skipping to the end of the output)"))
+
+        def send_output() -> None:
+            nonlocal pending_output, last_output_time
+            if pending_output and output_func:
+                output_func(Msg(end="").print("{}", "".join(pending_output)))
+            pending_output = []
+            last_output_time = time.monotonic()
+
+        def is_behind() -> bool:
+            # "print_status_when_done" is only set while input is being forwarded to the process
+            return bool(output_func) and print_status_when_done.is_set() and \
+                printed_length < len(buffer)
+
+        def catch_up() -> None:
+            # Print whatever hasn't been printed yet (as much of it as the buffer's tail has)
+            nonlocal printed_length, skipping
+            send_output()
+            unprinted_length = len(buffer) - printed_length
+            if unprinted_length <= 0:
+                return
+            tail = buffer.get_tail()
+            if unprinted_length > len(tail):
+                output_func(Msg().status("[{} characters omitted]",
+                                         unprinted_length - len(tail)).print())
+            else:
+                tail = tail[len(tail) - unprinted_length:]
+            output_func(Msg(end="").print("{}", tail))
+            printed_length = len(buffer)
+            skipping = False
+
+        # On Windows, select() only works on sockets, so we just block on os.read() (which returns
+        # as soon as any output is available) and send output after every read
+        selector = None
+        if sys.platform != "win32":
+            selector = selectors.DefaultSelector()
+            selector.register(stdout_fileno, selectors.EVENT_READ)
+
+        try:
+            while True:
+                if selector and pending_output:
+                    # Wait for more output, but not past when the pending output should be sent
+                    timeout = max(0.0, last_output_time + LocalHost.OUTPUT_INTERVAL -
+                                  time.monotonic())
+                    if not selector.select(timeout):
+                        send_output()
+                        continue
+                elif selector and is_behind():
+                    # If the output stops for a bit, the process might be prompting for input
+                    timeout = max(0.0, last_read_time + LocalHost.IDLE_OUTPUT_INTERVAL -
+                                  time.monotonic())
+                    if not selector.select(timeout):
+                        catch_up()
+                        continue
+
+                try:
+                    data = os.read(stdout_fileno, read_size)
+                except BrokenPipeError:
+                    LocalHost.logger.debug("BrokenPipeError when reading stdout of process {!r}",
                                            process.args)
-                break
-            if not data:
-                LocalHost.logger.debug("No more data from stdout of process {!r}", process.args)
-                break
-            buffer.write(data)
-            if output_func:
-                output_func(Msg(end="").print("{}", data))
+                    data = None
+                except Exception as e:
+                    if isinstance(e, OSError) and e.errno == errno.EIO:
+                        # On Linux, reading from a pseudo-terminal fails with EIO once the process
+                        # (and anything else using the terminal) has exited
+                        data = None
+                    else:
+                        LocalHost.logger.exception(
+                            "Exception when reading stdout of process {!r}", process.args)
+                        break
+                if not data:
+                    LocalHost.logger.debug("No more data from stdout of process {!r}",
+                                           process.args)
+                    break
+
+                if len(data) == read_size:
+                    read_size = min(read_size * 2, LocalHost.MAX_READ_SIZE)
+                elif len(data) < read_size // 4:
+                    read_size = max(read_size // 2, LocalHost.MIN_READ_SIZE)
+
+                last_read_time = time.monotonic()
+                add_output(limit_output(decoder.decode(data)))
+        finally:
+            if selector:
+                selector.close()
+
+        add_output(limit_output(decoder.decode(b"", final=True)))
+        buffer.finish()
         if output_func:
+            catch_up()
             output_func(Msg().print())
             if print_status_when_done.is_set():
                 output_func(Msg(end="").status("Press Enter to continue..."))
 
     def run_command(self, command: str, path: Path, environment: Mapping[str, str],
-                    stdin: str = None, print_output: bool = True) -> str:
+                    stdin: str = None, print_output: bool = True, tty: bool = False,
+                    limits: CommandItem.Limits = None) -> OutputBuffer:
         self.logger.info("Running command {!r}", command)
 
+        if tty and pty is None:
+            self.logger.warning("Pseudo-terminals aren't supported here; using pipes for {!r}",
+                                command)
+            tty = False
+
         with self.channel.blocking_io() as (output_func, input_func, prompt_func):
-            process = self._start_process_with_pipes(command, path, environment, bufsize=0)
+            master_fd = None
+            if tty:
+                process, master_fd = self._start_process_with_pty(command, path, environment,
+                                                                  limits)
+                stdout_fileno = master_fd
+                encoding = locale.getpreferredencoding(False)
+                # Closing stdin for a terminal means sending the end-of-file character
+                eof = termios.tcgetattr(master_fd)[6][termios.VEOF]
+
+                def write_stdin(text: str) -> None:
+                    LocalHost._try_pty_write(process, master_fd, (text + "\n").encode(encoding))
+
+                def close_stdin() -> None:
+                    LocalHost._try_pty_write(process, master_fd, eof)
+            else:
+                process = self._start_process_with_pipes(command, path, environment, limits=limits,
+                                                         bufsize=0)
+                stdout_fileno = process.stdout.fileno()
+
+                def write_stdin(text: str) -> None:
+                    LocalHost._try_stdin_write(process, text)
+
+                def close_stdin() -> None:
+                    LocalHost._try_stdin_close(process)
+
+            watchdog = LocalHost.Watchdog(process, limits)
 
             # Start a thread to handle the command's output
-            output = io.StringIO()
+            output = OutputBuffer()
             print_status_when_done = threading.Event()
             if print_output:
                 print_status_when_done.set()
             t = threading.Thread(target=LocalHost._stdout_reader_thread,
-                                 args=(process, output, output_func if print_output else None,
-                                       print_status_when_done))
+                                 args=(process, stdout_fileno, output,
+                                       output_func if print_output else None,
+                                       print_status_when_done, watchdog.get_max_output(),
+                                       watchdog.stop_for_output))
             t.daemon = True
             t.start()
 
             # If we have predetermined input, write it to stdin
             if stdin is not None:
-                LocalHost._try_stdin_write(process, stdin)
+                write_stdin(stdin)
 
             try:
                 if print_output:
@@ -548,25 +1061,72 @@ class LocalHost(Host):
                         stdin = input_func()
                         if stdin is None:
                             break
-                        LocalHost._try_stdin_write(process, stdin)
+                        write_stdin(stdin)
                     print_status_when_done.clear()
                 else:
                     # Wait for the process to complete, without sending it more standard input
                     self.logger.debug("Waiting for process without forwarding input")
 
-                LocalHost._try_stdin_close(process)
+                close_stdin()
                 if process.poll() is None:
                     process.wait()
             except (InterruptedError, KeyboardInterrupt):
                 print_status_when_done.clear()
-                LocalHost._kill_process_gracefully(process)
-                LocalHost._try_stdin_close(process)
+                LocalHost._kill_process_gracefully(process, watchdog.use_group)
+                close_stdin()
             t.join()
+            watchdog.finish()
+            if master_fd is not None:
+                os.close(master_fd)
 
+        error = watchdog.get_error(process.returncode)
+        if error:
+            raise CommandRunError(error)
         if process.returncode != 0:
             raise CommandRunError("Command had nonzero return code: {}".format(process.returncode))
-        output.seek(0)
-        return output.read()
+        return output
+
+    def run_command_captured(self, command: str, path: Path, environment: Mapping[str, str],
+                             stdin: str = None, limits: CommandItem.Limits = None,
+                             stop_event: threading.Event = None) -> CommandResult:
+        self.logger.info("Running captured command {!r}", command)
+        if stop_event is not None and limits is None:
+            # No limits, but it still needs its own process group, so stopping it stops anything
+            # that it started too
+            limits = CommandItem.Limits()
+        start_time = time.time()
+        process = self._start_process_with_pipes(command, path, environment, limits=limits,
+                                                 bufsize=0)
+        watchdog = LocalHost.Watchdog(process, limits)
+
+        # Read the output in a thread (instead of using "communicate"), so it can be cut off if it
+        # goes over the limit
+        output = OutputBuffer()
+        t = threading.Thread(target=LocalHost._stdout_reader_thread,
+                             args=(process, process.stdout.fileno(), output, None,
+                                   threading.Event(), watchdog.get_max_output(),
+                                   watchdog.stop_for_output))
+        t.daemon = True
+        t.start()
+
+        try:
+            LocalHost._try_stdin_write(process, stdin)
+            LocalHost._try_stdin_close(process)
+            if stop_event is None:
+                process.wait()
+            else:
+                while process.poll() is None:
+                    if stop_event.wait(LocalHost.STOP_EVENT_POLL_INTERVAL):
+                        watchdog.stop("Command was stopped before it finished")
+                        process.wait()
+            t.join()
+        except (InterruptedError, KeyboardInterrupt):
+            LocalHost._kill_process_gracefully(process, watchdog.use_group)
+            raise
+        finally:
+            watchdog.finish()
+        return CommandResult(output, process.returncode, start_time, time.time(),
+                             watchdog.get_error(process.returncode))
 
     def run_command_passthrough(self, command: str, path: Path,
                                 environment: Mapping[str, str]) -> None:
@@ -581,12 +1141,16 @@ class LocalHost(Host):
             raise CommandRunError("Command had nonzero return code: {}".format(process.returncode))
 
     def start_background_command(self, command: str, path: Path, environment: Mapping[str, str],
-                                 stdin: str = None) -> BackgroundCommand:
+                                 stdin: str = None,
+                                 limits: CommandItem.Limits = None) -> BackgroundCommand:
         self.logger.info("Starting background command {!r}", command)
-        process = self._start_process_with_pipes(command, path, environment, bufsize=0)
+        process = self._start_process_with_pipes(command, path, environment, limits=limits,
+                                                 bufsize=0)
+        background_command = LocalHost.LocalBackgroundCommand(
+            process, command, path, LocalHost.Watchdog(process, limits))
         LocalHost._try_stdin_write(process, stdin)
         LocalHost._try_stdin_close(process)
-        return LocalHost.LocalBackgroundCommand(process, command, path)
+        return background_command
 
     def gradefast_path_to_local_path(self, path: Path) -> LocalPath:
         # Overridden for Windows in LocalWindowsHost
@@ -620,13 +1184,9 @@ class LocalHost(Host):
             os.mkdir(folder_local_path.get_local_path())
         os.rename(local_path.get_local_path(), file_local_path.get_local_path())
 
-    def unzip(self, path: Path, folder_path: Path) -> None:
-        local_path = self.gradefast_path_to_local_path(path)
-        folder_local_path = self.gradefast_path_to_local_path(folder_path)
-        if not os.path.exists(folder_local_path.get_local_path()):
-            os.mkdir(folder_local_path.get_local_path())
-        zipfile.ZipFile(local_path.get_local_path(), "r").extractall(
-            folder_local_path.get_local_path())
+    def extract_archive(self, path: Path, folder_path: Path) -> None:
+        extract_archive(self.gradefast_path_to_local_path(path),
+                        self.gradefast_path_to_local_path(folder_path))
 
     def get_home_folder(self) -> Path:
         return self.local_path_to_gradefast_path(LocalPath(os.path.expanduser("~")))
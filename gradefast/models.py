@@ -66,30 +66,108 @@ def memoize(func: Callable[[T], U]) -> Callable[[T], U]:
 
 class CommandItem(SlotEqualityMixin):
     __slots__ = ("name", "command", "environment", "is_background", "is_passthrough", "stdin",
-                 "diff", "version")
+                 "diff", "prefetch", "is_tty", "limits", "cache", "version")
+
+    class DiffScoring(SlotEqualityMixin):
+        __slots__ = ("grade_item", "rule")
+
+        # How the diff is turned into a score
+        RULE_ALL_OR_NOTHING = "all or nothing"
+        RULE_MATCHING_LINES = "matching lines"
+        RULE_SIMILARITY = "similarity"
+        RULES = (RULE_ALL_OR_NOTHING, RULE_MATCHING_LINES, RULE_SIMILARITY)
+
+        def __init__(self, grade_item: Union[str, Sequence[int]],
+                     rule: str = RULE_ALL_OR_NOTHING) -> None:
+            """
+            Where to put a score based on the result of a diff.
+
+            :param grade_item: The grade item to set the score of, either by name or by path (a
+                list of indices into the grade structure).
+            :param rule: How to score the diff: full points only if the output matches
+                (RULE_ALL_OR_NOTHING), points for the fraction of lines that match
+                (RULE_MATCHING_LINES), or points for how similar the output is to the reference
+                (RULE_SIMILARITY).
+            """
+            assert rule in CommandItem.DiffScoring.RULES
+            self.grade_item = grade_item if isinstance(grade_item, str) else tuple(grade_item)
+            self.rule = rule
 
     class Diff(SlotEqualityMixin):
-        __slots__ = ("content", "file", "submission_file", "command", "collapse_whitespace")
+        __slots__ = ("content", "file", "submission_file", "command", "collapse_whitespace",
+                     "cache", "scoring")
+
+        # How widely the output of a diff "command" can be reused
+        CACHE_NONE = "none"
+        CACHE_SUBMISSION = "submission"
+        CACHE_GLOBAL = "global"
+        CACHE_SCOPES = (CACHE_NONE, CACHE_SUBMISSION, CACHE_GLOBAL)
 
         def __init__(self, content: str = None, file: str = None, submission_file: str = None,
-                     command: str = None, collapse_whitespace: Optional[bool] = False) -> None:
+                     command: str = None, collapse_whitespace: Optional[bool] = False,
+                     cache: str = CACHE_NONE, scoring: "CommandItem.DiffScoring" = None) -> None:
             """
             ONE AND ONLY ONE of the following parameters must be provided:
             content, file, submission_file, or command.
 
             For more, see: https://github.com/jhartz/gradefast/wiki/Command-Structure#command-items
+
+            :param cache: For "command", when the command's output can be reused instead of
+                running it again: never (CACHE_NONE), for the same submission (CACHE_SUBMISSION),
+                or for every submission (CACHE_GLOBAL, for commands whose output doesn't depend on
+                the submission, like running a reference solution).
+            :param scoring: Where to put a score based on the result of the diff, if anywhere.
             """
             assert [content, file, submission_file, command].count(None) == 3
+            assert cache in CommandItem.Diff.CACHE_SCOPES
             self.content = content
             self.file = file
             self.submission_file = submission_file
             self.command = command
 
             self.collapse_whitespace = collapse_whitespace
+            self.cache = cache
+            self.scoring = scoring
+
+    class Limits(SlotEqualityMixin):
+        __slots__ = ("timeout", "cpu_limit", "memory_limit", "max_output")
+
+        def __init__(self, timeout: float = None, cpu_limit: float = None,
+                     memory_limit: int = None, max_output: int = None) -> None:
+            """
+            Limits on what a command can use. If a command goes over one of these, it is stopped.
+            Any of the limits can be None, meaning that there's no limit.
+
+            :param timeout: The maximum time that the command can run for (in seconds).
+            :param cpu_limit: The maximum CPU time that the command can use (in seconds).
+            :param memory_limit: The maximum memory that the command can use (in bytes).
+            :param max_output: The maximum amount of output that the command can print (in
+                characters).
+            """
+            self.timeout = timeout
+            self.cpu_limit = cpu_limit
+            self.memory_limit = memory_limit
+            self.max_output = max_output
+
+    class Cache(SlotEqualityMixin):
+        __slots__ = ("inputs",)
+
+        def __init__(self, inputs: Sequence[str] = None) -> None:
+            """
+            Settings for caching the results of a command in the build cache (see
+            gradefast/buildcache.py).
+
+            :param inputs: Shell-style patterns (matched against paths relative to the command's
+                working directory) for the files that the command depends on. If this is None,
+                the command depends on every file in its working directory.
+            """
+            self.inputs = tuple(inputs) if inputs is not None else None
 
     def __init__(self, name: str, command: str, environment: Mapping[str, str] = None,
                  is_background: Optional[bool] = False, is_passthrough: Optional[bool] = False,
-                 stdin: str = None, diff: "Diff" = None) -> None:
+                 stdin: str = None, diff: "Diff" = None, prefetch: bool = None,
+                 is_tty: Optional[bool] = False, limits: "Limits" = None,
+                 cache: "Cache" = None) -> None:
         self.name = name
         self.command = command
         self.environment = environment or {}
@@ -97,6 +175,10 @@ class CommandItem(SlotEqualityMixin):
         self.is_passthrough = is_passthrough or False
         self.stdin = stdin
         self.diff = diff
+        self.prefetch = prefetch
+        self.is_tty = is_tty or False
+        self.limits = limits
+        self.cache = cache
         self.version = 1
 
     def get_name(self) -> str:
@@ -104,9 +186,25 @@ class CommandItem(SlotEqualityMixin):
             return "{} ({})".format(self.name, self.version)
         return self.name
 
+    def can_prefetch(self) -> bool:
+        """
+        Determine whether this command can be run ahead of time, without any interaction with the
+        user (see CommandPrefetcher in grader/prefetch.py).
+
+        By default, only commands that are driven by "input" are prefetched (otherwise, when the
+        command is run live, the user could type input for it). This can be overridden using the
+        "prefetch" property.
+        """
+        if self.is_background or self.is_passthrough:
+            return False
+        if self.prefetch is not None:
+            return self.prefetch
+        return self.stdin is not None
+
     def get_modified(self, new_command: str) -> "CommandItem":
         command_item = CommandItem(self.name, new_command, self.environment, self.is_background,
-                                   self.is_passthrough, self.stdin, self.diff)
+                                   self.is_passthrough, self.stdin, self.diff, self.prefetch,
+                                   self.is_tty, self.limits, self.cache)
         command_item.version += self.version
         return command_item
 
@@ -384,6 +482,7 @@ Settings = NamedTuple("Settings", [
     ("project_name", str),
     ("save_file", Optional[LocalPath]),
     ("use_legacy_save_file_format", bool),
+    ("use_structured_save_file_format", bool),
     ("log_file", Optional[LocalPath]),
     ("log_as_html", Optional[bool]),
 
@@ -393,13 +492,20 @@ Settings = NamedTuple("Settings", [
     ("host", int),
     ("port", int),
     ("prompt_for_auth", bool),
+    ("gradebook_server", str),
 
     # Grader settings
     ("commands", Sequence[Command]),
     ("submission_regex", Optional[str]),
     ("check_zipfiles", bool),
     ("check_file_extensions", Optional[Sequence[str]]),
+    ("extract_workers", int),
     ("diff_file_path", Optional[LocalPath]),
+    ("diff_engine", str),
+    ("build_cache_path", Optional[LocalPath]),
+    ("prefetch_count", int),
+    ("prefetch_workers", int),
+    ("background_workers", int),
 
     # {Color,}CLIChannel (iochannels.py) settings
     ("use_readline", bool),
@@ -427,17 +533,25 @@ class SettingsDefaults:
 
     save_file = None
     use_legacy_save_file_format = False
+    use_structured_save_file_format = False
     log_file = None
     log_as_html = False
 
     # GradeBook settings
     prompt_for_auth = True
+    gradebook_server = "flask"
 
     # Grader settings
     submission_regex = None
     check_zipfiles = False
     check_file_extensions = None
+    extract_workers = 4
     diff_file_path = None
+    diff_engine = "myers"
+    build_cache_path = None
+    prefetch_count = 0
+    prefetch_workers = 2
+    background_workers = 2
 
     # {Color,}CLIChannel (iochannels.py) settings
     use_readline = True
@@ -0,0 +1,318 @@
+"""
+Bounded storage for the output of commands, spilling to disk when it gets too big.
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+import mmap
+import os
+import tempfile
+import weakref
+from array import array
+from typing import BinaryIO, Iterable, Iterator, List, Optional, Sequence, Union
+
+from gradefast.loggingwrapper import get_logger
+
+_logger = get_logger("outputbuffer")
+
+# The encoding used for spill files (the text was already decoded from whatever the command used)
+_SPILL_ENCODING = "utf-8"
+_SPILL_ERRORS = "surrogatepass"
+
+
+def _remove_spill_file(path: str, mapped_lines: Iterable["_MappedLines"] = ()) -> None:
+    # Anything still reading from the file has to let go of it first (or, on Windows, it can't be
+    # removed)
+    for lines in list(mapped_lines):
+        lines.close()
+    try:
+        os.remove(path)
+    except OSError:
+        _logger.exception("Error removing spill file {}", path)
+
+
+class _MappedLines(Sequence[str]):
+    """
+    The lines of a spill file, read through a memory map. Only the offset of each line is kept in
+    memory; the lines themselves are decoded when they're accessed.
+
+    The memory map is closed by close() (or when this is garbage collected), after which the lines
+    can't be accessed anymore.
+    """
+
+    def __init__(self, path: str) -> None:
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._finalizer = weakref.finalize(self, self._map.close)
+
+        # Offsets of the start of each line, plus the end of the last line
+        self._offsets = array("q", [0])
+        length = len(self._map)
+        position = 0
+        while position < length:
+            newline = self._map.find(b"\n", position)
+            if newline == -1:
+                position = length
+            else:
+                position = newline + 1
+            self._offsets.append(position)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, List[str]]:
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("line index out of range")
+        line = self._map[self._offsets[index]:self._offsets[index + 1]]
+        return line.decode(_SPILL_ENCODING, _SPILL_ERRORS).rstrip("\n")
+
+    def __iter__(self) -> Iterator[str]:
+        for index in range(len(self)):
+            yield self[index]
+
+    def close(self) -> None:
+        self._finalizer()
+
+
+class OutputBuffer:
+    """
+    Holds the output from a command without keeping all of it in memory.
+
+    The first "head_size" and last "tail_size" characters are always kept in memory. Once the
+    output is longer than that, all of it is written to a temporary "spill" file, and the middle is
+    dropped from memory. The spill file is removed when the OutputBuffer is closed or garbage
+    collected.
+
+    An OutputBuffer can be pickled (to send it between processes on the same machine). The copy
+    shares the spill file, which is still removed along with the original, unless
+    transfer_spill_file() was called first to make the copy take it over.
+    """
+
+    HEAD_SIZE = 256 * 1024
+    TAIL_SIZE = 64 * 1024
+
+    def __init__(self, head_size: int = None, tail_size: int = None) -> None:
+        self.head_size = head_size if head_size is not None else OutputBuffer.HEAD_SIZE
+        self.tail_size = tail_size if tail_size is not None else OutputBuffer.TAIL_SIZE
+        self._length = 0
+        self._head = []  # type: List[str]
+        # Once the output is spilled, this holds the most recent chunks (at least "tail_size"
+        # characters); before that, it holds everything after the head
+        self._tail = []  # type: List[str]
+        self._tail_length = 0
+
+        self._spill_path = None  # type: Optional[str]
+        self._spill_file = None  # type: Optional[BinaryIO]
+        self._finalizer = None  # type: Optional[weakref.finalize]
+        # Whether the next pickled copy takes over the spill file (see transfer_spill_file)
+        self._transfer_spill_file = False
+        # The results of get_lines() that read from the spill file (closed when it's removed)
+        self._mapped_lines = weakref.WeakSet()  # type: weakref.WeakSet
+
+    def write(self, text: str) -> None:
+        """
+        Add some output to the end of the buffer.
+        """
+        if not text:
+            return
+
+        head_length = min(self._length, self.head_size)
+        self._length += len(text)
+        if head_length < self.head_size:
+            self._head.append(text[:self.head_size - head_length])
+            text = text[self.head_size - head_length:]
+            if not text:
+                return
+
+        self._tail.append(text)
+        self._tail_length += len(text)
+
+        if self._spill_file is None and self._length > self.head_size + self.tail_size:
+            self._start_spilling()
+        elif self._spill_file is not None:
+            self._spill_file.write(text.encode(_SPILL_ENCODING, _SPILL_ERRORS))
+            self._trim_tail()
+
+    def _start_spilling(self) -> None:
+        fd, self._spill_path = tempfile.mkstemp(prefix="gradefast-output-", suffix=".txt")
+        self._finalizer = weakref.finalize(self, _remove_spill_file, self._spill_path,
+                                           self._mapped_lines)
+        self._spill_file = os.fdopen(fd, "wb")
+        _logger.debug("Spilling output to {}", self._spill_path)
+        # Nothing has been dropped yet, so this is everything so far
+        for chunk in self._head + self._tail:
+            self._spill_file.write(chunk.encode(_SPILL_ENCODING, _SPILL_ERRORS))
+        self._trim_tail()
+
+    def _trim_tail(self) -> None:
+        # Drop whole chunks from the start of the tail while we still have enough without them
+        drop = 0
+        while drop < len(self._tail) and \
+                self._tail_length - len(self._tail[drop]) >= self.tail_size:
+            self._tail_length -= len(self._tail[drop])
+            drop += 1
+        if drop:
+            del self._tail[:drop]
+        if len(self._tail) == 1 and self._tail_length > 2 * self.tail_size:
+            # Don't keep around one giant chunk
+            self._tail[0] = self._tail[0][-self.tail_size:]
+            self._tail_length = self.tail_size
+
+    def finish(self) -> None:
+        """
+        Indicate that no more output will be written (flushing the spill file, if any).
+        """
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def close(self) -> None:
+        """
+        Remove the spill file (if any). After this, only the head and tail are available (and the
+        lines from get_lines() can't be accessed anymore, if they came from the spill file).
+        """
+        self.finish()
+        for lines in list(self._mapped_lines):
+            lines.close()
+        if self._finalizer is not None:
+            self._finalizer()
+            self._finalizer = None
+        self._spill_path = None
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __bool__(self) -> bool:
+        return self._length > 0
+
+    def is_spilled(self) -> bool:
+        """
+        Determine whether the output was too long to keep entirely in memory.
+        """
+        return self._length > self.head_size + self.tail_size
+
+    def get_omitted_length(self) -> int:
+        """
+        Get the number of characters that aren't included in get_summary().
+        """
+        return max(0, self._length - self.head_size - self.tail_size)
+
+    def get_head(self) -> str:
+        """
+        Get the beginning of the output (up to "head_size" characters).
+        """
+        if len(self._head) > 1:
+            self._head = ["".join(self._head)]
+        return self._head[0] if self._head else ""
+
+    def get_tail(self) -> str:
+        """
+        Get the rest of the output after the head (up to "tail_size" characters).
+        """
+        tail = "".join(self._tail)
+        if self.is_spilled():
+            tail = tail[-self.tail_size:]
+        return tail
+
+    def get_summary(self) -> str:
+        """
+        Get the output, with the middle cut out (and replaced with a note) if it was too long to
+        keep in memory.
+        """
+        if not self.is_spilled():
+            return self.get_head() + self.get_tail()
+        return "{}\n\n... [{} characters omitted] ...\n\n{}".format(
+            self.get_head(), self.get_omitted_length(), self.get_tail())
+
+    def _get_spill_path(self) -> str:
+        if self._spill_path is None:
+            raise ValueError("The full output is no longer available")
+        self.finish()
+        return self._spill_path
+
+    def get_text(self) -> str:
+        """
+        Get all the output as one string. If the output was spilled to disk, this reads the whole
+        spill file back into memory.
+        """
+        if not self.is_spilled():
+            return self.get_head() + self.get_tail()
+        with open(self._get_spill_path(), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return m[:].decode(_SPILL_ENCODING, _SPILL_ERRORS)
+
+    def get_lines(self) -> Sequence[str]:
+        """
+        Get the lines of the output (split at newlines, without the newlines). If the output was
+        spilled to disk, the lines are read from a memory map of the spill file as they're accessed
+        (until the OutputBuffer is closed).
+        """
+        if not self.is_spilled():
+            lines = self.get_text().split("\n")
+            if lines[-1] == "":
+                lines.pop()
+            return lines
+        lines = _MappedLines(self._get_spill_path())
+        self._mapped_lines.add(lines)
+        return lines
+
+    def iter_text(self, chunk_size: int = 64 * 1024) -> Iterator[str]:
+        """
+        Iterate over all the output in chunks, without reading it all into memory at once.
+        """
+        if not self.is_spilled():
+            yield self.get_text()
+            return
+        with open(self._get_spill_path(), "r", encoding=_SPILL_ENCODING, errors=_SPILL_ERRORS,
+                  newline="") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
+    def transfer_spill_file(self) -> None:
+        """
+        Make the next pickled copy of this OutputBuffer responsible for removing the spill file
+        (if any), instead of this one. This is needed to send an OutputBuffer to another process,
+        since this one might be garbage collected before the copy is unpickled.
+        """
+        self._transfer_spill_file = True
+
+    def __getstate__(self) -> dict:
+        self.finish()
+        state = {
+            "head_size": self.head_size,
+            "tail_size": self.tail_size,
+            "length": self._length,
+            "head": self.get_head(),
+            "tail": self.get_tail() if self.is_spilled() else "".join(self._tail),
+            "spill_path": self._spill_path,
+            "owns_spill_file": False
+        }
+        if self._transfer_spill_file and self._finalizer is not None:
+            self._finalizer.detach()
+            self._finalizer = None
+            state["owns_spill_file"] = True
+        self._transfer_spill_file = False
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__init__(state["head_size"], state["tail_size"])
+        self._length = state["length"]
+        self._head = [state["head"]] if state["head"] else []
+        self._tail = [state["tail"]] if state["tail"] else []
+        self._tail_length = len(state["tail"])
+        self._spill_path = state["spill_path"]
+        if self._spill_path is not None and state["owns_spill_file"]:
+            self._finalizer = weakref.finalize(self, _remove_spill_file, self._spill_path,
+                                               self._mapped_lines)
+
+    def __str__(self) -> str:
+        return self.get_summary()
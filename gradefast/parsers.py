@@ -144,13 +144,24 @@ def _parse_command(command_dict: dict, path: List[int], subject: str) -> Command
 
         for key in command_dict.keys():
             if key not in ["name", "command", "environment", "background", "passthrough",
-                           "passthru", "input", "stdin", "diff"]:
+                           "passthru", "input", "stdin", "diff", "prefetch", "tty",
+                           "timeout", "cpu limit", "memory limit", "max output", "cacheable",
+                           "cache inputs"]:
                 errors.add("Command item", subject, "has an invalid property: \"{}\"".format(key))
 
         is_background = command_dict.get("background")
         is_passthrough = command_dict.get("passthrough") or command_dict.get("passthru")
         stdin = _str_or_none(command_dict.get("input") or command_dict.get("stdin"))
         diff_value = command_dict.get("diff")
+        prefetch = command_dict.get("prefetch")
+        is_tty = command_dict.get("tty")
+
+        if prefetch is not None and not isinstance(prefetch, bool):
+            errors.add("Command item", subject, "\"prefetch\" must be true or false")
+        if is_tty is not None and not isinstance(is_tty, bool):
+            errors.add("Command item", subject, "\"tty\" must be true or false")
+        if is_tty and is_background:
+            errors.add("Command item", subject, "has both \"background\" and \"tty\" set")
 
         if is_passthrough:
             if is_background:
@@ -162,12 +173,39 @@ def _parse_command(command_dict: dict, path: List[int], subject: str) -> Command
             if diff_value:
                 errors.add("Command item", subject,
                            "has both \"passthrough\" and \"diff\" set")
+            if prefetch:
+                errors.add("Command item", subject,
+                           "has both \"passthrough\" and \"prefetch\" set")
+            if is_tty:
+                # Passthrough commands already use the real terminal
+                errors.add("Command item", subject,
+                           "has both \"passthrough\" and \"tty\" set")
 
         try:
             diff = _parse_command_diff(diff_value, subject)
         except ModelParseError as exc:
             errors.add_all(exc)
 
+        limits = None
+        try:
+            limits = _parse_command_limits(command_dict, subject)
+        except ModelParseError as exc:
+            errors.add_all(exc)
+        if limits and is_passthrough:
+            errors.add("Command item", subject, "has both \"passthrough\" and limits set")
+
+        cache = None
+        try:
+            cache = _parse_command_cache(command_dict, subject)
+        except ModelParseError as exc:
+            errors.add_all(exc)
+        if cache:
+            for key, value in [("background", is_background), ("passthrough", is_passthrough),
+                               ("tty", is_tty)]:
+                if value:
+                    errors.add("Command item", subject,
+                               "has both \"{}\" and \"cacheable\" set".format(key))
+
         errors.raise_if_errors()
         return CommandItem(
             str(command_dict["name"]).strip(),
@@ -176,7 +214,11 @@ def _parse_command(command_dict: dict, path: List[int], subject: str) -> Command
             is_background,
             is_passthrough,
             stdin,
-            diff
+            diff,
+            prefetch,
+            is_tty,
+            limits,
+            cache
         )
 
 
@@ -207,14 +249,137 @@ def _parse_command_diff(diff_object: Optional[Union[dict, str]],
                    "content, file, submission file, command")
 
     for key in diff_object.keys():
-        if key not in ["content", "file", "submission file", "command", "collapse whitespace"]:
+        if key not in ["content", "file", "submission file", "command", "collapse whitespace",
+                       "cache", "score", "score rule"]:
             errors.add("Command item", subject,
                        "diff object has an invalid property: \"{}\"".format(key))
 
+    cache = diff_object.get("cache", CommandItem.Diff.CACHE_NONE)
+    if cache is False:
+        cache = CommandItem.Diff.CACHE_NONE
+    if cache not in CommandItem.Diff.CACHE_SCOPES:
+        errors.add("Command item", subject,
+                   "diff cache must be one of: {}".format(", ".join(CommandItem.Diff.CACHE_SCOPES)))
+    elif cache != CommandItem.Diff.CACHE_NONE and command is None:
+        errors.add("Command item", subject, "diff cache can only be set for a diff command")
+
+    scoring = None
+    grade_item = diff_object.get("score")
+    rule = diff_object.get("score rule", CommandItem.DiffScoring.RULE_ALL_OR_NOTHING)
+    if grade_item is None:
+        if "score rule" in diff_object:
+            errors.add("Command item", subject, "diff has a \"score rule\" but no \"score\"")
+    elif not isinstance(grade_item, str) and not (
+            isinstance(grade_item, list) and grade_item and
+            all(isinstance(index, int) and not isinstance(index, bool) and index >= 0
+                for index in grade_item)):
+        errors.add("Command item", subject,
+                   "diff score must be a grade item name or a list of indices")
+    elif rule not in CommandItem.DiffScoring.RULES:
+        errors.add("Command item", subject, "diff score rule must be one of: {}".format(
+            ", ".join(CommandItem.DiffScoring.RULES)))
+    else:
+        scoring = CommandItem.DiffScoring(grade_item, rule)
+
     errors.raise_if_errors()
     return CommandItem.Diff(
         content=content, file=file, submission_file=submission_file, command=command,
-        collapse_whitespace=diff_object.get("collapse whitespace", False))
+        collapse_whitespace=diff_object.get("collapse whitespace", False), cache=cache,
+        scoring=scoring)
+
+
+def _parse_command_cache(command_dict: dict, subject: str) -> Optional[CommandItem.Cache]:
+    """
+    Parse the "cacheable" and "cache inputs" properties for a command.
+    """
+    errors = ModelParseError()
+    cacheable = command_dict.get("cacheable")
+    inputs = command_dict.get("cache inputs")
+
+    if cacheable is not None and not isinstance(cacheable, bool):
+        errors.add("Command item", subject, "\"cacheable\" must be true or false")
+    if isinstance(inputs, str):
+        inputs = [inputs]
+    if inputs is not None:
+        if not cacheable:
+            errors.add("Command item", subject,
+                       "has \"cache inputs\" without \"cacheable\" set")
+        if not isinstance(inputs, list) or not all(isinstance(pattern, str) and pattern
+                                                   for pattern in inputs):
+            errors.add("Command item", subject,
+                       "\"cache inputs\" must be a pattern or a list of patterns")
+
+    errors.raise_if_errors()
+    if not cacheable:
+        return None
+    return CommandItem.Cache(inputs)
+
+
+_SIZE_SUFFIXES = {
+    "K": 1024,
+    "M": 1024 ** 2,
+    "G": 1024 ** 3
+}
+
+
+def _parse_size(value: Union[int, str]) -> int:
+    """
+    Parse a size (like "512M" or "1G"), which can be a number or a string with a suffix (K, M, or
+    G, optionally followed by "B").
+    """
+    if isinstance(value, bool):
+        raise ValueError("Not a size: " + str(value))
+    if isinstance(value, (int, float)):
+        size = value
+    else:
+        size_str = str(value).strip().upper()
+        if size_str.endswith("B"):
+            size_str = size_str[:-1]
+        multiplier = 1
+        if size_str[-1:] in _SIZE_SUFFIXES:
+            multiplier = _SIZE_SUFFIXES[size_str[-1]]
+            size_str = size_str[:-1]
+        try:
+            size = float(size_str) * multiplier
+        except ValueError:
+            raise ValueError("Not a size: " + str(value))
+    if size <= 0:
+        raise ValueError("Not a positive size: " + str(value))
+    return int(size)
+
+
+def _parse_command_limits(command_dict: dict, subject: str) -> Optional[CommandItem.Limits]:
+    """
+    Parse the limit properties ("timeout", "cpu limit", "memory limit", and "max output") for a
+    command.
+    """
+    if not any(key in command_dict
+               for key in ["timeout", "cpu limit", "memory limit", "max output"]):
+        return None
+
+    errors = ModelParseError()
+    limits = CommandItem.Limits()
+
+    for key, attr in [("timeout", "timeout"), ("cpu limit", "cpu_limit")]:
+        if key in command_dict:
+            value = command_dict[key]
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                errors.add("Command item", subject,
+                           "\"{}\" must be a positive number of seconds".format(key))
+            else:
+                setattr(limits, attr, value)
+
+    for key, attr in [("memory limit", "memory_limit"), ("max output", "max_output")]:
+        if key in command_dict:
+            try:
+                setattr(limits, attr, _parse_size(command_dict[key]))
+            except ValueError:
+                errors.add("Command item", subject,
+                           "\"{}\" must be a positive size (like 1000, \"512K\", or \"1G\")"
+                           .format(key))
+
+    errors.raise_if_errors()
+    return limits
 
 
 def parse_grade_structure(lst: List[dict]) -> List[GradeItem]:
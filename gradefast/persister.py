@@ -8,15 +8,18 @@ Author: Jake Hartz <jake@hartz.io>
 
 import pickle
 import queue
+import re
 import shelve
 import sqlite3
 import threading
-from typing import Any, Optional
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
 
 from pyprovide import inject
 
 from gradefast.loggingwrapper import get_logger
-from gradefast.models import Settings
+from gradefast.models import Path, Settings
 
 # Pickle protocol v4 was added in Python 3.4
 _PICKLE_PROTOCOL_VERSION = 4
@@ -24,6 +27,13 @@ _PICKLE_PROTOCOL_VERSION = 4
 _logger = get_logger("persister")
 
 
+class SaveFileFormatError(Exception):
+    """
+    Error resulting from opening a save file that was written in a different format.
+    """
+    pass
+
+
 class Persister:
     """
     Interface for a persister to save data to a GradeFast save file. The persisted data should be
@@ -37,6 +47,14 @@ class Persister:
     def set(self, namespace: str, key: str, value: Any) -> None:
         raise NotImplementedError()
 
+    def set_many(self, namespace: str, values: Dict[str, Any]) -> None:
+        """
+        Set a bunch of keys at once. Subclasses can override this if they can do it more
+        efficiently than calling set() for each one.
+        """
+        for key, value in values.items():
+            self.set(namespace, key, value)
+
     def clear(self, namespace: str, key: str) -> None:
         raise NotImplementedError()
 
@@ -120,8 +138,11 @@ class SqlitePersister(Persister):
     GradeFast persister that uses sqlite and pickle. This is preferred over shelve because it works
     cross-platform.
 
-    The mutator methods ("set", "clear", and "clear_all") do not commit the data right away, so
-    they may return before the changes have been committed to the database.
+    The mutator methods ("set", "set_many", "clear", and "clear_all") don't wait for the sqlite
+    thread; they queue up the change and return right away (values are pickled first, so they can
+    be modified afterwards). The changes are committed together a short time later (see
+    SqlitePersisterThread.COMMIT_DELAY). Since requests are handled in order, "get" always sees the
+    changes from earlier calls.
 
     Unfortunately, this is a bit of a hackjob since we have to deal with the fact that Python
     sqlite connections can't be accessed from multiple threads :(
@@ -131,30 +152,53 @@ class SqlitePersister(Persister):
     def __init__(self, settings: Settings):
         self._th = None
         if settings.save_file:
-            self._th = SqlitePersisterThread(settings.save_file)
+            self._th = self._create_thread(settings.save_file)
             self._th.start()
+            self._th.wait_until_open()
         else:
             _logger.info("No save file specified")
 
+    def _create_thread(self, save_file) -> "SqlitePersisterThread":
+        return SqlitePersisterThread(save_file)
+
     def get(self, namespace: str, key: str) -> Any:
         if self._th is None:
             return
         return self._th.do_request(SqlitePersisterRequest("get", namespace, key))
 
-    def set(self, namespace: str, key: str, value: str) -> Any:
+    def set(self, namespace: str, key: str, value: Any) -> None:
         if self._th is None:
             return
-        return self._th.do_request(SqlitePersisterRequest("set", namespace, key, value))
+        try:
+            pickled_value = pickle.dumps(value, protocol=_PICKLE_PROTOCOL_VERSION)
+        except:
+            _logger.exception("Error persisting {} to SQLite save file", key)
+            return
+        self._th.do_request(SqlitePersisterRequest("set", namespace, key, pickled_value),
+                            wait=False)
 
-    def clear(self, namespace: str, key: str) -> Any:
+    def set_many(self, namespace: str, values: Dict[str, Any]) -> None:
         if self._th is None:
             return
-        return self._th.do_request(SqlitePersisterRequest("clear", namespace, key))
+        pickled_values = []  # type: List[Tuple[str, bytes]]
+        for key, value in values.items():
+            try:
+                pickled_values.append(
+                    (key, pickle.dumps(value, protocol=_PICKLE_PROTOCOL_VERSION)))
+            except:
+                _logger.exception("Error persisting {} to SQLite save file", key)
+        self._th.do_request(SqlitePersisterRequest("set_many", namespace, value=pickled_values),
+                            wait=False)
 
-    def clear_all(self, namespace: str) -> Any:
+    def clear(self, namespace: str, key: str) -> None:
         if self._th is None:
             return
-        return self._th.do_request(SqlitePersisterRequest("clear_all", namespace))
+        self._th.do_request(SqlitePersisterRequest("clear", namespace, key), wait=False)
+
+    def clear_all(self, namespace: str) -> None:
+        if self._th is None:
+            return
+        self._th.do_request(SqlitePersisterRequest("clear_all", namespace), wait=False)
 
     def close(self) -> Any:
         if self._th is None:
@@ -165,7 +209,7 @@ class SqlitePersister(Persister):
 
 class SqlitePersisterRequest:
     def __init__(self, action: str, namespace: Optional[str] = None, key: Optional[str] = None,
-                 value: Optional[str] = None):
+                 value: Any = None):
         self.action = action
         self.namespace = namespace
         self.key = key
@@ -194,61 +238,162 @@ class SqlitePersisterRequest:
         return s
 
 
+# The values of the "user_version" field in the header of a SQLite save file, which marks which
+# persister wrote it (files from before this was added have 0)
+_SQLITE_FORMAT_VERSIONS = {
+    "sqlite": 1,
+    "structured": 2
+}
+
+
 class SqlitePersisterThread(threading.Thread):
+    # How long to wait after a change before committing it (in seconds), so we can batch-commit if
+    # we have a lot of changes in a short amount of time
+    COMMIT_DELAY = 0.5
+
+    # The name of the save file format that this thread writes (see _SQLITE_FORMAT_VERSIONS)
+    FORMAT = "sqlite"
+
     def __init__(self, save_file):
         super().__init__(daemon=True)
         self.save_file = save_file
         self._conn = None  # type: sqlite3.Connection
         self._queue = queue.Queue()
-        self._commit_timer = None
+        # When the uncommitted changes should be committed (if there are any)
+        self._commit_deadline = None  # type: Optional[float]
 
-    def do_request(self, request: SqlitePersisterRequest):
-        self._queue.put(request)
-        return request.get_result()
+        self._opened = threading.Event()
+        self._open_error = None  # type: Optional[Exception]
 
-    def run(self):
-        _logger.info("Opening SQLite save file: {}", self.save_file)
-        self._conn = sqlite3.connect(self.save_file.get_local_path())
+    def wait_until_open(self) -> None:
+        """
+        Wait until the save file is opened.
 
-        with self._conn:
-            self._conn.execute("CREATE TABLE IF NOT EXISTS gradefast "
-                               "(namespace TEXT NOT NULL, data_key TEXT NOT NULL, "
-                               "data_value BLOB, PRIMARY KEY (namespace, data_key))")
+        :raises SaveFileFormatError: If the save file is in a format that we can't use.
+        """
+        self._opened.wait()
+        if self._open_error is not None:
+            raise self._open_error
 
-        while True:
-            request = self._queue.get(block=True)  # type: SqlitePersisterRequest
+    def do_request(self, request: SqlitePersisterRequest, wait: bool = True):
+        self._queue.put(request)
+        if wait:
+            return request.get_result()
 
-            if request.action == "get":
-                request.put_result(self._get(request.namespace, request.key))
+    def run(self):
+        try:
+            self._open()
+        except Exception as ex:
+            self._open_error = ex
+            if self._conn is not None:
+                self._conn.close()
+            return
+        finally:
+            self._opened.set()
 
-            elif request.action == "commit":
+        while True:
+            timeout = None
+            if self._commit_deadline is not None:
+                timeout = max(0.0, self._commit_deadline - time.monotonic())
+            try:
+                request = self._queue.get(timeout=timeout)  # type: SqlitePersisterRequest
+            except queue.Empty:
                 self._commit()
-                request.put_result()
+                continue
 
-            elif request.action == "close":
-                self._close()
-                request.put_result()
+            try:
+                if request.action == "get":
+                    request.put_result(self._get(request.namespace, request.key))
+                    continue
 
-            else:
-                if request.action == "set":
-                    self._set(request.namespace, request.key, request.value)
+                if request.action == "close":
+                    self._close()
                     request.put_result()
+                    return
 
+                if request.action == "set":
+                    self._set(request.namespace, request.key, request.value)
+                elif request.action == "set_many":
+                    self._set_many(request.namespace, request.value)
                 elif request.action == "clear":
                     self._clear(request.namespace, request.key)
-                    request.put_result()
-
                 elif request.action == "clear_all":
                     self._clear_all(request.namespace)
-                    request.put_result()
+                request.put_result()
+            except:
+                _logger.exception("Error handling {}", request)
+                request.put_result(None)
+
+            if self._commit_deadline is None:
+                self._commit_deadline = time.monotonic() + SqlitePersisterThread.COMMIT_DELAY
 
-                # Wait to commit the changes so we can batch-commit if we have a lot of changes in
-                # a short amount of time (0.5 seconds).
-                if self._commit_timer:
-                    self._commit_timer.cancel()
-                self._commit_timer = threading.Timer(0.5, lambda:
-                        self._queue.put(SqlitePersisterRequest("commit")))
-                self._commit_timer.start()
+    def _open(self) -> None:
+        _logger.info("Opening SQLite save file: {}", self.save_file)
+        self._conn = sqlite3.connect(self.save_file.get_local_path())
+        # With a write-ahead log, commits are a lot cheaper, and readers (like dump-save-file.py)
+        # don't block us. "NORMAL" is still safe from corruption in WAL mode; a power loss just
+        # might lose the last few commits.
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+
+        file_format = self._get_file_format()
+        self._check_file_format(file_format)
+        self._create_tables()
+        with self._conn:
+            if file_format != self.FORMAT:
+                self._convert_file(file_format)
+            self._conn.execute(
+                "PRAGMA user_version={}".format(_SQLITE_FORMAT_VERSIONS[self.FORMAT]))
+
+    def _get_file_format(self) -> Optional[str]:
+        """
+        Figure out which persister wrote the save file, before we create any tables in it.
+
+        :return: The name of the save file's format (see _SQLITE_FORMAT_VERSIONS), or None if it
+            was written by something we don't know about.
+        """
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version == 0:
+            # Either a new file, or one from before we marked the format; the structured format
+            # is the only one with a "submission_index" table
+            row = self._conn.execute("SELECT name FROM sqlite_master "
+                                     "WHERE type='table' AND name='submission_index'").fetchone()
+            return "sqlite" if row is None else "structured"
+        for name, format_version in _SQLITE_FORMAT_VERSIONS.items():
+            if version == format_version:
+                return name
+        return None
+
+    def _check_file_format(self, file_format: Optional[str]) -> None:
+        """
+        Make sure that we can use a save file (either because it's in our format, or because
+        _convert_file can convert it).
+
+        :param file_format: The format that the save file was in when we opened it (see
+            _get_file_format).
+        :raises SaveFileFormatError: If the save file is in a format that we can't use.
+        """
+        if file_format != self.FORMAT:
+            raise SaveFileFormatError(
+                "Save file {} was written with {}, not --save-file-format={}".format(
+                    self.save_file,
+                    "--save-file-format=" + file_format if file_format else "an unknown format",
+                    self.FORMAT))
+
+    def _convert_file(self, file_format: str) -> None:
+        """
+        Convert the data in a save file to our format. This is called in a transaction, after the
+        tables are created.
+
+        :param file_format: The format that the save file is in (see _get_file_format).
+        """
+        raise NotImplementedError()
+
+    def _create_tables(self) -> None:
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS gradefast "
+                               "(namespace TEXT NOT NULL, data_key TEXT NOT NULL, "
+                               "data_value BLOB, PRIMARY KEY (namespace, data_key))")
 
     def _get(self, namespace: str, key: str) -> Any:
         c = self._conn.cursor()
@@ -259,14 +404,15 @@ class SqlitePersisterThread(threading.Thread):
             return None
         return pickle.loads(row[0])
 
-    def _set(self, namespace: str, key: str, value: Any) -> None:
-        try:
-            pickled_value = pickle.dumps(value, protocol=_PICKLE_PROTOCOL_VERSION)
-            self._conn.execute("INSERT OR REPLACE INTO gradefast "
+    def _set(self, namespace: str, key: str, pickled_value: bytes) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO gradefast "
+                           "(namespace, data_key, data_value) VALUES (?, ?, ?)",
+                           (namespace, key, pickled_value))
+
+    def _set_many(self, namespace: str, pickled_values: List[Tuple[str, bytes]]) -> None:
+        self._conn.executemany("INSERT OR REPLACE INTO gradefast "
                                "(namespace, data_key, data_value) VALUES (?, ?, ?)",
-                               (namespace, key, pickled_value))
-        except:
-            _logger.exception("Error persisting {} to SQLite save file", key)
+                               [(namespace, key, value) for key, value in pickled_values])
 
     def _clear(self, namespace: str, key: str) -> None:
         self._conn.execute("DELETE FROM gradefast WHERE namespace=? AND data_key=?",
@@ -278,10 +424,442 @@ class SqlitePersisterThread(threading.Thread):
 
     def _close(self) -> None:
         _logger.info("Closing SQLite save file")
-        if self._commit_timer:
-            self._commit_timer.cancel()
-        self._conn.commit()
+        self._commit()
         self._conn.close()
 
-    def _commit(self):
+    def _commit(self) -> None:
         self._conn.commit()
+        self._commit_deadline = None
+
+
+# The tables used by StructuredSqlitePersister (in addition to the "gradefast" table). The columns
+# that hold scores don't have a type, so SQLite keeps ints as ints and floats as floats.
+_STRUCTURED_SCHEMA = """
+CREATE TABLE IF NOT EXISTS submissions (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    full_name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    log_count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS timings (
+    submission_id INTEGER NOT NULL,
+    timing_index INTEGER NOT NULL,
+    start_time REAL NOT NULL,
+    end_time REAL,
+    PRIMARY KEY (submission_id, timing_index)
+);
+CREATE TABLE IF NOT EXISTS submission_grades (
+    submission_id INTEGER PRIMARY KEY,
+    is_late INTEGER NOT NULL,
+    overall_comments TEXT
+);
+CREATE TABLE IF NOT EXISTS grade_items (
+    submission_id INTEGER NOT NULL,
+    grade_path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    name TEXT,
+    notes TEXT,
+    enabled INTEGER NOT NULL,
+    base_score,
+    comments TEXT,
+    late_deduction,
+    PRIMARY KEY (submission_id, grade_path)
+);
+CREATE INDEX IF NOT EXISTS grade_items_by_path ON grade_items (grade_path);
+CREATE TABLE IF NOT EXISTS hints (
+    submission_id INTEGER NOT NULL,
+    grade_path TEXT NOT NULL,
+    hint_index INTEGER NOT NULL,
+    enabled INTEGER NOT NULL,
+    PRIMARY KEY (submission_id, grade_path, hint_index)
+);
+CREATE INDEX IF NOT EXISTS hints_by_path ON hints (grade_path);
+CREATE TABLE IF NOT EXISTS submission_index (
+    submission_id INTEGER PRIMARY KEY,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    full_name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    log_count INTEGER NOT NULL,
+    is_late INTEGER NOT NULL,
+    points_earned,
+    points_possible
+);
+CREATE TABLE IF NOT EXISTS logs (
+    submission_id INTEGER NOT NULL,
+    log_index INTEGER NOT NULL,
+    html_log BLOB NOT NULL,
+    text_log BLOB NOT NULL,
+    PRIMARY KEY (submission_id, log_index)
+);
+"""
+
+# The tables that hold the data for each namespace
+_STRUCTURED_NAMESPACE_TABLES = {
+    "submissions": ("submissions", "timings", "submission_grades", "grade_items", "hints",
+                    "submission_index"),
+    "logs": ("logs",)
+}
+
+# The keys that the SubmissionManager uses (see submissions.py)
+_SUBMISSION_KEY = re.compile(r"^submission-(\d+)$")
+_SUBMISSION_GRADE_KEY = re.compile(r"^submission_grade-(\d+)$")
+_LOGS_KEY = re.compile(r"^submission-(\d+)-(\d+)$")
+
+
+def _format_grade_path(path: Sequence[int]) -> str:
+    return ".".join(str(index) for index in path)
+
+
+def _parse_grade_path(grade_path: str) -> Tuple[int, ...]:
+    return tuple(int(index) for index in grade_path.split("."))
+
+
+class StructuredSqlitePersister(SqlitePersister):
+    """
+    GradeFast persister that uses sqlite, with real tables for submissions, timings, grades,
+    hints, and logs instead of pickled blobs. This means that the save file can be queried with
+    SQL (without unpickling anything), and a change to one grade item only touches that item's row.
+
+    Anything that doesn't have its own table (like the grade structure) is pickled into the
+    "gradefast" table, just like SqlitePersister.
+    """
+
+    @inject()
+    def __init__(self, settings: Settings):
+        super().__init__(settings)
+
+    def _create_thread(self, save_file) -> "SqlitePersisterThread":
+        return StructuredSqlitePersisterThread(save_file)
+
+
+class StructuredSqlitePersisterThread(SqlitePersisterThread):
+    FORMAT = "structured"
+
+    def _create_tables(self) -> None:
+        super()._create_tables()
+        with self._conn:
+            self._conn.executescript(_STRUCTURED_SCHEMA)
+
+    def _check_file_format(self, file_format: Optional[str]) -> None:
+        if file_format != SqlitePersisterThread.FORMAT:
+            super()._check_file_format(file_format)
+
+    def _convert_file(self, file_format: str) -> None:
+        # Move everything that has its own table out of the "gradefast" table (where
+        # SqlitePersister pickled it)
+        rows = self._conn.execute("SELECT namespace, data_key, data_value FROM gradefast "
+                                  "ORDER BY namespace, data_key").fetchall()
+        migrated = []  # type: List[Tuple[str, str]]
+        for namespace, key, pickled_value in rows:
+            route = self._route(namespace, key)
+            if route is not None:
+                name, ids = route
+                getattr(self, "_set_" + name)(*ids, pickle.loads(pickled_value))
+                migrated.append((namespace, key))
+        if migrated:
+            _logger.info("Moving {} rows from the SQLite save file into the structured tables",
+                         len(migrated))
+            self._conn.executemany("DELETE FROM gradefast WHERE namespace=? AND data_key=?",
+                                   migrated)
+
+    @contextmanager
+    def _savepoint(self) -> Iterator[None]:
+        """
+        Context manager to make the changes inside it all-or-nothing. They're still committed
+        along with everything else (see SqlitePersisterThread._commit).
+        """
+        if not self._conn.in_transaction:
+            self._conn.execute("BEGIN")
+        self._conn.execute("SAVEPOINT structured_set")
+        try:
+            yield
+        except:
+            self._conn.execute("ROLLBACK TO structured_set")
+            self._conn.execute("RELEASE structured_set")
+            raise
+        self._conn.execute("RELEASE structured_set")
+
+    @staticmethod
+    def _route(namespace: str, key: str) -> Optional[Tuple[str, Tuple[int, ...]]]:
+        """
+        Figure out which table(s) hold the data for a key.
+
+        :return: The suffix of the _get_*, _set_*, and _clear_* methods for the key, and the IDs
+            to pass to them (or None if the key is stored in the "gradefast" table).
+        """
+        if namespace == "submissions":
+            if key == "index":
+                return "index", ()
+            match = _SUBMISSION_KEY.match(key)
+            if match:
+                return "submission", (int(match.group(1)),)
+            match = _SUBMISSION_GRADE_KEY.match(key)
+            if match:
+                return "submission_grade", (int(match.group(1)),)
+        elif namespace == "logs":
+            match = _LOGS_KEY.match(key)
+            if match:
+                return "logs", (int(match.group(1)), int(match.group(2)))
+        return None
+
+    def _get(self, namespace: str, key: str) -> Any:
+        route = self._route(namespace, key)
+        if route is None:
+            return super()._get(namespace, key)
+        name, ids = route
+        return getattr(self, "_get_" + name)(*ids)
+
+    def _set(self, namespace: str, key: str, pickled_value: bytes) -> None:
+        route = self._route(namespace, key)
+        if route is None:
+            super()._set(namespace, key, pickled_value)
+            return
+        name, ids = route
+        with self._savepoint():
+            getattr(self, "_set_" + name)(*ids, pickle.loads(pickled_value))
+
+    def _set_many(self, namespace: str, pickled_values: List[Tuple[str, bytes]]) -> None:
+        pickled_rows = []  # type: List[Tuple[str, bytes]]
+        routed_values = []  # type: List[Tuple[str, Tuple[int, ...], bytes]]
+        for key, pickled_value in pickled_values:
+            route = self._route(namespace, key)
+            if route is None:
+                pickled_rows.append((key, pickled_value))
+            else:
+                name, ids = route
+                routed_values.append((name, ids, pickled_value))
+
+        # If any of them fails, none of them are written (and the error is logged by run())
+        with self._savepoint():
+            super()._set_many(namespace, pickled_rows)
+            for name, ids, pickled_value in routed_values:
+                getattr(self, "_set_" + name)(*ids, pickle.loads(pickled_value))
+
+    def _clear(self, namespace: str, key: str) -> None:
+        route = self._route(namespace, key)
+        if route is None:
+            super()._clear(namespace, key)
+            return
+        name, ids = route
+        getattr(self, "_clear_" + name)(*ids)
+
+    def _clear_all(self, namespace: str) -> None:
+        super()._clear_all(namespace)
+        for table in _STRUCTURED_NAMESPACE_TABLES.get(namespace, ()):
+            self._conn.execute("DELETE FROM " + table)
+
+    def _sync_rows(self, table: str, key_columns: Sequence[str], value_columns: Sequence[str],
+                   rows: Dict[tuple, tuple], submission_id: int = None) -> None:
+        """
+        Make the rows in a table match "rows", only writing the rows that actually changed.
+
+        :param table: The name of the table.
+        :param key_columns: The columns that identify a row (not including "submission_id").
+        :param value_columns: The rest of the columns.
+        :param rows: The new rows, as a dict mapping key column values to value column values.
+        :param submission_id: If provided, only the rows for this submission are touched.
+        """
+        where = ""
+        params = ()  # type: tuple
+        if submission_id is not None:
+            key_columns = ("submission_id",) + tuple(key_columns)
+            rows = {(submission_id,) + key: values for key, values in rows.items()}
+            where = " WHERE submission_id=?"
+            params = (submission_id,)
+        key_count = len(key_columns)
+        columns = tuple(key_columns) + tuple(value_columns)
+
+        existing = {}  # type: Dict[tuple, tuple]
+        for row in self._conn.execute(
+                "SELECT {} FROM {}{}".format(", ".join(columns), table, where), params):
+            existing[tuple(row[:key_count])] = tuple(row[key_count:])
+
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+                table, ", ".join(columns), ", ".join("?" * len(columns))),
+            [key + values for key, values in rows.items() if existing.get(key) != values])
+        self._conn.executemany(
+            "DELETE FROM {} WHERE {}".format(
+                table, " AND ".join(column + "=?" for column in key_columns)),
+            [key for key in existing if key not in rows])
+
+    def _get_submission(self, submission_id: int) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT name, full_name, path, log_count FROM submissions WHERE id=?",
+            (submission_id,)).fetchone()
+        if row is None:
+            return None
+        times = self._conn.execute(
+            "SELECT start_time, end_time FROM timings WHERE submission_id=? "
+            "ORDER BY timing_index", (submission_id,)).fetchall()
+        return {
+            "id": submission_id,
+            "name": row[0],
+            "full_name": row[1],
+            "path": Path(row[2]),
+            "log_count": row[3],
+            "start_and_end_times": [(start, end) for start, end in times]
+        }
+
+    def _set_submission(self, submission_id: int, state: dict) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO submissions (id, name, full_name, path, log_count) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (submission_id, state["name"], state["full_name"], state["path"].get_gradefast_path(),
+             state["log_count"]))
+        times = state["start_and_end_times"]
+        self._sync_rows("timings", ("timing_index",), ("start_time", "end_time"), {
+            (index,): (start, end) for index, (start, end) in enumerate(times)
+        }, submission_id)
+
+    def _clear_submission(self, submission_id: int) -> None:
+        self._conn.execute("DELETE FROM submissions WHERE id=?", (submission_id,))
+        self._conn.execute("DELETE FROM timings WHERE submission_id=?", (submission_id,))
+
+    def _get_submission_grade(self, submission_id: int) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT is_late, overall_comments FROM submission_grades WHERE submission_id=?",
+            (submission_id,)).fetchone()
+        if row is None:
+            return None
+
+        hints_by_path = {}  # type: Dict[str, Dict[int, bool]]
+        for grade_path, hint_index, enabled in self._conn.execute(
+                "SELECT grade_path, hint_index, enabled FROM hints WHERE submission_id=?",
+                (submission_id,)):
+            hints_by_path.setdefault(grade_path, {})[hint_index] = bool(enabled)
+
+        items = self._conn.execute(
+            "SELECT grade_path, kind, name, notes, enabled, base_score, comments, late_deduction "
+            "FROM grade_items WHERE submission_id=?", (submission_id,)).fetchall()
+        # Sorting by path means that every item comes after its parent and its older siblings
+        items.sort(key=lambda item: _parse_grade_path(item[0]))
+
+        grades = []  # type: List[dict]
+        sections = {}  # type: Dict[Tuple[int, ...], dict]
+        for grade_path, kind, name, notes, enabled, base_score, comments, late_deduction in items:
+            path = _parse_grade_path(grade_path)
+            state = {
+                "name": name,
+                "notes": notes,
+                "enabled": bool(enabled),
+                "hints_set": hints_by_path.get(grade_path, {})
+            }
+            if kind == "section":
+                state["late_deduction"] = late_deduction
+                state["children"] = []
+                sections[path] = state
+            else:
+                state["base_score"] = base_score
+                state["comments"] = comments
+
+            if len(path) == 1:
+                grades.append(state)
+            else:
+                sections[path[:-1]]["children"].append(state)
+
+        return {
+            "grades": grades,
+            "is_late": bool(row[0]),
+            "overall_comments": row[1]
+        }
+
+    def _set_submission_grade(self, submission_id: int, state: dict) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO submission_grades (submission_id, is_late, overall_comments) "
+            "VALUES (?, ?, ?)", (submission_id, state["is_late"], state["overall_comments"]))
+
+        item_rows = {}  # type: Dict[tuple, tuple]
+        hint_rows = {}  # type: Dict[tuple, tuple]
+
+        def add_items(item_states: List[dict], parent_path: Tuple[int, ...]) -> None:
+            for index, item_state in enumerate(item_states):
+                grade_path = _format_grade_path(parent_path + (index,))
+                if "children" in item_state:
+                    item_rows[(grade_path,)] = (
+                        "section", item_state["name"], item_state["notes"], item_state["enabled"],
+                        None, None, item_state["late_deduction"])
+                    add_items(item_state["children"], parent_path + (index,))
+                else:
+                    item_rows[(grade_path,)] = (
+                        "score", item_state["name"], item_state["notes"], item_state["enabled"],
+                        item_state["base_score"], item_state["comments"], None)
+                for hint_index, enabled in item_state["hints_set"].items():
+                    hint_rows[(grade_path, hint_index)] = (enabled,)
+
+        add_items(state["grades"], ())
+        self._sync_rows("grade_items", ("grade_path",),
+                        ("kind", "name", "notes", "enabled", "base_score", "comments",
+                         "late_deduction"),
+                        item_rows, submission_id)
+        self._sync_rows("hints", ("grade_path", "hint_index"), ("enabled",), hint_rows,
+                        submission_id)
+
+    def _clear_submission_grade(self, submission_id: int) -> None:
+        for table in ("submission_grades", "grade_items", "hints"):
+            self._conn.execute("DELETE FROM {} WHERE submission_id=?".format(table),
+                               (submission_id,))
+
+    def _get_index(self) -> Optional[List[dict]]:
+        index = []
+        for row in self._conn.execute(
+                "SELECT submission_id, name, full_name, path, log_count, is_late, points_earned, "
+                "points_possible FROM submission_index ORDER BY position"):
+            # Same as Submission.get_times()
+            rows = self._conn.execute(
+                "SELECT start_time, end_time FROM timings WHERE submission_id=? "
+                "ORDER BY timing_index", (row[0],))
+            times = [(start, end) for start, end in rows if end is not None and end - start > 0]
+            index.append({
+                "submission_id": row[0],
+                "name": row[1],
+                "full_name": row[2],
+                "path": Path(row[3]),
+                "log_count": row[4],
+                "times": times,
+                "is_late": bool(row[5]),
+                "points_earned": row[6],
+                "points_possible": row[7]
+            })
+        # An empty table means that the index was never persisted
+        return index or None
+
+    def _set_index(self, index: List[dict]) -> None:
+        rows = {}  # type: Dict[tuple, tuple]
+        for position, summary in enumerate(index):
+            rows[(summary["submission_id"],)] = (
+                position, summary["name"], summary["full_name"],
+                summary["path"].get_gradefast_path(), summary["log_count"], summary["is_late"],
+                summary["points_earned"], summary["points_possible"])
+        self._sync_rows("submission_index", ("submission_id",),
+                        ("position", "name", "full_name", "path", "log_count", "is_late",
+                         "points_earned", "points_possible"),
+                        rows)
+
+    def _clear_index(self) -> None:
+        self._conn.execute("DELETE FROM submission_index")
+
+    def _get_logs(self, submission_id: int, log_index: int) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT html_log, text_log FROM logs WHERE submission_id=? AND log_index=?",
+            (submission_id, log_index)).fetchone()
+        if row is None:
+            return None
+        return {
+            "html_log": pickle.loads(row[0]),
+            "text_log": pickle.loads(row[1])
+        }
+
+    def _set_logs(self, submission_id: int, log_index: int, logs: dict) -> None:
+        self._conn.execute(
+            "INSERT OR REPLACE INTO logs (submission_id, log_index, html_log, text_log) "
+            "VALUES (?, ?, ?, ?)",
+            (submission_id, log_index,
+             pickle.dumps(logs["html_log"], protocol=_PICKLE_PROTOCOL_VERSION),
+             pickle.dumps(logs["text_log"], protocol=_PICKLE_PROTOCOL_VERSION)))
+
+    def _clear_logs(self, submission_id: int, log_index: int) -> None:
+        self._conn.execute("DELETE FROM logs WHERE submission_id=? AND log_index=?",
+                           (submission_id, log_index))
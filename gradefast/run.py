@@ -9,16 +9,19 @@ Author: Jake Hartz <jake@hartz.io>
 import threading
 import time
 import webbrowser
-from typing import Sequence
+from typing import Optional, Sequence
 
 from iochannels import Channel, Msg
 from pyprovide import Injector
 
+from gradefast import events
 from gradefast.gradebook.gradebook import GradeBook
+from gradefast.grader.batch import BatchGrader
 from gradefast.grader.grader import Grader
 from gradefast.loggingwrapper import get_logger
 from gradefast.models import Path, Settings
-from gradefast.persister import Persister
+from gradefast.persister import Persister, SaveFileFormatError
+from gradefast.submissions import SubmissionManager
 
 _logger = get_logger("run")
 
@@ -35,25 +38,100 @@ def _try_run_gradebook(gradebook: GradeBook) -> None:
         logger.exception("Exception when running gradebook server")
 
 
+def _get_persister(injector: Injector, channel: Channel) -> Optional[Persister]:
+    """
+    Initialize the Persister (i.e. save file wrapper), or tell the user why we can't.
+
+    :return: The Persister, or None if the save file can't be used (in which case the channel is
+        closed).
+    """
+    try:
+        return injector.get_instance(Persister)
+    except SaveFileFormatError as ex:
+        channel.error(str(ex))
+        channel.close()
+        return None
+
+
 def run_gradefast(injector: Injector, submission_paths: Sequence[Path]) -> None:
     # Initialize the Channel used to communicate via the CLI (if we haven't already)
     channel = injector.get_instance(Channel)
 
     # Initialize the Persister (i.e. save file wrapper)
-    persister = injector.get_instance(Persister)
+    persister = _get_persister(injector, channel)
+    if persister is None:
+        return
 
     # Wrap the rest in a try-finally to ensure the channel and persister get cleaned up properly
+    submission_manager = None
     try:
+        # Initialize the SubmissionManager (which may prompt about the save file)
+        submission_manager = injector.get_instance(SubmissionManager)
+
         _logger.debug("Running GradeFast")
         _run_gradefast_internal(injector, submission_paths)
     except:
         _logger.exception("Error running GradeFast")
     finally:
         _logger.debug("Closing resources")
+        injector.get_instance(events.EventManager).log_stats()
+        if submission_manager:
+            submission_manager.flush()
         persister.close()
         channel.close()
 
 
+def run_gradefast_batch(injector: Injector, submission_paths: Sequence[Path], jobs: int) -> None:
+    # Initialize the Channel and the Persister, like in run_gradefast
+    channel = injector.get_instance(Channel)
+    persister = _get_persister(injector, channel)
+    if persister is None:
+        return
+
+    submission_manager = None
+    try:
+        submission_manager = injector.get_instance(SubmissionManager)
+
+        _logger.debug("Running GradeFast in batch mode")
+        _run_gradefast_batch_internal(injector, submission_paths, jobs)
+    except:
+        _logger.exception("Error running GradeFast in batch mode")
+    finally:
+        _logger.debug("Closing resources")
+        if submission_manager:
+            submission_manager.flush()
+        persister.close()
+        channel.close()
+
+
+def _run_gradefast_batch_internal(injector: Injector, submission_paths: Sequence[Path],
+                                  jobs: int) -> None:
+    channel = injector.get_instance(Channel)
+    submission_manager = injector.get_instance(SubmissionManager)
+
+    if submission_manager.has_submissions():
+        # Don't add the same submissions all over again if we're picking up where we left off
+        channel.status("Using the submissions from the save file")
+    else:
+        grader = injector.get_instance(Grader)
+        for path in submission_paths:
+            grader.add_submissions_from_folder(path)
+        if not submission_manager.has_submissions():
+            channel.error("No submissions found (use \"--submissions\" to specify where they are)")
+            return
+
+    try:
+        injector.get_instance(BatchGrader).run_commands(jobs)
+    except (InterruptedError, KeyboardInterrupt):
+        channel.print()
+        channel.print_bordered("INTERRUPTED", type=Msg.PartType.ERROR)
+        channel.print()
+    else:
+        channel.print()
+        channel.print_bordered("Batch grading complete!", type=Msg.PartType.STATUS)
+        channel.print()
+
+
 def _run_gradefast_internal(injector: Injector, submission_paths: Sequence[Path]) -> None:
     settings = injector.get_instance(Settings)
     channel = injector.get_instance(Channel)
@@ -6,19 +6,21 @@ Licensed under the MIT License. For more, see the LICENSE file.
 Author: Jake Hartz <jake@hartz.io>
 """
 
+import copy
 import statistics
+import threading
 import time
 from collections import OrderedDict
-from typing import Callable, Dict, Iterable, List, NewType, Optional, Tuple
+from typing import Callable, Dict, Iterable, List, NewType, Optional, Set, Tuple
 
 from iochannels import Channel, MemoryLog
 from pyprovide import inject
 
 from gradefast import events
-from gradefast.grades import SubmissionGrade
+from gradefast.grades import SubmissionGrade, get_hint_generation
 from gradefast.hosts import Host
 from gradefast.loggingwrapper import get_logger
-from gradefast.models import EMPTY_STATS, Path, Settings, Stats
+from gradefast.models import EMPTY_STATS, GradeItem, Path, ScoreNumber, Settings, Stats
 from gradefast.persister import Persister
 
 _logger = get_logger("submissions")
@@ -96,6 +98,8 @@ class Submission:
             feedback.
         """
         self._change_handler = None
+        self._log_saver = None  # type: Callable[[int, MemoryLog, MemoryLog], None]
+        self._log_loader = None  # type: Callable[[int], Optional[Tuple[MemoryLog, MemoryLog]]]
 
         self._submission_id = submission_id
         self._name = name
@@ -103,8 +107,10 @@ class Submission:
         self._path = path
         self._submission_grade = submission_grade
 
-        self._html_logs = []  # type: List[MemoryLog]
-        self._text_logs = []  # type: List[MemoryLog]
+        # Logs are persisted separately from the rest of the submission's state (see
+        # set_log_persistence). "None" indicates a log that hasn't been loaded yet.
+        self._html_logs = []  # type: List[Optional[MemoryLog]]
+        self._text_logs = []  # type: List[Optional[MemoryLog]]
         self._start_and_end_times = []  # type: List[Tuple[float, Optional[float]]]
 
     def get_state(self) -> dict:
@@ -112,7 +118,8 @@ class Submission:
         Return state that should be persisted to the GradeFast save file (serialized via pickle).
         See Persister in persister.py for details.
 
-        This doesn't include this submission's SubmissionGrade; that is persisted separately.
+        This doesn't include this submission's SubmissionGrade or its logs; those are persisted
+        separately.
         """
         return {
             "id": self._submission_id,
@@ -120,8 +127,7 @@ class Submission:
             "full_name": self._full_name,
             "path": self._path,
 
-            "html_logs": self._html_logs,
-            "text_logs": self._text_logs,
+            "log_count": len(self._html_logs),
             "start_and_end_times": self._start_and_end_times
         }
 
@@ -133,8 +139,13 @@ class Submission:
         """
         submission = Submission(state["id"], state["name"], state["full_name"], state["path"],
                                 submission_grade)
-        submission._html_logs = state["html_logs"]
-        submission._text_logs = state["text_logs"]
+        if "html_logs" in state:
+            # Older save files include the logs in the submission's state
+            submission._html_logs = state["html_logs"]
+            submission._text_logs = state["text_logs"]
+        else:
+            submission._html_logs = [None] * state["log_count"]
+            submission._text_logs = [None] * state["log_count"]
         submission._start_and_end_times = state["start_and_end_times"]
         return submission
 
@@ -142,6 +153,20 @@ class Submission:
         self._change_handler = change_handler
         self._submission_grade.set_change_handler(change_handler)
 
+    def set_log_persistence(
+            self, log_saver: Callable[[int, MemoryLog, MemoryLog], None],
+            log_loader: Callable[[int], Optional[Tuple[MemoryLog, MemoryLog]]]) -> None:
+        """
+        Set the functions used to persist and restore this submission's logs.
+
+        :param log_saver: Called with the index, HTML log, and text log when a pair of logs is
+            closed.
+        :param log_loader: Called with an index to get the HTML log and text log that were
+            previously saved with that index (or None if they can't be found).
+        """
+        self._log_saver = log_saver
+        self._log_loader = log_loader
+
     def changed(self) -> None:
         if self._change_handler:
             self._change_handler()
@@ -167,15 +192,49 @@ class Submission:
                 if end is not None and end - start > 0]
 
     def add_logs(self, html_log: MemoryLog, text_log: MemoryLog) -> None:
+        """
+        Add a new pair of logs for this submission. Once they're done being written to, they should
+        be closed with close_logs().
+        """
         self._html_logs.append(html_log)
         self._text_logs.append(text_log)
         self.changed()
 
+    def close_logs(self) -> None:
+        """
+        Close the most recently added pair of logs, and persist them.
+        """
+        index = len(self._html_logs) - 1
+        html_log = self._html_logs[index]
+        text_log = self._text_logs[index]
+        html_log.close()
+        text_log.close()
+        if self._log_saver:
+            self._log_saver(index, html_log, text_log)
+            # Don't hang on to them; they're loaded again if anyone wants to see them
+            self._html_logs[index] = None
+            self._text_logs[index] = None
+
+    def has_logs(self) -> bool:
+        return len(self._html_logs) > 0
+
+    def _get_logs(self, which: int) -> List[MemoryLog]:
+        logs = []
+        for index, (html_log, text_log) in enumerate(zip(self._html_logs, self._text_logs)):
+            if html_log is None and self._log_loader:
+                loaded = self._log_loader(index)
+                if loaded is None:
+                    continue
+                html_log, text_log = loaded
+            if html_log is not None:
+                logs.append((html_log, text_log)[which])
+        return logs
+
     def get_html_logs(self) -> List[MemoryLog]:
-        return self._html_logs
+        return self._get_logs(0)
 
     def get_text_logs(self) -> List[MemoryLog]:
-        return self._text_logs
+        return self._get_logs(1)
 
     def start_timer(self) -> TimerContext:
         context = len(self._start_and_end_times)
@@ -194,26 +253,104 @@ class Submission:
             return "{} ({})".format(self._name, self._full_name)
         return self._name
 
-    def to_json(self) -> dict:
+    def get_summary(self) -> "SubmissionSummary":
         points_earned, points_possible = self._submission_grade.get_score()
+        return SubmissionSummary(self._submission_id, self._name, self._full_name, self._path,
+                                 len(self._html_logs), self.get_times(),
+                                 self._submission_grade.is_late(), points_earned, points_possible)
+
+    def to_json(self) -> dict:
+        return self.get_summary().to_json()
+
+
+class SubmissionSummary:
+    """
+    The parts of a submission that are needed to list it (and to calculate stats) without loading
+    the whole Submission and SubmissionGrade out of the save file. The SubmissionManager keeps
+    these for every submission in the save file's submission index.
+    """
+
+    __slots__ = ("submission_id", "name", "full_name", "path", "log_count", "times", "is_late",
+                 "points_earned", "points_possible")
+
+    def __init__(self, submission_id: int, name: str, full_name: str, path: Path, log_count: int,
+                 times: List[Tuple[float, float]], is_late: bool, points_earned: float,
+                 points_possible: float) -> None:
+        self.submission_id = submission_id
+        self.name = name
+        self.full_name = full_name
+        self.path = path
+        self.log_count = log_count
+        self.times = times
+        self.is_late = is_late
+        self.points_earned = points_earned
+        self.points_possible = points_possible
+
+    def get_state(self) -> dict:
+        """
+        Return state that should be persisted to the GradeFast save file (serialized via pickle).
+        """
+        return {slot: getattr(self, slot) for slot in SubmissionSummary.__slots__}
+
+    @staticmethod
+    def from_state(state: dict) -> "SubmissionSummary":
+        """
+        Create a new SubmissionSummary based on state persisted from the get_state() method.
+        """
+        return SubmissionSummary(**state)
+
+    def get_id(self) -> int:
+        return self.submission_id
+
+    def get_name(self) -> str:
+        return self.name
+
+    def get_full_name(self) -> str:
+        return self.full_name
+
+    def get_path(self) -> Path:
+        return self.path
+
+    def has_logs(self) -> bool:
+        return self.log_count > 0
+
+    def __str__(self) -> str:
+        if self.name != self.full_name:
+            return "{} ({})".format(self.name, self.full_name)
+        return self.name
+
+    def to_json(self) -> dict:
         return {
-            "id": self._submission_id,
-            "name": self._name,
-            "full_name": self._full_name,
-            "path": str(self._path),
-            "has_logs": len(self._html_logs) > 0,
-            "times": self.get_times(),
-            "is_late": self._submission_grade.is_late(),
-            "points_earned": points_earned,
-            "points_possible": points_possible
+            "id": self.submission_id,
+            "name": self.name,
+            "full_name": self.full_name,
+            "path": str(self.path),
+            "has_logs": self.has_logs(),
+            "times": self.times,
+            "is_late": self.is_late,
+            "points_earned": self.points_earned,
+            "points_possible": self.points_possible
         }
 
 
 class SubmissionManager:
     """
     Manages the GradeFast list of submissions, related stats.
+
+    Changes to submissions are persisted write-behind: a changed submission is marked as dirty, and
+    all the dirty submissions are persisted together a short time later (see PERSIST_DELAY), or
+    when flush() is called. Make sure to call flush() before closing the persister.
+
+    Along with each submission, the save file has an index of SubmissionSummary objects. When
+    restoring from the save file, only the index is read; each Submission is loaded the first time
+    it's requested (see get_submission). Adding or editing a hint can change the score of any
+    submission, so when that happens, the summaries of the submissions that haven't been loaded are
+    recalculated from their grades in the save file the next time they're needed.
     """
 
+    # How long to wait after a submission changes before persisting it (in seconds)
+    PERSIST_DELAY = 0.5
+
     @staticmethod
     def _get_submission_key(submission_id: int) -> str:
         return "submission-" + str(submission_id)
@@ -222,6 +359,10 @@ class SubmissionManager:
     def _get_submission_grade_key(submission_id: int) -> str:
         return "submission_grade-" + str(submission_id)
 
+    @staticmethod
+    def _get_logs_key(submission_id: int, index: int) -> str:
+        return "submission-{}-{}".format(submission_id, index)
+
     @inject()
     def __init__(self, channel: Channel, host: Host, persister: Persister,
                  event_manager: events.EventManager, settings: Settings) -> None:
@@ -233,8 +374,37 @@ class SubmissionManager:
         # This could be set to something else when restoring from the save file
         self._grade_structure = settings.grade_structure
 
-        self._submissions_by_id = OrderedDict()  # type: Dict[int, Submission]
+        # Every submission, in order (see SubmissionSummary)
+        self._summaries_by_id = OrderedDict()  # type: Dict[int, SubmissionSummary]
+        # The submissions that have been loaded (or created) so far
+        self._submissions_by_id = {}  # type: Dict[int, Submission]
+        # Held while loading a submission from the save file
+        self._load_lock = threading.Lock()
         self._last_id = 0
+        # The submissions restored from the index whose folders haven't been checked yet
+        self._unchecked_folder_ids = set()  # type: Set[int]
+
+        # Write-behind state (see flush). Submissions are changed from a few different threads (the
+        # grader, the GradeBook), so when one changes, it's marked as dirty (in the thread that
+        # changed it), and the next flush takes a snapshot of each dirty submission while holding
+        # the dirty lock. If a submission was in the middle of being changed, its change handler
+        # has to wait for the lock, so it's marked as dirty again and persisted in the next flush.
+        # Held while changing the dirty IDs or the summaries, or taking a snapshot of them
+        self._dirty_lock = threading.Lock()
+        self._dirty_ids = set()  # type: Set[int]
+        self._pending_grade_structure = None  # type: Optional[List[GradeItem]]
+        self._flush_timer = None  # type: Optional[threading.Timer]
+        # Held while actually writing to the persister
+        self._persist_lock = threading.RLock()
+        # What the submission list metadata looked like the last time we took a snapshot of it
+        self._persisted_ids = None  # type: Optional[List[int]]
+        self._hint_generation = get_hint_generation()
+        self._index_changed = False
+        # The submissions (that haven't been loaded) whose summaries are out-of-date because a hint
+        # was added or edited (see _refresh_stale_summaries)
+        self._stale_summary_ids = set()  # type: Set[int]
+        # Held while refreshing the stale summaries
+        self._refresh_lock = threading.Lock()
 
         # Only restore the grades for persisted submissions if we're keeping the same grade
         # structure
@@ -301,16 +471,29 @@ class SubmissionManager:
 
         # Read any persisted submissions from the save file
         persisted_submissions_ids = self.persister.get("submissions", "ids")
-        if persisted_submissions_ids:
-            for submission_id in persisted_submissions_ids:
-                if submission_id in self._submissions_by_id:
-                    _logger.warning("Duplicate submission ID {} found in saved data", submission_id)
-                else:
-                    self._restore_persisted_submission(submission_id, restore_grades=restore_grades)
-
-        # Re-persist everything we got. This will also persist the list of submissions and the
-        # grade structure.
-        self._persist_all_submissions()
+        persisted_index = self.persister.get("submissions", "index")
+        if persisted_submissions_ids and persisted_index is not None and restore_grades:
+            # The index is up-to-date, so we don't need to load any submissions yet
+            self._restore_persisted_index(persisted_submissions_ids, persisted_index)
+            # Nothing has changed, except maybe the list of submissions
+            self._persisted_ids = persisted_submissions_ids
+            with self._persist_lock:
+                self._persist_metadata()
+        else:
+            # Either this is an older save file without an index, or the scores in the index are
+            # out-of-date since we're not restoring the grades
+            if persisted_submissions_ids:
+                for submission_id in persisted_submissions_ids:
+                    if submission_id in self._summaries_by_id:
+                        _logger.warning("Duplicate submission ID {} found in saved data",
+                                        submission_id)
+                    else:
+                        self._restore_persisted_submission(submission_id,
+                                                           restore_grades=restore_grades)
+
+            # Re-persist everything we got. This will also persist the list of submissions, the
+            # index, and the grade structure.
+            self._persist_all_submissions()
         # Persist the original grade structure (see the wall of comment text above). We only want
         # to do this once, so that if the user makes changes to the grade structure (adding or
         # editing hints), we'll still have the original grade structure stored. If we're using a
@@ -322,46 +505,269 @@ class SubmissionManager:
         self.event_manager.dispatch_event(events.NewSubmissionsEvent())
 
     def _get_change_handler(self, submission_id: int) -> Callable[[], None]:
-        return lambda: self._persist_submission(submission_id)
+        return lambda: self._mark_dirty(submission_id)
+
+    def _set_handlers(self, submission: Submission) -> None:
+        submission_id = submission.get_id()
+        submission.set_change_handler(self._get_change_handler(submission_id))
+        submission.set_log_persistence(
+            lambda index, html_log, text_log:
+                self._persist_logs(submission_id, index, html_log, text_log),
+            lambda index: self._restore_persisted_logs(submission_id, index))
+
+    def _mark_dirty(self, submission_id: int) -> None:
+        """
+        Mark a submission that just changed as dirty (so it's persisted in the next flush), and
+        update its summary. This is called in the thread that changed the submission.
+        """
+        with self._dirty_lock:
+            if submission_id not in self._summaries_by_id:
+                # It was dropped
+                return
+            # If a hint was just added or edited, this is the thread that did it
+            hint_generation = get_hint_generation()
+            if hint_generation != self._hint_generation:
+                self._pending_grade_structure = copy.deepcopy(self._grade_structure)
+                self._hint_generation = hint_generation
+                self._mark_summaries_stale()
+
+            self._dirty_ids.add(submission_id)
+            summary = self._submissions_by_id[submission_id].get_summary()
+            # Most changes (like comments) don't show up in the summary, so they don't need the
+            # index to be persisted again
+            if summary.get_state() != self._summaries_by_id[submission_id].get_state():
+                self._index_changed = True
+            self._summaries_by_id[submission_id] = summary
+            self._stale_summary_ids.discard(submission_id)
+
+            if self._flush_timer is None:
+                self._flush_timer = threading.Timer(SubmissionManager.PERSIST_DELAY, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+
+    def _mark_summaries_stale(self) -> None:
+        """
+        Update the summaries of the loaded submissions, and mark the rest as stale, after a hint
+        was added or edited. The dirty lock must be held.
+        """
+        for submission_id in list(self._summaries_by_id.keys()):
+            submission = self._submissions_by_id.get(submission_id)
+            if submission is None:
+                self._stale_summary_ids.add(submission_id)
+            else:
+                self._summaries_by_id[submission_id] = submission.get_summary()
+        self._index_changed = True
+
+    def _refresh_stale_summaries(self) -> None:
+        """
+        Recalculate the scores in the stale summaries (see _mark_summaries_stale) from the grades
+        in the save file, without loading the submissions.
+        """
+        with self._refresh_lock:
+            with self._dirty_lock:
+                if not self._stale_summary_ids:
+                    return
+                stale_summaries = [(submission_id, self._summaries_by_id[submission_id])
+                                   for submission_id in sorted(self._stale_summary_ids)
+                                   if submission_id in self._summaries_by_id]
+                self._stale_summary_ids = set()
+
+            scores = [self._get_persisted_score(submission_id)
+                      for submission_id, _ in stale_summaries]
+
+            with self._dirty_lock:
+                for (submission_id, summary), score in zip(stale_summaries, scores):
+                    # If the submission changed in the meantime, its summary is already up-to-date
+                    if score is None or self._summaries_by_id.get(submission_id) is not summary:
+                        continue
+                    summary_state = summary.get_state()
+                    summary_state["points_earned"], summary_state["points_possible"] = score
+                    self._summaries_by_id[submission_id] = \
+                        SubmissionSummary.from_state(summary_state)
+                    self._index_changed = True
+
+    def _get_persisted_score(self, submission_id: int) \
+            -> Optional[Tuple[ScoreNumber, ScoreNumber]]:
+        try:
+            submission_grade_state = self.persister.get(
+                "submissions", self._get_submission_grade_key(submission_id))
+            submission_grade = SubmissionGrade(self._grade_structure)
+            submission_grade.set_state(submission_grade_state, restore_grades=True)
+            return submission_grade.get_score()
+        except:
+            _logger.exception("Error recalculating the score of saved submission (ID {})",
+                              submission_id)
+            return None
+
+    def flush(self) -> None:
+        """
+        Persist all the submissions that changed since the last flush, along with the submission
+        list metadata if it changed.
+        """
+        # The index might have stale summaries that need to be recalculated first
+        self._refresh_stale_summaries()
+        # Hold the persist lock the whole time so that two flushes can't write their snapshots out
+        # of order
+        with self._persist_lock:
+            with self._dirty_lock:
+                values = OrderedDict()  # type: Dict[str, object]
+                for submission_id in sorted(self._dirty_ids):
+                    try:
+                        values.update(self._get_submission_values(submission_id))
+                    except RuntimeError:
+                        # It was changed while we were copying it (see _dirty_lock), so it'll be
+                        # marked as dirty again as soon as we let go of the lock
+                        _logger.debug("Submission (ID {}) changed while taking a snapshot",
+                                      submission_id)
+                self._dirty_ids = set()
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                # This goes after the submissions since it includes their summaries
+                values.update(self._take_metadata_values())
+
+            if values:
+                self.persister.set_many("submissions", values)
+                _logger.debug("Persisted {} changed values", len(values))
 
     def has_submissions(self) -> bool:
-        return len(self._submissions_by_id) > 0
+        return len(self._summaries_by_id) > 0
 
     def add_submission(self, name: str, full_name: str, path: Path,
                        send_event: bool = True) -> Submission:
         self._last_id += 1
         new_submission_id = self._last_id
-        assert new_submission_id not in self._submissions_by_id
+        assert new_submission_id not in self._summaries_by_id
 
         new_submission_grade = SubmissionGrade(self._grade_structure)
-        self._submissions_by_id[new_submission_id] = Submission(
-            new_submission_id, name, full_name, path, new_submission_grade)
-        self._submissions_by_id[new_submission_id].set_change_handler(
-            self._get_change_handler(new_submission_id))
+        submission = Submission(new_submission_id, name, full_name, path, new_submission_grade)
+        self._set_handlers(submission)
+        self._submissions_by_id[new_submission_id] = submission
+        with self._dirty_lock:
+            self._summaries_by_id[new_submission_id] = submission.get_summary()
 
-        self._persist_submission(new_submission_id)
+        self._mark_dirty(new_submission_id)
         if send_event:
             self.event_manager.dispatch_event(events.NewSubmissionsEvent())
 
-        return self._submissions_by_id[new_submission_id]
+        return submission
 
     def get_submission(self, submission_id: int) -> Submission:
-        return self._submissions_by_id[submission_id]
+        """
+        Get a submission, loading it from the save file if it hasn't been loaded yet.
+        """
+        submission = self._submissions_by_id.get(submission_id)
+        if submission is not None:
+            return submission
+
+        with self._load_lock:
+            # Check again, in case another thread just loaded it
+            submission = self._submissions_by_id.get(submission_id)
+            if submission is not None:
+                return submission
+
+            summary = self._summaries_by_id[submission_id]
+            submission = self._load_persisted_submission(submission_id, restore_grades=True)
+            if submission is None:
+                # Better than nothing...
+                _logger.error("Couldn't load submission {} (ID {}); starting over with its grades",
+                              summary, submission_id)
+                submission = Submission(submission_id, summary.name, summary.full_name,
+                                        summary.path, SubmissionGrade(self._grade_structure))
+            self._set_handlers(submission)
+            self._submissions_by_id[submission_id] = submission
+            return submission
 
     def drop_submission(self, submission_id: int) -> None:
-        assert submission_id in self._submissions_by_id
-        del self._submissions_by_id[submission_id]
-        self._clear_persisted_submission(submission_id)
+        assert submission_id in self._summaries_by_id
+        with self._dirty_lock:
+            summary = self._summaries_by_id.pop(submission_id)
+            self._dirty_ids.discard(submission_id)
+        self._unchecked_folder_ids.discard(submission_id)
+        submission = self._submissions_by_id.pop(submission_id, None)
+        if submission is not None:
+            summary = submission.get_summary()
+        self._clear_persisted_submission(submission_id, summary.log_count)
         self.event_manager.dispatch_event(events.NewSubmissionsEvent())
 
+    def drop_submission_if_missing(self, submission_id: int) -> bool:
+        """
+        Drop a submission that was restored from the save file if its folder doesn't exist anymore.
+        This is checked the first time that grading gets to each submission (rather than for every
+        submission when restoring, which can take a while on a remote host).
+
+        :return: Whether the submission was dropped.
+        """
+        if submission_id not in self._unchecked_folder_ids:
+            return False
+        self._unchecked_folder_ids.discard(submission_id)
+
+        summary = self._summaries_by_id[submission_id]
+        if self.host.folder_exists(summary.get_path()):
+            return False
+        _logger.warning("Previously saved submission {} (ID {}) no longer exists at {}",
+                        summary, submission_id, summary.get_path())
+        self.drop_submission(submission_id)
+        return True
+
+    def _restore_persisted_index(self, persisted_submission_ids: List[int],
+                                 persisted_index: List[dict]) -> None:
+        summaries_by_id = {}  # type: Dict[int, SubmissionSummary]
+        for summary_state in persisted_index:
+            try:
+                summary = SubmissionSummary.from_state(summary_state)
+            except:
+                _logger.exception("Error restoring saved submission index entry")
+                continue
+            summaries_by_id[summary.get_id()] = summary
+
+        for submission_id in persisted_submission_ids:
+            if submission_id in self._summaries_by_id:
+                _logger.warning("Duplicate submission ID {} found in saved data", submission_id)
+                continue
+
+            summary = summaries_by_id.get(submission_id)
+            if summary is None:
+                # The index is out of sync with the list of IDs; fall back to loading the whole
+                # submission
+                _logger.warning("Saved submission (ID {}) is missing from the index",
+                                submission_id)
+                self._restore_persisted_submission(submission_id, restore_grades=True)
+                self._index_changed = True
+                continue
+
+            # Checking that its folder still exists can wait until grading gets to it (see
+            # drop_submission_if_missing)
+            self._unchecked_folder_ids.add(submission_id)
+            self._last_id = max(self._last_id, submission_id)
+            self._summaries_by_id[submission_id] = summary
+
     def _restore_persisted_submission(self, submission_id: int, restore_grades: bool) -> None:
-        assert submission_id not in self._submissions_by_id
+        assert submission_id not in self._summaries_by_id
+        submission = self._load_persisted_submission(submission_id, restore_grades)
+        if submission is None:
+            return
+
+        if not self.host.folder_exists(submission.get_path()):
+            _logger.warning("Previously saved submission {} (ID {}) no longer exists at {}",
+                            submission, submission_id, submission.get_path())
+            self._clear_persisted_submission(submission_id, submission.get_summary().log_count,
+                                             persist_metadata=False)
+            return
+
+        self._set_handlers(submission)
+        self._last_id = max(self._last_id, submission_id)
+        self._submissions_by_id[submission_id] = submission
+        self._summaries_by_id[submission_id] = submission.get_summary()
+
+    def _load_persisted_submission(self, submission_id: int,
+                                   restore_grades: bool) -> Optional[Submission]:
         try:
             submission_state = self.persister.get(
                 "submissions", self._get_submission_key(submission_id))
             if not submission_state:
                 _logger.warning("Couldn't find saved submission (ID {})", submission_id)
-                return
+                return None
 
             submission_grade = SubmissionGrade(self._grade_structure)
             submission_grade_state = self.persister.get(
@@ -371,48 +777,115 @@ class SubmissionManager:
             submission = Submission.from_state(submission_state, submission_grade)
         except:
             _logger.exception("Error restoring saved submission (ID {})", submission_id)
-            return
+            return None
 
-        if not self.host.folder_exists(submission.get_path()):
-            _logger.warning("Previously saved submission {} (ID {}) no longer exists at {}",
-                            submission, submission_id, submission.get_path())
-            return
+        if "html_logs" in submission_state:
+            # Move the logs out of the submission's state (from an older save file)
+            for index, (html_log, text_log) in enumerate(zip(submission.get_html_logs(),
+                                                             submission.get_text_logs())):
+                self._persist_logs(submission_id, index, html_log, text_log)
+            submission._html_logs = [None] * len(submission._html_logs)
+            submission._text_logs = [None] * len(submission._text_logs)
 
-        submission.set_change_handler(self._get_change_handler(submission_id))
-        self._last_id = max(self._last_id, submission_id)
-        self._submissions_by_id[submission.get_id()] = submission
+        return submission
 
-    def _clear_persisted_submission(self, submission_id: int) -> None:
-        self._persist_metadata()
+    def _clear_persisted_submission(self, submission_id: int, log_count: int,
+                                    persist_metadata: bool = True) -> None:
+        with self._persist_lock:
+            if persist_metadata:
+                self._persist_metadata()
+
+            self.persister.clear("submissions", self._get_submission_key(submission_id))
+            self.persister.clear("submissions", self._get_submission_grade_key(submission_id))
+            for index in range(log_count):
+                self.persister.clear("logs", self._get_logs_key(submission_id, index))
+
+    def _persist_logs(self, submission_id: int, index: int, html_log: MemoryLog,
+                      text_log: MemoryLog) -> None:
+        # Logs aren't modified after they're closed, so they only need to be persisted once
+        self.persister.set("logs", self._get_logs_key(submission_id, index), {
+            "html_log": html_log,
+            "text_log": text_log
+        })
+
+    def _restore_persisted_logs(self, submission_id: int, index: int) \
+            -> Optional[Tuple[MemoryLog, MemoryLog]]:
+        try:
+            logs_state = self.persister.get("logs", self._get_logs_key(submission_id, index))
+        except:
+            _logger.exception("Error restoring saved logs (submission ID {}, index {})",
+                              submission_id, index)
+            return None
+        if not logs_state:
+            # This can happen if GradeFast was stopped before the logs were closed
+            _logger.warning("Couldn't find saved logs (submission ID {}, index {})",
+                            submission_id, index)
+            return None
+        return logs_state["html_log"], logs_state["text_log"]
+
+    def _get_submission_values(self, submission_id: int) -> Dict[str, object]:
+        """
+        Get a copy of everything that needs to be persisted for a submission (to pass to the
+        persister's set_many).
+        """
+        submission = self._submissions_by_id[submission_id]
+        return copy.deepcopy({
+            self._get_submission_key(submission_id): submission.get_state(),
+            self._get_submission_grade_key(submission_id): submission.get_grade().get_state()
+        })
 
-        self.persister.clear("submissions", self._get_submission_key(submission_id))
-        self.persister.clear("submissions", self._get_submission_grade_key(submission_id))
+    def _persist_all_submissions(self) -> None:
+        with self._persist_lock:
+            self.persister.clear_all("submissions")
 
-    def _persist_submission(self, submission_id: int) -> None:
-        assert submission_id in self._submissions_by_id
-        self._persist_metadata()
+            values = OrderedDict()  # type: Dict[str, object]
+            for submission_id in list(self._summaries_by_id.keys()):
+                submission = self.get_submission(submission_id)
+                values.update(self._get_submission_values(submission_id))
+                self._summaries_by_id[submission_id] = submission.get_summary()
+            self.persister.set_many("submissions", values)
 
-        self.persister.set("submissions", self._get_submission_key(submission_id),
-                           self._submissions_by_id[submission_id].get_state())
-        self.persister.set("submissions", self._get_submission_grade_key(submission_id),
-                           self._submissions_by_id[submission_id].get_grade().get_state())
+            self._persist_metadata(force=True)
 
-    def _persist_all_submissions(self) -> None:
-        self.persister.clear_all("submissions")
-        self._persist_metadata()
+    def _persist_metadata(self, force: bool = False) -> None:
+        """
+        Persist the list of submission IDs, the submission index, and the grade structure, if any
+        of them changed since the last time they were persisted.
 
-        for submission_id, submission in self._submissions_by_id.items():
-            self.persister.set("submissions", self._get_submission_key(submission_id),
-                               submission.get_state())
-            self.persister.set("submissions", self._get_submission_grade_key(submission_id),
-                               submission.get_grade().get_state())
+        :param force: Whether to persist them even if they haven't changed.
+        """
+        with self._persist_lock:
+            with self._dirty_lock:
+                values = self._take_metadata_values(force)
+            if values:
+                self.persister.set_many("submissions", values)
 
-    def _persist_metadata(self) -> None:
-        self.persister.set("submissions", "ids", list(self._submissions_by_id.keys()))
-        self.persister.set("submissions", "grade_structure", self._grade_structure)
+    def _take_metadata_values(self, force: bool = False) -> Dict[str, object]:
+        """
+        Take a snapshot of the parts of the submission list metadata that changed since the last
+        snapshot (to pass to the persister's set_many). The dirty lock must be held.
+
+        :param force: Whether to include everything even if it hasn't changed.
+        """
+        values = OrderedDict()  # type: Dict[str, object]
+        ids = list(self._summaries_by_id.keys())
+        if force or ids != self._persisted_ids:
+            values["ids"] = ids
+            self._persisted_ids = ids
+            self._index_changed = True
+        if force or self._index_changed:
+            values["index"] = [summary.get_state() for summary in self._summaries_by_id.values()]
+            self._index_changed = False
+        # The grade structure only changes when hints are added or edited (see _mark_dirty)
+        if force:
+            values["grade_structure"] = self._grade_structure
+        elif self._pending_grade_structure is not None:
+            values["grade_structure"] = self._pending_grade_structure
+        self._pending_grade_structure = None
+        return values
 
     def get_first_submission_id(self) -> Optional[int]:
-        for submission_id in self._submissions_by_id.keys():
+        for submission_id in self._summaries_by_id.keys():
             return submission_id
         return None
 
@@ -426,7 +899,7 @@ class SubmissionManager:
         while True:
             if submission_id > self.get_last_submission_id():
                 return None
-            if submission_id in self._submissions_by_id:
+            if submission_id in self._summaries_by_id:
                 return submission_id
             submission_id += 1
 
@@ -435,32 +908,64 @@ class SubmissionManager:
         while True:
             if submission_id < self.get_first_submission_id():
                 return None
-            if submission_id in self._submissions_by_id:
+            if submission_id in self._summaries_by_id:
                 return submission_id
             submission_id -= 1
 
     def get_all_submission_ids(self) -> Iterable[int]:
-        return self._submissions_by_id.keys()
+        return self._summaries_by_id.keys()
 
     def get_all_submissions(self) -> Iterable[Submission]:
-        return self._submissions_by_id.values()
+        """
+        Get every submission. This loads any submissions that haven't been loaded yet, so use
+        get_all_submission_summaries() if the summaries are enough.
+        """
+        return [self.get_submission(submission_id)
+                for submission_id in list(self._summaries_by_id.keys())]
+
+    def get_loaded_submission_ids(self) -> List[int]:
+        """
+        Get the IDs of the submissions that have been loaded (or created) so far, in order. The
+        other submissions can't be changed until they're loaded, but adding or editing a hint can
+        still change their summaries.
+        """
+        return [submission_id for submission_id in list(self._summaries_by_id.keys())
+                if submission_id in self._submissions_by_id]
+
+    def get_submission_summary(self, submission_id: int) -> SubmissionSummary:
+        """
+        Get an up-to-date summary of a submission, without loading it.
+        """
+        self._refresh_stale_summaries()
+        submission = self._submissions_by_id.get(submission_id)
+        if submission is None:
+            return self._summaries_by_id[submission_id]
+        return submission.get_summary()
+
+    def get_all_submission_summaries(self) -> List[SubmissionSummary]:
+        """
+        Get an up-to-date summary of every submission, without loading any submissions.
+        """
+        self._refresh_stale_summaries()
+        summaries = []
+        for submission_id, summary in list(self._summaries_by_id.items()):
+            submission = self._submissions_by_id.get(submission_id)
+            summaries.append(summary if submission is None else submission.get_summary())
+        return summaries
 
     def get_grading_stats(self) -> Stats:
         grades_with_id = []  # type: List[Tuple[float, int]]
-        for submission_id, submission in self._submissions_by_id.items():
-            points_earned, points_possible = submission.get_grade().get_score()
-            percentage = 100 * points_earned / points_possible
-            grades_with_id.append((percentage, submission_id))
+        for summary in self.get_all_submission_summaries():
+            percentage = 100 * summary.points_earned / summary.points_possible
+            grades_with_id.append((percentage, summary.get_id()))
 
         return _calculate_stats(grades_with_id)
 
     def get_timing_stats(self) -> Stats:
         times_with_id = []  # type: List[Tuple[float, int]]
-        for submission_id, submission in self._submissions_by_id.items():
-            total_time = round(sum((end - start)
-                                   for start, end in submission._start_and_end_times
-                                   if end is not None))
+        for summary in self.get_all_submission_summaries():
+            total_time = round(sum((end - start) for start, end in summary.times))
             if total_time > 0:
-                times_with_id.append((total_time, submission_id))
+                times_with_id.append((total_time, summary.get_id()))
 
         return _calculate_stats(times_with_id)
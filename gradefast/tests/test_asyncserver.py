@@ -0,0 +1,50 @@
+import asyncio
+import threading
+import unittest
+
+from gradefast.gradebook.asyncserver import AsyncClientUpdateQueue, _call_wsgi_app, \
+    _make_wsgi_environ
+from gradefast.gradebook.clientupdates import ClientUpdate
+
+
+class TestAsyncClientUpdateQueue(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_put_from_thread(self):
+        async def receive(update_queue):
+            return [await update_queue.get_async(), await update_queue.get_async()]
+
+        update_queue = AsyncClientUpdateQueue(self.loop, 10)
+        updates = [ClientUpdate("first"), ClientUpdate("second")]
+
+        def put_later():
+            for client_update in updates:
+                update_queue.put(client_update)
+
+        self.loop.call_later(0.05, threading.Thread(target=put_later).start)
+        self.assertEqual(self.loop.run_until_complete(asyncio.wait_for(receive(update_queue), 5)),
+                         updates)
+
+
+class TestWSGIBridge(unittest.TestCase):
+    def test_call_wsgi_app(self):
+        def app(environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/plain")])
+            return [environ["REQUEST_METHOD"].encode(), b" ", environ["PATH_INFO"].encode(), b" ",
+                    environ["QUERY_STRING"].encode(), b" ", environ["CONTENT_TYPE"].encode(),
+                    b" ", environ["HTTP_X_THING"].encode(), b" ", environ["wsgi.input"].read()]
+
+        environ = _make_wsgi_environ({
+            "type": "http",
+            "method": "POST",
+            "path": "/gradefast/_auth",
+            "query_string": b"a=b",
+            "headers": [(b"content-type", b"text/plain"), (b"x-thing", b"1"), (b"x-thing", b"2")]
+        }, b"body")
+        self.assertEqual(_call_wsgi_app(app, environ), (
+            "200 OK", [("Content-Type", "text/plain")],
+            b"POST /gradefast/_auth a=b text/plain 1,2 body"))
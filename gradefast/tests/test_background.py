@@ -0,0 +1,85 @@
+import threading
+import types
+import unittest
+
+from gradefast.grader.background import BackgroundCommandManager, BackgroundJob
+from gradefast.models import CommandItem
+
+
+class _FakeBackgroundCommand:
+    def __init__(self):
+        self.stopped = threading.Event()
+
+    def wait(self):
+        self.stopped.wait(10)
+
+    def get_output_size(self):
+        return 0
+
+    def stop(self):
+        self.stopped.set()
+
+    def get_error(self):
+        return "Stopped" if self.stopped.is_set() else None
+
+
+class TestBackgroundCommandManager(unittest.TestCase):
+    def setUp(self):
+        self.starting = threading.Event()
+        self.can_start = threading.Event()
+        self.can_start.set()
+        self.commands = []
+        self.manager = BackgroundCommandManager(
+            types.SimpleNamespace(start_background_command=self.start_background_command),
+            types.SimpleNamespace(background_workers=1),
+            types.SimpleNamespace(dispatch_event=lambda event: None))
+
+    def tearDown(self):
+        for command in self.commands:
+            command.stop()
+        self.manager.close()
+
+    def start_background_command(self, command, path, environment, stdin, limits=None):
+        self.starting.set()
+        self.can_start.wait(10)
+        background_command = _FakeBackgroundCommand()
+        self.commands.append(background_command)
+        return background_command
+
+    def submit(self, submission_id):
+        return self.manager.submit(submission_id, "test", CommandItem("Test", "test"), None, {})
+
+    def wait_until_done(self):
+        while self.manager.has_pending_jobs():
+            self.manager.wait_for_next()
+
+    def test_stop_all(self):
+        running = self.submit(1)
+        queued = self.submit(2)
+        self.assertTrue(self.starting.wait(10))
+        self.manager.stop_all()
+        self.wait_until_done()
+
+        self.assertEqual(running.status, BackgroundJob.FAILED)
+        self.assertEqual(queued.status, BackgroundJob.FAILED)
+        self.assertEqual(queued.error, "Background command never started")
+        # The queued job still needs to be claimed, so it ends up in its submission's logs
+        self.assertCountEqual(self.manager.claim_finished(), [running, queued])
+        self.assertEqual(self.manager.claim_finished(), [])
+
+    def test_stop_all_while_starting(self):
+        self.can_start.clear()
+        job = self.submit(1)
+        self.assertTrue(self.starting.wait(10))
+        self.manager.stop_all()
+        self.can_start.set()
+        self.wait_until_done()
+
+        # The command didn't exist yet when stop_all was called, so it's stopped once it starts
+        self.assertEqual(job.status, BackgroundJob.FAILED)
+        self.assertTrue(self.commands[0].stopped.is_set())
+        self.assertEqual(self.manager.claim_finished(), [job])
+
+
+if __name__ == "__main__":
+    unittest.main()
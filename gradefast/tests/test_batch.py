@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from iochannels import HTMLMemoryLog, MemoryLog
+
+from gradefast.grader.batch import BatchGrader, BatchStep, run_batch_submission
+from gradefast.hosts import LocalHost
+from gradefast.models import CommandItem, CommandSet, LocalPath
+from gradefast.persister import SqlitePersister
+from gradefast.submissions import SubmissionManager
+from gradefast.tests.test_grades import make_grade_structure
+
+
+@unittest.skipIf(os.name != "posix", "The test commands need a POSIX shell")
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings = types.SimpleNamespace(
+            base_env=dict(os.environ), shell_command=None, shell_args=None,
+            build_cache_path=None, diff_engine=None,
+            save_file=LocalPath(os.path.join(self.temp_dir, "save.sqlite")),
+            grade_structure=make_grade_structure(),
+            commands=[
+                CommandItem("Hello", "echo hello from $SUBMISSION_NAME"),
+                CommandItem("Interactive", "cat", is_passthrough=True),
+                CommandItem("Fail", "exit 3"),
+                CommandSet([
+                    CommandItem("In folder", "touch ran")
+                ], name="Code", folder=["code.*"], confirm_folder=True),
+                CommandItem("After", "touch after")
+            ])
+        self.host = LocalHost(None, self.settings)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def make_submission_folder(self, name, *subfolders):
+        folder = os.path.join(self.temp_dir, name)
+        os.mkdir(folder)
+        for subfolder in subfolders:
+            os.mkdir(os.path.join(folder, subfolder))
+        return self.host.local_path_to_gradefast_path(LocalPath(folder))
+
+
+class TestRunBatchSubmission(BatchTestCase):
+    def test_steps(self):
+        path = self.make_submission_folder("student", "code")
+        steps = run_batch_submission(LocalHost, self.settings, "student", path)
+        self.assertEqual([step.kind for step in steps], [
+            BatchStep.COMMAND, BatchStep.COMMAND, BatchStep.COMMAND, BatchStep.COMMAND_SET_START,
+            BatchStep.COMMAND, BatchStep.COMMAND_SET_END, BatchStep.COMMAND
+        ])
+
+        hello, interactive, fail = steps[:3]
+        self.assertIsNone(hello.error)
+        self.assertEqual(hello.result.output.get_summary().strip(), "hello from student")
+        self.assertIn("Passthrough commands can't be run", interactive.error)
+        self.assertIsNone(interactive.result)
+        self.assertIn("nonzero return code: 3", fail.error)
+
+        # The command set ran in the folder that it found (without confirming it)
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, "student", "code", "ran")))
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, "student", "after")))
+
+    def test_ambiguous_folder_stops_submission(self):
+        path = self.make_submission_folder("student", "code1", "code2")
+        steps = run_batch_submission(LocalHost, self.settings, "student", path)
+        self.assertEqual([step.kind for step in steps], [
+            BatchStep.COMMAND, BatchStep.COMMAND, BatchStep.COMMAND, BatchStep.STOPPED
+        ])
+        self.assertIn("Multiple folders found", steps[-1].error)
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, "student", "after")))
+
+
+class TestBatchGrader(BatchTestCase):
+    def setUp(self):
+        super().setUp()
+        self.errors = []
+        self.delegates = []
+        self.channel = types.SimpleNamespace(
+            add_delegate=lambda *logs: self.delegates.append(logs),
+            output=lambda *args, **kwargs: None, print=lambda *args, **kwargs: None,
+            status=lambda *args, **kwargs: None,
+            error=lambda msg, *args: self.errors.append(msg.format(*args)))
+        self.persister = SqlitePersister(self.settings)
+        self.submission_manager = SubmissionManager(
+            self.channel, self.host, self.persister,
+            types.SimpleNamespace(dispatch_event=lambda event: None), self.settings)
+        self.grader = BatchGrader(self.channel, self.host, self.settings,
+                                  self.submission_manager)
+
+    def tearDown(self):
+        self.submission_manager.flush()
+        self.persister.close()
+        super().tearDown()
+
+    def add_submission(self, name, *subfolders):
+        return self.submission_manager.add_submission(
+            name, name, self.make_submission_folder(name, *subfolders))
+
+    def get_summaries_with_logs(self):
+        return [summary.get_id()
+                for summary in self.submission_manager.get_all_submission_summaries()
+                if summary.has_logs()]
+
+    def test_record_steps(self):
+        submission = self.add_submission("student", "code")
+        steps = run_batch_submission(LocalHost, self.settings, "student", submission.get_path())
+        self.grader.record_steps(submission, steps)
+
+        self.assertEqual(len(self.delegates), 1)
+        self.assertTrue(submission.has_logs())
+        self.assertEqual(self.get_summaries_with_logs(), [submission.get_id()])
+        # The passthrough command and the failed command
+        self.assertEqual(len(self.errors), 2)
+
+    def test_run_commands_skips_submissions_with_logs(self):
+        done = self.add_submission("done", "code")
+        done.add_logs(HTMLMemoryLog(), MemoryLog())
+        done.close_logs()
+        first = self.add_submission("first", "code")
+        second = self.add_submission("second", "code1", "code2")
+
+        self.grader.run_commands(2)
+        self.assertEqual(sorted(self.get_summaries_with_logs()),
+                         sorted([done.get_id(), first.get_id(), second.get_id()]))
+        self.assertEqual(len(self.delegates), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, "done", "after")))
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, "first", "after")))
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, "second", "after")))
+
+        # Running again doesn't run anything
+        self.grader.run_commands(2)
+        self.assertEqual(len(self.delegates), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
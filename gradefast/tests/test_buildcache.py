@@ -0,0 +1,124 @@
+import os
+import shutil
+import tempfile
+import types
+import unittest
+
+from gradefast.buildcache import BuildCache
+from gradefast.models import CommandItem, LocalPath
+from gradefast.outputbuffer import OutputBuffer
+
+
+def _make_output(text):
+    output = OutputBuffer()
+    output.write(text)
+    output.finish()
+    return output
+
+
+class TestBuildCache(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.work_dir = os.path.join(self.temp_dir, "submission")
+        os.mkdir(self.work_dir)
+        self.cache = BuildCache(types.SimpleNamespace(
+            base_env={"HOME": "/home/test"},
+            build_cache_path=LocalPath(os.path.join(self.temp_dir, "cache"))))
+        self.command = CommandItem("Compile", "cc main.c", cache=CommandItem.Cache())
+        self.environment = {"HOME": "/home/test", "SUBMISSION_NAME": "test"}
+        self._write("main.c", "int main() {}")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, name, content):
+        with open(os.path.join(self.work_dir, name), "w") as f:
+            f.write(content)
+
+    def _read(self, name):
+        with open(os.path.join(self.work_dir, name)) as f:
+            return f.read()
+
+    def _compile(self, command=None):
+        """
+        Pretend to run a compile command (producing "a.out") and record it in the cache.
+        """
+        command = command or self.command
+        recording = self.cache.start_recording(command, self.work_dir, self.environment)
+        self._write("a.out", "compiled " + self._read("main.c"))
+        self.cache.record(command, recording, _make_output("compiler output\n"))
+
+    def _lookup(self, command=None, environment=None):
+        return self.cache.lookup(command or self.command, self.work_dir,
+                                 environment or self.environment)
+
+    def test_hit_and_restore(self):
+        self.assertIsNone(self._lookup())
+        self._compile()
+
+        cached = self._lookup()
+        self.assertIsNotNone(cached)
+        self.assertEqual(cached.output.get_text(), "compiler output\n")
+        self.assertEqual((cached.artifacts, cached.restored), (1, 0))
+
+        # Missing or changed files that the command produced are put back
+        os.remove(os.path.join(self.work_dir, "a.out"))
+        cached = self._lookup()
+        self.assertEqual((cached.artifacts, cached.restored), (1, 1))
+        self.assertEqual(self._read("a.out"), "compiled int main() {}")
+
+        # A new instance (like after a restart, with a different base environment) can use the
+        # same cache
+        cache = BuildCache(types.SimpleNamespace(
+            base_env={"HOME": "/home/test", "TERM": "xterm"},
+            build_cache_path=LocalPath(self.cache.cache_path)))
+        self.assertIsNotNone(cache.lookup(self.command, self.work_dir,
+                                          dict(self.environment, TERM="xterm")))
+
+    def test_long_output(self):
+        recording = self.cache.start_recording(self.command, self.work_dir, self.environment)
+        self._write("a.out", "compiled")
+        output = OutputBuffer(head_size=100, tail_size=100)
+        text = "".join("warning {}\n".format(i) for i in range(1000))
+        output.write(text)
+        output.finish()
+        self.assertTrue(output.is_spilled())
+        self.cache.record(self.command, recording, output)
+        output.close()
+
+        self.assertEqual(self._lookup().output.get_text(), text)
+        # The output was moved into place, and nothing was left behind
+        objects_path = os.path.join(self.cache.cache_path, "objects")
+        self.assertFalse([name for name in os.listdir(objects_path) if name.startswith(".tmp-")])
+
+        # Recording the same output again reuses the object that's already there
+        recording = self.cache.start_recording(self.command, self.work_dir, self.environment)
+        self.cache.record(self.command, recording, _make_output(text))
+        self.assertFalse([name for name in os.listdir(objects_path) if name.startswith(".tmp-")])
+
+    def test_key(self):
+        self._compile()
+
+        self.assertIsNone(self._lookup(self.command.get_modified("cc -O2 main.c")))
+        self.assertIsNone(self._lookup(environment=dict(self.environment, CFLAGS="-g")))
+        self.assertIsNone(self._lookup(environment=dict(self.environment, HOME="/other")))
+
+        self._write("main.c", "int main() { return 1; }")
+        self.assertIsNone(self._lookup())
+        self._write("notes.txt", "hello")
+        self._compile()
+        self.assertIsNotNone(self._lookup())
+        self.assertEqual(self._read("a.out"), "compiled int main() { return 1; }")
+
+    def test_inputs(self):
+        command = CommandItem("Compile", "cc main.c", cache=CommandItem.Cache(["*.c"]))
+        self._compile(command)
+
+        self._write("README", "not an input")
+        self.assertIsNotNone(self._lookup(command))
+        self._write("other.c", "int x;")
+        self.assertIsNone(self._lookup(command))
+
+    def test_disabled(self):
+        cache = BuildCache(types.SimpleNamespace(base_env={}, build_cache_path=None))
+        self.assertFalse(cache.is_enabled())
@@ -0,0 +1,122 @@
+import json
+import threading
+import unittest
+import uuid
+
+from gradefast.gradebook.clientupdates import ClientUpdate, ClientUpdateQueue
+from gradefast.models import Stats
+
+
+class TestClientUpdate(unittest.TestCase):
+    def test_encode(self):
+        update = ClientUpdate("auth", "line 1\nline 2")
+        self.assertEqual(update.encode().decode("utf-8").split("\n", 1)[1],
+                         "event: auth\ndata: line 1\ndata: line 2\n\n")
+        self.assertIs(update.encode(), update.encode())
+
+    def test_update_event(self):
+        client_id = uuid.UUID("12345678-1234-5678-1234-567812345678")
+        update = ClientUpdate.create_update_event("UPDATED_STATS", {
+            "client_id": client_id,
+            "grading_stats": Stats(min=1, max=2, median=1.5, mean=1.5, std_dev=0.5, modes=[]),
+            "name": "café"
+        })
+        lines = update.encode().decode("utf-8").split("\n")
+        self.assertEqual(lines[1], "event: update")
+        self.assertEqual(
+            lines[2],
+            'data: {"update_type":"UPDATED_STATS","update_data":{'
+            '"client_id":"12345678-1234-5678-1234-567812345678",'
+            '"grading_stats":{"min":1,"max":2,"median":1.5,"mean":1.5,"std_dev":0.5,"modes":[]},'
+            '"name":"caf\\u00e9"}}')
+        self.assertEqual(lines[3:], ["", ""])
+
+    def test_ids(self):
+        first = ClientUpdate("hello")
+        second = ClientUpdate("hello")
+        self.assertTrue(first.encode().startswith("id: {}\n".format(first._id).encode("utf-8")))
+        self.assertEqual(second._id, first._id + 1)
+
+
+def _update_type(client_update):
+    return json.loads(client_update._data)["update_type"]
+
+
+class TestClientUpdateQueue(unittest.TestCase):
+    def _get_all(self, update_queue):
+        client_updates = []
+        while True:
+            client_update = update_queue.get_nowait()
+            if client_update is None:
+                return client_updates
+            client_updates.append(client_update)
+
+    def test_order(self):
+        update_queue = ClientUpdateQueue(10)
+        client_updates = [ClientUpdate("hello"), ClientUpdate.create_update_event("A"),
+                          ClientUpdate.create_update_event("B")]
+        for client_update in client_updates:
+            self.assertTrue(update_queue.put(client_update))
+        self.assertEqual(len(update_queue), 3)
+        self.assertEqual(self._get_all(update_queue), client_updates)
+        self.assertIsNone(update_queue.get(0.01))
+
+    def test_coalesce(self):
+        update_queue = ClientUpdateQueue(10)
+        stats = [ClientUpdate.create_update_event("UPDATED_STATS", {"n": n},
+                                                  state_key="UPDATED_STATS") for n in range(3)]
+        full = ClientUpdate.create_update_event("SUBMISSION_UPDATED", state_key=("S", 1))
+        patch_1 = ClientUpdate.create_update_event("SUBMISSION_UPDATED", state_key=("S", 1),
+                                                   is_patch=True)
+        patch_2 = ClientUpdate.create_update_event("SUBMISSION_UPDATED", state_key=("S", 2),
+                                                   is_patch=True)
+        other = ClientUpdate.create_update_event("OTHER")
+
+        for client_update in [stats[0], patch_1, full, stats[1], patch_2, other]:
+            update_queue.put(client_update)
+        # Taking an update shouldn't confuse which ones are still waiting
+        self.assertIs(update_queue.get(), full)
+        update_queue.put(stats[2])
+        # Patches don't supersede anything (even other patches), but a full update supersedes
+        # everything with the same state key
+        update_queue.put(patch_1)
+        update_queue.put(patch_1)
+        self.assertEqual(self._get_all(update_queue), [patch_2, other, stats[2], patch_1, patch_1])
+
+    def test_overflow(self):
+        update_queue = ClientUpdateQueue(3)
+        for n in range(2):
+            self.assertTrue(update_queue.put(ClientUpdate.create_update_event("A")))
+        # Full updates can still replace what's waiting without overflowing
+        for n in range(3):
+            self.assertTrue(update_queue.put(ClientUpdate.create_update_event("B", state_key="B")))
+        self.assertEqual(len(update_queue), 3)
+
+        self.assertFalse(update_queue.put(ClientUpdate.create_update_event("C")))
+        client_updates = self._get_all(update_queue)
+        self.assertEqual([_update_type(client_update) for client_update in client_updates],
+                         ["RESYNC"])
+
+        # Afterwards, everything is back to normal
+        self.assertTrue(update_queue.put(ClientUpdate.create_update_event("D", state_key="D")))
+        self.assertEqual([_update_type(client_update)
+                          for client_update in self._get_all(update_queue)], ["D"])
+
+    def test_overflow_keeps_one_time_updates(self):
+        update_queue = ClientUpdateQueue(3)
+        hello = ClientUpdate("hello", requires_authentication=False)
+        auth = ClientUpdate("auth", {"data_key": "d", "update_key": "u"})
+        for client_update in [hello, auth, ClientUpdate.create_update_event("A")]:
+            self.assertTrue(update_queue.put(client_update))
+
+        self.assertFalse(update_queue.put(ClientUpdate.create_update_event("B", state_key="B")))
+        client_updates = self._get_all(update_queue)
+        self.assertEqual(client_updates[:2], [hello, auth])
+        self.assertEqual([_update_type(client_update) for client_update in client_updates[2:]],
+                         ["RESYNC"])
+
+    def test_get_waits(self):
+        update_queue = ClientUpdateQueue(10)
+        client_update = ClientUpdate("hello")
+        threading.Timer(0.05, update_queue.put, [client_update]).start()
+        self.assertIs(update_queue.get(5), client_update)
@@ -0,0 +1,51 @@
+import unittest
+
+from gradefast.gradebook.deltas import diff_grade_snapshots, diff_submission_summaries, \
+    make_grade_snapshot
+from gradefast.grades import SubmissionGrade
+from gradefast.tests.test_grades import make_grade_structure
+
+
+class TestGradeDeltas(unittest.TestCase):
+    def test_snapshot(self):
+        grade = SubmissionGrade(make_grade_structure())
+        snapshot = make_grade_snapshot(grade.get_data())
+        self.assertEqual(snapshot.fields["points_earned"], 20)
+        self.assertNotIn("grades", snapshot.fields)
+        self.assertEqual(sorted(snapshot.items.keys()), [(0,), (1,), (1, 0), (1, 1)])
+        self.assertEqual(snapshot.items[(1, 1)]["name"], "Item 3")
+        self.assertNotIn("children", snapshot.items[(1,)])
+
+    def test_no_changes(self):
+        grade = SubmissionGrade(make_grade_structure())
+        self.assertIsNone(diff_grade_snapshots(make_grade_snapshot(grade.get_data()),
+                                               make_grade_snapshot(grade.get_data())))
+
+    def test_changes(self):
+        grade = SubmissionGrade(make_grade_structure())
+        old = make_grade_snapshot(grade.get_data())
+        grade.get_by_path([1, 0]).set_effective_score("2")
+        grade.get_by_path([0]).set_hint_enabled(0, True)
+
+        patch = diff_grade_snapshots(old, make_grade_snapshot(grade.get_data()))
+        self.assertEqual(patch["fields"], {"points_earned": 15})
+        self.assertEqual([item["path"] for item in patch["items"]], [[0], [1, 0]])
+        self.assertEqual(patch["items"][0]["changes"]["score"], 8)
+        self.assertTrue(patch["items"][0]["changes"]["hints"][0]["enabled"])
+        self.assertEqual(patch["items"][1]["changes"], {"score": 2, "touched": True})
+
+
+class TestSubmissionSummaryDeltas(unittest.TestCase):
+    def test_changed_summaries(self):
+        sent = {
+            1: {"id": 1, "points_earned": 10},
+            2: {"id": 2, "points_earned": 5}
+        }
+        changed = diff_submission_summaries(sent, [
+            {"id": 1, "points_earned": 10},
+            {"id": 2, "points_earned": 7},
+            {"id": 3, "points_earned": 0}
+        ])
+        self.assertEqual([summary["id"] for summary in changed], [2, 3])
+        self.assertEqual(sent[2]["points_earned"], 7)
+        self.assertEqual(diff_submission_summaries(sent, [{"id": 2, "points_earned": 7}]), [])
@@ -0,0 +1,147 @@
+import difflib
+import pickle
+import random
+import unittest
+
+from gradefast.grader.diffing import DiffReference, DifflibDiffEngine, MyersDiffEngine, \
+    PatienceDiffEngine, diff_lines, get_diff_engine, score_diff
+from gradefast.models import CommandItem
+
+
+def _apply_opcodes(test, opcodes, a, b):
+    """
+    Rebuild "b" from "a" using some opcodes, checking that the "equal" ones really are equal.
+    """
+    result = []
+    a_position = b_position = 0
+    for tag, a_start, a_end, b_start, b_end in opcodes:
+        test.assertEqual((a_start, b_start), (a_position, b_position))
+        if tag == "equal":
+            test.assertListEqual(a[a_start:a_end], b[b_start:b_end])
+        result += b[b_start:b_end]
+        a_position, b_position = a_end, b_end
+    test.assertEqual((a_position, b_position), (len(a), len(b)))
+    return result
+
+
+def _matching_length(opcodes):
+    return sum(a_end - a_start for tag, a_start, a_end, _, _ in opcodes if tag == "equal")
+
+
+class TestDiffEngines(unittest.TestCase):
+    def test_random_sequences(self):
+        rand = random.Random(1234)
+        for _ in range(500):
+            a = [rand.randrange(4) for _ in range(rand.randrange(40))]
+            b = [rand.randrange(4) for _ in range(rand.randrange(40))]
+            matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+
+            for engine in (MyersDiffEngine(), PatienceDiffEngine(), DifflibDiffEngine()):
+                opcodes = engine.get_opcodes(a, b)
+                self.assertListEqual(_apply_opcodes(self, opcodes, a, b), b)
+
+            # Myers always finds a longest common subsequence, so it should do at least as well
+            # as difflib (which doesn't always)
+            self.assertGreaterEqual(_matching_length(MyersDiffEngine().get_opcodes(a, b)),
+                                    _matching_length(matcher.get_opcodes()))
+
+    def test_edge_cases(self):
+        for engine in (MyersDiffEngine(), PatienceDiffEngine()):
+            self.assertListEqual(engine.get_opcodes([], []), [])
+            self.assertListEqual(engine.get_opcodes([1, 2], []), [("delete", 0, 2, 0, 0)])
+            self.assertListEqual(engine.get_opcodes([], [1, 2]), [("insert", 0, 0, 0, 2)])
+            self.assertListEqual(engine.get_opcodes([1, 2, 3], [1, 2, 3]),
+                                 [("equal", 0, 3, 0, 3)])
+            self.assertListEqual(engine.get_opcodes([1, 2, 3], [1, 4, 3]),
+                                 [("equal", 0, 1, 0, 1), ("replace", 1, 2, 1, 2),
+                                  ("equal", 2, 3, 2, 3)])
+
+    def test_max_cost(self):
+        # When it gives up, the whole (trimmed) section is treated as replaced
+        a = [1, 2, 3, 4, 5, 6, 7, 0]
+        b = [8, 3, 9, 5, 10, 7, 11, 0]
+        opcodes = MyersDiffEngine(max_cost=1).get_opcodes(a, b)
+        self.assertListEqual(opcodes, [("replace", 0, 7, 0, 7), ("equal", 7, 8, 7, 8)])
+
+    def test_many_scattered_changes(self):
+        # Many more edits than MAX_COST (spread all over) shouldn't turn into one big replace
+        rand = random.Random(1234)
+        a = list(range(8000))
+        b = list(a)
+        changed = rand.sample(range(len(a)), 1100)
+        for i in changed:
+            b[i] = -i - 1
+
+        for engine in (MyersDiffEngine(), PatienceDiffEngine()):
+            opcodes = engine.get_opcodes(a, b)
+            self.assertListEqual(_apply_opcodes(self, opcodes, a, b), b)
+            # Splitting early might not find the shortest diff, but it should be close
+            self.assertGreater(len(opcodes), 1000)
+            self.assertGreaterEqual(_matching_length(opcodes), 0.99 * (len(a) - len(changed)))
+
+    def test_patience_anchors(self):
+        a = ["{", "a", "}", "{", "b", "}"]
+        b = ["{", "b", "}"]
+        opcodes = PatienceDiffEngine().get_opcodes(a, b)
+        self.assertListEqual(_apply_opcodes(self, opcodes, a, b), b)
+        # "b" is the only line that's unique in both, so it's matched up first
+        self.assertIn(("equal", 4, 6, 1, 3), opcodes)
+
+    def test_get_diff_engine(self):
+        self.assertIsInstance(get_diff_engine(), MyersDiffEngine)
+        self.assertIsInstance(get_diff_engine("patience"), PatienceDiffEngine)
+        with self.assertRaises(ValueError):
+            get_diff_engine("nope")
+
+
+class TestDiffLines(unittest.TestCase):
+    def test_identical(self):
+        self.assertListEqual(diff_lines(["Hello ", "World"], ["hello", "WORLD  "]), [])
+
+    def test_collapse_whitespace(self):
+        self.assertNotEqual(diff_lines(["a  b"], ["  a b"]), [])
+        self.assertListEqual(diff_lines(["a  b"], ["  a b"], collapse_whitespace=True), [])
+
+    def test_changes(self):
+        reference = ["line {}".format(i) for i in range(100)]
+        output = reference[:10] + ["extra"] + reference[10:50] + reference[51:]
+        self.assertListEqual(diff_lines(reference, output), [
+            ("equal", 0, 10, 0, 10),
+            ("insert", 10, 10, 10, 11),
+            ("equal", 10, 50, 11, 51),
+            ("delete", 50, 51, 51, 51),
+            ("equal", 51, 100, 51, 100)
+        ])
+
+    def test_reference_clean_lines(self):
+        reference = DiffReference("Hello  World \nBye\n", "test")
+        self.assertListEqual(reference.lines, ["Hello  World ", "Bye"])
+        self.assertListEqual(reference.get_clean_lines(), ["hello  world", "bye"])
+        self.assertListEqual(reference.get_clean_lines(True), ["hello world", "bye"])
+        self.assertIs(reference.get_clean_lines(), reference.get_clean_lines())
+
+        self.assertListEqual(diff_lines(reference.lines, ["hello  world", "BYE"],
+                                        reference_clean=reference.get_clean_lines()), [])
+
+        copy = pickle.loads(pickle.dumps(reference))
+        self.assertEqual(copy.source, "test")
+        self.assertListEqual(copy.get_clean_lines(), ["hello  world", "bye"])
+
+    def test_score_diff(self):
+        all_or_nothing = CommandItem.DiffScoring.RULE_ALL_OR_NOTHING
+        matching_lines = CommandItem.DiffScoring.RULE_MATCHING_LINES
+        similarity = CommandItem.DiffScoring.RULE_SIMILARITY
+
+        same = diff_lines(["a", "b"], ["A", "B"])
+        for rule in CommandItem.DiffScoring.RULES:
+            self.assertEqual(score_diff(same, rule), 1.0)
+
+        # 3 of the 4 reference lines are in the output, which has 6 lines
+        different = diff_lines(["a", "b", "c", "d"], ["a", "x", "c", "d", "y", "z"])
+        self.assertEqual(score_diff(different, all_or_nothing), 0.0)
+        self.assertAlmostEqual(score_diff(different, matching_lines), 3 / 6)
+        self.assertAlmostEqual(score_diff(different, similarity), 6 / 10)
+
+        nothing = diff_lines(["a", "b"], [])
+        self.assertEqual(score_diff(nothing, matching_lines), 0.0)
+        self.assertEqual(score_diff(nothing, similarity), 0.0)
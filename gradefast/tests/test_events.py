@@ -0,0 +1,170 @@
+import threading
+import time
+import unittest
+
+from gradefast.events import Event, EventHandler, EventManager, NewSubmissionsEvent, \
+    SubmissionGradeExternallyUpdatedEvent, SubmissionStartedEvent
+
+
+class _RecordingHandler(EventHandler):
+    """
+    Event handler that records the events it handles, and can be made to block in "handle" until
+    it's released.
+    """
+
+    handled_event_class = Event
+
+    def __init__(self, handle_time=0.0):
+        self.handle_time = handle_time
+        self.events = []
+        self.started = threading.Event()
+        self.released = threading.Event()
+        self.released.set()
+
+        self._lock = threading.Lock()
+        self._running = 0
+        self.max_running = 0
+
+    def handle(self, event):
+        with self._lock:
+            self._running += 1
+            self.max_running = max(self.max_running, self._running)
+        self.started.set()
+        self.released.wait(10)
+        time.sleep(self.handle_time)
+        with self._lock:
+            self._running -= 1
+            self.events.append(event)
+
+    def __str__(self):
+        # The stats are keyed by name, so each one needs a different name
+        return "{}-{:x}".format(super().__str__(), id(self))
+
+
+class TestEventManager(unittest.TestCase):
+    def setUp(self):
+        self.manager = EventManager(None)
+
+    def add_handler(self, handler):
+        self.manager.register_event_handlers(handler)
+        return handler
+
+    def get_stats(self, handler):
+        return self.manager.get_stats()[str(handler)]
+
+    def wait_for_handled(self, handler, count):
+        deadline = time.time() + 10
+        while self.get_stats(handler).handled < count:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def block(self, handler, event):
+        """
+        Dispatch an event, and wait for the handler to start handling it (without finishing).
+        """
+        handler.released.clear()
+        handler.started.clear()
+        self.manager.dispatch_event(event)
+        self.assertTrue(handler.started.wait(10))
+
+    def test_fifo_order(self):
+        handler = self.add_handler(_RecordingHandler())
+        events = [SubmissionStartedEvent(i) for i in range(100)]
+        for event in events:
+            self.manager.dispatch_event(event)
+        self.wait_for_handled(handler, len(events))
+        self.assertEqual(handler.events, events)
+
+    def test_handler_never_runs_concurrently(self):
+        handlers = [self.add_handler(_RecordingHandler(handle_time=0.002)) for _ in range(3)]
+
+        def dispatch_events():
+            for i in range(20):
+                self.manager.dispatch_event(SubmissionStartedEvent(i))
+
+        threads = [threading.Thread(target=dispatch_events) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for handler in handlers:
+            self.wait_for_handled(handler, 80)
+            self.assertEqual(handler.max_running, 1)
+
+    def test_new_submissions_coalesced_while_pending(self):
+        handler = self.add_handler(_RecordingHandler())
+        first = NewSubmissionsEvent()
+        self.block(handler, first)
+
+        # The first one is being handled (not pending), so the second one isn't coalesced...
+        second = NewSubmissionsEvent()
+        self.manager.dispatch_event(second)
+        # ...but the second one is pending, so the third one is
+        self.manager.dispatch_event(NewSubmissionsEvent())
+        self.assertEqual(self.get_stats(handler).coalesced, 1)
+
+        handler.released.set()
+        self.wait_for_handled(handler, 2)
+        self.assertEqual(handler.events, [first, second])
+
+    def test_grade_updates_coalesced_per_submission(self):
+        handler = self.add_handler(_RecordingHandler())
+        blocker = SubmissionStartedEvent(0)
+        self.block(handler, blocker)
+
+        events = [SubmissionGradeExternallyUpdatedEvent(1),
+                  SubmissionGradeExternallyUpdatedEvent(2)]
+        for event in events:
+            self.manager.dispatch_event(event)
+        self.manager.dispatch_event(SubmissionGradeExternallyUpdatedEvent(1))
+        self.manager.dispatch_event(SubmissionGradeExternallyUpdatedEvent(2))
+        self.assertEqual(self.get_stats(handler).coalesced, 2)
+
+        handler.released.set()
+        self.wait_for_handled(handler, 3)
+        self.assertEqual(handler.events, [blocker] + events)
+
+    def test_stats(self):
+        handler = self.add_handler(_RecordingHandler())
+        self.block(handler, SubmissionStartedEvent(0))
+        for i in range(1, 4):
+            self.manager.dispatch_event(SubmissionStartedEvent(i))
+        self.manager.dispatch_event(NewSubmissionsEvent())
+        self.manager.dispatch_event(NewSubmissionsEvent())
+
+        stats = self.get_stats(handler)
+        self.assertEqual(stats.queue_depth, 4)
+        self.assertEqual(stats.max_queue_depth, 4)
+        self.assertEqual(stats.coalesced, 1)
+        self.assertEqual(stats.handled, 0)
+
+        handler.released.set()
+        self.wait_for_handled(handler, 5)
+        stats = self.get_stats(handler)
+        self.assertEqual(stats.queue_depth, 0)
+        self.assertEqual(stats.max_queue_depth, 4)
+        self.assertEqual(stats.coalesced, 1)
+        self.assertEqual(stats.handled, 5)
+
+    def test_accept_can_dispatch(self):
+        manager = self.manager
+        handler = self.add_handler(_RecordingHandler())
+
+        class DispatchingHandler(EventHandler):
+            def accept(self, event):
+                if isinstance(event, NewSubmissionsEvent):
+                    manager.dispatch_event(SubmissionStartedEvent(1))
+                return False
+
+        self.add_handler(DispatchingHandler())
+        thread = threading.Thread(target=manager.dispatch_event, args=(NewSubmissionsEvent(),),
+                                  daemon=True)
+        thread.start()
+        thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.wait_for_handled(handler, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import json
+import types
+import unittest
+import uuid
+
+from gradefast.gradebook.clientupdates import ClientUpdateQueue
+from gradefast.gradebook.gradebook import GradeBook
+from gradefast.models import Path
+from gradefast.tests.test_submissions import SubmissionManagerTestCase
+
+
+class TestSubmissionListChanges(SubmissionManagerTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ("first", "second", "third"):
+            self.manager.add_submission(name, name, Path("/" + name))
+        # The second submission uses the hint
+        self.manager.get_submission(2).get_grade().get_by_path([0]).set_hint_enabled(0, True)
+        self.reopen()
+
+        event_manager = types.SimpleNamespace(register_all_event_handlers=lambda module: None)
+        self.gradebook = GradeBook(event_manager, self.settings, self.manager)
+        self.client_id = uuid.uuid4()
+        self.gradebook._authenticated_client_ids.add(self.client_id)
+        self.update_queue = ClientUpdateQueue(100)
+        self.gradebook.open_event_stream(self.client_id, self.update_queue)
+        self.gradebook.send_submission_list_changes()
+        self._get_submission_list_updates()
+
+    def _get_submission_list_updates(self):
+        updates = []
+        while True:
+            client_update = self.update_queue.get_nowait()
+            if client_update is None:
+                return updates
+            if client_update._event == "update":
+                data = json.loads(client_update._data)
+                if data["update_type"] in ("NEW_SUBMISSIONS", "SUBMISSIONS_PATCH"):
+                    updates.append(data)
+
+    def test_hint_edit_updates_unloaded_submissions(self):
+        self.gradebook._parse_action(1, self.client_id, 1, {
+            "type": "EDIT_HINT",
+            "path": [0],
+            "index": 0,
+            "content": {"name": "Missing lots of stuff", "value": -5}
+        })
+        # The second submission was never loaded, but its score changed
+        self.assertEqual(self.manager.get_loaded_submission_ids(), [1])
+        updates = self._get_submission_list_updates()
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0]["update_type"], "SUBMISSIONS_PATCH")
+        self.assertEqual([(summary["id"], summary["points_earned"])
+                          for summary in updates[0]["update_data"]["submissions"]], [(2, 15)])
+
+
+if __name__ == "__main__":
+    unittest.main()
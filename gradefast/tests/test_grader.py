@@ -0,0 +1,141 @@
+import random
+import time
+import types
+import unittest
+
+from gradefast.grader.diffing import DiffReference, DifflibDiffEngine, MyersDiffEngine, \
+    PatienceDiffEngine
+from gradefast.grader.grader import CommandRunner, apply_diff_score, get_scoring_diff, print_diff
+from gradefast.grader.prefetch import get_command_environment, get_prefetch_key
+from gradefast.grades import SubmissionGrade
+from gradefast.hosts import CommandResult
+from gradefast.models import CommandItem, Path
+from gradefast.outputbuffer import OutputBuffer
+from gradefast.tests.test_grades import make_grade_structure
+
+
+class TestApplyDiffScore(unittest.TestCase):
+    def setUp(self):
+        self.errors = []
+        self.channel = types.SimpleNamespace(
+            error=lambda msg, *args: self.errors.append(msg.format(*args)),
+            status=lambda *args: None, print=lambda *args: None, output=lambda *args: None,
+            bg_happy=lambda *args: None, bg_sad=lambda *args: None, bg_meh=lambda *args: None)
+        self.grade = SubmissionGrade(make_grade_structure())
+
+        # A long output with lots of changes spread all over it
+        rand = random.Random(1234)
+        self.reference = ["line {}".format(i) for i in range(8000)]
+        self.output = list(self.reference)
+        for i in rand.sample(range(len(self.reference)), 1100):
+            self.output[i] = "changed {}".format(i)
+
+    def score(self, engine, rule):
+        output = OutputBuffer()
+        output.write("\n".join(self.output))
+        reference = DiffReference("\n".join(self.reference), "test")
+        options = CommandItem.Diff(content=reference.text)
+        opcodes = print_diff(self.channel, output, reference, options, engine)
+        opcodes, exact = get_scoring_diff(output, reference, options, engine, opcodes)
+        return apply_diff_score(self.channel, self.grade, CommandItem.DiffScoring([0], rule),
+                                opcodes, exact)
+
+    def test_inexact_engines_scored_with_myers(self):
+        # Matching up the unique line first leaves only one matching line, but there are 2
+        self.reference = ["a", "a", "b"]
+        self.output = ["b", "a", "a"]
+        for engine in (PatienceDiffEngine(), DifflibDiffEngine()):
+            self.assertTrue(self.score(engine, CommandItem.DiffScoring.RULE_MATCHING_LINES))
+            self.assertFalse(engine.exact)
+            self.assertEqual(self.grade.get_by_path([0]).get_score(False), (6.67, 10))
+        self.assertEqual(self.errors, [])
+
+    def test_large_diff(self):
+        # Fewer changes, so Myers doesn't have to split the diff early
+        self.output = list(self.reference)
+        for i in random.Random(1234).sample(range(len(self.reference)), 300):
+            self.output[i] = "changed {}".format(i)
+        for engine in (MyersDiffEngine(), PatienceDiffEngine()):
+            self.assertTrue(self.score(engine, CommandItem.DiffScoring.RULE_MATCHING_LINES))
+            self.assertEqual(self.grade.get_by_path([0]).get_score(False), (9.62, 10))
+            self.assertTrue(self.score(engine, CommandItem.DiffScoring.RULE_SIMILARITY))
+            self.assertEqual(self.grade.get_by_path([0]).get_score(False), (9.62, 10))
+        self.assertEqual(self.errors, [])
+
+    def test_inexact_diff_not_scored(self):
+        # Myers has to split the diff early, so it can't count the matching lines exactly (and
+        # neither can any other engine, which falls back to Myers for scoring)
+        for engine in (MyersDiffEngine(), PatienceDiffEngine()):
+            self.errors = []
+            self.grade.get_by_path([0]).set_base_score(5)
+            self.assertFalse(self.score(engine, CommandItem.DiffScoring.RULE_MATCHING_LINES))
+            self.assertFalse(engine.exact)
+            self.assertEqual(self.grade.get_by_path([0]).get_score(False), (5, 10))
+            self.assertEqual(len(self.errors), 1)
+
+            # (but the output still doesn't match, which is all that matters for "all or nothing")
+            self.assertTrue(self.score(engine, CommandItem.DiffScoring.RULE_ALL_OR_NOTHING))
+            self.assertEqual(self.grade.get_by_path([0]).get_score(False), (0, 10))
+
+
+class TestCommandRunnerPrefetchedResults(unittest.TestCase):
+    def setUp(self):
+        self.path = Path("/submission")
+        self.commands = [
+            CommandItem("Compile", "make", stdin=""),
+            CommandItem("Test", "./test", stdin="input")
+        ]
+        self.choices = []
+        self.live_commands = []
+        self.shells = []
+
+        channel = types.SimpleNamespace(
+            prompt=lambda *args: self.choices.pop(0),
+            output=lambda *args: None, print=lambda *args: None,
+            status=lambda *args: None, error=lambda *args: None)
+        host = types.SimpleNamespace(
+            open_shell=lambda path, env: self.shells.append(path),
+            run_command=lambda command, *args, **kwargs: self.live_commands.append(command))
+        submission = types.SimpleNamespace(get_name=lambda: "name")
+
+        prefetched_results = {}
+        for command in self.commands:
+            environment = get_command_environment(command, {}, "name")
+            output = OutputBuffer()
+            output.write("prefetched output of " + command.command)
+            now = time.time()
+            prefetched_results[get_prefetch_key(command, self.path, environment)] = \
+                CommandResult(output, 0, now - 1, now)
+        self.runner = CommandRunner(None, channel, host, types.SimpleNamespace(), submission,
+                                    None, prefetched_results=prefetched_results)
+
+    def run_commands(self):
+        for command in self.commands:
+            self.assertTrue(self.runner._do_command(command, self.path, {}))
+        self.assertEqual(self.choices, [])
+
+    def test_prefetched_results_used(self):
+        self.choices = ["", "n", "", "n"]
+        self.run_commands()
+        self.assertEqual(self.live_commands, [])
+
+    def test_repeat_runs_later_commands_live(self):
+        self.choices = ["", "y", "", "n", "", "n"]
+        self.run_commands()
+        self.assertEqual(self.live_commands, ["make", "./test"])
+
+    def test_modify_runs_later_commands_live(self):
+        self.choices = ["m", "", "n", "", "n"]
+        self.runner._get_modified_command = lambda command: command.get_modified("make all")
+        self.run_commands()
+        self.assertEqual(self.live_commands, ["make all", "./test"])
+
+    def test_shell_runs_later_commands_live(self):
+        self.choices = ["o", "", "n", "", "n"]
+        self.run_commands()
+        self.assertEqual(self.shells, [self.path])
+        self.assertEqual(self.live_commands, ["make", "./test"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,162 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from gradefast.grades import SubmissionGrade, SubmissionGradeScore
+from gradefast.models import GradeScore, GradeSection, Hint
+
+
+def make_grade_structure():
+    return [
+        GradeScore("Item 1", "", True, [Hint("Missing stuff", -2, False)], 10, 10, ""),
+        GradeSection("Section", "", True, [], [
+            GradeScore("Item 2", "", True, [], 5, 5, ""),
+            GradeScore("Item 3", "", True, [], 5, 5, "")
+        ], 50)
+    ]
+
+
+class TestSubmissionGradeScore(unittest.TestCase):
+    def test_initial_score(self):
+        grade = SubmissionGrade(make_grade_structure())
+        self.assertEqual(grade.get_score(), (20, 20))
+
+    def test_leaf_change_updates_ancestors(self):
+        grade = SubmissionGrade(make_grade_structure())
+        section = grade.get_by_path([1])
+        self.assertEqual(section.get_score(False), (10, 10))
+        self.assertEqual(grade.get_score(), (20, 20))
+
+        grade.get_by_path([1, 0]).set_base_score(2)
+        self.assertEqual(section.get_score(False), (7, 10))
+        self.assertEqual(grade.get_score(), (17, 20))
+
+    def test_enabled_change_updates_ancestors(self):
+        grade = SubmissionGrade(make_grade_structure())
+        self.assertEqual(grade.get_score(), (20, 20))
+
+        grade.get_by_path([1, 1]).set_enabled(False)
+        self.assertEqual(grade.get_score(), (15, 15))
+
+        grade.get_by_path([1, 1]).set_enabled(True)
+        self.assertEqual(grade.get_score(), (20, 20))
+
+    def test_late_change(self):
+        grade = SubmissionGrade(make_grade_structure())
+        self.assertEqual(grade.get_score(), (20, 20))
+
+        grade.set_late(True)
+        self.assertEqual(grade.get_score(), (15, 20))
+
+        grade.get_by_path([1]).set_late_deduction(0)
+        self.assertEqual(grade.get_score(), (20, 20))
+
+    def test_hint_enabled(self):
+        grade = SubmissionGrade(make_grade_structure())
+        self.assertEqual(grade.get_score(), (20, 20))
+
+        grade.get_by_path([0]).set_hint_enabled(0, True)
+        self.assertEqual(grade.get_score(), (18, 20))
+
+    def test_hint_edit_updates_all_submissions(self):
+        structure = make_grade_structure()
+        grade1 = SubmissionGrade(structure)
+        grade2 = SubmissionGrade(structure)
+        grade1.get_by_path([0]).set_hint_enabled(0, True)
+        grade2.get_by_path([0]).set_hint_enabled(0, True)
+        self.assertEqual(grade1.get_score(), (18, 20))
+        self.assertEqual(grade2.get_score(), (18, 20))
+
+        grade1.replace_hint_for_all_grades([0], 0, "Missing lots of stuff", -5)
+        self.assertEqual(grade1.get_score(), (15, 20))
+        self.assertEqual(grade2.get_score(), (15, 20))
+
+        grade2.add_hint_to_all_grades([1, 0], "Bonus", 1)
+        grade1.get_by_path([1, 0]).set_hint_enabled(0, True)
+        self.assertEqual(grade1.get_score(), (16, 20))
+        self.assertEqual(grade2.get_score(), (15, 20))
+
+    def test_set_state(self):
+        grade1 = SubmissionGrade(make_grade_structure())
+        grade1.get_by_path([1, 0]).set_base_score(1)
+        grade1.get_by_path([0]).set_hint_enabled(0, True)
+
+        grade2 = SubmissionGrade(make_grade_structure())
+        self.assertEqual(grade2.get_score(), (20, 20))
+        grade2.set_state(grade1.get_state(), restore_grades=True)
+        self.assertEqual(grade2.get_score(), grade1.get_score())
+        self.assertEqual(grade2.get_score(), (14, 20))
+
+    def test_change_while_calculating(self):
+        grade = SubmissionGrade(make_grade_structure())
+        calculate_score = SubmissionGradeScore._calculate_score
+        calculating = threading.Event()
+
+        def slow_calculate_score(item, is_late):
+            score = calculate_score(item, is_late)
+            if item is grade.get_by_path([1, 0]):
+                calculating.set()
+                # Give the other thread plenty of time to change the grade
+                time.sleep(0.2)
+            return score
+
+        with mock.patch.object(SubmissionGradeScore, "_calculate_score", slow_calculate_score):
+            # Another thread calculates the score (with the old base score)...
+            thread = threading.Thread(target=grade.get_score)
+            thread.start()
+            calculating.wait()
+            # ...while this one changes it
+            grade.get_by_path([1, 0]).set_base_score(2)
+            thread.join()
+
+        # The old score wasn't cached after the change
+        self.assertEqual(grade.get_by_path([1]).get_score(False), (7, 10))
+        self.assertEqual(grade.get_score(), (17, 20))
+
+
+class TestSubmissionGradeFeedback(unittest.TestCase):
+    def test_feedback_is_cached(self):
+        grade = SubmissionGrade(make_grade_structure())
+        feedback = grade.get_feedback()
+        self.assertIs(grade.get_feedback(), feedback)
+        self.assertIs(grade.get_by_path([1]).get_feedback(False, 1),
+                      grade.get_by_path([1]).get_feedback(False, 1))
+
+    def test_leaf_change_updates_feedback(self):
+        grade = SubmissionGrade(make_grade_structure())
+        section = grade.get_by_path([1])
+        unchanged_item = grade.get_by_path([0])
+        old_section_feedback = section.get_feedback(False, 1)
+        old_item_feedback = unchanged_item.get_feedback(False, 1)
+        self.assertNotIn("Did a thing", grade.get_feedback())
+
+        grade.get_by_path([1, 1]).set_comments("Did a thing")
+        self.assertIn("Did a thing", grade.get_feedback())
+        self.assertIn("Did a thing", section.get_feedback(False, 1))
+        self.assertNotEqual(section.get_feedback(False, 1), old_section_feedback)
+        self.assertIs(unchanged_item.get_feedback(False, 1), old_item_feedback)
+
+    def test_late_change_updates_feedback(self):
+        grade = SubmissionGrade(make_grade_structure())
+        self.assertNotIn("Turned in late", grade.get_feedback())
+        grade.set_late(True)
+        self.assertIn("Turned in late", grade.get_feedback())
+        grade.set_late(False)
+        self.assertNotIn("Turned in late", grade.get_feedback())
+
+    def test_hint_edit_updates_feedback_for_all_submissions(self):
+        structure = make_grade_structure()
+        grade1 = SubmissionGrade(structure)
+        grade2 = SubmissionGrade(structure)
+        grade2.get_by_path([0]).set_hint_enabled(0, True)
+        self.assertIn("Missing stuff", grade2.get_feedback())
+
+        grade1.replace_hint_for_all_grades([0], 0, "Missing some things", -2)
+        self.assertNotIn("Missing stuff", grade2.get_feedback())
+        self.assertIn("Missing some things", grade2.get_feedback())
+        self.assertNotIn("Missing some things", grade1.get_feedback())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,294 @@
+import codecs
+import io
+import locale
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tarfile
+import tempfile
+import threading
+import time
+import types
+import unittest
+import zipfile
+from unittest import mock
+
+from gradefast import hosts
+from gradefast.hosts import LocalHost, extract_archive, split_archive_name
+from gradefast.models import CommandItem, LocalPath
+from gradefast.outputbuffer import OutputBuffer
+
+
+class TestSplitArchiveName(unittest.TestCase):
+    def test_split(self):
+        self.assertEqual(split_archive_name("abc1234.zip"), ("abc1234", "zip"))
+        self.assertEqual(split_archive_name("abc1234.tar.gz"), ("abc1234", "tar.gz"))
+        self.assertEqual(split_archive_name("abc.1234.TGZ"), ("abc.1234", "TGZ"))
+        self.assertEqual(split_archive_name("abc1234.tar.xz"), ("abc1234", "tar.xz"))
+
+    def test_not_archive(self):
+        self.assertIsNone(split_archive_name("abc1234.c"))
+        self.assertIsNone(split_archive_name("abc1234.gz"))
+        self.assertIsNone(split_archive_name("abc1234"))
+        self.assertIsNone(split_archive_name(".zip"))
+
+
+class TestExtractArchive(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.archive_path = os.path.join(self.temp_dir, "archive")
+        self.folder = os.path.join(self.temp_dir, "submission")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _extract(self):
+        extract_archive(LocalPath(self.archive_path), LocalPath(self.folder))
+
+    def _read(self, name):
+        with open(os.path.join(self.folder, name)) as f:
+            return f.read()
+
+    def test_zip(self):
+        with zipfile.ZipFile(self.archive_path, "w") as archive:
+            archive.writestr("main.c", "int main() {}")
+            archive.writestr("src/util.c", "int x;")
+        self._extract()
+        self.assertEqual(self._read("main.c"), "int main() {}")
+        self.assertEqual(self._read(os.path.join("src", "util.c")), "int x;")
+
+    def test_tar_gz(self):
+        with tarfile.open(self.archive_path, "w:gz") as archive:
+            for name, content in [("main.c", b"int main() {}"), ("../evil.c", b"oops")]:
+                info = tarfile.TarInfo(name)
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        self._extract()
+        self.assertEqual(self._read("main.c"), "int main() {}")
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, "evil.c")))
+
+
+@unittest.skipIf(hosts.resource is None, "The resource module isn't available")
+class TestSetLimitsScript(unittest.TestCase):
+    def _run(self, cpu_limit, memory_limit, command):
+        return subprocess.run(
+            [sys.executable, "-c", hosts._SET_LIMITS_SCRIPT, cpu_limit, memory_limit,
+             "/bin/sh", "-c", command], stdout=subprocess.PIPE, universal_newlines=True)
+
+    def test_limits(self):
+        result = self._run("1.5", str(256 * 1024 * 1024), "ulimit -t; ulimit -v")
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.stdout.split(), ["2", str(256 * 1024)])
+
+    def test_no_limits(self):
+        result = self._run("", "", "echo hi; exit 3")
+        self.assertEqual((result.returncode, result.stdout), (3, "hi\n"))
+
+    def test_missing_command(self):
+        result = subprocess.run(
+            [sys.executable, "-c", hosts._SET_LIMITS_SCRIPT, "1", "", "/nonexistent/command"],
+            stderr=subprocess.PIPE)
+        self.assertEqual(result.returncode, 127)
+
+
+@unittest.skipIf(os.name != "posix", "The test commands need a POSIX shell")
+class TestWatchdog(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.host = LocalHost(None, types.SimpleNamespace(shell_command=None, shell_args=None))
+        self.path = self.host.local_path_to_gradefast_path(LocalPath(self.temp_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _run(self, command, **limits):
+        start_time = time.monotonic()
+        result = self.host.run_command_captured(command, self.path, dict(os.environ),
+                                                limits=CommandItem.Limits(**limits))
+        return result, time.monotonic() - start_time
+
+    def test_timeout(self):
+        result, duration = self._run("sleep 30", timeout=0.5)
+        self.assertLess(duration, 10)
+        self.assertEqual(result.returncode, -signal.SIGTERM)
+        self.assertEqual(result.get_error(), "Command timed out after 0.5 seconds")
+
+    def test_sigterm_ignored(self):
+        with mock.patch.object(LocalHost, "KILL_GRACE_PERIOD", 1):
+            result, duration = self._run("trap '' TERM; sleep 30", timeout=0.5)
+        # It gets the "SIGKILL" once the grace period is up
+        self.assertGreaterEqual(duration, 1.5)
+        self.assertLess(duration, 10)
+        self.assertEqual(result.returncode, -signal.SIGKILL)
+        self.assertEqual(result.get_error(), "Command timed out after 0.5 seconds")
+
+    def test_process_group_stopped(self):
+        result, duration = self._run("sleep 60 & echo $!; wait", timeout=0.5)
+        self.assertLess(duration, 10)
+        pid = int(result.output.get_text())
+        deadline = time.time() + 5
+        while True:
+            try:
+                # The "sleep" might be a zombie for a moment, until whoever adopted it reaps it
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                break
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+
+    def test_max_output(self):
+        result, duration = self._run("yes", max_output=100000)
+        self.assertLess(duration, 10)
+        self.assertEqual(len(result.output), 100000)
+        self.assertEqual(result.output.get_text(), "y\n" * 50000)
+        self.assertEqual(result.get_error(),
+                         "Command printed more than 100000 characters of output")
+
+    def test_under_limits(self):
+        result, duration = self._run("echo hi; exit 3", timeout=10, max_output=100)
+        self.assertEqual(result.output.get_text(), "hi\n")
+        self.assertEqual(result.get_error(), "Command had nonzero return code: 3")
+
+    @unittest.skipIf(hosts.resource is None, "The resource module isn't available")
+    def test_cpu_limit(self):
+        result, duration = self._run("while :; do :; done", cpu_limit=1, timeout=20)
+        self.assertLess(duration, 10)
+        self.assertEqual(result.get_error(), "Command went over its CPU time limit of 1 seconds")
+
+    @unittest.skipIf(not hasattr(signal, "SIGXCPU"), "CPU limits aren't supported here")
+    def test_cpu_limit_error(self):
+        process = types.SimpleNamespace(args="test", poll=lambda: 0)
+        watchdog = LocalHost.Watchdog(process, CommandItem.Limits(cpu_limit=1))
+        message = "Command went over its CPU time limit of 1 seconds"
+        for returncode in (-signal.SIGXCPU, -signal.SIGKILL, 128 + signal.SIGXCPU):
+            self.assertEqual(watchdog.get_error(returncode), message)
+        self.assertIsNone(watchdog.get_error(0))
+        self.assertIsNone(watchdog.get_error(1))
+
+        watchdog = LocalHost.Watchdog(process, CommandItem.Limits(timeout=None))
+        self.assertIsNone(watchdog.get_error(-signal.SIGKILL))
+
+        # Stopping a process that already exited doesn't do anything
+        watchdog.stop("Stopped")
+        self.assertIsNone(watchdog.get_error(0))
+
+
+class _RecordingMsg:
+    """
+    Stands in for iochannels' Msg, to record the text that would be printed.
+    """
+
+    def __init__(self, end="\n"):
+        self.end = end
+        self.parts = []
+
+    def _add(self, text="", *args):
+        self.parts.append(text.format(*args))
+        return self
+
+    print = status = _add
+
+    def get_text(self):
+        return "\n".join(self.parts) + self.end
+
+
+class TestStdoutReaderThread(unittest.TestCase):
+    def _read(self, chunks, buffer, delay=0.0, interactive=False):
+        """
+        Run the reader thread on a pipe that "chunks" are written to (with "delay" seconds
+        between them).
+
+        :param interactive: Whether input would be forwarded to the process while it runs.
+
+        :return: All the text that would have been printed.
+        """
+        read_fd, write_fd = os.pipe()
+
+        def write_chunks():
+            try:
+                for chunk in chunks:
+                    os.write(write_fd, chunk)
+                    time.sleep(delay)
+            finally:
+                os.close(write_fd)
+
+        writer = threading.Thread(target=write_chunks, daemon=True)
+        writer.start()
+        messages = []
+        forwarding_input = threading.Event()
+        if interactive:
+            forwarding_input.set()
+        try:
+            with mock.patch.object(hosts, "Msg", _RecordingMsg):
+                LocalHost._stdout_reader_thread(types.SimpleNamespace(args="test"), read_fd,
+                                                buffer, messages.append, forwarding_input)
+        finally:
+            os.close(read_fd)
+        writer.join()
+        return "".join(msg.get_text() for msg in messages)
+
+    @unittest.skipIf(codecs.lookup(locale.getpreferredencoding(False)).name != "utf-8",
+                     "The preferred encoding isn't UTF-8")
+    def test_split_character(self):
+        buffer = OutputBuffer()
+        text = "caf\u00e9 \u2603\n"
+        data = text.encode("utf-8")
+        # Split in the middle of both characters, with enough time in between that each part is
+        # read separately
+        chunks = [data[:4], data[4:8], data[8:]]
+        printed = self._read(chunks, buffer, delay=0.2)
+        self.assertEqual(buffer.get_text(), text)
+        self.assertIn(text, printed)
+
+    def test_newlines_translated(self):
+        buffer = OutputBuffer()
+        self._read([b"one\r", b"\ntwo\r\n"], buffer, delay=0.1)
+        self.assertEqual(buffer.get_text(), "one\ntwo\n")
+
+    def test_long_output(self):
+        buffer = OutputBuffer(head_size=1000, tail_size=500)
+        text = "".join("line {}\n".format(i) for i in range(10000))
+        data = text.encode("ascii")
+        chunks = [data[i:i + 3000] for i in range(0, len(data), 3000)]
+        printed = self._read(chunks, buffer)
+
+        self.assertEqual(len(buffer), len(text))
+        self.assertEqual(buffer.get_text(), text)
+        omitted = len(text) - 1000 - 500
+        self.assertEqual(buffer.get_omitted_length(), omitted)
+        # Just the head and the tail are printed
+        self.assertTrue(printed.startswith(text[:1000]))
+        self.assertIn("(Skipping to the end of the output)", printed)
+        self.assertIn("[{} characters omitted]".format(omitted), printed)
+        self.assertIn(text[-500:], printed)
+        self.assertNotIn(text[1000:-500], printed)
+        self.assertLess(len(printed), 2000)
+
+    def test_output_between_head_and_tail(self):
+        buffer = OutputBuffer(head_size=1000, tail_size=500)
+        text = "".join("line {}\n".format(i) for i in range(150))
+        self.assertTrue(1000 < len(text) <= 1500)
+        printed = self._read([text.encode("ascii")], buffer)
+        # Nothing is skipped, so all of it is printed
+        self.assertIn(text, printed)
+        self.assertNotIn("Skipping", printed)
+        self.assertNotIn("omitted", printed)
+
+    def test_interactive_prompt_after_head(self):
+        buffer = OutputBuffer(head_size=100, tail_size=50)
+        chunks = [b"a" * 400, b"prompt: ", b"b" * 400]
+        printed = self._read(chunks, buffer, delay=0.5, interactive=True)
+        # The prompt is printed when the output stops, even though it's long gone from the tail by
+        # the time the process is done
+        self.assertTrue(printed.startswith("a" * 100))
+        self.assertIn("[250 characters omitted]", printed)
+        self.assertIn("a" * 50 + "prompt: ", printed)
+        self.assertNotIn("a" * 51, printed[100:])
+        self.assertIn("[350 characters omitted]", printed)
+        self.assertEqual(printed.count("(Skipping to the end of the output)"), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import pickle
+import unittest
+
+from gradefast.outputbuffer import OutputBuffer
+
+
+class TestOutputBuffer(unittest.TestCase):
+    def test_short_output(self):
+        buffer = OutputBuffer(head_size=10, tail_size=5)
+        buffer.write("abc\n")
+        buffer.write("def\n")
+        buffer.finish()
+
+        self.assertEqual(len(buffer), 8)
+        self.assertFalse(buffer.is_spilled())
+        self.assertEqual(buffer.get_text(), "abc\ndef\n")
+        self.assertEqual(buffer.get_summary(), "abc\ndef\n")
+        self.assertListEqual(list(buffer.get_lines()), ["abc", "def"])
+        self.assertEqual("".join(buffer.iter_text()), "abc\ndef\n")
+
+    def test_empty_output(self):
+        buffer = OutputBuffer()
+        buffer.finish()
+
+        self.assertFalse(buffer)
+        self.assertEqual(buffer.get_text(), "")
+        self.assertListEqual(list(buffer.get_lines()), [])
+
+    def test_spilled_output(self):
+        buffer = OutputBuffer(head_size=10, tail_size=5)
+        text = "".join("line {}\n".format(i) for i in range(1000))
+        for i in range(0, len(text), 7):
+            buffer.write(text[i:i + 7])
+        buffer.finish()
+
+        self.assertEqual(len(buffer), len(text))
+        self.assertTrue(buffer.is_spilled())
+        self.assertEqual(buffer.get_head(), text[:10])
+        self.assertEqual(buffer.get_tail(), text[-5:])
+        self.assertEqual(buffer.get_omitted_length(), len(text) - 15)
+        self.assertIn("characters omitted", buffer.get_summary())
+
+        self.assertEqual(buffer.get_text(), text)
+        self.assertEqual("".join(buffer.iter_text(chunk_size=100)), text)
+        lines = buffer.get_lines()
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(lines[0], "line 0")
+        self.assertEqual(lines[-1], "line 999")
+        self.assertListEqual(list(lines), text.splitlines())
+
+        buffer.close()
+        with self.assertRaises(ValueError):
+            buffer.get_text()
+
+    def test_unicode(self):
+        buffer = OutputBuffer(head_size=3, tail_size=3)
+        text = "héllo wörld €\n" * 10
+        buffer.write(text)
+        buffer.finish()
+
+        self.assertTrue(buffer.is_spilled())
+        self.assertEqual(buffer.get_text(), text)
+        self.assertEqual(buffer.get_lines()[3], "héllo wörld €")
+
+    def test_spill_file_removed(self):
+        buffer = OutputBuffer(head_size=1, tail_size=1)
+        buffer.write("abcdef")
+        buffer.finish()
+        path = buffer._spill_path
+        self.assertTrue(os.path.exists(path))
+
+        del buffer
+        self.assertFalse(os.path.exists(path))
+
+    def test_lines_closed_with_buffer(self):
+        buffer = OutputBuffer(head_size=1, tail_size=1)
+        buffer.write("abc\ndef\n")
+        lines = buffer.get_lines()
+        self.assertEqual(lines[1], "def")
+
+        buffer.close()
+        with self.assertRaises(ValueError):
+            lines[0]
+
+    def test_lines_closed_when_garbage_collected(self):
+        buffer = OutputBuffer(head_size=1, tail_size=1)
+        buffer.write("abc\ndef\n")
+        lines = buffer.get_lines()
+        mapping = lines._map
+        del lines
+        self.assertTrue(mapping.closed)
+
+        lines = buffer.get_lines()
+        path = buffer._spill_path
+        del buffer
+        self.assertFalse(os.path.exists(path))
+        with self.assertRaises(ValueError):
+            lines[0]
+
+    def test_pickle_without_transfer(self):
+        buffer = OutputBuffer(head_size=2, tail_size=2)
+        buffer.write("abcdef")
+        path = buffer._spill_path
+
+        # A copy that's never unpickled doesn't keep the spill file around...
+        pickle.dumps(buffer)
+        copy = pickle.loads(pickle.dumps(buffer))
+        # ...and one that is doesn't remove it out from under the original
+        del copy
+        self.assertEqual(buffer.get_text(), "abcdef")
+
+        del buffer
+        self.assertFalse(os.path.exists(path))
+
+    def test_pickle(self):
+        buffer = OutputBuffer(head_size=2, tail_size=2)
+        buffer.write("abcdef")
+        buffer.transfer_spill_file()
+        copy = pickle.loads(pickle.dumps(buffer))
+        path = buffer._spill_path
+        del buffer
+
+        # The copy takes over the spill file
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(copy.get_text(), "abcdef")
+        self.assertEqual(copy.get_summary(),
+                         copy.get_head() + "\n\n... [2 characters omitted] ...\n\n" +
+                         copy.get_tail())
+        copy.close()
+        self.assertFalse(os.path.exists(path))
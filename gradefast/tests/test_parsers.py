@@ -212,7 +212,10 @@ class TestParseCommands(unittest.TestCase):
     def test_command_item_invalid_combinations(self):
         for item1, item2 in [("passthrough", "background"),
                              ("passthrough", "input"),
-                             ("passthrough", "diff")]:
+                             ("passthrough", "diff"),
+                             ("passthrough", "prefetch"),
+                             ("passthrough", "tty"),
+                             ("background", "tty")]:
             with self.assertRaises(ModelParseError) as assertion:
                 parse_commands([
                     {
@@ -225,6 +228,154 @@ class TestParseCommands(unittest.TestCase):
 
             self.assertIn("has both", str(assertion.exception))
 
+    def test_command_item_prefetch(self):
+        commands = parse_commands([
+            {
+                "name": "compile",
+                "command": "make",
+                "prefetch": True
+            },
+            {
+                "name": "run interactively",
+                "command": "./a.out",
+                "input": "42",
+                "prefetch": False
+            }
+        ])
+        self.assertListEqual(commands, [
+            CommandItem(
+                name="compile",
+                command="make",
+                prefetch=True
+            ),
+            CommandItem(
+                name="run interactively",
+                command="./a.out",
+                stdin="42",
+                prefetch=False
+            )
+        ])
+        self.assertTrue(commands[0].can_prefetch())
+        self.assertFalse(commands[1].can_prefetch())
+
+    def test_command_item_prefetch_invalid(self):
+        with self.assertRaises(ModelParseError) as assertion:
+            parse_commands([
+                {
+                    "name": "test",
+                    "command": "make",
+                    "prefetch": "sure"
+                }
+            ])
+
+        self.assertIn("\"prefetch\" must be true or false", str(assertion.exception))
+
+    def test_command_item_tty(self):
+        commands = parse_commands([
+            {
+                "name": "run",
+                "command": "./a.out",
+                "tty": True
+            }
+        ])
+        self.assertListEqual(commands, [
+            CommandItem(
+                name="run",
+                command="./a.out",
+                is_tty=True
+            )
+        ])
+
+    def test_command_item_tty_invalid(self):
+        with self.assertRaises(ModelParseError) as assertion:
+            parse_commands([
+                {
+                    "name": "test",
+                    "command": "./a.out",
+                    "tty": "yes please"
+                }
+            ])
+
+        self.assertIn("\"tty\" must be true or false", str(assertion.exception))
+
+    def test_command_item_limits(self):
+        commands = parse_commands([
+            {
+                "name": "run",
+                "command": "./a.out",
+                "timeout": 10,
+                "cpu limit": 2.5,
+                "memory limit": "512M",
+                "max output": 100000
+            },
+            {
+                "name": "compile",
+                "command": "make"
+            }
+        ])
+        self.assertListEqual(commands, [
+            CommandItem(
+                name="run",
+                command="./a.out",
+                limits=CommandItem.Limits(timeout=10, cpu_limit=2.5,
+                                          memory_limit=512 * 1024 * 1024, max_output=100000)
+            ),
+            CommandItem(
+                name="compile",
+                command="make"
+            )
+        ])
+
+    def test_command_item_limits_invalid(self):
+        for key, value, error in [("timeout", "forever", "positive number of seconds"),
+                                  ("cpu limit", -1, "positive number of seconds"),
+                                  ("memory limit", "lots", "positive size"),
+                                  ("max output", 0, "positive size")]:
+            with self.assertRaises(ModelParseError) as assertion:
+                parse_commands([
+                    {
+                        "name": "test",
+                        "command": "./a.out",
+                        key: value
+                    }
+                ])
+
+            self.assertIn(error, str(assertion.exception))
+
+        with self.assertRaises(ModelParseError) as assertion:
+            parse_commands([
+                {
+                    "name": "test",
+                    "command": "./a.out",
+                    "passthrough": True,
+                    "timeout": 10
+                }
+            ])
+
+        self.assertIn("has both", str(assertion.exception))
+
+    def test_command_item_cacheable(self):
+        commands = parse_commands([
+            {"name": "all files", "command": "make", "cacheable": True},
+            {"name": "some files", "command": "javac *.java", "cacheable": True,
+             "cache inputs": "*.java"},
+            {"name": "not cacheable", "command": "make", "cacheable": False}
+        ])
+        self.assertEqual(commands[0].cache, CommandItem.Cache())
+        self.assertEqual(commands[1].cache, CommandItem.Cache(["*.java"]))
+        self.assertIsNone(commands[2].cache)
+
+        for command, error in [
+            ({"cacheable": "yes"}, "\"cacheable\" must be true or false"),
+            ({"cache inputs": ["*.c"]}, "has \"cache inputs\" without \"cacheable\" set"),
+            ({"cacheable": True, "cache inputs": [1]}, "\"cache inputs\" must be a pattern"),
+            ({"cacheable": True, "background": True},
+             "has both \"background\" and \"cacheable\" set")
+        ]:
+            with self.assertRaises(ModelParseError) as assertion:
+                parse_commands([dict({"name": "test", "command": "make"}, **command)])
+            self.assertIn(error, str(assertion.exception))
+
     def test_command_item_diff_str(self):
         commands = parse_commands([
             {
@@ -333,6 +484,67 @@ class TestParseCommands(unittest.TestCase):
             )
         ])
 
+    def test_command_item_diff_cache(self):
+        commands = parse_commands([
+            {
+                "name": "test",
+                "command": "./a.out",
+                "diff": {
+                    "command": "./solution",
+                    "cache": "global"
+                }
+            }
+        ])
+        self.assertEqual(commands[0].diff, CommandItem.Diff(command="./solution",
+                                                            cache=CommandItem.Diff.CACHE_GLOBAL))
+
+        with self.assertRaises(ModelParseError) as assertion:
+            parse_commands([{"name": "test", "command": "",
+                             "diff": {"command": "./solution", "cache": "forever"}}])
+        self.assertIn("diff cache must be one of: none, submission, global",
+                      str(assertion.exception))
+
+        with self.assertRaises(ModelParseError) as assertion:
+            parse_commands([{"name": "test", "command": "",
+                             "diff": {"file": "test.out", "cache": "global"}}])
+        self.assertIn("diff cache can only be set for a diff command", str(assertion.exception))
+
+    def test_command_item_diff_score(self):
+        commands = parse_commands([
+            {
+                "name": "by name",
+                "command": "./a.out",
+                "diff": {
+                    "file": "test.out",
+                    "score": "Output"
+                }
+            },
+            {
+                "name": "by path",
+                "command": "./a.out",
+                "diff": {
+                    "file": "test.out",
+                    "score": [1, 0],
+                    "score rule": "matching lines"
+                }
+            }
+        ])
+        self.assertEqual(commands[0].diff.scoring, CommandItem.DiffScoring("Output"))
+        self.assertEqual(commands[1].diff.scoring, CommandItem.DiffScoring(
+            [1, 0], CommandItem.DiffScoring.RULE_MATCHING_LINES))
+
+        for diff, error in [
+            ({"file": "test.out", "score": 5}, "diff score must be a grade item name"),
+            ({"file": "test.out", "score": [-1]}, "diff score must be a grade item name"),
+            ({"file": "test.out", "score": "Output", "score rule": "lenient"},
+             "diff score rule must be one of"),
+            ({"file": "test.out", "score rule": "similarity"},
+             "diff has a \"score rule\" but no \"score\"")
+        ]:
+            with self.assertRaises(ModelParseError) as assertion:
+                parse_commands([{"name": "test", "command": "", "diff": diff}])
+            self.assertIn(error, str(assertion.exception))
+
     def test_command_item_diff_invalid_properties(self):
         with self.assertRaises(ModelParseError) as assertion:
             parse_commands([
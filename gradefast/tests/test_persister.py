@@ -0,0 +1,282 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import types
+import unittest
+
+from iochannels import HTMLMemoryLog, MemoryLog
+
+from gradefast.grades import SubmissionGrade
+from gradefast.models import LocalPath, Path
+from gradefast.persister import SaveFileFormatError, SqlitePersister, SqlitePersisterThread, \
+    StructuredSqlitePersister, StructuredSqlitePersisterThread
+from gradefast.submissions import Submission
+from gradefast.tests.test_grades import make_grade_structure
+
+
+def make_submission(submission_id):
+    grade = SubmissionGrade(make_grade_structure())
+    grade.get_by_path([0]).set_hint_enabled(0, True)
+    grade.get_by_path([0]).set_comments("Some comments")
+    grade.get_by_path([1]).set_late_deduction(25)
+    grade.get_by_path([1, 0]).set_base_score(2.5)
+    grade.get_by_path([1, 1]).set_enabled(False)
+    grade.set_late(True)
+    grade.set_overall_comments("Overall")
+
+    submission = Submission(submission_id, "name", "full name", Path("/submission"), grade)
+    submission._start_and_end_times = [(1.0, 3.0), (4.0, None)]
+    return submission
+
+
+class PersisterTestCase(unittest.TestCase):
+    persister_class = SqlitePersister
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.save_file = os.path.join(self.temp_dir, "save.sqlite")
+        self.persister = self.persister_class(
+            types.SimpleNamespace(save_file=LocalPath(self.save_file)))
+
+    def tearDown(self):
+        if self.persister is not None:
+            self.persister.close()
+        shutil.rmtree(self.temp_dir)
+
+    def reopen(self):
+        self.persister.close()
+        self.persister = self.persister_class(
+            types.SimpleNamespace(save_file=LocalPath(self.save_file)))
+
+
+class TestSqlitePersister(PersisterTestCase):
+    def get_committed(self, key):
+        """
+        Get a value from the save file the way another process would see it.
+        """
+        conn = sqlite3.connect(self.save_file)
+        try:
+            return conn.execute("SELECT data_value FROM gradefast WHERE namespace=? AND data_key=?",
+                                ("test", key)).fetchone()
+        finally:
+            conn.close()
+
+    def test_wal_mode(self):
+        # Wait for the save file to be opened
+        self.persister.get("test", "a")
+        conn = sqlite3.connect(self.save_file)
+        try:
+            self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        finally:
+            conn.close()
+
+    def test_set_many_is_one_request(self):
+        actions = []
+        do_request = self.persister._th.do_request
+
+        def recording_do_request(request, wait=True):
+            actions.append(request.action)
+            return do_request(request, wait)
+
+        self.persister._th.do_request = recording_do_request
+        values = {"key-" + str(i): {"value": i} for i in range(100)}
+        self.persister.set_many("test", values)
+        self.assertEqual(actions, ["set_many"])
+
+        # Changes are seen by later requests, even before they're committed
+        for key, value in values.items():
+            self.assertEqual(self.persister.get("test", key), value)
+
+    def test_changes_committed_together(self):
+        self.persister.set("test", "a", 1)
+        self.persister.set_many("test", {"b": 2, "c": 3})
+        self.assertEqual(self.persister.get("test", "c"), 3)
+        self.assertIsNone(self.get_committed("a"))
+
+        deadline = time.time() + SqlitePersisterThread.COMMIT_DELAY + 5
+        while self.get_committed("a") is None:
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+        self.assertIsNotNone(self.get_committed("c"))
+
+    def test_close_commits(self):
+        self.persister.set_many("test", {"a": 1, "b": 2})
+        self.reopen()
+        self.assertEqual(self.persister.get("test", "a"), 1)
+        self.assertEqual(self.persister.get("test", "b"), 2)
+
+    def test_unpicklable_value_skipped(self):
+        self.persister.set_many("test", {"a": 1, "b": lambda: None, "c": 3})
+        self.assertEqual(self.persister.get("test", "a"), 1)
+        self.assertIsNone(self.persister.get("test", "b"))
+        self.assertEqual(self.persister.get("test", "c"), 3)
+
+    def test_structured_save_file_refused(self):
+        self.persister.close()
+        self.persister = StructuredSqlitePersister(
+            types.SimpleNamespace(save_file=LocalPath(self.save_file)))
+        self.persister.set("submissions", "submission-1", make_submission(1).get_state())
+        self.persister.close()
+        self.persister = None
+
+        with self.assertRaises(SaveFileFormatError):
+            SqlitePersister(types.SimpleNamespace(save_file=LocalPath(self.save_file)))
+
+
+class TestStructuredSqlitePersister(PersisterTestCase):
+    persister_class = StructuredSqlitePersister
+
+    def test_round_trip(self):
+        submission = make_submission(1)
+        submission_state = submission.get_state()
+        submission_grade_state = submission.get_grade().get_state()
+        index = [submission.get_summary().get_state()]
+        grade_structure = make_grade_structure()
+
+        self.persister.set_many("submissions", {
+            "submission-1": submission_state,
+            "submission_grade-1": submission_grade_state,
+            "index": index,
+            "ids": [1],
+            "grade_structure": grade_structure
+        })
+        self.persister.set("logs", "submission-1-0", {
+            "html_log": HTMLMemoryLog(),
+            "text_log": MemoryLog()
+        })
+        self.reopen()
+
+        self.assertEqual(self.persister.get("submissions", "submission-1"), submission_state)
+        self.assertEqual(self.persister.get("submissions", "submission_grade-1"),
+                         submission_grade_state)
+        self.assertEqual(self.persister.get("submissions", "index"), index)
+        self.assertEqual(self.persister.get("submissions", "ids"), [1])
+        self.assertEqual(self.persister.get("submissions", "grade_structure"), grade_structure)
+        logs = self.persister.get("logs", "submission-1-0")
+        self.assertIsInstance(logs["html_log"], HTMLMemoryLog)
+        self.assertIsInstance(logs["text_log"], MemoryLog)
+
+        grade = SubmissionGrade(make_grade_structure())
+        grade.set_state(self.persister.get("submissions", "submission_grade-1"),
+                        restore_grades=True)
+        self.assertEqual(grade.get_score(), submission.get_grade().get_score())
+
+    def test_clear(self):
+        submission = make_submission(1)
+        self.persister.set("submissions", "submission-1", submission.get_state())
+        self.persister.set("submissions", "submission_grade-1",
+                           submission.get_grade().get_state())
+        self.persister.set("submissions", "ids", [1])
+        self.persister.clear("submissions", "submission_grade-1")
+        self.assertIsNone(self.persister.get("submissions", "submission_grade-1"))
+        self.assertIsNotNone(self.persister.get("submissions", "submission-1"))
+
+        self.persister.clear_all("submissions")
+        self.assertIsNone(self.persister.get("submissions", "submission-1"))
+        self.assertIsNone(self.persister.get("submissions", "ids"))
+
+    def test_set_many_is_all_or_nothing(self):
+        submission = make_submission(1)
+        self.persister.set_many("submissions", {
+            "submission-1": submission.get_state(),
+            "submission-2": {"name": "missing the rest"},
+            "ids": [1, 2]
+        })
+        self.assertIsNone(self.persister.get("submissions", "submission-1"))
+        self.assertIsNone(self.persister.get("submissions", "ids"))
+
+        self.persister.set_many("submissions", {
+            "submission-1": submission.get_state(),
+            "ids": [1]
+        })
+        self.assertEqual(self.persister.get("submissions", "submission-1"),
+                         submission.get_state())
+        self.assertEqual(self.persister.get("submissions", "ids"), [1])
+
+    def test_pickled_save_file_migrated(self):
+        # Write a save file in the pickled format first
+        self.persister.close()
+        self.save_file = os.path.join(self.temp_dir, "pickled.sqlite")
+        self.persister = SqlitePersister(types.SimpleNamespace(save_file=LocalPath(self.save_file)))
+        submission = make_submission(1)
+        submission_state = submission.get_state()
+        submission_grade_state = submission.get_grade().get_state()
+        index = [submission.get_summary().get_state()]
+        self.persister.set_many("submissions", {
+            "submission-1": submission_state,
+            "submission_grade-1": submission_grade_state,
+            "index": index,
+            "ids": [1]
+        })
+        self.persister.set("logs", "submission-1-0", {
+            "html_log": HTMLMemoryLog(),
+            "text_log": MemoryLog()
+        })
+        self.reopen()
+
+        self.assertEqual(self.persister.get("submissions", "submission-1"), submission_state)
+        self.assertEqual(self.persister.get("submissions", "submission_grade-1"),
+                         submission_grade_state)
+        self.assertEqual(self.persister.get("submissions", "index"), index)
+        self.assertEqual(self.persister.get("submissions", "ids"), [1])
+        self.assertIsInstance(self.persister.get("logs", "submission-1-0")["text_log"], MemoryLog)
+
+        # The migrated rows were moved out of the "gradefast" table
+        self.persister.close()
+        self.persister = None
+        conn = sqlite3.connect(self.save_file)
+        try:
+            rows = conn.execute("SELECT namespace, data_key FROM gradefast").fetchall()
+        finally:
+            conn.close()
+        self.assertEqual(rows, [("submissions", "ids")])
+
+        # Now it's a structured save file, so the pickled format can't open it
+        with self.assertRaises(SaveFileFormatError):
+            SqlitePersister(types.SimpleNamespace(save_file=LocalPath(self.save_file)))
+
+    def test_only_changed_rows_written(self):
+        # Use the sqlite thread's methods directly (in this thread, with a separate save file), to
+        # count the changes
+        save_file = os.path.join(self.temp_dir, "direct.sqlite")
+        th = StructuredSqlitePersisterThread(LocalPath(save_file))
+        th._conn = sqlite3.connect(save_file)
+        th._create_tables()
+        try:
+            submission = make_submission(2)
+            grade = submission.get_grade()
+            th._set_submission(2, submission.get_state())
+            th._set_submission_grade(2, grade.get_state())
+            th._commit()
+
+            def count_changes(set_method, state):
+                total_changes = th._conn.total_changes
+                set_method(2, state)
+                th._commit()
+                return th._conn.total_changes - total_changes
+
+            # Just the submission_grades row
+            self.assertEqual(count_changes(th._set_submission_grade, grade.get_state()), 1)
+            # Plus the changed grade item
+            grade.get_by_path([1, 1]).set_base_score(1)
+            self.assertEqual(count_changes(th._set_submission_grade, grade.get_state()), 2)
+            # Plus the changed hint
+            grade.get_by_path([0]).set_hint_enabled(0, False)
+            self.assertEqual(count_changes(th._set_submission_grade, grade.get_state()), 2)
+
+            # Just the submissions row, and then the changed timing
+            self.assertEqual(count_changes(th._set_submission, submission.get_state()), 1)
+            submission._start_and_end_times[1] = (4.0, 5.0)
+            self.assertEqual(count_changes(th._set_submission, submission.get_state()), 2)
+            # Plus the removed timing
+            submission._start_and_end_times.pop()
+            self.assertEqual(count_changes(th._set_submission, submission.get_state()), 2)
+            self.assertEqual(th._get_submission(2), submission.get_state())
+        finally:
+            th._conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import shutil
+import tempfile
+import time
+import types
+import unittest
+
+from gradefast.buildcache import BuildCache
+from gradefast.grader.prefetch import CommandPrefetcher
+from gradefast.hosts import LocalHost
+from gradefast.models import CommandItem, LocalPath
+
+
+@unittest.skipIf(os.name != "posix", "The test commands need a POSIX shell")
+class TestCommandPrefetcher(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        settings = types.SimpleNamespace(
+            prefetch_count=1, prefetch_workers=1, base_env=dict(os.environ), shell_command=None,
+            shell_args=None, commands=[
+                CommandItem("Slow", "touch started; sleep 30", prefetch=True),
+                CommandItem("Next", "touch next", prefetch=True)
+            ])
+        self.host = LocalHost(None, settings)
+        submission = types.SimpleNamespace(
+            get_name=lambda: "test",
+            get_path=lambda: self.host.local_path_to_gradefast_path(LocalPath(self.temp_dir)))
+        submission_manager = types.SimpleNamespace(
+            get_next_submission_id=lambda submission_id: 1 if submission_id == 0 else None,
+            get_submission=lambda submission_id: submission)
+        build_cache = BuildCache(types.SimpleNamespace(base_env={}, build_cache_path=None))
+        self.prefetcher = CommandPrefetcher(self.host, settings, submission_manager, build_cache)
+
+    def tearDown(self):
+        self.prefetcher.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_interrupted_claim_stops_prefetch(self):
+        self.prefetcher.prefetch_after(0)
+        deadline = time.time() + 10
+        while not os.path.exists(os.path.join(self.temp_dir, "started")):
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+
+        # Pretend that the user pressed Ctrl-C while we were waiting for the prefetch
+        future = self.prefetcher._futures[1]
+
+        def interrupted_result(timeout=None):
+            raise KeyboardInterrupt()
+        future.result = interrupted_result
+
+        start = time.time()
+        self.assertEqual(self.prefetcher.claim(1), {})
+        # The slow command was stopped (instead of left running alongside the live run), and
+        # nothing after it was started
+        self.assertLess(time.time() - start, LocalHost.KILL_GRACE_PERIOD + 5)
+        self.assertTrue(future.done())
+        self.assertFalse(os.path.exists(os.path.join(self.temp_dir, "next")))
@@ -0,0 +1,345 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+from iochannels import HTMLMemoryLog, MemoryLog
+
+from gradefast.models import LocalPath, Path
+from gradefast.persister import SqlitePersister, StructuredSqlitePersister
+from gradefast.submissions import SubmissionManager
+from gradefast.tests.test_grades import make_grade_structure
+
+
+class RecordingSqlitePersister(SqlitePersister):
+    """
+    A SqlitePersister that keeps track of which keys were passed to each set_many call.
+    """
+
+    def __init__(self, settings):
+        super().__init__(settings)
+        self.set_many_keys = []
+
+    def set_many(self, namespace, values):
+        self.set_many_keys.append(list(values.keys()))
+        super().set_many(namespace, values)
+
+
+class RecordingStructuredSqlitePersister(RecordingSqlitePersister, StructuredSqlitePersister):
+    pass
+
+
+class SubmissionManagerTestCase(unittest.TestCase):
+    persister_class = RecordingSqlitePersister
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.settings = types.SimpleNamespace(
+            save_file=LocalPath(os.path.join(self.temp_dir, "save.sqlite")),
+            grade_structure=make_grade_structure())
+        # The submission folders that have been deleted, and the ones that have been checked (by
+        # GradeFast path)
+        self.missing_paths = set()
+        self.checked_paths = []
+        self.persister = None
+        self.open()
+
+    def tearDown(self):
+        self.close()
+        shutil.rmtree(self.temp_dir)
+
+    def open(self):
+        """
+        Open the save file and make a SubmissionManager for it, like GradeFast does when it starts.
+        """
+        channel = types.SimpleNamespace(print=lambda *args, **kwargs: None,
+                                        error=lambda *args, **kwargs: None)
+        host = types.SimpleNamespace(folder_exists=self.folder_exists)
+        event_manager = types.SimpleNamespace(dispatch_event=lambda event: None)
+        self.persister = self.persister_class(self.settings)
+        self.manager = SubmissionManager(channel, host, self.persister, event_manager,
+                                         self.settings)
+        # Only keep track of what's written after startup
+        self.persister.set_many_keys.clear()
+
+    def folder_exists(self, path):
+        self.checked_paths.append(path.get_gradefast_path())
+        return path.get_gradefast_path() not in self.missing_paths
+
+    def close(self):
+        """
+        Flush the SubmissionManager and close the save file, like GradeFast does when it exits.
+        """
+        if self.persister is not None:
+            self.manager.flush()
+            self.persister.close()
+            self.persister = None
+
+    def reopen(self):
+        self.close()
+        self.open()
+
+    def get_persisted_base_score(self, submission_id):
+        grade_state = self.persister.get("submissions", "submission_grade-" + str(submission_id))
+        return grade_state["grades"][0]["base_score"]
+
+
+class TestWriteBehind(SubmissionManagerTestCase):
+    def test_changes_are_debounced(self):
+        with mock.patch.object(SubmissionManager, "PERSIST_DELAY", 0.2):
+            submission = self.manager.add_submission("test", "test", Path("/test"))
+            for score in (7, 8, 9):
+                submission.get_grade().get_by_path([0]).set_base_score(score)
+            self.assertEqual(self.persister.set_many_keys, [])
+
+            deadline = time.time() + 5
+            while not self.persister.set_many_keys:
+                self.assertLess(time.time(), deadline)
+                time.sleep(0.05)
+            time.sleep(0.5)
+
+        # All the changes were persisted together, in one write
+        self.assertEqual(len(self.persister.set_many_keys), 1)
+        self.assertIn("submission-1", self.persister.set_many_keys[0])
+        self.assertIn("submission_grade-1", self.persister.set_many_keys[0])
+        self.assertIn("index", self.persister.set_many_keys[0])
+        self.assertEqual(self.get_persisted_base_score(1), 9)
+
+    def test_explicit_flush(self):
+        submission = self.manager.add_submission("test", "test", Path("/test"))
+        submission.get_grade().get_by_path([0]).set_base_score(7)
+        self.manager.flush()
+        self.assertEqual(self.get_persisted_base_score(1), 7)
+        self.assertIsNone(self.manager._flush_timer)
+
+        # Nothing changed, so there's nothing to write
+        self.manager.flush()
+        self.assertEqual(len(self.persister.set_many_keys), 1)
+
+    def test_snapshot_taken_once_per_flush(self):
+        submission = self.manager.add_submission("test", "test", Path("/test"))
+        get_submission_values = self.manager._get_submission_values
+        snapshot_ids = []
+
+        def recording_get_submission_values(submission_id):
+            snapshot_ids.append(submission_id)
+            return get_submission_values(submission_id)
+
+        self.manager._get_submission_values = recording_get_submission_values
+        for score in (7, 8, 9):
+            submission.get_grade().get_by_path([0]).set_base_score(score)
+        self.assertEqual(snapshot_ids, [])
+        self.manager.flush()
+        self.assertEqual(snapshot_ids, [1])
+        self.assertEqual(self.get_persisted_base_score(1), 9)
+
+    def test_index_persisted_when_changed(self):
+        submission = self.manager.add_submission("test", "test", Path("/test"))
+        self.manager.flush()
+        self.persister.set_many_keys.clear()
+
+        # Comments aren't part of the summary...
+        submission.get_grade().get_by_path([0]).set_comments("Nice")
+        self.manager.flush()
+        self.assertEqual(self.persister.set_many_keys, [["submission-1", "submission_grade-1"]])
+
+        # ...but scores are
+        submission.get_grade().get_by_path([0]).set_base_score(7)
+        self.manager.flush()
+        self.assertEqual(self.persister.set_many_keys[-1],
+                         ["submission-1", "submission_grade-1", "index"])
+        self.assertEqual(self.persister.get("submissions", "index")[0]["points_earned"], 17)
+
+    def test_state_after_shutdown(self):
+        submission = self.manager.add_submission("test", "test", Path("/test"))
+        submission.get_grade().get_by_path([0]).set_base_score(7)
+        submission.get_grade().add_hint_to_all_grades([1, 0], "Bonus", 1)
+        self.manager.add_submission("other", "other", Path("/other"))
+        self.reopen()
+
+        self.assertEqual(list(self.manager.get_all_submission_ids()), [1, 2])
+        self.assertEqual(self.manager.get_submission_summary(1).points_earned, 17)
+        self.assertEqual(self.manager.get_submission(1).get_grade().get_score(), (17, 20))
+        grade_structure = self.persister.get("submissions", "grade_structure")
+        self.assertEqual(grade_structure[1].grades[0].hints[0].name, "Bonus")
+        self.assertIsNone(self.manager._flush_timer)
+
+
+class TestLogs(SubmissionManagerTestCase):
+    def add_logs(self, submission):
+        submission.add_logs(HTMLMemoryLog(), MemoryLog())
+        submission.close_logs()
+
+    def assert_logs(self, submission, count):
+        self.assertEqual(len(submission.get_html_logs()), count)
+        self.assertEqual(len(submission.get_text_logs()), count)
+        for html_log in submission.get_html_logs():
+            self.assertIsInstance(html_log, HTMLMemoryLog)
+
+    def test_logs_persisted_separately(self):
+        submission = self.manager.add_submission("test", "test", Path("/test"))
+        self.add_logs(submission)
+        self.add_logs(submission)
+        # Closed logs aren't kept in memory
+        self.assertEqual(submission._html_logs, [None, None])
+        self.assert_logs(submission, 2)
+        self.manager.flush()
+
+        submission_state = self.persister.get("submissions", "submission-1")
+        self.assertNotIn("html_logs", submission_state)
+        self.assertEqual(submission_state["log_count"], 2)
+        self.assertIsNotNone(self.persister.get("logs", "submission-1-1"))
+
+        self.reopen()
+        self.assertTrue(self.manager.get_submission_summary(1).has_logs())
+        self.assert_logs(self.manager.get_submission(1), 2)
+
+    def test_unclosed_logs_skipped(self):
+        submission = self.manager.add_submission("test", "test", Path("/test"))
+        self.add_logs(submission)
+        # GradeFast was stopped before these were closed
+        submission.add_logs(HTMLMemoryLog(), MemoryLog())
+        self.reopen()
+        self.assert_logs(self.manager.get_submission(1), 1)
+
+    def test_logs_cleared_for_missing_folder(self):
+        for name in ("first", "second"):
+            self.add_logs(self.manager.add_submission(name, name, Path("/" + name)))
+        self.manager.flush()
+        # Without an index (like an older save file), every submission is loaded when restoring
+        self.persister.clear("submissions", "index")
+        self.missing_paths.add("/second")
+        self.reopen()
+
+        self.assertEqual(list(self.manager.get_all_submission_ids()), [1])
+        self.assertIsNotNone(self.persister.get("logs", "submission-1-0"))
+        self.assertIsNone(self.persister.get("logs", "submission-2-0"))
+
+    def test_logs_migrated_from_submission_state(self):
+        self.manager.add_submission("test", "test", Path("/test"))
+        self.manager.flush()
+        # Make it look like an older save file, with the logs in the submission's state (and no
+        # index)
+        submission_state = self.persister.get("submissions", "submission-1")
+        del submission_state["log_count"]
+        submission_state["html_logs"] = [HTMLMemoryLog()]
+        submission_state["text_logs"] = [MemoryLog()]
+        self.persister.set("submissions", "submission-1", submission_state)
+        self.persister.clear("submissions", "index")
+        self.reopen()
+
+        self.assert_logs(self.manager.get_submission(1), 1)
+        self.assertIsNotNone(self.persister.get("logs", "submission-1-0"))
+        submission_state = self.persister.get("submissions", "submission-1")
+        self.assertNotIn("html_logs", submission_state)
+        self.assertEqual(submission_state["log_count"], 1)
+
+
+class TestLazyIndex(SubmissionManagerTestCase):
+    def setUp(self):
+        super().setUp()
+        for name in ("first", "second", "third"):
+            self.manager.add_submission(name, name, Path("/" + name))
+        # The second submission uses the hint
+        self.manager.get_submission(2).get_grade().get_by_path([0]).set_hint_enabled(0, True)
+        self.reopen()
+
+    def test_restored_without_loading(self):
+        self.assertEqual(self.manager.get_loaded_submission_ids(), [])
+        self.assertEqual([summary.points_earned
+                          for summary in self.manager.get_all_submission_summaries()],
+                         [20, 18, 20])
+        self.assertEqual(self.manager.get_submission_summary(2).get_name(), "second")
+        self.assertEqual(self.manager.get_loaded_submission_ids(), [])
+
+        self.assertEqual(self.manager.get_submission(2).get_grade().get_score(), (18, 20))
+        self.assertEqual(self.manager.get_loaded_submission_ids(), [2])
+
+    def test_concurrent_loads(self):
+        load_persisted_submission = self.manager._load_persisted_submission
+        loaded_ids = []
+
+        def slow_load_persisted_submission(submission_id, restore_grades):
+            loaded_ids.append(submission_id)
+            time.sleep(0.1)
+            return load_persisted_submission(submission_id, restore_grades)
+
+        submissions = []
+        self.manager._load_persisted_submission = slow_load_persisted_submission
+        threads = [threading.Thread(
+            target=lambda: submissions.append(self.manager.get_submission(2)))
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # It was only loaded once, and everybody got the same one
+        self.assertEqual(loaded_ids, [2])
+        self.assertEqual(len(submissions), 4)
+        for submission in submissions:
+            self.assertIs(submission, submissions[0])
+
+    def test_missing_index_entry(self):
+        index = self.persister.get("submissions", "index")
+        self.persister.set("submissions", "index", [summary_state for summary_state in index
+                                                    if summary_state["submission_id"] != 2])
+        self.reopen()
+
+        # It's loaded instead, and put back in the index
+        self.assertEqual(self.manager.get_loaded_submission_ids(), [2])
+        self.assertEqual(self.manager.get_submission_summary(2).points_earned, 18)
+        self.manager.flush()
+        self.assertEqual(len(self.persister.get("submissions", "index")), 3)
+
+    def test_missing_folder(self):
+        self.missing_paths.add("/second")
+        self.checked_paths.clear()
+        self.reopen()
+
+        # The folders aren't checked until grading gets to them
+        self.assertEqual(self.checked_paths, [])
+        self.assertEqual(list(self.manager.get_all_submission_ids()), [1, 2, 3])
+        self.assertFalse(self.manager.drop_submission_if_missing(1))
+        self.assertTrue(self.manager.drop_submission_if_missing(2))
+        self.assertFalse(self.manager.drop_submission_if_missing(1))
+        self.assertEqual(self.checked_paths, ["/first", "/second"])
+
+        self.assertEqual(list(self.manager.get_all_submission_ids()), [1, 3])
+        self.assertEqual(self.manager.get_loaded_submission_ids(), [])
+        self.assertIsNone(self.persister.get("submissions", "submission-2"))
+        self.assertEqual(self.persister.get("submissions", "ids"), [1, 3])
+
+    def test_hint_edit_updates_unloaded_summaries(self):
+        self.manager.get_submission(1).get_grade().replace_hint_for_all_grades(
+            [0], 0, "Missing lots of stuff", -5)
+        self.assertEqual(self.manager.get_loaded_submission_ids(), [1])
+        self.assertEqual(self.manager.get_submission_summary(2).points_earned, 15)
+        self.assertEqual(self.manager.get_grading_stats().min, (75, [2]))
+
+        # The index in the save file is updated too
+        self.manager.flush()
+        index = self.persister.get("submissions", "index")
+        self.assertEqual([summary_state["points_earned"] for summary_state in index],
+                         [20, 15, 20])
+        self.assertEqual(self.manager.get_loaded_submission_ids(), [1])
+
+        self.reopen()
+        self.assertEqual(self.manager.get_submission_summary(2).points_earned, 15)
+        self.assertEqual(self.manager.get_submission(2).get_grade().get_score(), (15, 20))
+
+
+class TestWriteBehindStructured(TestWriteBehind):
+    persister_class = RecordingStructuredSqlitePersister
+
+
+class TestLazyIndexStructured(TestLazyIndex):
+    persister_class = RecordingStructuredSqlitePersister
+
+
+if __name__ == "__main__":
+    unittest.main()
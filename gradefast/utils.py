@@ -10,7 +10,7 @@ import json
 import sys
 import time
 import uuid
-from typing import Any, Union
+from typing import Any, Callable, Dict, Union
 
 
 def required_package_error(module_name: str, package_name: str = None) -> None:
@@ -90,14 +90,26 @@ def markdown_to_html_inline(text: str) -> str:
 
 class GradeBookJSONEncoder(json.JSONEncoder):
     """
-    A custom JSONEncoder that encodes UUIDs as a string containing the hex version of the UUID.
+    A custom JSONEncoder that encodes UUIDs as a string containing the hex version of the UUID, and
+    any other object with a "to_json" method as whatever that method returns.
     """
 
+    # How to convert objects of each type that the json module can't encode by itself. This is
+    # filled in with the classes of any objects that have a "to_json" method as we come across
+    # them, so we only have to look for the method once per class.
+    _converters = {
+        uuid.UUID: str
+    }  # type: Dict[type, Callable[[Any], object]]
+
     def default(self, o):
-        if isinstance(o, uuid.UUID):
-            return str(o)
+        converter = GradeBookJSONEncoder._converters.get(type(o))
+        if converter is not None:
+            return converter(o)
 
         # If the object has a to_json method, use that
+        if callable(getattr(type(o), "to_json", None)):
+            GradeBookJSONEncoder._converters[type(o)] = type(o).to_json
+            return o.to_json()
         if hasattr(o, "to_json") and callable(o.to_json):
             return o.to_json()
 
@@ -105,6 +117,7 @@ class GradeBookJSONEncoder(json.JSONEncoder):
 
 
 _json_encoder_instance = None
+_compact_json_encoder_instance = None
 
 
 def to_json(o: object, **kwargs: Any) -> str:
@@ -121,6 +134,18 @@ def to_json(o: object, **kwargs: Any) -> str:
     return encoder.encode(o)
 
 
+def to_compact_json(o: object) -> str:
+    """
+    Convert an object to a JSON string without any extra whitespace. This is meant for data that is
+    sent to GradeBook clients, where smaller is better and nobody has to read it.
+    """
+    global _compact_json_encoder_instance
+    if _compact_json_encoder_instance is None:
+        _compact_json_encoder_instance = GradeBookJSONEncoder(separators=(",", ":"),
+                                                              check_circular=False)
+    return _compact_json_encoder_instance.encode(o)
+
+
 def from_json(s: str, **kwargs: Any) -> object:
     """
     Convert a JSON string to an object representation. For usage, see json.loads(...).
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Utility script to benchmark diffing long command output against a reference, like the grader does
+for commands with a "diff" property.
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+import argparse
+import difflib
+import os
+import random
+import sys
+import time
+from typing import Callable, List
+
+# Make sure we can access the GradeFast classes
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), ".."))
+
+from gradefast.grader.diffing import DIFF_ENGINES, clean_line, diff_lines, get_diff_engine
+
+
+def make_reference(lines: int) -> List[str]:
+    return ["Line {}: value = {}".format(i, random.randint(0, 1000)) for i in range(lines)]
+
+
+def make_output(reference: List[str], changes: int) -> List[str]:
+    """
+    Make a copy of some reference lines with some lines changed, added, and removed.
+    """
+    output = list(reference)
+    for _ in range(changes):
+        index = random.randrange(len(output))
+        kind = random.randrange(3)
+        if kind == 0:
+            output[index] = "Something else entirely"
+        elif kind == 1:
+            output.insert(index, "An extra line")
+        else:
+            del output[index]
+    return output
+
+
+def ndiff(reference: List[str], output: List[str]) -> None:
+    """
+    Diff the way the grader used to (with difflib.ndiff on the cleaned-up lines).
+    """
+    for _ in difflib.ndiff([clean_line(line) + "\n" for line in reference],
+                           [clean_line(line) + "\n" for line in output]):
+        pass
+
+
+def time_it(func: Callable[[], None], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the diff engines.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="The numbers of lines of output to diff")
+    parser.add_argument("--changes", type=float, default=0.01,
+                        help="The fraction of lines to change in the \"changed\" scenario")
+    parser.add_argument("--slow-limit", type=int, default=10000,
+                        help="Skip difflib and ndiff for more lines than this (they're slow)")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    random.seed(0)
+    print("{:<10} {:<12} {:<10} {:>10}".format("Lines", "Scenario", "Engine", "Best (ms)"))
+
+    def report(size: int, scenario: str, name: str, func: Callable[[], None]) -> None:
+        print("{:<10} {:<12} {:<10} {:>10.1f}".format(
+            size, scenario, name, time_it(func, args.repeat) * 1000))
+
+    for size in args.sizes:
+        reference = make_reference(size)
+        scenarios = [
+            ("identical", list(reference)),
+            ("changed", make_output(reference, max(1, int(size * args.changes))))
+        ]
+        for scenario, output in scenarios:
+            for name in sorted(DIFF_ENGINES.keys()):
+                if name == "difflib" and size > args.slow_limit:
+                    continue
+                engine = get_diff_engine(name)
+                report(size, scenario, name,
+                       lambda: diff_lines(reference, output, engine=engine))
+            if size <= args.slow_limit:
+                report(size, scenario, "ndiff", lambda: ndiff(reference, output))
+
+
+if __name__ == "__main__":
+    main()
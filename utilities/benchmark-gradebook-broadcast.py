@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+"""
+Utility script to benchmark broadcasting updates to GradeBook clients, like the GradeBook does
+whenever a grade or the submission list changes.
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import uuid
+from typing import Callable, List
+
+# Make sure we can access the GradeFast classes
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), ".."))
+
+from gradefast.gradebook.clientupdates import ClientUpdate
+from gradefast.grades import SubmissionGrade
+from gradefast.models import GradeScore, GradeSection, Hint, Path
+from gradefast.submissions import SubmissionSummary
+
+
+class OldJSONEncoder(json.JSONEncoder):
+    """
+    The JSON encoder that the GradeBook used to use (which looks for a "to_json" method on every
+    object that the json module can't encode by itself).
+    """
+
+    def default(self, o):
+        if isinstance(o, uuid.UUID):
+            return str(o)
+        if hasattr(o, "to_json") and callable(o.to_json):
+            return o.to_json()
+        return super().default(o)
+
+
+def old_broadcast(update_data: object, clients: int) -> None:
+    """
+    Broadcast an update the way the GradeBook used to: encode the data to JSON once, and then put
+    it in the Server-Sent Events format (and encode that as UTF-8) for each client.
+    """
+    data = OldJSONEncoder().encode({"update_type": "BENCHMARK", "update_data": update_data})
+    for _ in range(clients):
+        result = "id: 1\n"
+        result += "event: update\n"
+        for line in data.splitlines():
+            result += "data: " + line + "\n"
+        result += "\n"
+        result.encode("utf-8")
+
+
+def new_broadcast(update_data: object, clients: int) -> None:
+    """
+    Broadcast an update using ClientUpdate, which encodes everything once.
+    """
+    update = ClientUpdate.create_update_event("BENCHMARK", update_data)
+    for _ in range(clients):
+        update.encode()
+
+
+def make_grade_data(items: int) -> dict:
+    """
+    Make the data for a SUBMISSION_UPDATED update for a grade structure with about this many items.
+    """
+    sections = []
+    for section_index in range(max(1, items // 10)):
+        scores = [
+            GradeScore("Item {}.{}".format(section_index, index),
+                       "Some notes about **this** item", True,
+                       [Hint("Hint {}".format(hint), -1, False) for hint in range(3)],
+                       10, 10, "")
+            for index in range(10)
+        ]
+        sections.append(GradeSection("Section {}".format(section_index), "", True, [], scores, 0))
+    return SubmissionGrade(sections).get_data()
+
+
+def make_submission_list(submissions: int) -> List[SubmissionSummary]:
+    return [SubmissionSummary(submission_id, "student{}".format(submission_id),
+                              "Student {}".format(submission_id),
+                              Path("/submissions/student{}".format(submission_id)), 1,
+                              [(1500000000.0, 1500000600.0)], False, 90, 100)
+            for submission_id in range(1, submissions + 1)]
+
+
+def time_it(func: Callable[[], None], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark broadcasting GradeBook updates.")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64],
+                        help="The numbers of GradeBook clients to broadcast to")
+    parser.add_argument("--grade-items", type=int, default=200,
+                        help="The number of grade items in the grade structure")
+    parser.add_argument("--submissions", type=int, default=1000,
+                        help="The number of submissions in the submission list")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    payloads = [
+        ("grade", make_grade_data(args.grade_items)),
+        ("list", {"submissions": make_submission_list(args.submissions)})
+    ]
+
+    print("{:<8} {:>8} {:>10} {:>12} {:>12} {:>8}".format(
+        "Payload", "Clients", "Size (KB)", "Old (ms)", "New (ms)", "Speedup"))
+    for name, payload in payloads:
+        size = len(ClientUpdate.create_update_event("BENCHMARK", payload).encode()) / 1024
+        for clients in args.clients:
+            old = time_it(lambda: old_broadcast(payload, clients), args.repeat)
+            new = time_it(lambda: new_broadcast(payload, clients), args.repeat)
+            print("{:<8} {:>8} {:>10.1f} {:>12.2f} {:>12.2f} {:>7.1f}x".format(
+                name, clients, size, old * 1000, new * 1000, old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Utility script to benchmark calculating scores and rendering feedback for a large class, like the
+gradebook does when exporting grades.
+
+Licensed under the MIT License. For more, see the LICENSE file.
+
+Author: Jake Hartz <jake@hartz.io>
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from typing import Callable, List
+
+# Make sure we can access the GradeFast classes
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), ".."))
+
+from gradefast.grades import SubmissionGrade, SubmissionGradeScore
+from gradefast.models import GradeItem, GradeScore, GradeSection, Hint
+
+
+def make_grade_structure(sections: int, items_per_section: int) -> List[GradeItem]:
+    return [
+        GradeSection("Section {}".format(s), "", True, [], [
+            GradeScore("Item {}.{}".format(s, i), "Notes for *item* {}.{}".format(s, i), True, [
+                Hint("Forgot something", -1, False),
+                Hint("Did something **extra**", 1, False)
+            ], 10, 10, "")
+            for i in range(items_per_section)
+        ], 10)
+        for s in range(sections)
+    ]
+
+
+def export(grades: List[SubmissionGrade]) -> None:
+    """
+    Do the same work per submission as GradeBook._get_grades_export.
+    """
+    for grade in grades:
+        grade.get_score()
+        grade.get_feedback()
+
+
+def uncached_export(grades: List[SubmissionGrade]) -> None:
+    """
+    Like export, but throw away every cache first (i.e. how exporting worked before caching).
+    """
+    for grade in grades:
+        for item in grade.enumerate_all(include_disabled=True):
+            item._invalidate_caches()
+    export(grades)
+
+
+def edit_some(grades: List[SubmissionGrade], count: int) -> None:
+    for grade in random.sample(grades, count):
+        item = random.choice([item for item in grade.enumerate_all()
+                              if isinstance(item, SubmissionGradeScore)])
+        item.set_base_score(random.randint(0, 10))
+        item.set_comments("Changed at {}".format(time.time()))
+
+
+def time_it(func: Callable[[], None], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark grade score and feedback caching.")
+    parser.add_argument("--submissions", type=int, default=500)
+    parser.add_argument("--sections", type=int, default=6)
+    parser.add_argument("--items-per-section", type=int, default=10)
+    parser.add_argument("--edits", type=int, default=10,
+                        help="The number of submissions to edit between exports")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    random.seed(0)
+    structure = make_grade_structure(args.sections, args.items_per_section)
+    grades = [SubmissionGrade(structure) for _ in range(args.submissions)]
+    for grade in grades:
+        for item in grade.enumerate_all():
+            if random.random() < 0.3:
+                item.set_hint_enabled(0, True)
+        grade.set_late(random.random() < 0.1)
+
+    print("{} submissions, {} grade items each".format(
+        args.submissions, args.sections * (args.items_per_section + 1)))
+    print("{:<40} {:>10}".format("Scenario", "Best (ms)"))
+
+    def report(name: str, func: Callable[[], None]) -> None:
+        print("{:<40} {:>10.1f}".format(name, time_it(func, args.repeat) * 1000))
+
+    report("Export without caching", lambda: uncached_export(grades))
+    report("Export with nothing changed", lambda: export(grades))
+    report("Export after {} edits".format(args.edits),
+           lambda: (edit_some(grades, args.edits), export(grades)))
+
+
+if __name__ == "__main__":
+    main()
@@ -70,6 +70,33 @@ def get_sqlite_data(filename):
         conn.close()
 
 
+def get_structured_sqlite_data(filename):
+    # Everything that doesn't have its own table is in the same table as the "sqlite" format
+    d = get_sqlite_data(filename)
+
+    conn = sqlite3.connect(filename)
+    try:
+        c = conn.cursor()
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name != 'gradefast' "
+                  "ORDER BY name")
+        tables = [row[0] for row in c.fetchall()]
+
+        for table in tables:
+            c.execute("SELECT * FROM " + table)
+            columns = [column[0] for column in c.description]
+            rows = []
+            for row in c:
+                # The only blobs are pickled logs
+                rows.append(OrderedDict(
+                    (column, pickle.loads(value) if isinstance(value, bytes) else value)
+                    for column, value in zip(columns, row)))
+            d[table] = rows
+
+        return d
+    finally:
+        conn.close()
+
+
 def get_shelve_data(filename):
     with shelve.open(filename, flag="c", protocol=4) as shelf:
         d = OrderedDict()
@@ -82,7 +109,7 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--output", choices=["json", "yaml", "tagged-yaml"], default="json",
                         help="The output format")
-    parser.add_argument("--format", choices=["sqlite", "legacy"],
+    parser.add_argument("--format", choices=["sqlite", "structured", "legacy"],
                         help="The GradeFast save file format")
     parser.add_argument("save_file", metavar="save-file",
                         help="The path to a GradeFast save file")
@@ -90,6 +117,8 @@ def main():
 
     if args.format == "sqlite":
         d = get_sqlite_data(args.save_file)
+    elif args.format == "structured":
+        d = get_structured_sqlite_data(args.save_file)
     elif args.format == "legacy":
         d = get_shelve_data(args.save_file)
     else: